@@ -0,0 +1,69 @@
+"""
+Run the synthetic-data benchmark suite and compare it with a stored baseline.
+
+    python benchmarking/run_benchmark.py --size small
+    python benchmarking/run_benchmark.py --size tiny --lbm --update-baseline
+
+Results are written to <out-dir>/results.json. Baselines are stored per size and data
+type in benchmarking/baselines/. Exits with status 1 if any stage regressed.
+"""
+
+import os
+import sys
+import argparse
+
+repo_path = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, repo_path)
+
+from suite3d import benchmark, synthetic
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split("\n\n")[0].strip())
+    parser.add_argument("--size", default="small", choices=list(synthetic.SIZES))
+    parser.add_argument("--lbm", action="store_true", help="LBM strips with crosstalk")
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--stages", nargs="+", default=list(benchmark.STAGES))
+    parser.add_argument("--out-dir", default=os.path.join(repo_path, "benchmarking", "runs"))
+    parser.add_argument("--baseline", default=None, help="baseline json to compare with")
+    parser.add_argument("--update-baseline", action="store_true")
+    parser.add_argument("--n-proc", type=int, default=None, help="processes for all stages")
+    parser.add_argument("--keep-files", action="store_true")
+    parser.add_argument("--verbosity", type=int, default=1)
+    args = parser.parse_args()
+
+    name = args.size + ("-lbm" if args.lbm else "")
+    baseline_path = args.baseline or os.path.join(
+        repo_path, "benchmarking", "baselines", name + ".json"
+    )
+    param_overrides = {}
+    if args.n_proc is not None:
+        for key in ("n_proc", "n_proc_corr", "n_proc_detect", "n_proc_reg"):
+            param_overrides[key] = args.n_proc
+
+    results = benchmark.run_benchmark(
+        os.path.join(args.out_dir, name),
+        size=args.size,
+        lbm=args.lbm,
+        seed=args.seed,
+        stages=args.stages,
+        param_overrides=param_overrides,
+        keep_files=args.keep_files,
+        verbosity=args.verbosity,
+    )
+
+    if args.update_baseline:
+        benchmark.save_baseline(results, baseline_path)
+        print("Saved baseline to %s" % baseline_path)
+        return 0
+    if not os.path.exists(baseline_path):
+        print("No baseline at %s, run with --update-baseline to create one" % baseline_path)
+        return 0
+    regressions = benchmark.compare_to_baseline(
+        results, benchmark.load_baseline(baseline_path)
+    )
+    return 1 if regressions else 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
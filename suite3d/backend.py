@@ -0,0 +1,119 @@
+# Array backend used by the registration code, so the same batched functions
+# run on the GPU (cupy) or the CPU (numpy) depending on params['gpu_reg']
+import numpy as n
+import scipy.fft
+from scipy import ndimage
+
+try:
+    import cupy as cp
+    from cupyx.scipy import fft as cufft
+    from cupyx.scipy import ndimage as cuimage
+except ImportError:
+    cp = None
+    cufft = None
+    cuimage = None
+
+try:
+    import psutil
+except ImportError:
+    psutil = None
+
+
+class ArrayBackend:
+    """
+    Bundles the array module (numpy or cupy) with the matching fft / ndimage
+    modules and the host <-> device transfers, so a pipeline stage can be
+    written once and run on either device.
+
+    Parameters
+    ----------
+    use_gpu : bool, optional
+        Use cupy if it is installed, by default True. Falls back to numpy
+        when cupy can not be imported.
+    """
+
+    def __init__(self, use_gpu=True):
+        self.is_gpu = bool(use_gpu) and cp is not None
+        if self.is_gpu:
+            self.xp = cp
+            self.fft = cufft
+            self.ndimage = cuimage
+            # cufft plans are sized by the array, workers does not apply
+            self.fft_kwargs = {}
+        else:
+            self.xp = n
+            self.fft = scipy.fft
+            self.ndimage = ndimage
+            self.fft_kwargs = {"workers": -1}
+        self.name = "gpu" if self.is_gpu else "cpu"
+
+    def __repr__(self):
+        return "ArrayBackend(%s)" % self.name
+
+    def to_device(self, arr, dtype=None):
+        """
+        Copy a host array onto the backend. The CPU backend always returns a
+        copy as well, so batches can be modified in place without touching
+        the caller's movie.
+        """
+        if self.is_gpu:
+            return cp.asarray(arr, dtype=dtype)
+        return n.array(arr, dtype=dtype, copy=True)
+
+    def asarray(self, arr, dtype=None):
+        """Like to_device, but does not copy arrays already on the backend"""
+        return self.xp.asarray(arr, dtype=dtype)
+
+    def asnumpy(self, arr):
+        """Move an array to the host, on the CPU this is not a copy"""
+        if self.is_gpu:
+            return cp.asnumpy(arr)
+        return n.asarray(arr)
+
+    def to_host(self, arr):
+        """Like asnumpy, but always returns a copy"""
+        if self.is_gpu:
+            return cp.asnumpy(arr)
+        return n.array(arr, copy=True)
+
+    def fftn(self, arr, axes=None):
+        return self.fft.fftn(arr, axes=axes, **self.fft_kwargs)
+
+    def ifftn(self, arr, axes=None):
+        return self.fft.ifftn(arr, axes=axes, **self.fft_kwargs)
+
+    def free_memory(self):
+        """Release cached device blocks, a no-op on the CPU"""
+        if self.is_gpu:
+            cp.get_default_memory_pool().free_all_blocks()
+
+    def free_bytes(self):
+        """
+        Memory available for new arrays on the backend, None if unknown
+        """
+        if self.is_gpu:
+            from . import register_gpu as reg
+
+            return reg.get_free_gpu_memory(cp)
+        if psutil is None:
+            return None
+        return psutil.virtual_memory().available
+
+    def oom_errors(self):
+        """Exceptions raised when the backend runs out of memory"""
+        from . import register_gpu as reg
+
+        return reg.gpu_oom_errors(self.xp)
+
+
+_backends = {}
+
+
+def get_backend(use_gpu=True):
+    """
+    Return the (cached) array backend, use_gpu is normally params['gpu_reg']
+    """
+    use_gpu = bool(use_gpu) and cp is not None
+    if use_gpu not in _backends:
+        _backends[use_gpu] = ArrayBackend(use_gpu)
+    return _backends[use_gpu]
@@ -0,0 +1,314 @@
+import os
+import json
+import time
+import shutil
+import numpy as n
+from scipy.spatial import distance_matrix
+
+from . import synthetic
+from . import profiling
+from .job_log import PeakMemorySampler
+
+# Benchmark suite on synthetic data. run_benchmark writes a synthetic recording (see
+# synthetic.py) with a fixed seed, runs the CPU pipeline stage by stage on it, and
+# records the wall and CPU time, the peak memory and the profiler table of each stage,
+# plus how well the known motion, crosstalk, cells and activity were recovered.
+# compare_to_baseline checks the results against a stored json baseline. The suite
+# runs without a GPU or network, see benchmarking/run_benchmark.py for the CLI.
+
+STAGES = ("init_pass", "register", "svd", "corrmap", "segmentation", "extraction")
+
+# a stage regresses if it is both time_ratio times slower and time_slack_s seconds slower
+# than the baseline (and the same for memory), or if an accuracy metric gets worse by
+# more than its tolerance
+DEFAULT_THRESHOLDS = {
+    "time_ratio": 1.5,
+    "time_slack_s": 2.0,
+    "mem_ratio": 1.3,
+    "mem_slack_gb": 0.25,
+    "shift_error_px": 0.5,
+    "crosstalk_error": 0.05,
+    "roi_match_rate": 0.1,
+    "trace_corr": 0.1,
+}
+
+GB = 1024**3
+
+
+def shift_error(recovered, true_shifts):
+    """
+    Mean absolute error (px) of recovered rigid (y, x) shifts. The registration reports
+    the shift that undoes the motion relative to its reference, so the sign is flipped
+    and the constant offset between the reference and the true frame is removed.
+
+    Args:
+        recovered (ndarray): (nt, 2)
+        true_shifts (ndarray): (nt, 2)
+
+    Returns:
+        float: error in pixels
+    """
+    nt = min(len(recovered), len(true_shifts))
+    diff = recovered[:nt] + true_shifts[:nt]
+    diff = diff - n.median(diff, axis=0)
+    return float(n.abs(diff).mean())
+
+
+def match_rois(true_centers, detected_centers, max_dist=3.0, z_scale=2.0):
+    """
+    Match true cells to detected ROIs one-to-one by distance between centers, after
+    removing the median offset between each cell and its nearest ROI (registration to
+    a reference and padding move the whole volume).
+
+    Args:
+        true_centers (ndarray): (n_cells, 3) z, y, x
+        detected_centers (ndarray): (n_rois, 3) z, y, x
+        max_dist (float, optional): max distance of a match, in pixels. Defaults to 3.0.
+        z_scale (float, optional): weight of z distances relative to y/x. Defaults to 2.0.
+
+    Returns:
+        tuple: match rate (fraction of true cells matched), matches as list of (cell_idx, roi_idx)
+    """
+    if len(detected_centers) == 0 or len(true_centers) == 0:
+        return 0.0, []
+    scale = n.array([z_scale, 1.0, 1.0])
+    true_c = n.asarray(true_centers, dtype=float)
+    det_c = n.asarray(detected_centers, dtype=float)
+    nearest = distance_matrix(true_c * scale, det_c * scale).argmin(axis=1)
+    offset = n.median(det_c[nearest] - true_c, axis=0)
+    dists = distance_matrix((true_c + offset) * scale, det_c * scale)
+
+    matches = []
+    used = set()
+    for flat_idx in n.argsort(dists, axis=None):
+        cell_idx, roi_idx = n.unravel_index(flat_idx, dists.shape)
+        if dists[cell_idx, roi_idx] > max_dist:
+            break
+        if cell_idx in (m[0] for m in matches) or roi_idx in used:
+            continue
+        matches.append((int(cell_idx), int(roi_idx)))
+        used.add(roi_idx)
+    return len(matches) / len(true_c), matches
+
+
+def trace_correlation(F, calcium, matches):
+    """Mean correlation between the extracted trace of each matched ROI and the true calcium"""
+    if not matches:
+        return 0.0
+    nt = min(F.shape[1], calcium.shape[1])
+    corrs = []
+    for cell_idx, roi_idx in matches:
+        corrs.append(n.corrcoef(F[roi_idx, :nt], calcium[cell_idx, :nt])[0, 1])
+    return float(n.nanmean(corrs))
+
+
+def recovered_shifts(job):
+    """Rigid (y, x) shift of each frame from the CPU registration offsets, averaged over planes"""
+    offsets = job.load_registration_results()
+    ys = n.concatenate(offsets["ymaxs_rr"], axis=0)
+    xs = n.concatenate(offsets["xmaxs_rr"], axis=0)
+    return n.stack([ys.mean(axis=1), xs.mean(axis=1)], axis=1)
+
+
+def run_stage(name, func, results, log):
+    """Run func as a benchmark stage, and add its timing and memory to results['stages']"""
+    log("Benchmark stage %s" % name, 0)
+    profiling.PROFILER.reset()
+    with PeakMemorySampler() as mem:
+        wall0, cpu0 = time.perf_counter(), time.process_time()
+        out = func()
+        wall, cpu = time.perf_counter() - wall0, time.process_time() - cpu0
+    results["stages"][name] = {
+        "wall": wall,
+        "cpu": cpu,
+        "peak_rss_gb": mem.peak / GB,
+        "delta_rss_gb": (mem.peak - mem.start_rss) / GB,
+        "profile": profiling.PROFILER.table(),
+    }
+    log("%s took %.2f s (peak RSS %.2f GB)" % (name, wall, mem.peak / GB), 0)
+    return out
+
+
+def run_benchmark(
+    out_dir,
+    size="small",
+    lbm=False,
+    seed=0,
+    stages=STAGES,
+    recording_kwargs=None,
+    param_overrides=None,
+    keep_files=False,
+    verbosity=1,
+):
+    """
+    Generate a synthetic recording and run the CPU pipeline on it, stage by stage
+
+    Args:
+        out_dir (str): directory for the recording, the job and results.json
+        size (str, optional): one of synthetic.SIZES. Defaults to 'small'.
+        lbm (bool, optional): LBM strips with crosstalk instead of standard multiplane tifs. Defaults to False.
+        seed (int, optional): seed of the recording and of numpy's global generator. Defaults to 0.
+        stages (tuple, optional): stages to run, in the order of STAGES. Each needs the previous ones.
+        recording_kwargs (dict, optional): overrides for synthetic.make_synthetic_recording. Defaults to None.
+        param_overrides (dict, optional): overrides for the job params. Defaults to None.
+        keep_files (bool, optional): keep the tifs and the job directory. Defaults to False.
+        verbosity (int, optional): job verbosity. Defaults to 1.
+
+    Returns:
+        dict: results with config, stages (wall, cpu, peak_rss_gb, profile) and accuracy
+    """
+    from .job import Job
+
+    for stage in stages:
+        assert stage in STAGES, "Unknown stage %s" % stage
+    stages = [s for s in STAGES if s in stages]
+
+    rec_kwargs = dict(synthetic.SIZES[size])
+    if lbm:
+        rec_kwargs.update(lbm=True, crosstalk_coeff=0.15)
+    rec_kwargs.update(recording_kwargs or {})
+    os.makedirs(out_dir, exist_ok=True)
+    data_dir = os.path.join(out_dir, "data")
+    n.random.seed(seed)
+
+    results = {
+        "config": {"size": size, "lbm": lbm, "seed": seed, "recording": rec_kwargs},
+        "stages": {},
+        "accuracy": {},
+    }
+
+    tic = time.time()
+    tifs, gt = synthetic.make_synthetic_recording(data_dir, seed=seed, **rec_kwargs)
+    results["config"]["generate_s"] = time.time() - tic
+    params = synthetic.job_params_for_recording(gt, **(param_overrides or {}))
+
+    job = Job(
+        out_dir, "benchmark", tifs=tifs, params=params, create=True,
+        overwrite=True, verbosity=verbosity,
+    )
+    log = job.log
+    accuracy = results["accuracy"]
+    matches = []
+
+    try:
+        if "init_pass" in stages:
+            run_stage("init_pass", job.run_init_pass, results, log)
+            if gt["crosstalk_coeff"] > 0 and params["subtract_crosstalk"]:
+                est = job.load_summary()["crosstalk_coeff"]
+                accuracy["crosstalk_error"] = abs(float(est) - gt["crosstalk_coeff"])
+        if "register" in stages:
+            run_stage("register", job.register, results, log)
+            accuracy["shift_error_px"] = shift_error(recovered_shifts(job), gt["shifts"])
+        if "svd" in stages:
+            job.make_svd_dirs()
+            run_stage("svd", lambda: job.svd_decompose_movie("svd"), results, log)
+        if "corrmap" in stages:
+            run_stage("corrmap", job.calculate_corr_map, results, log)
+        if "segmentation" in stages:
+            run_stage("segmentation", job.segment_rois, results, log)
+            stats = job.load_segmentation_results(to_load=["stats"])
+            meds = n.array([s["med"] for s in stats]).reshape(-1, 3)
+            accuracy["n_rois"] = len(meds)
+            accuracy["roi_match_rate"], matches = match_rois(gt["centers"], meds)
+        if "extraction" in stages:
+
+            def extract():
+                job.compute_npil_masks()
+                return job.extract_and_deconvolve()
+
+            traces = run_stage("extraction", extract, results, log)
+            accuracy["trace_corr"] = trace_correlation(
+                n.asarray(traces["F"]), gt["calcium"], matches
+            )
+    finally:
+        job.flush_log()
+        with open(os.path.join(out_dir, "results.json"), "w") as f:
+            json.dump(results, f, indent=2, default=to_builtin)
+        if not keep_files:
+            shutil.rmtree(data_dir, ignore_errors=True)
+            shutil.rmtree(job.job_dir, ignore_errors=True)
+
+    return results
+
+
+def to_builtin(obj):
+    """json default for numpy scalars and arrays"""
+    if isinstance(obj, n.ndarray):
+        return obj.tolist()
+    if isinstance(obj, n.generic):
+        return obj.item()
+    raise TypeError("Can't serialise %s" % type(obj))
+
+
+def save_baseline(results, path):
+    """Store benchmark results as the baseline to compare future runs against"""
+    os.makedirs(os.path.dirname(os.path.abspath(path)), exist_ok=True)
+    with open(path, "w") as f:
+        json.dump(results, f, indent=2, default=to_builtin)
+
+
+def load_baseline(path):
+    with open(path, "r") as f:
+        return json.load(f)
+
+
+def compare_to_baseline(results, baseline, thresholds=None, print_output=True):
+    """
+    Compare benchmark results with a baseline
+
+    Args:
+        results (dict): from run_benchmark
+        baseline (dict): results of an earlier run, see save_baseline
+        thresholds (dict, optional): overrides for DEFAULT_THRESHOLDS. Defaults to None.
+        print_output (bool, optional): print a table of the comparison. Defaults to True.
+
+    Returns:
+        list: description of each regression, empty if there are none
+    """
+    th = dict(DEFAULT_THRESHOLDS)
+    th.update(thresholds or {})
+    regressions = []
+    lines = ["%-14s %12s %12s %12s %12s" % ("Stage", "Wall (s)", "Base (s)", "Peak (GB)", "Base (GB)")]
+    for name, st in results["stages"].items():
+        base = baseline.get("stages", {}).get(name)
+        if base is None:
+            lines.append("%-14s %12.2f %12s %12.2f %12s" % (name, st["wall"], "-", st["peak_rss_gb"], "-"))
+            continue
+        lines.append(
+            "%-14s %12.2f %12.2f %12.2f %12.2f"
+            % (name, st["wall"], base["wall"], st["peak_rss_gb"], base["peak_rss_gb"])
+        )
+        if (
+            st["wall"] > base["wall"] * th["time_ratio"]
+            and st["wall"] - base["wall"] > th["time_slack_s"]
+        ):
+            regressions.append(
+                "%s: wall time %.2f s vs baseline %.2f s" % (name, st["wall"], base["wall"])
+            )
+        if (
+            st["peak_rss_gb"] > base["peak_rss_gb"] * th["mem_ratio"]
+            and st["peak_rss_gb"] - base["peak_rss_gb"] > th["mem_slack_gb"]
+        ):
+            regressions.append(
+                "%s: peak memory %.2f GB vs baseline %.2f GB"
+                % (name, st["peak_rss_gb"], base["peak_rss_gb"])
+            )
+
+    # errors should not go up, match rates and correlations should not go down
+    lower_is_better = ("shift_error_px", "crosstalk_error")
+    higher_is_better = ("roi_match_rate", "trace_corr")
+    base_acc = baseline.get("accuracy", {})
+    for key, val in results["accuracy"].items():
+        if key not in base_acc:
+            continue
+        lines.append("%-14s %12.3f %12.3f" % (key[:14], val, base_acc[key]))
+        if key in lower_is_better and val - base_acc[key] > th[key]:
+            regressions.append("%s: %.3f vs baseline %.3f" % (key, val, base_acc[key]))
+        if key in higher_is_better and base_acc[key] - val > th[key]:
+            regressions.append("%s: %.3f vs baseline %.3f" % (key, val, base_acc[key]))
+
+    if print_output:
+        print("\n".join(lines))
+        for reg in regressions:
+            print("REGRESSION " + reg)
+    return regressions
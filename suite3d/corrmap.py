@@ -7,8 +7,13 @@ from . import detection3d as dtu
 from .utils import to_int, default_log, get_matching_params, make_batch_paths
 from . import utils
 from . import extension as ext
+from . import svd_utils as svu
+from .mov_sub_store import MovSubStore
+from . import profiling
+from . import shmem as shm
 import time
 import multiprocessing
+from concurrent.futures import ThreadPoolExecutor
 
 corr_map_param_names = [
     "voxel_size_um",
@@ -48,6 +53,7 @@ def calculate_corrmap(
         params (dict): Dictionary of parameters containing the keys in the lists above
         summary (dict, optional): Output of job.load_summary(). Only necessary if edge_crop_npix > 0, because we need to know the plane shifts to crop the edges of planes. Defaults to None.
         batch_dir (str, optional): Path to directory where batch results should be stored. Defaults to None.
+        save_mov_sub (bool, optional): Write mov_sub to a MovSubStore in mov_sub_dir. Defaults to True.
         mov_sub_dir (str, optional): Path to directory where mov_sub should be stored. Defaults to None.
         iter_limit (int, optional): Number of batches to do. Defaults to None.
         log (func, optional): Defaults to default_log.
@@ -83,77 +89,308 @@ def calculate_corrmap(
     if dir is None:
         save = False
         batch_dirs = None
-        mov_sub_paths = None
     else:
         # make a set of directories to store intermediate results,
         # and a set of filenames where mov_sub will be saved
         save = True
         batch_dirs = make_batch_paths(batch_dir, n_batches, prefix="batch", dirs=True)
-        mov_sub_paths = make_batch_paths(
-            mov_sub_dir, n_batches, prefix="mov_sub", suffix=".npy", dirs=False
+
+    # mov_sub is written by the workers straight into a memory-mapped store laid out
+    # in the patches that segmentation uses, see mov_sub_store.py
+    mov_sub_store = None
+    if save and save_mov_sub and mov_sub_dir is not None:
+        timebin = corr_map_params.get("detection_timebin", 1)
+        batch_nts = [
+            min(nt, (i + 1) * t_batch_size) - i * t_batch_size for i in range(n_batches)
+        ]
+        if timebin > 1:
+            batch_nts = [b // timebin for b in batch_nts]
+        mov_sub_store = MovSubStore.create(
+            mov_sub_dir,
+            (sum(batch_nts), nz, ny, nx),
+            params.get("patch_size_xy", default_params.params["patch_size_xy"]),
+            params.get("patch_overlap_xy", default_params.params["patch_overlap_xy"]),
+            dtype=save_dtype if save_dtype is not None else n.float32,
         )
+        mov_sub_t0s = n.concatenate([[0], n.cumsum(batch_nts)])
 
     # initialize accumulators
     accums = init_corr_map_accumulators((nz, ny, nx), dtype=dtype)
 
-    for batch_idx in range(n_batches):
-        log("prep", tic=True)
-        start_idx = batch_idx * t_batch_size
-        end_idx = min(nt, start_idx + t_batch_size)
-        log("Running batch %d of %d" % (batch_idx + 1, n_batches), 2)
-        mov_batch = mov[:, start_idx:end_idx]
-
-        log("batch_timebin", tic=True)
+    # the pool and the shared memory buffers are reused by every batch, and both are
+    # freed when the loop ends or raises
+    n_processors = computation_params["n_proc"]
+    with shm.ShmemArena() as arena, multiprocessing.Pool(n_processors) as pool:
+        for batch_idx in range(n_batches):
+            log("prep", tic=True)
+            start_idx = batch_idx * t_batch_size
+            end_idx = min(nt, start_idx + t_batch_size)
+            log("Running batch %d of %d" % (batch_idx + 1, n_batches), 2)
+            mov_batch = mov[:, start_idx:end_idx]
+
+            log("batch_timebin", tic=True)
         
-        if corr_map_params.get("detection_timebin", 1) > 1:
-            log(
-                f"Binning with timebin of size {corr_map_params['detection_timebin']:02d}",
-                2,
-            )
-            mov_batch = ext.binned_mean_ax1(
-                mov_batch, corr_map_params["detection_timebin"]
-            )
-        log("batch_timebin", toc=True)
-        # change the order to nt, nz, ny, nx
-        # first try doing in dask, because mov is probably a dask array
-        # if that fails (if mov is not a dask array), do it in numpy
-        try:
-            mov_batch = darr.swapaxes(mov_batch, 0, 1).compute().astype(dtype)
-        except:
-            log("Not a dask array", 3)
-            mov_batch = n.swapaxes(mov_batch, 0, 1).astype(dtype)
-        # compute the correlation map for this batch and update accumulators
-        log("prep", toc=True)
-        log("batch", tic=True)
-
-        n_processors = computation_params["n_proc"]
-        pool = multiprocessing.Pool(n_processors)
-        vmap_batch, mov_sub_batch = compute_corr_map_batch(
-            mov_batch,
-            corr_map_params,
-            computation_params,
-            accums,
-            summary,
-            log,
-            pool=pool,
-        )
-        log("batch", toc=True)
-        log("save", tic=True)
-        if save:
-            # save results to previously created dirs
-            save_batch_results(
-                vmap_batch,
-                accums,
-                batch_dirs[batch_idx],
-            )
-            if save_mov_sub:
-                n.save(mov_sub_paths[batch_idx], mov_sub_batch.astype(save_dtype))
-        log("save", toc=True)
+            if corr_map_params.get("detection_timebin", 1) > 1:
+                log(
+                    f"Binning with timebin of size {corr_map_params['detection_timebin']:02d}",
+                    2,
+                )
+                mov_batch = ext.binned_mean_ax1(
+                    mov_batch, corr_map_params["detection_timebin"]
+                )
+            log("batch_timebin", toc=True)
+            # change the order to nt, nz, ny, nx
+            # first try doing in dask, because mov is probably a dask array
+            # if that fails (if mov is not a dask array), do it in numpy
+            try:
+                mov_batch = darr.swapaxes(mov_batch, 0, 1).compute().astype(dtype, copy=False)
+            except:
+                log("Not a dask array", 3)
+                mov_batch = n.swapaxes(mov_batch, 0, 1).astype(dtype, copy=False)
+            # compute the correlation map for this batch and update accumulators
+            log("prep", toc=True)
+            log("batch", tic=True)
+
+            with profiling.stage(
+                "corrmap_batch", frames=mov_batch.shape[0], nbytes=mov_batch.nbytes
+            ):
+                vmap_batch, mov_sub_batch = compute_corr_map_batch(
+                    mov_batch,
+                    corr_map_params,
+                    computation_params,
+                    accums,
+                    summary,
+                    log,
+                    pool=pool,
+                    arena=arena,
+                    mov_sub_store=mov_sub_store,
+                    mov_sub_t0=mov_sub_t0s[batch_idx] if mov_sub_store is not None else 0,
+                )
+            log("batch", toc=True)
+            log("save", tic=True)
+            if save:
+                # save results to previously created dirs
+                save_batch_results(
+                    vmap_batch,
+                    accums,
+                    batch_dirs[batch_idx],
+                )
+            if mov_sub_store is not None:
+                mov_sub_store.flush()
+            log("save", toc=True)
     gc.collect()
     save_batch_results(vmap_batch, accums, batch_dir)
     return vmap_batch
 
 
+def calculate_corrmap_from_svd(
+    svd_info,
+    params,
+    summary=None,
+    batch_dir=None,
+    n_comps=None,
+    n_threads=8,
+    log=default_log,
+):
+    """
+    Compute the correlation map directly from the block SVD of the movie, without
+    reconstructing the denoised movie. Each block is padded by the reach of the spatial
+    filters with the blended movie of its neighbours, projected onto the block's temporal
+    components (U_b^T U_j for a neighbour j, as U_b is orthonormal). The filters and the
+    reduction then run on the factors (see svd_utils.corrmap_block_from_usv) and the
+    per-block maps are blended with the overlap mask used for reconstruction.
+
+    The cost is O(n_comp**2) per voxel of each padded block, plus O(nt * n_comp**2) for
+    the projection of every neighbouring block, against O(nt) per voxel and filter tap
+    for calculate_corrmap, so it pays off when n_comp is well below nt. Each thread holds
+    the n_comp spatial components of a padded block, a few times over while filtering.
+
+    Without intensity_thresh, the result is the same as calculate_corrmap on the
+    reconstructed movie in a single batch (of under 500 frames, as accumulate_sdmov skips
+    the differences between its minibatches) wherever one block covers the filter reach,
+    including a single block covering the volume. Near block edges it differs by the part
+    of the neighbours' signal outside the block's temporal components, and sdmov in the
+    overlaps is blended from each block's own value. With intensity_thresh (or
+    standard_vmap False) the thresholded sums are Gaussian estimates.
+
+    Args:
+        svd_info (dict or str): output of block_and_svd, or the directory containing svd_info.npy
+        params (dict): Dictionary of parameters containing the keys in corr_map_param_names
+        summary (dict, optional): Output of job.load_summary(). Needed for edge_crop_npix > 0.
+        batch_dir (str, optional): Directory to save the results in. Defaults to None.
+        n_comps (int, optional): Number of components to use. Defaults to params['n_svd_comp'].
+        n_threads (int, optional): Number of blocks processed in parallel. Defaults to 8.
+        log (func, optional): Defaults to default_log.
+
+    Returns:
+        ndarray: vmap
+    """
+    if type(svd_info) == str:
+        svd_info = n.load(os.path.join(svd_info, "svd_info.npy"), allow_pickle=True).item()
+    if n_comps is None:
+        n_comps = params.get("n_svd_comp", svd_info["n_comps"])
+    corr_map_params = get_matching_params(corr_map_param_names, params)
+    vz, vy, vx = corr_map_params["voxel_size_um"]
+    npil_filt_pix = (
+        (corr_map_params["npil_filt_z_um"] / vz),
+        (corr_map_params["npil_filt_xy_um"] / vy),
+        (corr_map_params["npil_filt_xy_um"] / vx),
+    )
+    cell_filt_pix = (
+        (corr_map_params["cell_filt_z_um"] / vz),
+        (corr_map_params["cell_filt_xy_um"] / vy),
+        (corr_map_params["cell_filt_xy_um"] / vx),
+    )
+    detection_timebin = corr_map_params.get("detection_timebin") or 1
+
+    if svd_info["mov_shape"][0] > 30:
+        nt, nz, ny, nx = svd_info["mov_shape"]
+    else:
+        nz, nt, ny, nx = svd_info["mov_shape"]
+    vol_shape = (nz, ny, nx)
+    block_shape = tuple(svd_info["block_shape"])
+    block_limits = svd_info["blocks"]
+    block_dirs = svd_info["svd_dirs"]
+    log(
+        "Computing correlation map from %d SVD blocks with %d components, volume shape: %d, %d, %d"
+        % (len(block_dirs), n_comps, nz, ny, nx),
+        1,
+    )
+
+    # the svd directories only exist for valid blocks, match them to their limits
+    block_idxs = [int(os.path.basename(os.path.normpath(d))) for d in block_dirs]
+    block_sls = [
+        tuple(slice(lim[0], lim[1]) for lim in block_limits[:, idx]) for idx in block_idxs
+    ]
+    reach = svu.corrmap_filter_reach(
+        corr_map_params["npil_filt_type"], npil_filt_pix,
+        corr_map_params["cell_filt_type"], cell_filt_pix,
+    )
+    region_sls = [
+        tuple(
+            slice(max(0, sl.start - r), min(size, sl.stop + r))
+            for sl, r, size in zip(block_sl, reach, vol_shape)
+        )
+        for block_sl in block_sls
+    ]
+    log("Padding blocks by %s px for the spatial filters" % str(tuple(reach)), 2)
+
+    crop_mask = None
+    edge_crop_npix = corr_map_params["edge_crop_npix"]
+    if edge_crop_npix is not None and edge_crop_npix > 0:
+        if summary is not None and params.get("svd_crop") is None:
+            crop_mask = utils.edge_crop_movie(
+                n.ones((1, nz, ny, nx), dtype=n.float32), summary, edge_crop_npix
+            )[0]
+        else:
+            log("Skipping edge crop, the SVD movie is cropped or no summary given", 2)
+
+    blend_mask = svu.get_overlap_mask(block_shape, svd_info["block_overlaps"]).astype(n.float32)
+    norm = n.zeros(vol_shape, dtype=n.float32)
+    n_cover = n.zeros(vol_shape, dtype=n.float32)
+    for block_sl in block_sls:
+        norm[block_sl] += blend_mask
+        n_cover[block_sl] += 1
+    # the reconstructed movie is 0 where the mask vanishes, but its filtered map is not,
+    # so the per-block maps are averaged there instead of blended
+    unblended = norm < 1e-5
+    norm[unblended] = n.inf
+    n_cover[n_cover == 0] = n.inf
+
+    def load_w(j, sl=None, blend=True):
+        # S V of block j on the slice sl, weighted by its share of the blended movie
+        block_sl = block_sls[j]
+        sl = block_sl if sl is None else sl
+        in_block = tuple(slice(s.start - b.start, s.stop - b.start) for s, b in zip(sl, block_sl))
+        s_j, v_j = svu.load_sv(block_dirs[j], n_comps, compute=True)
+        w_j = v_j.reshape((-1,) + block_shape)[(slice(None),) + in_block]
+        w_j = w_j * s_j[:, n.newaxis, n.newaxis, n.newaxis]
+        if blend:
+            w_j *= blend_mask[in_block] / norm[sl]
+        if crop_mask is not None:
+            w_j *= crop_mask[sl]
+        return w_j
+
+    def load_u(j):
+        u = svu.load_u(block_dirs[j], n_comps, compute=True)
+        return (u,) + svu.corrmap_preprocess_u(
+            u, corr_map_params["temporal_hpf"], detection_timebin
+        )
+
+    def run_block_moments(i):
+        # the mean image is linear in the movie, so each block adds its own share. sdmov
+        # is not, so the blocks' own values are blended, which is exact where they agree
+        __, u_binned, u_hpf = load_u(i)
+        w = load_w(i, blend=False).reshape(u_hpf.shape[1], -1)
+        sdmov_block = svu.sdmov_from_usv(u_hpf, w)
+        mean_block = u_binned.mean(axis=0) @ w
+        return block_sls[i], sdmov_block, mean_block
+
+    def run_block(i):
+        region_sl = region_sls[i]
+        region_shape = tuple(s.stop - s.start for s in region_sl)
+        u, __, u_hpf = load_u(i)
+        w = n.zeros((u.shape[1],) + region_shape, dtype=n.float32)
+        # spatial components of the blended movie over the padded block, in this block's
+        # temporal basis
+        for j, block_sl in enumerate(block_sls):
+            inter = tuple(
+                slice(max(r.start, b.start), min(r.stop, b.stop)) for r, b in zip(region_sl, block_sl)
+            )
+            if any(s.stop <= s.start for s in inter):
+                continue
+            w_j = load_w(j, inter)
+            if j != i:
+                w_j = n.tensordot(u.T @ svu.load_u(block_dirs[j], n_comps, compute=True), w_j, axes=1)
+            in_region = tuple(slice(s.start - r.start, s.stop - r.start) for s, r in zip(inter, region_sl))
+            w[(slice(None),) + in_region] += w_j
+        w /= sdmov[region_sl] ** corr_map_params["sdnorm_exp"]
+        block_in_region = tuple(
+            slice(b.start - r.start, b.stop - r.start) for b, r in zip(block_sls[i], region_sl)
+        )
+        vmap_2_block = svu.corrmap_block_from_usv(
+            u_hpf, w.reshape(w.shape[0], -1), region_shape, block_in_region,
+            corr_map_params["npil_filt_type"], npil_filt_pix,
+            corr_map_params["cell_filt_type"], cell_filt_pix,
+            intensity_thresh=corr_map_params["intensity_thresh"],
+            standard_vmap=corr_map_params["standard_vmap"],
+        )
+        return block_sls[i], vmap_2_block
+
+    nt_binned = nt // detection_timebin
+    sdmov = n.zeros(vol_shape, dtype=n.float32)
+    mean_img = n.zeros(vol_shape, dtype=n.float32)
+    vmap_2 = n.zeros(vol_shape, dtype=n.float32)
+    vmap_2_mean = n.zeros(vol_shape, dtype=n.float32)
+    log("corrmap_svd", tic=True)
+    with ThreadPoolExecutor(n_threads) as pool:
+        # blocks are accumulated in the main thread as they complete
+        for sl, sdmov_block, mean_block in pool.map(run_block_moments, range(len(block_dirs))):
+            sdmov[sl] += blend_mask * sdmov_block.reshape(block_shape)
+            mean_img[sl] += blend_mask * mean_block.reshape(block_shape)
+        sdmov /= norm
+        mean_img /= norm
+        sdmov[unblended] = 1.0
+        for sl, vmap_2_block in pool.map(run_block, range(len(block_dirs))):
+            vmap_2_block = vmap_2_block.reshape(block_shape)
+            vmap_2[sl] += blend_mask * vmap_2_block
+            vmap_2_mean[sl] += vmap_2_block
+    log("corrmap_svd", toc=True)
+
+    vmap_2 /= norm
+    vmap_2[unblended] = vmap_2_mean[unblended] / n_cover[unblended]
+    vmap = n.sqrt(n.maximum(1e-10, vmap_2 / nt_binned))
+    if corr_map_params["fix_vmap_edge_planes"] and nz > 1:
+        vmap[0] = vmap[0] * vmap[1].mean() / vmap[0].mean()
+        vmap[-1] = vmap[-1] * vmap[-2].mean() / vmap[-1].mean()
+
+    if batch_dir is not None:
+        n.save(os.path.join(batch_dir, "vmap2.npy"), vmap_2)
+        n.save(os.path.join(batch_dir, "vmap.npy"), vmap)
+        n.save(os.path.join(batch_dir, "mean_img.npy"), mean_img)
+    return vmap
+
+
 def compute_corr_map_batch(
     mov,
     corr_map_params=None,
@@ -162,6 +399,9 @@ def compute_corr_map_batch(
     summary=None,
     log=default_log,
     pool=None,
+    mov_sub_store=None,
+    mov_sub_t0=0,
+    arena=None,
 ):
     # TODO DOCSTRING
     log("batch_setup", tic=True)
@@ -214,9 +454,8 @@ def compute_corr_map_batch(
     dtype = computation_params["dtype"]
     minibatch_size = max(20, int(n.ceil(nb / n_processors)))
 
-    # make sure mov is the correct dtype
-    if mov.dtype is not dtype:
-        mov = mov.astype(dtype)
+    # make sure mov is the correct dtype, without copying it if it already is
+    mov = mov.astype(dtype, copy=False)
 
     # if calling the function repeatedly with differnt batches,
     # results will accumulate in 'accumulators'. If this call is the
@@ -280,6 +519,9 @@ def compute_corr_map_batch(
         standard_vmap=corr_map_params["standard_vmap"],
         log=log,
         pool=pool,
+        mov_sub_store=mov_sub_store,
+        mov_sub_t0=mov_sub_t0,
+        arena=arena,
     )
 
     log("batch_filt_reduce", toc=True)
@@ -1,3 +1,6 @@
+import threading
+from multiprocessing.pool import ThreadPool
+
 import numpy as np
 from numba import njit, prange
 from scipy.ndimage import filters
@@ -75,17 +78,18 @@ def oasis(F: np.ndarray, batch_size: int, tau: float, fs: float) -> np.ndarray:
 
     """
     NN,NT = F.shape
-    F = F.astype(np.float32)
+    F = F.astype(np.float32, copy=False)
     S = np.zeros((NN,NT), dtype=np.float32)
+    # work buffers are allocated once and reused by every batch
+    nb = min(batch_size, NN)
+    v = np.zeros((nb,NT), dtype=np.float32)
+    w = np.zeros((nb,NT), dtype=np.float32)
+    t = np.zeros((nb,NT), dtype=np.int64)
+    l = np.zeros((nb,NT), dtype=np.float32)
     for i in range(0, NN, batch_size):
-        f = F[i:i+batch_size]
-        v = np.zeros((f.shape[0],NT), dtype=np.float32)
-        w = np.zeros((f.shape[0],NT), dtype=np.float32)
-        t = np.zeros((f.shape[0],NT), dtype=np.int64)
-        l = np.zeros((f.shape[0],NT), dtype=np.float32)
-        s = np.zeros((f.shape[0],NT), dtype=np.float32)
-        oasis_matrix(f, v, w, t, l, s, tau, fs)
-        S[i:i+batch_size] = s
+        f = np.ascontiguousarray(F[i:i+batch_size])
+        nf = f.shape[0]
+        oasis_matrix(f, v[:nf], w[:nf], t[:nf], l[:nf], S[i:i+nf], tau, fs)
     return S
 
 
@@ -140,3 +144,253 @@ def preprocess(F: np.ndarray, baseline: str, win_baseline: float,
     F = F - Flow
 
     return F
+
+
+#############################################
+#
+# Chunked, multithreaded deconvolution for suite3d.
+# Equivalent to preprocess() followed by oasis(), with the boundaries of
+# scipy.ndimage's default 'reflect' mode.
+#
+#############################################
+
+BASELINE_MODES = {'maximin': 1, 'constant': 2, 'constant_prctile': 2}
+
+
+@njit(cache=True)
+def reflect_index(i, NT):
+    """ scipy.ndimage's 'reflect' boundary: d c b a | a b c d | d c b a """
+    period = 2 * NT
+    i = i % period
+    if i >= NT:
+        i = period - 1 - i
+    return i
+
+
+def gaussian_weights(sigma, truncate=4.0):
+    """ normalised 1D gaussian, same taps as scipy.ndimage.gaussian_filter1d """
+    if sigma <= 0:
+        return np.ones(1, dtype=np.float32)
+    radius = int(truncate * float(sigma) + 0.5)
+    x = np.arange(-radius, radius + 1)
+    phi = np.exp(-0.5 / sigma ** 2 * x ** 2)
+    return (phi / phi.sum()).astype(np.float32)
+
+
+@njit(nogil=True, cache=True)
+def gaussian_filter_trace(F, weights, out):
+    """ correlate a trace with symmetric weights, accumulating in float32 """
+    NT = F.shape[0]
+    r = (weights.shape[0] - 1) // 2
+    for it in range(NT):
+        acc = weights[r] * F[it]
+        if it - r < 0 or it + r >= NT:
+            for k in range(1, r + 1):
+                acc += weights[r + k] * (F[reflect_index(it - k, NT)]
+                                         + F[reflect_index(it + k, NT)])
+        else:
+            for k in range(1, r + 1):
+                acc += weights[r + k] * (F[it - k] + F[it + k])
+        out[it] = acc
+
+
+@njit(nogil=True, cache=True)
+def sliding_extremum_trace(F, win, take_max, pad, idx, out):
+    """ running min (or max) over win frames with a monotonic deque, O(NT) """
+    NT = F.shape[0]
+    left = win // 2
+    npad = NT + win - 1
+    for k in range(npad):
+        pad[k] = F[reflect_index(k - left, NT)]
+    head = 0
+    tail = 0
+    for k in range(npad):
+        x = pad[k]
+        if take_max:
+            while tail > head and pad[idx[tail - 1]] <= x:
+                tail -= 1
+        else:
+            while tail > head and pad[idx[tail - 1]] >= x:
+                tail -= 1
+        idx[tail] = k
+        tail += 1
+        if idx[head] <= k - win:
+            head += 1
+        if k >= win - 1:
+            out[k - win + 1] = pad[idx[head]]
+
+
+@njit(nogil=True, cache=True)
+def deconvolve_rows(F, mode, weights, win, flow, tau, fs, pad, idx, tmp1, tmp2,
+                    v, w, t, l, S):
+    """ subtract the baseline from each row of F in place and deconvolve it into S """
+    for i in range(F.shape[0]):
+        f = F[i]
+        if mode == 1:
+            gaussian_filter_trace(f, weights, tmp1)
+            sliding_extremum_trace(tmp1, win, False, pad, idx, tmp2)
+            sliding_extremum_trace(tmp2, win, True, pad, idx, tmp1)
+            for it in range(f.shape[0]):
+                f[it] -= tmp1[it]
+        elif mode == 2:
+            for it in range(f.shape[0]):
+                f[it] -= flow[i]
+        s = S[i]
+        s[:] = 0
+        oasis_trace(f, v, w, t, l, s, np.float32(tau), np.float32(fs))
+
+
+@njit(nogil=True, cache=True)
+def gaussian_min_rows(F, weights, tmp):
+    """ minimum of the gaussian-filtered rows of F """
+    fmin = np.inf
+    for i in range(F.shape[0]):
+        gaussian_filter_trace(F[i], weights, tmp)
+        fmin = min(fmin, tmp.min())
+    return fmin
+
+
+class DeconvolutionEngine:
+    """
+    Baseline subtraction and OASIS deconvolution of many traces, equivalent to
+    preprocess() followed by oasis(). F and Fneu are read in chunks of rows, so they
+    can be memory maps of F.npy and Fneu.npy, and the neuropil subtraction is done
+    per chunk. Chunks are split over a thread pool that is kept for the lifetime of
+    the engine, and each thread reuses its own float32 work buffers.
+
+    Args:
+        nt (int): number of frames of each trace
+        tau (float): timescale of the sensor
+        fs (float): sampling rate per plane
+        baseline (str, optional): 'maximin', 'constant', 'constant_prctile' or None. Defaults to 'maximin'.
+        win_baseline (float, optional): window (in seconds) for max filter. Defaults to 60.
+        sig_baseline (float, optional): width of the gaussian filter. Defaults to 10.
+        prctile_baseline (float, optional): percentile for 'constant_prctile'. Defaults to 8.
+        n_proc (int, optional): number of threads. Defaults to 1.
+    """
+
+    def __init__(self, nt, tau, fs, baseline='maximin', win_baseline=60, sig_baseline=10,
+                 prctile_baseline=8, n_proc=1):
+        self.nt = int(nt)
+        self.tau = tau
+        self.fs = fs
+        self.baseline = baseline
+        self.mode = BASELINE_MODES.get(baseline, 0)
+        self.win = int(win_baseline * fs)
+        if self.mode == 1 and self.win < 1:
+            raise ValueError('win_baseline * fs must be at least one frame')
+        self.weights = gaussian_weights(sig_baseline)
+        self.prctile_baseline = prctile_baseline
+        self.n_proc = max(int(n_proc), 1)
+        self.pool = ThreadPool(self.n_proc) if self.n_proc > 1 else None
+        self.local = threading.local()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+    def close(self):
+        if self.pool is not None:
+            self.pool.close()
+            self.pool.join()
+            self.pool = None
+
+    def buffers(self, n_rows):
+        """ work buffers of the calling thread, reallocated only if they grow """
+        bufs = getattr(self.local, 'bufs', None)
+        if bufs is None or bufs['F'].shape[0] < n_rows:
+            nt = self.nt
+            npad = nt + max(self.win, 1) - 1
+            bufs = {
+                'F': np.zeros((n_rows, nt), dtype=np.float32),
+                'flow': np.zeros(n_rows, dtype=np.float32),
+                'pad': np.zeros(npad, dtype=np.float32),
+                'idx': np.zeros(npad, dtype=np.int64),
+                'tmp1': np.zeros(nt, dtype=np.float32),
+                'tmp2': np.zeros(nt, dtype=np.float32),
+                'v': np.zeros(nt, dtype=np.float32),
+                'w': np.zeros(nt, dtype=np.float32),
+                't': np.zeros(nt, dtype=np.int64),
+                'l': np.zeros(nt, dtype=np.float32),
+            }
+            self.local.bufs = bufs
+        return bufs
+
+    def load_rows(self, F, Fneu, npil_coeff, r0, r1):
+        """ F - npil_coeff * Fneu for rows r0:r1, in this thread's buffer """
+        f = self.buffers(r1 - r0)['F'][: r1 - r0]
+        if Fneu is None:
+            f[:] = F[r0:r1]
+        else:
+            np.multiply(Fneu[r0:r1], -npil_coeff, out=f, casting='unsafe')
+            f += F[r0:r1]
+        return f
+
+    def run_rows(self, args):
+        F, Fneu, npil_coeff, r0, r1, flow_const, out = args
+        f = self.load_rows(F, Fneu, npil_coeff, r0, r1)
+        bufs = self.buffers(r1 - r0)
+        flow = bufs['flow'][: r1 - r0]
+        if self.baseline == 'constant_prctile':
+            flow[:] = np.percentile(f, self.prctile_baseline, axis=1)
+        else:
+            flow[:] = flow_const
+        deconvolve_rows(f, self.mode, self.weights, self.win, flow, self.tau, self.fs,
+                        bufs['pad'], bufs['idx'], bufs['tmp1'], bufs['tmp2'],
+                        bufs['v'], bufs['w'], bufs['t'], bufs['l'], out[r0:r1])
+
+    def min_rows(self, args):
+        F, Fneu, npil_coeff, r0, r1 = args
+        f = self.load_rows(F, Fneu, npil_coeff, r0, r1)
+        return gaussian_min_rows(f, self.weights, self.buffers(r1 - r0)['tmp1'])
+
+    def map(self, func, tasks):
+        if self.pool is None:
+            return [func(task) for task in tasks]
+        return self.pool.map(func, tasks)
+
+    def split(self, r0, r1):
+        """ split rows r0:r1 into one contiguous range per thread """
+        edges = np.linspace(r0, r1, min(self.n_proc, r1 - r0) + 1).astype(int)
+        return list(zip(edges[:-1], edges[1:]))
+
+    def deconvolve(self, F, Fneu=None, npil_coeff=0.7, out=None, batch_size=3000,
+                   log_cb=None):
+        """
+        Deconvolve F - npil_coeff * Fneu
+
+        Args:
+            F (ndarray): n_roi, nt array or memory map
+            Fneu (ndarray, optional): n_roi, nt neuropil traces. Defaults to None.
+            npil_coeff (float, optional): neuropil coefficient. Defaults to 0.7.
+            out (ndarray, optional): n_roi, nt float32 output, e.g. a memory map. Defaults to None.
+            batch_size (int, optional): number of rows processed per chunk. Defaults to 3000.
+            log_cb (callable, optional): log(string, level). Defaults to None.
+
+        Returns:
+            ndarray: out, the deconvolved traces
+        """
+        n_roi, nt = F.shape
+        assert nt == self.nt
+        if out is None:
+            out = np.zeros((n_roi, nt), dtype=np.float32)
+        assert out.dtype == np.float32 and out.flags.c_contiguous
+        chunks = [(r0, min(r0 + batch_size, n_roi)) for r0 in range(0, n_roi, batch_size)]
+
+        flow_const = 0.0
+        if self.baseline == 'constant':
+            # the constant baseline is the minimum over all filtered traces
+            flow_const = np.inf
+            for r0, r1 in chunks:
+                tasks = [(F, Fneu, npil_coeff, a, b) for a, b in self.split(r0, r1)]
+                flow_const = min([flow_const] + list(self.map(self.min_rows, tasks)))
+
+        for i, (r0, r1) in enumerate(chunks):
+            if log_cb is not None:
+                log_cb('Deconvolving rois %d to %d of %d' % (r0, r1, n_roi), 3)
+            tasks = [(F, Fneu, npil_coeff, a, b, flow_const, out)
+                     for a, b in self.split(r0, r1)]
+            self.map(self.run_rows, tasks)
+        return out
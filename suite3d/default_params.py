@@ -44,7 +44,17 @@ params = {
     "fix_fastZ": False,  # if you messed up your ROI z-definitions in scanimage, this is useful
     "num_colors": 1,  # if not lbm data, how many color channels were recorded by scanimage
     "functional_color_channel": 0,  # if not lbm data, which color channel is the functional one
+    # dtype of saved movies and of large movie buffers (mov_sub, segmentation patches,
+    # extraction batches). Computations on them always accumulate in float32
     "save_dtype": "float16",
+    # run the main Job steps under cProfile and save the stats to job_dir/profiles
+    "cprofile": False,
+    # RAM in GB that the pipeline may use when planning batch sizes. None uses 80% of the
+    # available memory
+    "mem_budget_gb": None,
+    # choose tif_batch_size, split_tif_size, t_batch_size, mproc_batchsize, patch_size_xy
+    # and extract_batchsize_frames from mem_budget_gb at the start of each step (job.plan_memory)
+    "auto_memory_plan": False,
     ### Initialization Step ###
     # number of files to use for the initialization step
     # Usually the equivalent of ~1 minute is enough
@@ -89,7 +99,11 @@ params = {
     # whether or not to align each z plane in x/y
     "plane_to_plane_alignment": True,
     # number of frames per batch in gpu registration
-    "gpu_reg_batchsize": 10,
+    # None picks the largest batch that fits in the free GPU memory
+    # batches are halved and retried if the GPU runs out of memory
+    "gpu_reg_batchsize": None,
+    # fraction of the free GPU memory used when picking batch sizes automatically
+    "gpu_mem_fraction": 0.8,
     "max_shift_nr": 3,
     "nr_npad": 3,
     "nr_subpixel": 10,
@@ -97,6 +111,7 @@ params = {
     # 3d registration params
     "pc_size": n.asarray((2, 40, 40)),  # ~ max_reg_zyx
     "3d_reg": True,  # Use the new 3d registration fucntions
+    # run the batched 3d registration with cupy, False runs the same code with numpy
     "gpu_reg": True,
     # reference image paramaters
     "percent_contribute": 0.9,
@@ -106,16 +121,25 @@ params = {
     "sigma_reference": (1.45, 0),
     "smooth_sigma_reference": 1.15,
     "n_reference_iterations": 8,
+    # a plane stops iterating early when its frames stop moving and the reference
+    # correlates with the previous one to within this tolerance (CPU only), 0 to disable
+    "reference_conv_tol": 1e-3,
     "max_reg_xy_reference": 50,
     # max value in x/y which a plane can be shifted for the reference
-    "gpu_reference_batch_size": 20,
+    "gpu_reference_batch_size": None, # None picks from the free GPU memory
     # parameters from suite2p
     "nonrigid": False,
     "apply_z_shift": False, 
+    # 3D registration: None applies integer shifts, 'linear' or 'fourier' applies
+    # the sub-pixel shifts estimated from the phase correlation
+    "subpixel_shift": None,
     "smooth_sigma": 1.15,
     "snr_thresh" : 1.2, #SNR threshold for nonrigid registration (2D)
     "maxregshift": 0.15,# only used in 2D, CPU registration (suite2p)
     "smooth_sigma_time" : 0, # only used in 2D, CPU registration (suite2p)
+    # max number of processes registering z-planes in parallel (2D, CPU registration)
+    # the actual pool size is also limited by the available memory per plane
+    "n_proc_reg": set_num_processors(16),
     "reg_filter_pcorr": 1,
     "reg_norm_frames": True,  # clip frames during registration
     # At the end of initalization, register and save an example bin
@@ -157,6 +181,21 @@ params = {
     # by dask. Too high leads to memory bottlenecks
     # Limited performance improvement by increasing this
     "n_svd_blocks_per_batch": 1,
+    # Choose svd_time_chunk, svd_pix_chunk and n_svd_blocks_per_batch from the available RAM
+    # and cores instead of the values above. The chosen plan is saved in svd_info['svd_plan']
+    "svd_auto_plan": False,
+    # RAM in GB that the SVD may use. None uses 80% of the available memory
+    "svd_mem_budget_gb": None,
+    # run the dask SVD on a local dask.distributed cluster with per-worker memory limits
+    "svd_use_dask_cluster": False,
+    # "dask" runs svd_compressed on each block separately, "streaming" computes a randomized
+    # SVD of all blocks at once with 2 * svd_n_power_iter + 2 passes over the movie in time order
+    "svd_method": "dask",
+    # number of frames loaded at each step of a streaming SVD pass
+    "svd_stream_t_batch_size": 1000,
+    # number of power iterations and extra sketch components for the streaming SVD
+    "svd_n_power_iter": 2,
+    "svd_n_oversample": 20,
     ### Correlation Map ###
     # number of svd components to use in reconstruction is n_svd_comp
     # strength of normalization, 1.0 is standard. reduce below 1.0 (to ~0.8) if you see bright
@@ -246,6 +285,8 @@ params = {
     # coefficient to multiply neuropil activity by before subtracting from cell activity
     "npil_coeff": 0.7,
     "npil_to_roi_npix_ratio": None,
+    # number of frames loaded at once during extraction. reduce if you run out of memory
+    "extract_batchsize_frames": 500,
     "min_npil_npix": 100,
     # S2P deconvolution parameters
     "dcnv_baseline": "maximin",
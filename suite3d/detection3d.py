@@ -1,4 +1,5 @@
 import time
+import contextlib
 from dask_image.ndfilters import uniform_filter as dask_uniform_filter
 import cProfile
 import multiprocessing
@@ -7,9 +8,13 @@ import numpy as n
 np = n
 from dask import array as darr
 from scipy.ndimage import maximum_filter, gaussian_filter, uniform_filter
+from numba import njit, prange
+import scipy.fft
 
 from . import utils
+from . import shmem as shm
 from .utils import default_log
+from .precision import COMPUTE_DTYPE
 
 # This file is adapted from the original suite2p (Stringer & Pachitariu et al)
 
@@ -118,11 +123,18 @@ def filter_and_reduce_movie(
     standard_vmap=True,
     pool=None,
     log=default_log,
+    engine="separable",
+    mov_sub_store=None,
+    mov_sub_t0=0,
+    arena=None,
+    copy=False,
 ):
     """
     Apply neuropil subtraction and cell deteciton filters to movie. Then, threshold
     each pixel, and take the squared sum of times where it exceeds the threshold.
-    Optimized in shared memory.
+    With engine='separable', the filtering and the reduction are done together on
+    minibatches of frames, so the filtered movie is never held in full. With
+    engine='scipy' the filters run on the pool in shared memory.
 
     Args:
         mov (ndarray): nt,nz,ny,nx
@@ -134,57 +146,89 @@ def filter_and_reduce_movie(
         n_proc (int, optional): Number of processors. Defaults to 8.
         minibatch_size (int, optional): Number of frames to give each processor. Defaults to 20.
         log (func, optional): Defaults to default_log.
+        engine (str, optional): 'separable' or 'scipy'. Defaults to 'separable'.
+        mov_sub_store (MovSubStore, optional): store to write the neuropil subtracted
+            movie to, starting at frame mov_sub_t0. Defaults to None.
+        arena (ShmemArena, optional): arena for the engine='scipy' shared memory buffers.
+            A caller running many batches passes its own so the buffers are reused, and
+            closes it when done. Defaults to None, a new arena closed before returning.
+        copy (bool, optional): with engine='separable', neuropil subtract a copy of mov.
+            Defaults to False, which subtracts mov in place (if it is already float32)
+            and returns it as mov_sub.
 
     Returns:
         vmap_2, mov_sub
     """
+    if engine == "separable" and cell_filt_type in ("unif", "gaussian"):
+        log("Subtracting neuropil, applying cell filters and reducing", 3)
+        log("dtu_npsub_conv3d_vmap", tic=True)
+        if copy:
+            mov_sub = n.array(mov, dtype=n.float32, copy=True)
+        else:
+            mov_sub = n.asarray(mov, dtype=n.float32)
+        del mov
+        vmap_2 = np_sub_and_conv3d_reduce(
+            mov_sub,
+            npil_filt_type,
+            npil_filt_size,
+            cell_filt_type,
+            cell_filt_size,
+            intensity_thresh,
+            minibatch_size,
+            standard_vmap,
+            mov_sub_store=mov_sub_store,
+            mov_sub_t0=mov_sub_t0,
+        )
+        log("dtu_npsub_conv3d_vmap", toc=True)
+        return vmap_2, mov_sub
 
     log(f"Loading movie of size {mov.shape} into shared memory", 3)
     log("dtu_shmem", tic=True)
-    # Load a copy of the movie into shared memory, and delete the original
-    shmem_mov_sub, shmem_par_mov_sub, mov_sub = utils.create_shmem_from_arr(
-        mov, copy=True
-    )
-    del mov
-    # Create another array in shared memory for the neuropil-subtracted movie
-    shmem_mov_filt, shmem_par_mov_filt, mov_filt = utils.create_shmem_from_arr(
-        mov_sub, copy=False
-    )
-    log("dtu_shmem", toc=True)
-    log("Subtracting neuropil and applying cell filters", 3)
-    log("dtu_npsub_conv3d", tic=True)
-    np_sub_and_conv3d_split_shmem(
-        shmem_par_mov_sub,
-        shmem_par_mov_filt,
-        npil_filt_size,
-        cell_filt_size,
-        n_proc=n_proc,
-        batch_size=minibatch_size,
-        np_filt_type=npil_filt_type,
-        conv_filt_type=cell_filt_type,
-        pool=pool,
-    )
-    log("dtu_npsub_conv3d", toc=True)
-    log("Reducing filtered movie to compute correlation map", 3)
-    log("dtu_vmap", tic=True)
-
-    if standard_vmap:
-        vmap_2 = get_vmap3d(
-            mov_filt, intensity_thresh, sqrt=False, mean_subtract=False, fix_edges=False
+    owns_arena = arena is None
+    with shm.ShmemArena() if owns_arena else contextlib.nullcontext(arena) as arena:
+        # Load a copy of the movie into shared memory, and delete the original
+        shmem_par_mov_sub, mov_sub = arena.from_arr("mov_sub", mov)
+        del mov
+        # Create another array in shared memory for the neuropil-subtracted movie
+        shmem_par_mov_filt, mov_filt = arena.get("mov_filt", mov_sub.shape, mov_sub.dtype)
+        log("dtu_shmem", toc=True)
+        log("Subtracting neuropil and applying cell filters", 3)
+        log("dtu_npsub_conv3d", tic=True)
+        np_sub_and_conv3d_split_shmem(
+            shmem_par_mov_sub,
+            shmem_par_mov_filt,
+            npil_filt_size,
+            cell_filt_size,
+            n_proc=n_proc,
+            batch_size=minibatch_size,
+            np_filt_type=npil_filt_type,
+            conv_filt_type=cell_filt_type,
+            pool=pool,
         )
-    else:
-        log("RUNNING NEW VMAP, 2")
-        vmap_2 = get_vmap3d_cov(mov_filt, mov_sub, thresh=intensity_thresh)
-
-    log("dtu_vmap", toc=True)
-    # close and free the shared memory arrays
-    log("dtu_cleanup", tic=True)
-    shmem_mov_filt.close()
-    shmem_mov_filt.unlink()
-    # before closing the mov_sub shared memory, make a copy of it to return
-    mov_sub_return = mov_sub.copy()
-    shmem_mov_sub.close()
-    shmem_mov_sub.unlink()
+        log("dtu_npsub_conv3d", toc=True)
+        log("Reducing filtered movie to compute correlation map", 3)
+        log("dtu_vmap", tic=True)
+
+        if standard_vmap:
+            vmap_2 = get_vmap3d(
+                mov_filt, intensity_thresh, sqrt=False, mean_subtract=False, fix_edges=False
+            )
+        else:
+            log("RUNNING NEW VMAP, 2")
+            vmap_2 = get_vmap3d_cov(mov_filt, mov_sub, thresh=intensity_thresh)
+
+        log("dtu_vmap", toc=True)
+        # free the shared memory arrays, the arena unlinks them even if a step above fails.
+        # a caller's arena keeps mov_filt for its next batch
+        log("dtu_cleanup", tic=True)
+        del mov_filt
+        if owns_arena:
+            arena.release("mov_filt")
+        # before closing the mov_sub shared memory, make a copy of it to return
+        mov_sub_return = mov_sub.copy()
+        if mov_sub_store is not None:
+            mov_sub_store.write(mov_sub_t0, mov_sub)
+        del mov_sub
     log("dtu_cleanup", toc=True)
     return vmap_2, mov_sub_return
 
@@ -195,19 +239,57 @@ def accumulate_vmap_2(vmap_2, new_vmap_2, ns_total):
     return vmap
 
 
-def get_vmap3d_cov(mov1, mov2, thresh=0):
+@njit(parallel=True, nogil=True, cache=True)
+def thresholded_sum_sq(mov, thresh, mean, subtract_mean, vmap):
+    """
+    Single pass over a nt, nz, ny, nx movie adding the sum over time of
+    (mov - mean)**2, where (mov - mean) > thresh[z], to vmap (nz, ny, nx). mean is only
+    read if subtract_mean is True
+    """
+    nt, nz, ny, nx = mov.shape
+    for z in prange(nz):
+        acc = n.zeros((ny, nx), dtype=n.float32)
+        th = thresh[z]
+        for t in range(nt):
+            for y in range(ny):
+                # branch-free so the inner loop vectorises
+                if subtract_mean:
+                    for x in range(nx):
+                        v = n.float32(mov[t, z, y, x] - mean[z, y, x])
+                        acc[y, x] += v * v if v > th else n.float32(0)
+                else:
+                    for x in range(nx):
+                        v = n.float32(mov[t, z, y, x])
+                        acc[y, x] += v * v if v > th else n.float32(0)
+        vmap[z] += acc
+    return vmap
+
+
+@njit(parallel=True, nogil=True, cache=True)
+def thresholded_sum_prod(mov1, mov2, thresh, vmap):
+    """
+    Single pass adding the sum over time of mov1 * mov2, where mov1 > thresh, to vmap
+    """
+    nt, nz, ny, nx = mov1.shape
+    for z in prange(nz):
+        acc = n.zeros((ny, nx), dtype=n.float32)
+        for t in range(nt):
+            for y in range(ny):
+                for x in range(nx):
+                    v = n.float32(mov1[t, z, y, x])
+                    w = n.float32(mov2[t, z, y, x])
+                    acc[y, x] += v * w if v > thresh else n.float32(0)
+        vmap[z] += acc
+    return vmap
+
+
+def get_vmap3d_cov(mov1, mov2, thresh=0, vmap=None):
     if thresh is None:
         thresh = 0
     nt, nz, ny, nx = mov1.shape
-    vmap = n.zeros((nz, ny, nx))
-    for tidx in range(nt):
-        active_pix = mov1[tidx] > thresh
-        # print(mov1.shape)
-        # print(mov2.shape)
-        # print(mov1[tidx][active_pix].shape)
-        # print(vmap.shape)
-        vmap[active_pix] += mov1[tidx][active_pix] * mov2[tidx][active_pix]
-    return vmap
+    if vmap is None:
+        vmap = n.zeros((nz, ny, nx), dtype=COMPUTE_DTYPE)
+    return thresholded_sum_prod(mov1, mov2, float(thresh), vmap)
 
 
 def threshold_reduce(
@@ -234,17 +316,9 @@ def threshold_reduce(
         The standard deviation of the non-thresholded pixels
     """
     nbinned, Lyp, Lxp = mov.shape
-    Vt = np.zeros((Lyp, Lxp), "float32")
-    if mean_subtract:
-        mov = mov.copy() - mov.mean(axis=0)
-    # print(f"Intensity thresh is {intensity_threshold}")
-    if intensity_threshold is None:
-        intensity_threshold = mov.min()
-
-    # print(f"Intensity thresh is {intensity_threshold}")
-    # print(f"Mov mean is {mov.mean()}")
-    for t in range(nbinned):
-        Vt += mov[t] ** 2 * (mov[t] > intensity_threshold)
+    Vt = np.zeros((1, Lyp, Lxp), "float32")
+    thresholded_sum_sq_3d(mov[:, n.newaxis], intensity_threshold, mean_subtract, Vt)
+    Vt = Vt[0]
     if sqrt:
         Vt = Vt**0.5
     if fix_edges:
@@ -405,19 +479,37 @@ def square_convolution_2d(
     return movt
 
 
+def thresholded_sum_sq_3d(mov, intensity_threshold, mean_subtract, vmap):
+    """
+    Adds the thresholded sum of squares of a nt, nz, ny, nx movie to vmap. If the
+    threshold is None, the minimum of each plane is used
+    """
+    nt, nz, ny, nx = mov.shape
+    mean = n.zeros((1, 1, 1), dtype=n.float32)
+    if mean_subtract:
+        mean = mov.mean(axis=0)
+    if intensity_threshold is None:
+        thresh = n.array(
+            [(mov[:, z] - mean[z % mean.shape[0]]).min() for z in range(nz)], dtype=n.float64
+        )
+    else:
+        thresh = n.full(nz, intensity_threshold, dtype=n.float64)
+    return thresholded_sum_sq(mov, thresh, mean, mean_subtract, vmap)
+
+
 def get_vmap3d(
     movu0, intensity_threshold=None, fix_edges=False, sqrt=True, mean_subtract=True
 ):
     nt, nz, ny, nx = movu0.shape
-    vmap = n.zeros((nz, ny, nx))
-    for i in range(nz):
-        vmap[i] = threshold_reduce(
-            movu0[:, i],
-            intensity_threshold,
-            mean_subtract=mean_subtract,
-            fix_edges=fix_edges,
-            sqrt=sqrt,
-        )
+    vmap = n.zeros((nz, ny, nx), dtype=COMPUTE_DTYPE)
+    thresholded_sum_sq_3d(movu0, intensity_threshold, mean_subtract, vmap)
+    if sqrt:
+        vmap = vmap**0.5
+    if fix_edges:
+        vmap[:, 0] = vmap[:, 1]
+        vmap[:, -1] = vmap[:, -2]
+        vmap[:, :, 0] = vmap[:, :, 1]
+        vmap[:, :, -1] = vmap[:, :, -2]
     return vmap
 
 
@@ -516,6 +608,227 @@ def np_sub_and_conv3d_shmem(
 filter_mode = "mirror"
 
 
+@njit(nogil=True, cache=True)
+def mirror_index(i, n_len):
+    """scipy.ndimage's 'mirror' boundary: d c b | a b c d | c b a"""
+    if n_len == 1:
+        return 0
+    period = 2 * n_len - 2
+    i = abs(i) % period
+    if i >= n_len:
+        i = period - i
+    return i
+
+
+@njit(parallel=True, nogil=True, cache=True)
+def correlate_last_axis(arr, weights, left, box):
+    """
+    Correlate every line along the last axis of a 4D array with weights, in place, using
+    mirror boundaries. The window of output i starts at input i - left. If box is True
+    the weights are assumed to be equal and a running sum is used, so the cost per voxel
+    does not depend on the filter size, otherwise they must be symmetric with an odd
+    length. Sums are in float64, as in scipy.ndimage
+    """
+    d0, d1, d2, n_len = arr.shape
+    size = weights.shape[0]
+    half = size // 2
+    for i in prange(d0 * d1):
+        a = i // d1
+        b = i % d1
+        buf = n.empty(n_len + size - 1)
+        line = n.empty(n_len)
+        for c in range(d2):
+            # only the padding needs the mirrored indices
+            for j in range(n_len + size - 1):
+                src = j - left
+                if src < 0 or src >= n_len:
+                    src = mirror_index(src, n_len)
+                buf[j] = arr[a, b, c, src]
+            if box:
+                w = weights[0]
+                acc = 0.0
+                for j in range(size):
+                    acc += buf[j]
+                arr[a, b, c, 0] = acc * w
+                for j in range(1, n_len):
+                    acc += buf[j + size - 1] - buf[j - 1]
+                    arr[a, b, c, j] = acc * w
+            else:
+                # symmetric weights, pair up the taps on either side of the centre.
+                # Looping over the taps outside keeps the inner loop vectorisable
+                w = weights[half]
+                for j in range(n_len):
+                    line[j] = w * buf[j + half]
+                for k in range(half):
+                    w = weights[k]
+                    for j in range(n_len):
+                        line[j] += w * (buf[j + k] + buf[j + size - 1 - k])
+                for j in range(n_len):
+                    arr[a, b, c, j] = line[j]
+
+
+def filter_weights(filt_type, size, truncate=4.0):
+    """
+    1D weights and window offset matching scipy's uniform_filter (size is truncated to an
+    int) and gaussian_filter (size is sigma). Returns None if the axis is not filtered
+    """
+    if filt_type == "unif":
+        size = int(size)
+        if size <= 1:
+            return None
+        return n.full(size, 1.0 / size), size // 2, True
+    elif filt_type == "gaussian":
+        if size <= 1e-15:
+            return None
+        radius = int(truncate * float(size) + 0.5)
+        x = n.arange(-radius, radius + 1)
+        weights = n.exp(-0.5 / float(size) ** 2 * x**2)
+        return weights / weights.sum(), radius, False
+    raise ValueError("Unknown filter type %s" % filt_type)
+
+
+_kernel_spectra = {}
+
+
+def kernel_spectrum(weights, fft_len):
+    """conj(rfft) of weights zero-padded to fft_len, cached across batches"""
+    key = (weights.tobytes(), fft_len)
+    if key not in _kernel_spectra:
+        kernel = n.zeros(fft_len)
+        kernel[: weights.shape[0]] = weights
+        _kernel_spectra[key] = n.conj(scipy.fft.rfft(kernel)).astype(n.complex64)
+    return _kernel_spectra[key]
+
+
+def fft_correlate_axis(mov, weights, left, axis):
+    """
+    Same as correlate_last_axis along the given axis, in place, by mirror-padding the
+    lines and multiplying their spectrum with the cached kernel spectrum. Cheaper than
+    the direct sum for wide kernels, equivalent up to float32 rounding
+    """
+    n_len = mov.shape[axis]
+    size = weights.shape[0]
+    pad = [(0, 0)] * mov.ndim
+    pad[axis] = (left, size - 1 - left)
+    if n_len > 1:
+        # numpy's 'reflect' is scipy.ndimage's 'mirror'
+        padded = n.pad(mov, pad, mode="reflect")
+    else:
+        padded = n.pad(mov, pad, mode="edge")
+    fft_len = padded.shape[axis]
+    spec = scipy.fft.rfft(padded, axis=axis, workers=-1)
+    del padded
+    shape = [1] * mov.ndim
+    shape[axis] = -1
+    spec *= kernel_spectrum(weights, fft_len).reshape(shape)
+    out = scipy.fft.irfft(spec, n=fft_len, axis=axis, workers=-1)
+    del spec
+    # the first n_len outputs are the ones that do not wrap around
+    mov[:] = out[tuple(slice(0, n_len) if i == axis else slice(None) for i in range(mov.ndim))]
+    return mov
+
+
+def separable_filter_batch(mov, filt_type, filt_size, fft_min_taps=49):
+    """
+    Applies a 3D uniform or gaussian filter to every frame of a nt, nz, ny, nx float32
+    movie in place, as one separable pass per axis over the whole batch. Equivalent to
+    calling scipy's uniform_filter / gaussian_filter on each frame with mode='mirror'.
+    Uniform filters use running sums, gaussians are summed directly or, for wide kernels,
+    convolved with FFTs
+
+    Args:
+        mov (ndarray): nt, nz, ny, nx float32 movie, filtered in place
+        filt_type (str): 'unif' or 'gaussian'
+        filt_size (tuple): 3-tuple of the size (unif) or sigma (gaussian) in z, y, x
+        fft_min_taps (int, optional): gaussian kernels with at least this many taps
+            are applied with FFTs. Defaults to 49 (sigma of 6 pixels).
+
+    Returns:
+        mov
+    """
+    for axis, size in zip((1, 2, 3), filt_size):
+        filt = filter_weights(filt_type, size)
+        if filt is None or mov.shape[axis] == 0:
+            continue
+        weights, left, box = filt
+        if not box and weights.shape[0] >= fft_min_taps:
+            fft_correlate_axis(mov, weights, left, axis)
+        else:
+            correlate_last_axis(n.moveaxis(mov, axis, -1), weights, left, box)
+    return mov
+
+
+def np_sub_and_conv3d_batch(
+    mov_sub, mov_filt, np_filt_size, conv_filt_size, c1, np_filt_type, conv_filt_type
+):
+    """
+    Neuropil subtraction (in place on mov_sub) and cell filtering (into mov_filt) for a
+    batch of frames using separable_filter_batch. Same result as np_sub_and_conv3d_split_shmem_w
+    """
+    if np_filt_type is not None and np_filt_type != "none":
+        npil = separable_filter_batch(
+            mov_sub.astype(n.float32, copy=True), np_filt_type, np_filt_size
+        )
+        npil /= c1
+        mov_sub -= npil
+        del npil
+    mov_filt[:] = mov_sub
+    separable_filter_batch(mov_filt, conv_filt_type, conv_filt_size)
+    mov_filt *= conv_filt_size[-1]
+
+
+def np_sub_and_conv3d_reduce(
+    mov_sub,
+    np_filt_type,
+    np_filt_size,
+    conv_filt_type,
+    conv_filt_size,
+    intensity_thresh,
+    batch_size=50,
+    standard_vmap=True,
+    mov_sub_store=None,
+    mov_sub_t0=0,
+):
+    """
+    Neuropil subtraction of mov_sub (in place) and cell filtering, batch_size frames at a
+    time. Each filtered minibatch is reduced to the thresholded sum of squares (or, if
+    standard_vmap is False, the thresholded covariance with mov_sub) while it is still
+    in cache, so only a minibatch of the filtered movie is ever allocated. If a
+    MovSubStore is given, each subtracted minibatch is written to it at frame
+    mov_sub_t0 + its index in the batch.
+
+    Returns:
+        vmap_2: nz, ny, nx
+    """
+    nt, nz, ny, nx = mov_sub.shape
+    c1 = 1
+    if np_filt_type is not None and np_filt_type != "none":
+        c1 = separable_filter_batch(
+            n.ones((1, nz, ny, nx), dtype=n.float32), np_filt_type, np_filt_size
+        )[0]
+    # with no threshold get_vmap3d uses the minimum of each plane, which a single pass
+    # can not know in advance, so every voxel is included. get_vmap3d_cov uses 0
+    sq_thresh = n.full(nz, -n.inf if intensity_thresh is None else intensity_thresh)
+    cov_thresh = 0.0 if intensity_thresh is None else float(intensity_thresh)
+    no_mean = n.zeros((1, 1, 1), dtype=n.float32)
+    vmap_2 = n.zeros((nz, ny, nx), dtype=COMPUTE_DTYPE)
+    batch_size = min(batch_size, nt)
+    mov_filt = n.empty((batch_size, nz, ny, nx), dtype=n.float32)
+    for idx in range(0, nt, batch_size):
+        sl = slice(idx, min(nt, idx + batch_size))
+        filt = mov_filt[: sl.stop - sl.start]
+        np_sub_and_conv3d_batch(
+            mov_sub[sl], filt, np_filt_size, conv_filt_size, c1, np_filt_type, conv_filt_type
+        )
+        if mov_sub_store is not None:
+            mov_sub_store.write(mov_sub_t0 + sl.start, mov_sub[sl])
+        if standard_vmap:
+            thresholded_sum_sq(filt, sq_thresh, no_mean, False, vmap_2)
+        else:
+            thresholded_sum_prod(filt, mov_sub[sl], cov_thresh, vmap_2)
+    return vmap_2
+
+
 def np_sub_and_conv3d_split_shmem_w(
     sub_par, filt_par, idxs, np_filt_size, conv_filt_size, c1, c2, np_filt, conv_filt
 ):
@@ -553,9 +866,33 @@ def np_sub_and_conv3d_split_shmem(
     pool=None,
     np_filt_type="unif",
     conv_filt_type="unif",
+    engine="separable",
 ):
+    """
+    Neuropil subtraction (in place on the shmem_sub movie) and cell filtering (into the
+    shmem_filt movie). With engine='separable' the filters run on batches of batch_size
+    frames in this process, parallelised with numba. engine='scipy' runs scipy's filters
+    frame by frame on the pool
+    """
     tic = time.time()
     nt, Lz, Ly, Lx = shmem_sub["shape"]
+    if engine == "separable" and conv_filt_type in ("unif", "gaussian"):
+        sub_sh, mov_sub = utils.load_shmem(shmem_sub)
+        filt_sh, mov_filt = utils.load_shmem(shmem_filt)
+        c1 = 1
+        if np_filt_type is not None and np_filt_type != "none":
+            c1 = separable_filter_batch(
+                n.ones((1, Lz, Ly, Lx), dtype=n.float32), np_filt_type, np_filt_size
+            )[0]
+        for idx in range(0, nt, batch_size):
+            sl = slice(idx, min(nt, idx + batch_size))
+            np_sub_and_conv3d_batch(
+                mov_sub[sl], mov_filt[sl], np_filt_size, conv_filt_size, c1,
+                np_filt_type, conv_filt_type,
+            )
+        sub_sh.close()
+        filt_sh.close()
+        return
     if np_filt_type == "unif":
         np_filt = uniform_filter
     elif np_filt_type == "gaussian":
@@ -573,8 +910,8 @@ def np_sub_and_conv3d_split_shmem(
     else:
         conv_filt = None
     if np_filt is not None:
-        c1 = np_filt(n.ones((Lz, Ly, Lx)), np_filt_size, mode=filter_mode)
-    c2 = conv_filt(n.ones((Lz, Ly, Lx)), conv_filt_size, mode=filter_mode)
+        c1 = np_filt(n.ones((Lz, Ly, Lx), dtype=COMPUTE_DTYPE), np_filt_size, mode=filter_mode)
+    c2 = conv_filt(n.ones((Lz, Ly, Lx), dtype=COMPUTE_DTYPE), conv_filt_size, mode=filter_mode)
 
     batches = [
         n.arange(idx, min(nt, idx + batch_size)) for idx in n.arange(0, nt, batch_size)
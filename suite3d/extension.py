@@ -1,4 +1,5 @@
 import os
+import contextlib
 from scipy.interpolate import RectBivariateSpline
 from scipy.ndimage import (
     maximum_filter,
@@ -11,6 +12,9 @@ from multiprocessing import Pool
 from . import utils
 from scipy.spatial import distance_matrix
 from .utils import default_log
+from . import profiling
+from . import shmem as shm
+from .precision import COMPUTE_DTYPE, storage_dtype, sum_squares, to_compute
 
 from skimage.filters import threshold_local
 
@@ -168,6 +172,8 @@ def detect_cells_mp(
     extension_func = 'corr',
     debug=False,
     patch_idx=-1,
+    save_dtype="float32",
+    arena=None,
     **kwargs,
 ):
     """
@@ -192,81 +198,87 @@ def detect_cells_mp(
         savepath (str): Path to save results
         debug (bool): Whether to run in debug mode
         patch_idx (int): Index of the current patch
+        save_dtype (str): Storage dtype of the shared memory patch, see precision.py
+        arena (ShmemArena): Arena to hold the patch in, so a caller segmenting many
+            patches reuses one buffer. Defaults to None, a new arena closed before returning
 
     Returns:
         list: List of detected cell statistics
     """
     stats = []
     log("Loading movie patch to shared memory", 3)
-    shmem_patch, shmem_par_patch, patch = utils.create_shmem_from_arr(patch, copy=True)
-    patch_norms = n.sqrt((patch**2).sum(axis=0))
-    log("Loaded", 3)
-    Th2 = activity_thresh
-    vmultiplier = 1
-    peak_thresh = vmultiplier * peak_thresh
-    vmin = vmap.min()
-    log(f"Starting extraction with peak_thresh: {peak_thresh:.3f} and Th2: {Th2:.3f}", 2)
-    nt, nz, ny, nx = patch.shape
-    n_iters = max_iter // n_proc_detect
-    roi_idx = 0
-    widxs = n.arange(n_proc_detect)
-
-    with Pool(n_proc_detect) as p:
-        for iter_idx in range(n_iters):
-            outs = find_top_n_rois(vmap, n_rois=n_proc_detect)
-            filtered_rois = filter_rois(outs, peak_thresh)
-
-            if not filtered_rois:
-                log(f"Iter {iter_idx:04d}: peak is too small - ending extraction", 2)
-                break
-
-            log(
-                f"Iter {iter_idx:04d}: running {len(filtered_rois):02d} ROIs in parallel",
-                3,
-            )
-            roi_idxs = n.arange(len(filtered_rois)) + roi_idx + 1
-
-            returns = p.starmap(
-                detect_cells_worker,
-                [
-                    (
-                        widxs[i],
-                        roi_idxs[i],
-                        shmem_par_patch,
-                        filtered_rois[i],
-                        Th2,
-                        percentile,
-                        roi_ext_iterations,
-                        extend_thresh,
-                        max_ext_iters,
-                        offset,
-                        max_pix,
-                        patch_idx,
-                        patch_norms,
-                        extension_func,
+    # patch may be a memory map of the mov_sub store, it is read (and converted to the
+    # storage dtype if needed) in the one copy to shared memory
+    with shm.ShmemArena() if arena is None else contextlib.nullcontext(arena) as arena:
+        shmem_par_patch, patch = arena.from_arr(
+            "patch", patch, dtype=storage_dtype(save_dtype)
+        )
+        patch_norms = n.sqrt(sum_squares(patch))
+        log("Loaded", 3)
+        Th2 = activity_thresh
+        vmultiplier = 1
+        peak_thresh = vmultiplier * peak_thresh
+        vmin = vmap.min()
+        log(f"Starting extraction with peak_thresh: {peak_thresh:.3f} and Th2: {Th2:.3f}", 2)
+        nt, nz, ny, nx = patch.shape
+        n_iters = max_iter // n_proc_detect
+        roi_idx = 0
+        widxs = n.arange(n_proc_detect)
+
+        with Pool(n_proc_detect) as p:
+            for iter_idx in range(n_iters):
+                with profiling.stage("detection_round"):
+                    outs = find_top_n_rois(vmap, n_rois=n_proc_detect)
+                    filtered_rois = filter_rois(outs, peak_thresh)
+
+                    if not filtered_rois:
+                        log(f"Iter {iter_idx:04d}: peak is too small - ending extraction", 2)
+                        break
+
+                    log(
+                        f"Iter {iter_idx:04d}: running {len(filtered_rois):02d} ROIs in parallel",
+                        3,
+                    )
+                    roi_idxs = n.arange(len(filtered_rois)) + roi_idx + 1
+
+                    returns = p.starmap(
+                        detect_cells_worker,
+                        [
+                            (
+                                widxs[i],
+                                roi_idxs[i],
+                                shmem_par_patch,
+                                filtered_rois[i],
+                                Th2,
+                                percentile,
+                                roi_ext_iterations,
+                                extend_thresh,
+                                max_ext_iters,
+                                offset,
+                                max_pix,
+                                patch_idx,
+                                patch_norms,
+                                extension_func,
+                            )
+                            for i in range(len(filtered_rois))
+                        ],
                     )
-                    for i in range(len(filtered_rois))
-                ],
-            )
-
-            process_returns(
-                returns,
-                patch,
-                vmap,
-                stats,
-                allow_overlap,
-                vmin,
-                savepath,
-                log,
-                ext_subtract_iters,
-            )
-            roi_idx = len(stats)
 
-            if savepath is not None and roi_idx % 250 == 0 and roi_idx > 0:
-                save_checkpoint(savepath, stats, log)
+                    process_returns(
+                        returns,
+                        patch,
+                        vmap,
+                        stats,
+                        allow_overlap,
+                        vmin,
+                        savepath,
+                        log,
+                        ext_subtract_iters,
+                    )
+                    roi_idx = len(stats)
 
-    shmem_patch.close()
-    shmem_patch.unlink()
+                    if savepath is not None and roi_idx % 250 == 0 and roi_idx > 0:
+                        save_checkpoint(savepath, stats, log)
     log(f"Found {roi_idx} cells in {iter_idx+1} iterations")
     save_final_results(savepath, stats, log)
     return stats
@@ -332,7 +344,7 @@ def update_vmap(
     """
     nz, ny, nx = vmap.shape
     if allow_overlap:
-        mnew = patch[:, zz, yy, xx]
+        mnew = to_compute(patch[:, zz, yy, xx])
         vmap[zz, yy, xx] = (mnew * n.float32(mnew > threshold)).sum(axis=0) ** 0.5
     else:
         zzx, yyx, xxx = extend_roi3d(zz, yy, xx, vmap.shape, extend_z=True)
@@ -431,7 +443,8 @@ def detect_cells_worker(
     """
     patch_sh, patch = utils.load_shmem(patch_par)
     med, zz, yy, xx, lam, peak_val = out
-    tproj = patch[:, zz, yy, xx] @ lam
+    # the shared patch may be float16, pixels are converted before any reduction
+    tproj = to_compute(patch[:, zz, yy, xx]) @ lam
     threshold = min(Th2, n.percentile(tproj, percentile)) if percentile > 0 else Th2
 
     if extension_func == 'corr':
@@ -467,11 +480,11 @@ def detect_cells_worker(
             max_pix=max_pix,
             patch_norms=patch_norms,
         )
-        tproj = patch[:, zz, yy, xx] @ lam
+        tproj = to_compute(patch[:, zz, yy, xx]) @ lam
         active_frames = n.nonzero(tproj > threshold)[0]
         npix = len(lam)
 
-    sub = n.zeros((patch.shape[0], npix))
+    sub = n.zeros((patch.shape[0], npix), dtype=COMPUTE_DTYPE)
     sub[active_frames] = tproj[active_frames, n.newaxis] @ lam[n.newaxis]
     patch_sh.close()
     stat = {
@@ -590,7 +603,7 @@ def alternate_iter_extend3d(
 ):
     npix = 0
     iter_idx = 0
-    mov_act = mov[active_frames]
+    mov_act = to_compute(mov[active_frames])
     lam = n.ones_like(zz, dtype=float) / (len(zz))
     # print("Called alternate_iter_extend_3d")
     while npix < max_pix and iter_idx < max_ext_iters:
@@ -657,7 +670,8 @@ def iter_extend3d(
     # pr.enable()
     npix = 0
     iter_idx = 0
-    mov_act = mov[active_frames].mean(axis=0)
+    # the movie may be float16, lam**2 would overflow for bright cells if not converted
+    mov_act = mov[active_frames].mean(axis=0, dtype=COMPUTE_DTYPE)
     # lam = n.array([lam0])
     while npix < max_pix and iter_idx < max_ext_iters:
         npix = len(yy)
@@ -817,17 +831,13 @@ def compute_npil_masks_mp(stats, shape, offset=(0, 0, 0), n_proc=8, npil_pars={}
     # TODO: parallelize this (EASY)
     # tic = time.time()
     cell_pix = create_cell_pix(stats, shape)
-    cell_shmem, cell_shmem_par, cell_pix = utils.create_shmem_from_arr(
-        cell_pix, copy=True
-    )
     # print(time.time() - tic)
-    pool = Pool(n_proc)
-    all_np_coords = pool.starmap(
-        compute_npil_masks_mp_helper,
-        [(stat["coords"], cell_shmem_par, npil_pars, offset) for stat in stats],
-    )
-    cell_shmem.close()
-    cell_shmem.unlink()
+    with shm.ShmemArena() as arena, Pool(n_proc) as pool:
+        cell_shmem_par, cell_pix = arena.from_arr("cell_pix", cell_pix)
+        all_np_coords = pool.starmap(
+            compute_npil_masks_mp_helper,
+            [(stat["coords"], cell_shmem_par, npil_pars, offset) for stat in stats],
+        )
 
     for i, stat in enumerate(stats):
         stat["npcoords"] = all_np_coords[i][0]
@@ -869,40 +879,36 @@ def extract_activity_mp(
         nt = mov.shape[1]
     print(mov.shape)
     ns = len(stats)
-    F_roi = n.zeros((ns, nt))
-    F_neu = n.zeros((ns, nt))
-    shmem_F_roi, shmem_par_F_roi, F_roi = utils.create_shmem_from_arr(F_roi, copy=True)
-    shmem_F_neu, shmem_par_F_neu, F_neu = utils.create_shmem_from_arr(F_neu, copy=True)
-    # print(offset)
-    n_batches = int(n.ceil(nt / batchsize_frames))
-    log("Will extract in %d batches of %d" % (n_batches, batchsize_frames), 3)
-    for batch_idx in range(n_batches):
-        log("Extracting batch %04d of %04d" % (batch_idx, n_batches), 4)
-        start = batch_idx * batchsize_frames
-        end = min(nt, start + batchsize_frames)
-        mov_batch = mov[:, start:end].compute()
-        shmem_batch, shmem_par_batch, mov_batch = utils.create_shmem_from_arr(
-            mov_batch, copy=True
-        )
-        log("Batch size: %.2f GB" % (mov_batch.nbytes / (1024**3),), 4)
-        for i in range(ns):
-            stat = stats[i]
-            zc, yc, xc = stat["coords"]
-            npzc, npyc, npxc = stat["npcoords"]
-
-            lam = stat["lam"] / stat["lam"].sum()
-            F_roi[i, start:end] = lam @ mov_batch[zc, :, yc, xc]
-            F_neu[i, start:end] = mov_batch[npzc, :, npyc, npxc].mean(axis=0)
-        shmem_batch.close()
-        shmem_batch.unlink()
-        del mov_batch
-
-    F_roi_out = F_roi.copy()
-    F_neu_out = F_neu.copy()
-    shmem_F_roi.close()
-    shmem_F_roi.unlink()
-    shmem_F_neu.close()
-    shmem_F_neu.unlink()
+    # the batch buffer is reused for every batch of the same size
+    with shm.ShmemArena() as arena:
+        shmem_par_F_roi, F_roi = arena.get("F_roi", (ns, nt), COMPUTE_DTYPE, zero=True)
+        shmem_par_F_neu, F_neu = arena.get("F_neu", (ns, nt), COMPUTE_DTYPE, zero=True)
+        # print(offset)
+        n_batches = int(n.ceil(nt / batchsize_frames))
+        log("Will extract in %d batches of %d" % (n_batches, batchsize_frames), 3)
+        for batch_idx in range(n_batches):
+            log("Extracting batch %04d of %04d" % (batch_idx, n_batches), 4)
+            start = batch_idx * batchsize_frames
+            end = min(nt, start + batchsize_frames)
+            shmem_par_batch, mov_batch = arena.from_arr(
+                "batch", mov[:, start:end].compute()
+            )
+            log("Batch size: %.2f GB" % (mov_batch.nbytes / (1024**3),), 4)
+            for i in range(ns):
+                stat = stats[i]
+                zc, yc, xc = stat["coords"]
+                npzc, npyc, npxc = stat["npcoords"]
+
+                lam = (stat["lam"] / stat["lam"].sum()).astype(COMPUTE_DTYPE)
+                F_roi[i, start:end] = lam @ mov_batch[zc, :, yc, xc].astype(COMPUTE_DTYPE)
+                F_neu[i, start:end] = mov_batch[npzc, :, npyc, npxc].mean(
+                    axis=0, dtype=COMPUTE_DTYPE
+                )
+            del mov_batch
+
+        F_roi_out = F_roi.copy()
+        F_neu_out = F_neu.copy()
+        del F_roi, F_neu
     return F_roi_out, F_neu_out
 
 
@@ -943,8 +949,8 @@ def extract_activity(
             nt = mov.shape[1]
     # print(mov.shape)
     ns = len(stats)
-    F_roi = n.zeros((ns, nt))
-    F_neu = n.zeros((ns, nt))
+    F_roi = n.zeros((ns, nt), dtype=COMPUTE_DTYPE)
+    F_neu = n.zeros((ns, nt), dtype=COMPUTE_DTYPE)
     # print(offset)
     n_batches = int(n.ceil(nt / batchsize_frames))
     batch_save_interval = 100
@@ -955,46 +961,51 @@ def extract_activity(
         log("Extracting batch %04d of %04d" % (batch_idx, n_batches), 4)
         start = batch_idx * batchsize_frames
         end = min(nt, start + batchsize_frames)
-        try:
-            if mov_shape_tfirst:
-                mov_batch = mov[start:end].swapaxes(0, 1).compute()
-            else:
-                mov_batch = mov[:, start:end].compute()
-        except:
-            log("NOT A DASK ARRAY!", 3)
-            mov_batch = mov[:, start:end]
+        with profiling.stage("extract_load") as rec:
+            try:
+                if mov_shape_tfirst:
+                    mov_batch = mov[start:end].swapaxes(0, 1).compute()
+                else:
+                    mov_batch = mov[:, start:end].compute()
+            except:
+                log("NOT A DASK ARRAY!", 3)
+                mov_batch = mov[:, start:end]
+            rec.count(frames=end - start, nbytes=mov_batch.nbytes)
         log("Batch size: %d GB" % (mov_batch.nbytes / (1024**3),), 4)
-        for i in range(ns):
-            stat = stats[i]
-            if stat is None:
-                continue
-            # if offset is not None:
-            #     zc, yc, xc = stat['coords_patch']
-            #     npzc, npyc, npxc = stat['npcoords_patch']
-            #     print(stat['npcoords_patch'])
-            #     print(stat['npcoords'])
-            # else:
-            zc, yc, xc = stat["coords"]
-            npzc, npyc, npxc = stat["npcoords"]
-            if npil_to_roi_npix_ratio is not None:
-                npix_roi = len(zc)
-                npix_npil = len(npzc)
-                if npix_npil > npix_roi * npil_to_roi_npix_ratio:
-                    n_sample = max(min_npil_npix, int(npix_roi * npil_to_roi_npix_ratio))
-                    if npix_npil < n_sample:
-                        print("Very few npix pixels")
-                        n_sample = npix_npil
-
-                    sample_idxs = n.random.choice(
-                        n.arange(npix_npil), size=n_sample, replace=False
-                    )
-                    npzc = npzc[sample_idxs]
-                    npyc = npyc[sample_idxs]
-                    npxc = npxc[sample_idxs]
-
-            lam = stat["lam"] / stat["lam"].sum()
-            F_roi[i, start:end] = lam @ mov_batch[zc, :, yc, xc]
-            F_neu[i, start:end] = mov_batch[npzc, :, npyc, npxc].mean(axis=0)
+        with profiling.stage("extract_batch", frames=end - start, nbytes=mov_batch.nbytes):
+            for i in range(ns):
+                stat = stats[i]
+                if stat is None:
+                    continue
+                # if offset is not None:
+                #     zc, yc, xc = stat['coords_patch']
+                #     npzc, npyc, npxc = stat['npcoords_patch']
+                #     print(stat['npcoords_patch'])
+                #     print(stat['npcoords'])
+                # else:
+                zc, yc, xc = stat["coords"]
+                npzc, npyc, npxc = stat["npcoords"]
+                if npil_to_roi_npix_ratio is not None:
+                    npix_roi = len(zc)
+                    npix_npil = len(npzc)
+                    if npix_npil > npix_roi * npil_to_roi_npix_ratio:
+                        n_sample = max(min_npil_npix, int(npix_roi * npil_to_roi_npix_ratio))
+                        if npix_npil < n_sample:
+                            print("Very few npix pixels")
+                            n_sample = npix_npil
+
+                        sample_idxs = n.random.choice(
+                            n.arange(npix_npil), size=n_sample, replace=False
+                        )
+                        npzc = npzc[sample_idxs]
+                        npyc = npyc[sample_idxs]
+                        npxc = npxc[sample_idxs]
+
+                lam = (stat["lam"] / stat["lam"].sum()).astype(COMPUTE_DTYPE)
+                F_roi[i, start:end] = lam @ mov_batch[zc, :, yc, xc].astype(COMPUTE_DTYPE)
+                F_neu[i, start:end] = mov_batch[npzc, :, npyc, npxc].mean(
+                    axis=0, dtype=COMPUTE_DTYPE
+                )
         if (
             (intermediate_save_dir is not None)
             and (batch_idx > 0)
@@ -195,6 +195,8 @@ def run_init_pass(job):
         "sigma": params.get("sigma_reference", [1.45, 0]),  # Y/X smooth, Z smooth
         "smooth_sigma": params.get("smooth_sigma_reference", 1.15),  # spatial taper width
         "niter": params.get("n_reference_iterations", 8),
+        # stop iterating once shifts and reference settle (CPU reference)
+        "conv_tol": params.get("reference_conv_tol", 1e-3),
         "max_reg_xy_reference": params.get("max_reg_xy_reference", 50),
         "pc_size": params.get(
             "pc_size", (2, 20, 20)
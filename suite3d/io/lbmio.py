@@ -1,6 +1,7 @@
 import tifffile
 import numpy as n
 import time
+import contextlib
 import copy
 from multiprocessing import shared_memory, Pool
 from scipy import signal
@@ -8,8 +9,11 @@ from scipy import signal
 # import imreg_dft as imreg
 import json
 from ..developer import deprecated_inputs, todo
+from .. import profiling
+from .. import shmem as shm
 
 
+@profiling.profiled("stitch", frames_axis=1)
 @deprecated_inputs(
     "Translation is never set to anything except None or zeros, so it's effectively ignored."
 )
@@ -24,6 +28,7 @@ def load_and_stitch_full_tif_mp(
     debug=False,
     translations=None,  # deprecated
     skip_roi=None,
+    arena=None,
 ):
     tic = time.time()
 
@@ -50,90 +55,86 @@ def load_and_stitch_full_tif_mp(
     # print("SKipping " + str(skip_roi))
     rois = get_meso_rois(path, fix_fastZ=fix_fastZ, skip_roi=skip_roi)
 
-    sh_mem = shared_memory.SharedMemory(create=True, size=tiffile.nbytes)
-    sh_tif = n.ndarray(tiffile.shape, dtype=tiffile.dtype, buffer=sh_mem.buf)
-    sh_tif[:] = tiffile[:]
-    if debug:
-        print("4, %.4f" % (time.time() - tic))
+    # the arena unlinks both segments if loading or stitching fails. A caller loading
+    # many tifs passes its own arena, so the segments are reused by the next tif
+    owns_arena = arena is None
+    with shm.ShmemArena() if owns_arena else contextlib.nullcontext(arena) as arena:
+        sh_tif_shmem_params, sh_tif = arena.from_arr("tif", tiffile)
+        if debug:
+            print("4, %.4f" % (time.time() - tic))
 
-    sh_mem_name = sh_mem.name
-    sh_mem_params = (sh_tif.shape, sh_tif.dtype)
-    n_t = sh_tif.shape[0]
-    n_ch_tif = len(channels)
+        sh_mem_name = sh_tif_shmem_params["name"]
+        sh_mem_params = (sh_tif.shape, sh_tif.dtype)
+        n_t = sh_tif.shape[0]
+        n_ch_tif = len(channels)
 
-    # split and stitch two frames to figure out the output size
-    ims_sample = _split_rois_from_tif(tiffile[:2], rois, ch_id=0)
-    if debug:
-        print("5, %.4f" % (time.time() - tic))
-    rois_stitch = copy.deepcopy(rois)
-    if skip_roi is not None:
-        ims_sample.pop(skip_roi)
-        rois_stitch.pop(skip_roi)
-    sample_out = _stitch_rois_fast(ims_sample, rois_stitch)
-    __, n_y, n_x = sample_out.shape
+        # split and stitch two frames to figure out the output size
+        ims_sample = _split_rois_from_tif(tiffile[:2], rois, ch_id=0)
+        if debug:
+            print("5, %.4f" % (time.time() - tic))
+        rois_stitch = copy.deepcopy(rois)
+        if skip_roi is not None:
+            ims_sample.pop(skip_roi)
+            rois_stitch.pop(skip_roi)
+        sample_out = _stitch_rois_fast(ims_sample, rois_stitch)
+        __, n_y, n_x = sample_out.shape
 
-    if debug:
-        print("6, %.4f" % (time.time() - tic))
+        if debug:
+            print("6, %.4f" % (time.time() - tic))
 
-    del tiffile
+        del tiffile
 
-    shape_out = (n_ch_tif, n_t, n_y, n_x)
-    size_out = (n_t * n_ch_tif * n_y * n_x) * sh_tif[0, 0, 0, 0].nbytes
-    sh_mem_out = shared_memory.SharedMemory(create=True, size=size_out)
-    sh_out = n.ndarray(shape_out, dtype=sh_tif.dtype, buffer=sh_mem_out.buf)
-    sh_out_name = sh_mem_out.name
-    sh_out_params = (sh_out.shape, sh_out.dtype)
+        shape_out = (n_ch_tif, n_t, n_y, n_x)
+        sh_out_shmem_params, sh_out = arena.get("out", shape_out, sh_tif.dtype)
+        sh_out_name = sh_out_shmem_params["name"]
+        sh_out_params = (sh_out.shape, sh_out.dtype)
 
-    if debug:
-        print("7, %.4f" % (time.time() - tic))
-
-    if translations is None:
-        translations = n.zeros((n_ch_tif, 2))
-
-    if verbose:
-        prep_tic = time.time()
-        print("    Loaded file into shared memory in %.2f sec" % (prep_tic - tic))
-
-    p = Pool(processes=n_proc)
-    _ = p.starmap(
-        load_and_stitch_full_tif_worker,
-        [
-            (
-                idx,
-                ch_id,
-                rois,
-                sh_mem_name,
-                sh_mem_params,
-                sh_out_name,
-                sh_out_params,
-                translations[idx],
-                filt,
-                skip_roi,
+        if debug:
+            print("7, %.4f" % (time.time() - tic))
+
+        if translations is None:
+            translations = n.zeros((n_ch_tif, 2))
+
+        if verbose:
+            prep_tic = time.time()
+            print("    Loaded file into shared memory in %.2f sec" % (prep_tic - tic))
+
+        with Pool(processes=n_proc) as p:
+            _ = p.starmap(
+                load_and_stitch_full_tif_worker,
+                [
+                    (
+                        idx,
+                        ch_id,
+                        rois,
+                        sh_mem_name,
+                        sh_mem_params,
+                        sh_out_name,
+                        sh_out_params,
+                        translations[idx],
+                        filt,
+                        skip_roi,
+                    )
+                    for idx, ch_id in enumerate(channels)
+                ],
             )
-            for idx, ch_id in enumerate(channels)
-        ],
-    )
 
-    if verbose:
-        proc_tic = time.time()
-        print("    Workers completed in %.2f sec" % (proc_tic - prep_tic))
+        if verbose:
+            proc_tic = time.time()
+            print("    Workers completed in %.2f sec" % (proc_tic - prep_tic))
 
-    if debug:
-        print("8, %.4f" % (time.time() - tic))
-
-    if verbose:
-        print("    Total time: %.2f sec" % (time.time() - tic))
-
-    sh_mem.close()
-    sh_mem.unlink()
-    p.close()
-    p.terminate()
+        if debug:
+            print("8, %.4f" % (time.time() - tic))
 
-    im_full = n.zeros(sh_out.shape, sh_out.dtype)
-    im_full[:] = sh_out[:]
-    sh_mem_out.close()
-    sh_mem_out.unlink()
+        if verbose:
+            print("    Total time: %.2f sec" % (time.time() - tic))
 
+        # a caller's arena keeps the raw tif segment for the next tif, otherwise it is
+        # freed before the output is copied out
+        if owns_arena:
+            arena.release("tif")
+        im_full = n.zeros(sh_out.shape, sh_out.dtype)
+        im_full[:] = sh_out[:]
     return im_full
 
 
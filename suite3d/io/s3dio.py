@@ -2,6 +2,8 @@ import tifffile
 import numpy as n
 import time
 from ..developer import todo, deprecated_inputs
+from .. import profiling
+from .. import shmem as shm
 from .lbmio import (
     load_and_stitch_full_tif_mp,
     convert_lbm_plane_to_channel,
@@ -75,9 +77,11 @@ class s3dio:
         # example use of _update_prms to get the parameters to use for this call
         params = self._update_prms(**parameters)
         _dataloader = self._get_dataloader(params)
-        mov_list = _dataloader(paths, params, verbose=verbose, debug=debug)
-        # concatenate movies across time to make a single movie
-        mov = n.concatenate(mov_list, axis=1)
+        with profiling.stage("load") as rec:
+            mov_list = _dataloader(paths, params, verbose=verbose, debug=debug)
+            # concatenate movies across time to make a single movie
+            mov = n.concatenate(mov_list, axis=1)
+            rec.count(frames=mov.shape[1], nbytes=mov.nbytes)
 
         if verbose:
             size = mov.nbytes / (1024**3)
@@ -275,26 +279,29 @@ class s3dio:
                 )
 
         mov_list = []
-        for tif_path in paths:
-            if verbose:
-                self.job.log("Loading %s" % tif_path, 2)
-
-            todo(
-                "Removed the **mp_args argument from load_and_stitch_full_tif_mp, should we add it back?"
-            )
-            im = load_and_stitch_full_tif_mp(
-                tif_path,
-                channels,
-                n_ch_tif,
-                filt=params["notch_filt"],
-                fix_fastZ=params.get("fix_fastZ", False),
-                skip_roi=params.get("skip_roi", None),
-                n_proc=params.get("n_proc"),
-                verbose=verbose,
-                debug=debug,
-            )
+        # the shared memory segments are reused by every tif of the same size
+        with shm.ShmemArena() as arena:
+            for tif_path in paths:
+                if verbose:
+                    self.job.log("Loading %s" % tif_path, 2)
+
+                todo(
+                    "Removed the **mp_args argument from load_and_stitch_full_tif_mp, should we add it back?"
+                )
+                im = load_and_stitch_full_tif_mp(
+                    tif_path,
+                    channels,
+                    n_ch_tif,
+                    filt=params["notch_filt"],
+                    fix_fastZ=params.get("fix_fastZ", False),
+                    skip_roi=params.get("skip_roi", None),
+                    n_proc=params.get("n_proc"),
+                    verbose=verbose,
+                    debug=debug,
+                    arena=arena,
+                )
 
-            mov_list.append(im)
+                mov_list.append(im)
 
         return mov_list
 
@@ -1,24 +1,28 @@
 import os
 import numpy as n
 import copy
+import multiprocessing
 from multiprocessing import shared_memory, Pool
 from scipy.ndimage import uniform_filter
 from dask import array as darr
 import time
 
 
-from .s2p_registration import nonrigid_transform_data, register_frames
+from .s2p_registration import register_frames, shift_frames
 # from . import deepinterp as dp
 
 from . import detection3d as det3d
 from . import svd_utils as svu
 from . import lbmio
 from . import utils
+from . import shmem as shm
 from . import register_gpu as reg_gpu
 from . import reg_3d as reg_3d
 from . import reference_image as ref
 from . import quality_metrics as qm
+from . import profiling
 from .utils import default_log
+from .backend import get_backend
 from .io import s3dio
 
 import traceback
@@ -30,6 +34,11 @@ try:
 except:
     print("CUPY not installed! ")
 
+try:
+    import psutil
+except:
+    psutil = None
+
 
 def init_batches(tifs, batch_size, max_tifs_to_analyze=None):
     if max_tifs_to_analyze is not None and max_tifs_to_analyze > 0:
@@ -51,7 +60,28 @@ def register_mov(
     log_cb=default_log,
     convolve_method="fast_cpu",
     do_rigid=True,
+    pool=None,
+    shmem_params=None,
 ):
+    """
+    Register each plane of mov3d to its reference in place with suite2p-style
+    rigid + nonrigid registration.
+
+    If a pool is given, mov3d must live in shared memory described by
+    shmem_params. Each worker then attaches to the batch, registers a single
+    plane in place and returns only the offsets.
+
+    Args:
+        mov3d (ndarray): nz, nt, ny, nx
+        refs_and_masks (list): refs and masks for each plane
+        all_ops (list): suite2p ops dict for each plane
+        pool (multiprocessing.Pool, optional): pool of plane-registration workers.
+            Defaults to None, which registers the planes serially.
+        shmem_params (dict, optional): shared memory params of mov3d, required with pool
+
+    Returns:
+        dict: offsets, each of shape (nt, nz, ...)
+    """
     nz, nt, ny, nx = mov3d.shape
     all_offsets = {
         "xmaxs_rr": [],
@@ -61,15 +91,27 @@ def register_mov(
         "ymaxs_nr": [],
         "cm1s": [],
     }
-    for plane_idx in range(nz):
-        log_cb("Registering plane %d" % plane_idx, 2)
-        mov3d[plane_idx], ym, xm, cm, ym1, xm1, cm1 = register_frames(
-            refAndMasks=refs_and_masks[plane_idx],
-            frames=mov3d[plane_idx],
-            ops=all_ops[plane_idx],
-            convolve_method=convolve_method,
-            do_rigid=do_rigid,
-        )
+    if pool is not None:
+        assert shmem_params is not None
+        log_cb("Registering %d planes in parallel" % nz, 2)
+        worker_params = [
+            (shmem_params, plane_idx, refs_and_masks[plane_idx], all_ops[plane_idx], do_rigid)
+            for plane_idx in range(nz)
+        ]
+        plane_offsets = pool.starmap(register_plane_shmem_w, worker_params)
+    else:
+        plane_offsets = []
+        for plane_idx in range(nz):
+            log_cb("Registering plane %d" % plane_idx, 2)
+            mov3d[plane_idx], ym, xm, cm, ym1, xm1, cm1 = register_frames(
+                refAndMasks=refs_and_masks[plane_idx],
+                frames=mov3d[plane_idx],
+                ops=all_ops[plane_idx],
+                do_rigid=do_rigid,
+            )
+            plane_offsets.append((ym, xm, cm, ym1, xm1, cm1))
+
+    for ym, xm, cm, ym1, xm1, cm1 in plane_offsets:
         all_offsets["xmaxs_rr"].append(xm)
         all_offsets["ymaxs_rr"].append(ym)
         all_offsets["cms"].append(cm)
@@ -77,58 +119,118 @@ def register_mov(
         all_offsets["ymaxs_nr"].append(ym1)
         all_offsets["cm1s"].append(cm1)
 
-    for k, v in all_offsets.items():
-        all_offsets[k] = n.swapaxes(n.array(v), 0, 1)
+    for k, v in list(all_offsets.items()):
+        if v[0] is None:
+            # nonrigid offsets are None without nonrigid registration
+            del all_offsets[k]
+        else:
+            all_offsets[k] = n.swapaxes(n.array(v), 0, 1)
 
     return all_offsets
 
 
+def register_plane_shmem_w(shmem_params, plane_idx, ref_and_masks, ops, do_rigid=True):
+    """
+    Worker for register_mov. Attaches to the shared batch, registers one
+    plane in place and returns its offsets.
+    """
+    shmem, mov3d = utils.load_shmem(shmem_params)
+    plane = mov3d[plane_idx]
+    frames, ym, xm, cm, ym1, xm1, cm1 = register_frames(
+        refAndMasks=ref_and_masks,
+        frames=plane,
+        ops=ops,
+        do_rigid=do_rigid,
+    )
+    # the shifted frames are written to a separate buffer, copy them back
+    if frames is not plane:
+        plane[:] = frames
+    del frames, plane, mov3d
+    shmem.close()
+    return ym, xm, cm, ym1, xm1, cm1
+
+
+def init_reg_worker(n_threads):
+    """
+    Limit the threads used by each plane-registration worker so that the
+    pool does not oversubscribe the cores.
+    """
+    try:
+        import numba
+
+        numba.set_num_threads(max(1, min(n_threads, numba.config.NUMBA_NUM_THREADS)))
+    except Exception:
+        pass
+    try:
+        import mkl
+
+        mkl.set_num_threads(max(1, n_threads))
+    except Exception:
+        pass
+
+
+def make_reg_pool(n_workers, n_threads):
+    """
+    Start a pool of plane-registration workers. The workers are started from a
+    forkserver (spawn where that is not available) instead of being forked, because
+    the pool is created while the IO thread and the job log flush thread are running,
+    and a forked worker could inherit a lock held by one of them.
+
+    Args:
+        n_workers (int): number of workers, see get_reg_pool_size
+        n_threads (int): numba/mkl threads per worker
+
+    Returns:
+        multiprocessing.pool.Pool
+    """
+    methods = multiprocessing.get_all_start_methods()
+    ctx = multiprocessing.get_context("forkserver" if "forkserver" in methods else "spawn")
+    return ctx.Pool(n_workers, initializer=init_reg_worker, initargs=(n_threads,))
+
+
+def get_reg_pool_size(mov_shape, n_proc_max, nonrigid=True, mem_frac=0.5, log_cb=default_log):
+    """
+    Choose the number of plane-registration workers from the number of cores
+    and the memory each worker needs to register a single plane.
+
+    Args:
+        mov_shape (tuple): nz, nt, ny, nx of a registration batch
+        n_proc_max (int): upper limit on the number of workers
+        nonrigid (bool, optional): nonrigid registration needs extra buffers. Defaults to True.
+        mem_frac (float, optional): fraction of available memory the workers may use. Defaults to 0.5.
+
+    Returns:
+        int: number of workers
+    """
+    nz, nt, ny, nx = mov_shape
+    # float32 smoothed copy + complex64 fft, and for nonrigid the shifted copy
+    # and the upsampled y/x shift maps
+    bytes_per_pix = 4 + 8 + (12 + 4 if nonrigid else 0)
+    plane_bytes = nt * ny * nx * bytes_per_pix
+    n_proc = max(1, min(n_proc_max, nz))
+    if psutil is not None:
+        avail_bytes = psutil.virtual_memory().available * mem_frac
+        n_proc = max(1, min(n_proc, int(avail_bytes // max(plane_bytes, 1))))
+    log_cb(
+        "Using %d workers for plane registration (%.2f GB per plane)"
+        % (n_proc, plane_bytes / 1024**3),
+        2,
+    )
+    return n_proc
+
+
 def fuse_movie(mov, n_skip, centers, shift_xs):
-    n_skip_l = n_skip // 2
-    n_skip_r = n_skip - n_skip_l
     nz, nt, ny, nx = mov.shape
-
-    centers = n.concatenate([centers, [nx]])
-    # print(centers)
-    n_seams = len(centers)
+    n_seams = len(centers) + 1
     nxnew = nx - (n_skip) * (n_seams)
-    # print(nxnew)
-    mov_fused = n.zeros((nz, nt, ny, nxnew), dtype=mov.dtype)
-
-    # print(mov.shape)
-    # print(mov_fused.shape)
-    # print(centers)
-
-    for zidx in range(nz):
-        curr_x = 0
-        curr_x_new = 0
-        for i in range(n_seams):
-            # print("  Seam %d" % i)
-            wid = (centers[i] + shift_xs[zidx]) - curr_x
-            # print(wid)
-            # print(curr_x, curr_x_new)
-            # print(mov_fused[zidx, :, :, curr_x_new: curr_x_new + wid - n_skip].shape)
-            # print(wid - n_skip)
-            # print(mov[zidx, :, :, curr_x + n_skip_l: curr_x + wid - n_skip_r].shape)
-            # print(wid - n_skip_r - n_skip_l)
-
-            target_len = mov_fused[
-                zidx, :, :, curr_x_new : curr_x_new + wid - n_skip
-            ].shape[-1]
-            source_len = mov[
-                zidx, :, :, curr_x + n_skip_l : curr_x + wid - n_skip_r
-            ].shape[-1]
-            source_crop = 0
-            if target_len != source_len:
-                source_crop = target_len - source_len
-                # print("\n\n\n\nXXXXXXXXXXXXXXXCropping source by %d" % source_crop)
-            # print(target_len, source_len, source_crop)
-            mov_fused[zidx, :, :, curr_x_new : curr_x_new + wid - n_skip] = mov[
-                zidx, :, :, curr_x + n_skip_l : curr_x + wid - n_skip_r + source_crop
-            ]
-            curr_x_new += wid - n_skip
-            curr_x += wid
 
+    # strips to copy for each plane, executed in one parallel pass
+    x_pieces = [
+        reg_3d.fuse_movie_pieces(n_skip, centers, shift_xs[zidx], nx, nxnew)
+        for zidx in range(nz)
+    ]
+    plan = reg_3d.build_gather_plan(nz, ny, nx, ny, nxnew, x_pieces=x_pieces)
+    mov_fused = reg_3d.execute_gather_plan(n.asarray(mov), plan, ny, nxnew)
     return mov_fused
 
 
@@ -298,7 +400,9 @@ def register_dataset_gpu(
     split_tif_size = params.get("split_tif_size", None)
     n_ch_tif = params.get("n_ch_tif", 30)
     max_rigid_shift = params.get("max_rigid_shift_pix", 75)
+    # None picks the largest batch that fits in the free GPU memory
     gpu_reg_batchsize = params.get("gpu_reg_batchsize", 10)
+    gpu_mem_fraction = params.get("gpu_mem_fraction", 0.8)
     max_shift_nr = params.get("max_shift_nr", 3)
     nr_npad = params.get("nr_npad", 3)
     nr_subpixel = params.get("nr_subpixel", 10)
@@ -405,19 +509,30 @@ def register_dataset_gpu(
         mov_shifted = None
         # print(mov_cpu.shape)
         log_cb("Loaded batch of size %s" % ((str(mov_cpu.shape))), 2)
-        for gpu_batch_idx in range(int(n.ceil(nt / gpu_reg_batchsize))):
-            if max_gpu_batches is not None:
-                if gpu_batch_idx >= max_gpu_batches:
-                    break
-            idx0 = gpu_reg_batchsize * gpu_batch_idx
-            idx1 = min(idx0 + gpu_reg_batchsize, nt)
+        if gpu_reg_batchsize is None:
+            # frames are fused and padded on the GPU to the reference shape
+            nz_reg, ny_reg, nx_reg = ref_2ds.shape
+            frame_bytes = reg_gpu.estimate_rigid_2d_frame_bytes(
+                nz_reg, ny_reg, nx_reg, max_rigid_shift, *mov_cpu.shape[2:]
+            )
+            if nonrigid:
+                frame_bytes += reg_gpu.estimate_nonrigid_2d_frame_bytes(
+                    nz_reg, ref_nr.shape[1], ref_nr.shape[-2:], max_shift_nr, nr_npad
+                )
+            fixed_bytes = mask_mul.nbytes + mask_offset.nbytes + ref_2ds.nbytes
+            fixed_bytes += mask_mul_nr.nbytes + mask_offset_nr.nbytes + ref_nr.nbytes
+            gpu_reg_batchsize = reg_gpu.auto_gpu_batch_size(
+                frame_bytes,
+                fixed_bytes,
+                mem_fraction=gpu_mem_fraction,
+                max_batch_size=nt,
+                log_cb=log_cb,
+            )
+
+        def reg_gpu_batch(batch_size):
+            idx1 = min(idx0 + batch_size, nt)
             log_cb("Sending frames %d-%d to GPU for rigid registration" % (idx0, idx1), 3)
             tic_rigid = time.time()
-
-            # print("######\n\nBEFORE RIGID: 0.5p: %.3f 99.5p: %.3f, Mean: %.3f, Min: %.3f, Max:%.3f" %
-            #        (n.percentile(mov_cpu[10,idx0:idx1],0.5), n.percentile(mov_cpu[10,idx0:idx1],99.5),
-            #         mov_cpu[10,idx0:idx1].mean(), mov_cpu[10,idx0:idx1].min(), mov_cpu[10,idx0:idx1].max()))
-
             mov_shifted_gpu, ymaxs_rr_gpu, xmaxs_rr_gpu, __ = reg_gpu.rigid_2d_reg_gpu(
                 mov_cpu[:, idx0:idx1],
                 mask_mul,
@@ -443,7 +558,6 @@ def register_dataset_gpu(
             log_cb(
                 "Completed rigid registration in %.2f sec" % (time.time() - tic_rigid), 3
             )
-            tic_nonrigid = time.time()
             if nonrigid:
                 ymaxs_nr_gpu, xmaxs_nr_gpu, snrs = reg_gpu.nonrigid_2d_reg_gpu(
                     mov_shifted_gpu,
@@ -465,13 +579,47 @@ def register_dataset_gpu(
                 log_cb(
                     "Computed non-rigid shifts in %.2f sec" % (time.time() - tic_rigid), 3
                 )
-
-                tic_get = time.time()
                 ymaxs_nr_cpu = ymaxs_nr_gpu.get()
                 xmaxs_nr_cpu = xmaxs_nr_gpu.get()
             else:
+                ymaxs_nr_cpu = None
+                xmaxs_nr_cpu = None
+            del mov_shifted_gpu
+            return (
+                idx1,
+                mov_shifted_cpu,
+                ymaxs_rr_gpu,
+                xmaxs_rr_gpu,
+                ymaxs_nr_cpu,
+                xmaxs_nr_cpu,
+            )
+
+        idx0 = 0
+        gpu_batch_idx = 0
+        while idx0 < nt:
+            if max_gpu_batches is not None:
+                if gpu_batch_idx >= max_gpu_batches:
+                    break
+            # print("######\n\nBEFORE RIGID: 0.5p: %.3f 99.5p: %.3f, Mean: %.3f, Min: %.3f, Max:%.3f" %
+            #        (n.percentile(mov_cpu[10,idx0:idx1],0.5), n.percentile(mov_cpu[10,idx0:idx1],99.5),
+            #         mov_cpu[10,idx0:idx1].mean(), mov_cpu[10,idx0:idx1].min(), mov_cpu[10,idx0:idx1].max()))
+
+            with profiling.stage("register_batch") as rec:
+                batch_out, gpu_reg_batchsize = reg_gpu.run_with_oom_backoff(
+                    reg_gpu_batch, gpu_reg_batchsize, log_cb=log_cb
+                )
+                (
+                    idx1,
+                    mov_shifted_cpu,
+                    ymaxs_rr_gpu,
+                    xmaxs_rr_gpu,
+                    ymaxs_nr_cpu,
+                    xmaxs_nr_cpu,
+                ) = batch_out
+                rec.count(frames=idx1 - idx0, nbytes=mov_cpu[:, idx0:idx1].nbytes)
+            tic_get = time.time()
+            if not nonrigid:
                 print("NO NONRIGID\n\n\n")
-                tic_get = time.time()
                 xmaxs_nr_cpu = n.zeros_like(ymaxs_rr_gpu)
                 ymaxs_nr_cpu = n.zeros_like(ymaxs_rr_gpu)
 
@@ -509,21 +657,25 @@ def register_dataset_gpu(
 
             shift_tic = time.time()
             nz = mov_shifted_cpu.shape[1]
-            for zidx in range(nz):
-                if nonrigid:
-                    # print("SHIFITNG: %d" % zidx)
-                    # TODO migrate to suite3D?
-
-                    mov_shifted[zidx, idx0:idx1] = nonrigid_transform_data(
-                        mov_shifted_cpu[:, zidx],
-                        nblocks,
-                        xblock=xblocks,
-                        yblock=yblocks,
-                        ymax1=ymaxs_nr_cpu[:, zidx],
-                        xmax1=xmaxs_nr_cpu[:, zidx],
-                    )
-                else:
-                    mov_shifted[zidx, idx0:idx1] = mov_shifted_cpu[:, zidx]
+            with profiling.stage(
+                "shift_batch", frames=idx1 - idx0, nbytes=mov_shifted_cpu.nbytes
+            ):
+                for zidx in range(nz):
+                    if nonrigid:
+                        # print("SHIFITNG: %d" % zidx)
+                        # TODO migrate to suite3D?
+
+                        shift_frames(
+                            mov_shifted_cpu[:, zidx],
+                            ymax1=ymaxs_nr_cpu[:, zidx],
+                            xmax1=xmaxs_nr_cpu[:, zidx],
+                            nblocks=nblocks,
+                            xblock=xblocks,
+                            yblock=yblocks,
+                            out=mov_shifted[zidx, idx0:idx1],
+                        )
+                    else:
+                        mov_shifted[zidx, idx0:idx1] = mov_shifted_cpu[:, zidx]
 
             # print("######\n\nAFter NONRIGID: 0.5p: %.3f 99.5p: %.3f, Mean: %.3f, Min: %.3f, Max:%.3f" %
             #        (n.percentile(mov_shifted[10,idx0:idx1],0.5), n.percentile(mov_shifted[10,idx0:idx1],99.5),
@@ -544,6 +696,8 @@ def register_dataset_gpu(
             mempool.free_all_blocks()
 
             log_cb("After GPU Batch:", level=3, log_mem_usage=True)
+            idx0 = idx1
+            gpu_batch_idx += 1
 
         concat_t = time.time()
         log_cb("Concatenating movie", 2)
@@ -578,7 +732,11 @@ def register_dataset_gpu(
                 % (str(mov_save.shape), reg_data_path),
                 2,
             )
-            n.save(reg_data_path, mov_save.astype(save_dtype))
+            with profiling.stage("save", frames=mov_save.shape[1]) as rec:
+                mov_save_cast = mov_save.astype(save_dtype)
+                n.save(reg_data_path, mov_save_cast)
+                rec.count(nbytes=mov_save_cast.nbytes)
+                del mov_save_cast
             log_cb("Saved in %.2f sec" % (time.time() - save_t), 3)
             file_idx += 1
         n.save(offset_path, all_offsets)
@@ -639,8 +797,9 @@ def register_dataset_s2p(
                 op['rmin'] = rmins[i]
                 op['rmax'] = rmaxs[i]
             op['snr_thresh'] = params.get("snr_thresh", 1.2)  
+            op['maxregshift'] = params.get("maxregshift", 0.15)
             op['NRsm'] = reference_params["NRsm"]
-            op['yblocks'], op['xblocks'] = reference_params["yblock"], reference_params["xblock"]
+            op['yblock'], op['xblock'] = reference_params["yblock"], reference_params["xblock"]
             op['nblocks'] = reference_params["nblocks"]    
             op['maxregshiftNR'] = params.get("max_shift_nr", 3)
             all_ops.append(op)
@@ -666,6 +825,8 @@ def register_dataset_s2p(
     )
 
     loaded_movs = [0]
+    n_proc_reg = params.get("n_proc_reg", 1)
+    reg_pool = None
 
     def io_thread_loader(tifs, batch_idx):
         log_cb("   [Thread] Loading batch %d \n" % batch_idx, 5)
@@ -687,74 +848,106 @@ def register_dataset_s2p(
     io_thread.start()
 
     file_idx = 0
-    for batch_idx in range(start_batch_idx, n_batches):
-        try:
-            log_cb("Start Batch: ", level=3, log_mem_usage=True)
-            # reg_data_path = reg_data_paths[batch_idx]
-            offset_path = offset_paths[batch_idx]
-            log_cb("Loading Batch %d of %d" % (batch_idx + 1, n_batches), 0)
-            io_thread.join()
-            log_cb("Batch %d IO thread joined" % (batch_idx))
-            log_cb("After IO thread join", level=3, log_mem_usage=True)
-            if enforce_positivity:
-                # print(loaded_movs[0].shape)
-                # print(min_pix_vals.shape)
-                log_cb("Subtracting min vals to enfore positivity", 1)
-                loaded_movs[0] -= min_pix_vals.reshape(len(min_pix_vals), 1, 1, 1)
-                # print(loaded_movs[0].shape
-            mov_pad = reg_gpu.fuse_and_pad(
-                loaded_movs[0], fuse_shift, ypad, xpad, new_xs, old_xs
-            )
-            if do_subtract_crosstalk:
-                mov_pad = utils.crosstalk_subtract(mov_pad, crosstalk_coeff, cavity_size)
-            shmem_mov, shmem_mov_params, mov = utils.create_shmem_from_arr(
-                mov_pad, copy=True
-            )
-            log_cb("After Sharr creation:", level=3, log_mem_usage=True)
-            if batch_idx + 1 < n_batches:
-                log_cb("Launching IO thread for next batch")
-                io_thread = threading.Thread(
-                    target=io_thread_loader, args=(batches[batch_idx + 1], batch_idx + 1)
-                )
-                io_thread.start()
-                log_cb("After IO thread launch:", level=3, log_mem_usage=True)
-            log_cb("Registering Batch %d" % batch_idx, 1)
-
-            log_cb("Before Reg:", level=3, log_mem_usage=True)
-            log_cb()
-            all_offsets = register_mov(mov, refs_and_masks, all_ops, log_cb)
-            if split_tif_size is None:
-                split_tif_size = mov.shape[1]
-            for i in range(0, mov.shape[1], split_tif_size):
-                reg_data_path = os.path.join(
-                    job_reg_data_dir, "fused_reg_data%04d.npy" % file_idx
-                )
-                reg_data_paths.append(reg_data_path)
-                end_idx = min(mov.shape[1], i + split_tif_size)
-                log_cb(
-                    "Saving registered file of shape %s to %s"
-                    % (str(mov[:, i:end_idx].shape), reg_data_path),
-                    2,
-                )
-                n.save(reg_data_path, mov[:, i:end_idx].astype(save_dtype))
-                file_idx += 1
-            n.save(offset_path, all_offsets)
-            log_cb("After reg:", level=3, log_mem_usage=True)
-
-            shmem_mov.close()
-            shmem_mov.unlink()
-            log_cb("After close + unlink shmem:", level=3, log_mem_usage=True)
-            nz, nt, ny, nx = mov.shape
-            n_frames_proc_new = n_frames_proc + nt
-
-            n_cleared = gc.collect()
-            log_cb("Garbage collected %d items" % n_cleared, 2)
-            log_cb("After gc collect: ", level=3, log_mem_usage=True)
-        except Exception as exc:
-            log_cb("Error occured in iteration %d" % batch_idx, 0)
-            tb = traceback.format_exc()
-            log_cb(tb, 0)
-            break
+    # the batch loop only catches Exception, the pool is also closed on KeyboardInterrupt
+    try:
+        # the shared memory batch is reused across batches of the same size
+        with shm.ShmemArena() as arena:
+            for batch_idx in range(start_batch_idx, n_batches):
+                try:
+                    log_cb("Start Batch: ", level=3, log_mem_usage=True)
+                    # reg_data_path = reg_data_paths[batch_idx]
+                    offset_path = offset_paths[batch_idx]
+                    log_cb("Loading Batch %d of %d" % (batch_idx + 1, n_batches), 0)
+                    io_thread.join()
+                    log_cb("Batch %d IO thread joined" % (batch_idx))
+                    log_cb("After IO thread join", level=3, log_mem_usage=True)
+                    if enforce_positivity:
+                        # print(loaded_movs[0].shape)
+                        # print(min_pix_vals.shape)
+                        log_cb("Subtracting min vals to enfore positivity", 1)
+                        loaded_movs[0] -= min_pix_vals.reshape(len(min_pix_vals), 1, 1, 1)
+                        # print(loaded_movs[0].shape
+                    mov_pad = reg_gpu.fuse_and_pad(
+                        loaded_movs[0], fuse_shift, ypad, xpad, new_xs, old_xs
+                    )
+                    if do_subtract_crosstalk:
+                        mov_pad = utils.crosstalk_subtract(
+                            mov_pad, crosstalk_coeff, cavity_size
+                        )
+                    shmem_mov_params, mov = arena.from_arr("reg_batch", mov_pad)
+                    del mov_pad
+                    log_cb("After Sharr creation:", level=3, log_mem_usage=True)
+                    if batch_idx + 1 < n_batches:
+                        log_cb("Launching IO thread for next batch")
+                        io_thread = threading.Thread(
+                            target=io_thread_loader,
+                            args=(batches[batch_idx + 1], batch_idx + 1),
+                        )
+                        io_thread.start()
+                        log_cb("After IO thread launch:", level=3, log_mem_usage=True)
+                    log_cb("Registering Batch %d" % batch_idx, 1)
+
+                    log_cb("Before Reg:", level=3, log_mem_usage=True)
+                    log_cb()
+                    if reg_pool is None and n_proc_reg > 1:
+                        # the pool persists across batches so workers and their
+                        # compiled kernels are reused
+                        n_workers = get_reg_pool_size(
+                            mov.shape, n_proc_reg, nonrigid=nonrigid, log_cb=log_cb
+                        )
+                        if n_workers > 1:
+                            n_threads = max(1, utils.cpu_count() // n_workers)
+                            reg_pool = make_reg_pool(n_workers, n_threads)
+                    with profiling.stage(
+                        "register_batch", frames=mov.shape[1], nbytes=mov.nbytes
+                    ):
+                        all_offsets = register_mov(
+                            mov,
+                            refs_and_masks,
+                            all_ops,
+                            log_cb,
+                            pool=reg_pool,
+                            shmem_params=shmem_mov_params,
+                        )
+                    if split_tif_size is None:
+                        split_tif_size = mov.shape[1]
+                    for i in range(0, mov.shape[1], split_tif_size):
+                        reg_data_path = os.path.join(
+                            job_reg_data_dir, "fused_reg_data%04d.npy" % file_idx
+                        )
+                        reg_data_paths.append(reg_data_path)
+                        end_idx = min(mov.shape[1], i + split_tif_size)
+                        log_cb(
+                            "Saving registered file of shape %s to %s"
+                            % (str(mov[:, i:end_idx].shape), reg_data_path),
+                            2,
+                        )
+                        with profiling.stage("save", frames=end_idx - i) as rec:
+                            mov_save = mov[:, i:end_idx].astype(save_dtype)
+                            n.save(reg_data_path, mov_save)
+                            rec.count(nbytes=mov_save.nbytes)
+                            del mov_save
+                        file_idx += 1
+                    n.save(offset_path, all_offsets)
+                    log_cb("After reg:", level=3, log_mem_usage=True)
+
+                    nz, nt, ny, nx = mov.shape
+                    del mov
+                    n_frames_proc_new = n_frames_proc + nt
+
+                    n_cleared = gc.collect()
+                    log_cb("Garbage collected %d items" % n_cleared, 2)
+                    log_cb("After gc collect: ", level=3, log_mem_usage=True)
+                except Exception as exc:
+                    log_cb("Error occured in iteration %d" % batch_idx, 0)
+                    tb = traceback.format_exc()
+                    log_cb(tb, 0)
+                    break
+    finally:
+        # like leaving a with Pool block, so an interrupt doesn't wait for busy workers
+        if reg_pool is not None:
+            reg_pool.terminate()
+            reg_pool.join()
 
 
 def calculate_corrmap_from_svd(
@@ -960,6 +1153,7 @@ def register_dataset_gpu_3d(
     # choose the top 2% of pix in each plane to run
     # quality metrics on
     top_pix = qm.choose_top_pix(ref_img_3d)
+    reg_metrics = qm.RegistrationMetrics(top_pix, frate_hz)
 
 
     # NOTE TODO the current mask_mul etc is uncropped, so currently calculated here but should be changed in reference_image.py
@@ -995,7 +1189,10 @@ def register_dataset_gpu_3d(
     n_ch_tif = params.get("n_ch_tif", 30)
     max_rigid_shift = params.get("max_rigid_shift_pix", 75)
     apply_z_shift = params.get("apply_z_shift", False)
+    subpixel_shift = params.get("subpixel_shift", None)
+    # None picks the largest batch that fits in the free GPU memory
     gpu_reg_batchsize = params.get("gpu_reg_batchsize", 10)
+    gpu_mem_fraction = params.get("gpu_mem_fraction", 0.8)
     max_shift_nr = params.get("max_shift_nr", 3)
     nr_npad = params.get("nr_npad", 3)
     nr_subpixel = params.get("nr_subpixel", 10)
@@ -1010,6 +1207,9 @@ def register_dataset_gpu_3d(
         save_dtype = n.float32
     elif save_dtype_str == "float16":
         save_dtype = n.float16
+    # numpy or cupy, so the same batched registration runs without a GPU
+    backend = get_backend(params.get("gpu_reg", True))
+    log_cb("Running 3D registration on the %s" % backend.name, 1)
 
     # catch if rmins/rmaxs where not calculate in init_pass
     if rmins is None and rmaxs is None:
@@ -1058,6 +1258,10 @@ def register_dataset_gpu_3d(
             "[Thread] Thread for batch %d ready to join after %2.2f sec \n"
             % (batch_idx, time.time() - tic_thread),
             5,
+            stage="registration_io",
+            batch_idx=batch_idx,
+            duration=time.time() - tic_thread,
+            bytes_read=loaded_mov.nbytes,
         )
         log_cb("   [Thread] After load %d \n" % batch_idx, 5, log_mem_usage=True)
         # log_cb("loaded mov: ")
@@ -1069,7 +1273,13 @@ def register_dataset_gpu_3d(
 
     file_idx = 0
     for batch_idx in range(n_batches):
-        log_cb("Memory at batch %d." % batch_idx, level=3, log_mem_usage=True)
+        log_cb(
+            "Memory at batch %d." % batch_idx,
+            level=3,
+            log_mem_usage=True,
+            stage="registration",
+            batch_idx=batch_idx,
+        )
         offset_path = offset_paths[batch_idx]
         log_cb("Loading Batch %d of %d" % (batch_idx, n_batches - 1), 0)
         io_thread.join()
@@ -1098,41 +1308,68 @@ def register_dataset_gpu_3d(
         # New function has loop over batches as part of registration
 
         time_pre_reg = time.time()
+        if gpu_reg_batchsize is None:
+            nz_raw, __, ny_raw, nx_raw = mov_cpu.shape
+            gpu_reg_batchsize = reg_gpu.auto_gpu_batch_size(
+                reg_gpu.estimate_rigid_3d_frame_bytes(
+                    nz_raw, ny_raw + int(ypad), nx_raw + int(xpad), ny_raw, nx_raw
+                ),
+                fixed_bytes=mask_mul.nbytes + mask_offset.nbytes + ref_2ds.nbytes,
+                free_bytes=backend.free_bytes(),
+                mem_fraction=gpu_mem_fraction,
+                max_batch_size=nt,
+                xp=backend.xp,
+                log_cb=log_cb,
+            )
         # log time it takes
-        phase_corr_shifted, int_shift, pc_peak_loc, sub_pixel_shifts, mov_cpu = (
-            reg_3d.rigid_3d_ref_gpu(
-                mov_cpu,
-                mask_mul,
-                mask_offset,
-                ref_2ds,
-                pc_size,
-                batch_size=gpu_reg_batchsize,  # TODO make xpad/ypad automatically integers
-                rmins=rmins,
-                rmaxs=rmaxs,
-                crosstalk_coeff=crosstalk_coeff,
-                shift_reg=False,
-                xpad=int(xpad),
-                ypad=int(ypad),
-                fuse_shift=fuse_shift,
-                new_xs=new_xs,
-                old_xs=old_xs,
-                plane_shifts=plane_shifts,
-                process_mov=True,
-                cavity_size=cavity_size,
+        with profiling.stage("register_batch", frames=nt, nbytes=mov_cpu.nbytes):
+            phase_corr_shifted, int_shift, pc_peak_loc, sub_pixel_shifts, mov_cpu = (
+                reg_3d.rigid_3d_ref(
+                    mov_cpu,
+                    mask_mul,
+                    mask_offset,
+                    ref_2ds,
+                    pc_size,
+                    batch_size=gpu_reg_batchsize,  # TODO make xpad/ypad automatically integers
+                    rmins=rmins,
+                    rmaxs=rmaxs,
+                    crosstalk_coeff=crosstalk_coeff,
+                    shift_reg=False,
+                    xpad=int(xpad),
+                    ypad=int(ypad),
+                    fuse_shift=fuse_shift,
+                    new_xs=new_xs,
+                    old_xs=old_xs,
+                    plane_shifts=plane_shifts,
+                    process_mov=True,
+                    cavity_size=cavity_size,
+                    log_cb=log_cb,
+                    backend=backend,
+                )
             )
-        )
 
         log_cb(f"Completed rigid reg on batch in :{time.time() - time_pre_reg}s")
 
         time_shift = time.time()
         # shift entire abtch on cpu at once
         # log this info
-        mov_shifted = reg_3d.shift_mov_fast(mov_cpu, -int_shift)
+        with profiling.stage("shift_batch", frames=nt, nbytes=mov_cpu.nbytes):
+            if subpixel_shift is not None:
+                # shifts mov_cpu in place, it isn't used after this
+                mov_shifted = reg_3d.shift_mov_subpixel(
+                    mov_cpu,
+                    int_shift,
+                    sub_pixel_shifts,
+                    method=subpixel_shift,
+                    apply_z_shift=apply_z_shift,
+                )
+            else:
+                mov_shifted = reg_3d.shift_mov_fast(mov_cpu, -int_shift)
 
-        if apply_z_shift:
-            # if there is at least one 
-            if n.max(int_shift[0]) > 1:
-                mov_shifted = reg_3d.shift_mov_z(mov_shifted, int_shift)
+                if apply_z_shift:
+                    # if there is at least one 
+                    if n.max(int_shift[0]) > 1:
+                        mov_shifted = reg_3d.shift_mov_z(mov_shifted, int_shift)
         log_cb(f"Shifted the mov in: {time.time() - time_shift}s")
 
         # NOTE changed this so gets int_shifts + sub_pixel shifts etc
@@ -1163,22 +1400,36 @@ def register_dataset_gpu_3d(
                 % (str(mov_save.shape), reg_data_path),
                 2,
             )
-            n.save(reg_data_path, mov_save.astype(save_dtype))
-            log_cb("Saved in %.2f sec" % (time.time() - save_t), 3)
-
-            metrics_path = os.path.join(
-                job_reg_data_dir, "reg_metrics_%04d.npy" % file_idx
+            with profiling.stage("save", frames=mov_save.shape[1]) as rec:
+                mov_save_cast = mov_save.astype(save_dtype)
+                n.save(reg_data_path, mov_save_cast)
+                rec.count(nbytes=mov_save_cast.nbytes)
+                del mov_save_cast
+            log_cb(
+                "Saved in %.2f sec" % (time.time() - save_t),
+                3,
+                stage="registration_save",
+                batch_idx=batch_idx,
+                duration=time.time() - save_t,
+                bytes_written=mov_save.size * n.dtype(save_dtype).itemsize,
             )
-            mean_img_path = os.path.join(job_reg_data_dir, "mean_img_%04d.npy" % file_idx)
-            log_cb("Computing quality metrics and saving", 2)
 
-            mean_img, metrics = qm.compute_metrics_for_movie(
-                mov_save, frate_hz, top_pix=top_pix
-            )
+            mean_img_path = os.path.join(job_reg_data_dir, "mean_img_%04d.npy" % file_idx)
+            log_cb("Updating quality metrics", 2)
+            metric_t = time.time()
+            mean_img = reg_metrics.add_split(mov_save)
             n.save(mean_img_path, mean_img)
-            n.save(metrics_path, metrics)
+            log_cb("Updated in %.2f sec" % (time.time() - metric_t), 3)
 
             file_idx += 1
         n.save(offset_path, all_offsets)
+        # one table for the whole run, rewritten each batch so it is usable if the run stops early
+        reg_metrics.save(os.path.join(job_reg_data_dir, "reg_metrics.npy"))
 
-        log_cb("After full batch saving:", level=3, log_mem_usage=True)
+        log_cb(
+            "After full batch saving:",
+            level=3,
+            log_mem_usage=True,
+            stage="registration",
+            batch_idx=batch_idx,
+        )
@@ -12,22 +12,23 @@ import itertools
 from multiprocessing import Pool
 import shutil
 from matplotlib import pyplot as plt
+from dask import array as darr
 
 try:
     from skimage.io import imread
 except:
     print("No skimage")
 
-try:
-    import psutil
-except:
-    print("No psutil")
-
 from suite3d import dcnv
 
 from . import utils
 from . import lbmio
+from . import job_log
+from . import profiling
+from . import memory_plan
+from . import shmem
 from .io import get_frame_counts
+from .mov_sub_store import MovSubStore, store_exists
 
 try:
     from . import corrmap
@@ -80,14 +81,16 @@ class Job:
         self.job_id = job_id
         self.summary = None
         self.timers = {}
+        self.cpu_timers = {}
 
         if create:
+            self.init_job_dir(root_dir, job_id, exist_ok=overwrite)
+            # free shared memory left behind by earlier runs that crashed
+            shmem.sweep_once(log_cb=self.log)
             if parent_job is not None:
-                self.init_job_dir(root_dir, job_id, exist_ok=overwrite)
                 return self.copy_parent_job(
                     parent_job, copy_parent_dirs, copy_parent_symlink
                 )
-            self.init_job_dir(root_dir, job_id, exist_ok=overwrite)
             def_params = get_default_params()
             self.log("Loading default params")
             for k, v in params.items():
@@ -104,6 +107,7 @@ class Job:
         else:
             self.job_dir = os.path.join(root_dir, "s3d-%s" % job_id)
             self.load_dirs()
+            shmem.sweep_once(log_cb=self.log)
             self.load_params(params_path=params_path)
             self.tifs = self.params.get("tifs", [])
 
@@ -168,24 +172,55 @@ class Job:
 
     def tic(self, key="default"):
         self.timers[key] = time.time()
+        self.cpu_timers[key] = time.process_time()
 
     def toc(self, key="default", log=True, level=2):
         tx = time.time() - self.timers.get(key, n.nan)
+        if key in self.cpu_timers:
+            # every tic/toc pair is also recorded as a stage by the profiler
+            profiling.PROFILER.add(key, tx, time.process_time() - self.cpu_timers.pop(key))
         if log:
-            # print("logging")
-            self.log(f"Timer {key} completed in {tx:.3f} sec", level=level)
+            self.log(
+                f"Timer {key} completed in {tx:.3f} sec",
+                level=level,
+                stage=key,
+                duration=tx,
+                kind="timer",
+            )
         return tx
 
     def log(
-        self, string="", level=1, logfile=True, log_mem_usage=False, tic=False, toc=False
+        self,
+        string="",
+        level=1,
+        logfile=True,
+        log_mem_usage=False,
+        tic=False,
+        toc=False,
+        stage=None,
+        batch_idx=None,
+        duration=None,
+        bytes_read=None,
+        bytes_written=None,
+        nbytes=None,
+        kind="log",
     ):
-        """Print messages based on current verbosity level
+        """Print messages based on current verbosity level, and record them as events
+        in log.jsonl (and as text in log.txt) in the job directory
 
         Args:
             string (str): String to be printed
             level (int, optional): Level equal or below self.verbosity will be printed. Defaults to 1.
+            logfile (bool, optional): Whether to write the event to the log files. Defaults to True.
+            log_mem_usage (bool, optional): Record current memory usage. Defaults to False.
+            stage (str, optional): Pipeline stage the event belongs to. Defaults to None.
+            batch_idx (int, optional): Index of the batch being processed. Defaults to None.
+            duration (float, optional): Duration in seconds. Defaults to None.
+            bytes_read (int, optional): Number of bytes read. Defaults to None.
+            bytes_written (int, optional): Number of bytes written. Defaults to None.
+            nbytes (int, optional): Number of bytes processed, for profile events. Defaults to None.
+            kind (str, optional): Event kind, 'log', 'timer' or 'profile'. Defaults to 'log'.
         """
-        # print("test", string)
         if tic:
             self.tic(string)
             return
@@ -193,38 +228,46 @@ class Job:
             self.toc(string, level=level + 2)
             return
 
+        event = {"time": time.time(), "kind": kind, "level": level, "message": string}
+        for key, val in (
+            ("stage", stage),
+            ("batch_idx", batch_idx),
+            ("duration", duration),
+            ("bytes_read", bytes_read),
+            ("bytes_written", bytes_written),
+            ("nbytes", nbytes),
+        ):
+            if val is not None:
+                event[key] = val
         if log_mem_usage:
-
-            vm = psutil.virtual_memory()
-            sm = psutil.swap_memory()
-
-            vm_avail = vm.available
-            vm_unavail = vm.total - vm_avail
-
-            total = sm.used + vm_unavail
-            string = "{:<20}".format(string)
-            string += (
-                "Total Used: %07.3f GB, Virtual Available: %07.3f GB, Virtual Used: %07.3f GB, Swap Used: %07.3f GB"
-                % (
-                    (
-                        total / (1024**3),
-                        vm_avail / (1024**3),
-                        vm_unavail / (1024**3),
-                        sm.used / (1024**3),
-                    )
-                )
-            )
+            event["mem"] = job_log.memory_snapshot()
+            string = "{:<20}".format(string) + job_log.format_memory(event["mem"])
 
         if level <= self.verbosity:
-            # print('xxx')
             print(("   " * level) + string)
         if logfile:
-            logfile = os.path.join(self.job_dir, "log.txt")
-            self.logfile = logfile
-            with open(logfile, "a+") as f:
-                datetime_string = datetime.datetime.now().strftime("%Y-%m-%d %H:%M:%S")
-                header = "\n[%s][%02d] " % (datetime_string, level)
-                f.write(header + "   " * level + string)
+            self.get_logger().write(event)
+
+    def get_logger(self):
+        """Buffered writer of this job's log.jsonl and log.txt"""
+        logger = getattr(self, "logger", None)
+        if logger is None or logger.job_dir != self.job_dir:
+            if logger is not None:
+                logger.close()
+            logger = job_log.JobLogger(self.job_dir)
+            self.logger = logger
+            self.logfile = logger.text_path
+        return logger
+
+    def flush_log(self):
+        """Write any buffered log events to disk"""
+        if getattr(self, "logger", None) is not None:
+            self.logger.flush()
+
+    def load_log_events(self, kind=None):
+        """Load the structured events of log.jsonl, see job_log.read_events"""
+        self.flush_log()
+        return job_log.read_events(self.job_dir, kind=kind)
 
     def load_file(
         self, filename, dir_name=None, path=None, allow_pickle=True, mmap_mode=None
@@ -360,6 +403,9 @@ class Job:
             params = self.params
         if new_params is not None:
             params.update(new_params)
+        # the copies record the batch sizes a step ran with, but the main params.npy keeps
+        # the values the user asked for, see plan_memory
+        requested = (params.get("memory_plan") or {}).get("requested", {})
         if copy_dir_tag is not None:
             params_path = os.path.join(self.dirs[copy_dir_tag], "params.npy")
             n.save(params_path, params)
@@ -369,7 +415,7 @@ class Job:
             n.save(params_path, params)
             self.log("Saved a copy of params at %s" % copy_dir)
         if update_main_params:
-            n.save(os.path.join(self.dirs["job_dir"], "params.npy"), params)
+            n.save(os.path.join(self.dirs["job_dir"], "params.npy"), {**params, **requested})
         self.log("Updated main params file")
 
     def load_params(self, dir=None, params_path=None):
@@ -534,6 +580,7 @@ class Job:
             if summary["fuse_shifts"] is not None:
                 utils.plot_fuse_shifts(summary["fuse_shifts"], summary["fuse_ccs"])
 
+    @profiling.profile_job_stage("register")
     def register(self, tifs=None):
         """
         Register the dataset using the method specified in job.params.
@@ -542,6 +589,8 @@ class Job:
             tifs (list): List of tif files to register. If None, uses self.tifs.
             start_batch_idx (int): Starting batch index.
         """
+        if self.params.get("auto_memory_plan", False):
+            self.plan_memory()
         self.make_new_dir("registered_fused_data")
         params = self.params
         summary = self.load_summary()
@@ -556,17 +605,15 @@ class Job:
         self.log(f"Starting registration: 3D: {do_3d_reg}, GPU: {do_gpu_reg}", 1)
 
         if do_3d_reg:
-            if do_gpu_reg:
-                register_dataset_gpu_3d(self, tifs, params, self.dirs, summary, self.log)
-            else:
-                pass
-                # register_dataset_3d(self,tifs, params, self.dirs, summary, self.log, start_batch_idx=start_batch_idx)
+            # the array backend (cupy or numpy) is picked from gpu_reg
+            register_dataset_gpu_3d(self, tifs, params, self.dirs, summary, self.log)
         else:
             if do_gpu_reg:
                 register_dataset_gpu(self, tifs, params, self.dirs, summary, self.log)
             else:
                 register_dataset_s2p(self, tifs, params, self.dirs, summary, self.log)
 
+    @profiling.profile_job_stage("calculate_corr_map")
     def calculate_corr_map(
         self,
         mov=None,
@@ -574,6 +621,7 @@ class Job:
         iter_limit=None,
         output_dir_name=None,
         save_mov_sub=True,
+        svd_info=None,
     ):
         """
         Calculate the correlation map. Saves the correlation map results in
@@ -585,22 +633,39 @@ class Job:
             save (bool, optional): Whether to create dirs and save results. Defaults to True.
             iter_limit (int, optional): Number of batches to run. Set to None for the whole recording. Defaults to None.
             output_dir_name (str, optional): Name of the parent directory to place results in. Defaults to None.
+            svd_info (dict or str, optional): If provided, compute the correlation map directly from the SVD
+                                              factors instead of the movie. No mov_sub is saved in this mode.
         """
-        if save:
-            corr_map_dir = self.make_new_dir("corrmap", parent_dir_name=output_dir_name)
-            mov_sub_dir = self.make_new_dir("mov_sub", parent_dir_name=output_dir_name)
-        else:
-            corr_map_dir = self.make_new_dir("corrmap", parent_dir_name=output_dir_name)
-            mov_sub_dir = self.make_new_dir("mov_sub", parent_dir_name=output_dir_name)
+        corr_map_dir = self.make_new_dir("corrmap", parent_dir_name=output_dir_name)
 
         if self.params.get('detection_timebin') is None:
             self.params['detection_timebin'] = int(n.round(self.params['fs'] / (self.params['tau'])))
             self.log("Updated detection_timebin to %d based on framerate and tau" % self.params['detection_timebin'])
 
+        if svd_info is not None:
+            # the movie is not read and no mov_sub is made in this mode
+            self.save_params(copy_dir=corr_map_dir)
+            self.corrmap = corrmap.calculate_corrmap_from_svd(
+                svd_info,
+                params=self.params,
+                summary=self.load_summary(),
+                batch_dir=corr_map_dir,
+                n_threads=self.params["n_proc_corr"],
+                log=self.log,
+            )
+            return self.corrmap
+
+        mov_sub_dir = self.make_new_dir("mov_sub", parent_dir_name=output_dir_name)
+        if self.params.get("auto_memory_plan", False):
+            # also picks patch_size_xy, which sets the layout of the mov_sub store.
+            # segment_rois takes the layout from the store, so a later plan can't change it
+            self.plan_memory()
+
         if mov is None:
             mov = self.get_registered_movie("registered_fused_data", "fused")
 
         self.save_params(copy_dir=corr_map_dir)
+
         self.corrmap = corrmap.calculate_corrmap(
             mov=mov,
             params=self.params,
@@ -743,6 +808,7 @@ class Job:
         mov=None,
         iter_limit=None,
         save_mov_sub=False,
+        svd_info=None,
     ):
         sweep_summary = self.setup_sweep(
             params_to_sweep, sweep_name, all_combinations=all_combinations
@@ -762,15 +828,14 @@ class Job:
                 save_mov_sub=save_mov_sub,
                 mov=mov,
                 iter_limit=iter_limit,
+                svd_info=svd_info,
             )
             self.log(f"Output mean {corrmap_out.mean()}, std {corrmap_out.std()}")
             results = {"corrmap": corrmap_out, "output_dir": comb_dir_name}
             if comb_idx == 0:
                 maps = self.load_corr_map_results(comb_dir_name)
                 sweep_summary["mean_img"] = maps["mean_img"]
-                sweep_summary["max_img"] = maps["max_img"]
-                sweep_summary["mean_img"] = maps["mean_img"]
-                sweep_summary["max_img"] = maps["max_img"]
+                sweep_summary["max_img"] = maps.get("max_img")
 
             sweep_summary["results"].append(results)
             self.save_file("sweep_summary", sweep_summary, path=sweep_dir_path)
@@ -866,6 +931,7 @@ class Job:
             )
         return stack_dirs
 
+    @profiling.profile_job_stage("segment_rois")
     def segment_rois(
         self,
         input_dir_name=None,
@@ -886,6 +952,10 @@ class Job:
 
         # load the results of the correlation map step
         mov_sub = self.get_subtracted_movie(parent_dir_name=input_dir_name, astype=None)
+        mov_sub_key = "mov_sub" if input_dir_name is None else input_dir_name + "-mov_sub"
+        mov_sub_store = None
+        if store_exists(self.dirs[mov_sub_key]):
+            mov_sub_store = MovSubStore.open(self.dirs[mov_sub_key])
         maps = self.load_corr_map_results(parent_dir_name=input_dir_name)
         if vmap is None:
             local_thresh = self.params.get('local_thresh', True)
@@ -925,6 +995,10 @@ class Job:
         # get the coordinates to split the movie into patches
         patch_size_xy = self.params["patch_size_xy"]
         patch_overlap_xy = self.params["patch_overlap_xy"]
+        if mov_sub_store is not None and self.params.get("auto_memory_plan", False):
+            # the patch size was planned when calculate_corr_map wrote the store
+            patch_size_xy = mov_sub_store.patch_size_xy
+            patch_overlap_xy = mov_sub_store.patch_overlap_xy
         nt, nz, ny, nx = mov_sub.shape
         patches, grid_shape = svu.make_blocks(
             (nz, ny, nx), (nz,) + patch_size_xy, (0,) + patch_overlap_xy
@@ -936,6 +1010,13 @@ class Job:
             nonoverlapping_mask=True,
         )
         n_patches = patches.shape[1]
+        # if corrmap stored mov_sub in the same patches, each patch is memory-mapped directly
+        use_store_patches = mov_sub_store is not None and mov_sub_store.matches(
+            patch_size_xy, patch_overlap_xy
+        )
+        if use_store_patches:
+            patches = mov_sub_store.patches
+            patches_vmap = mov_sub_store.patches_nonoverlap
 
         # optional argument to segment only some patches
         if patches_to_segment is None:
@@ -943,68 +1024,79 @@ class Job:
 
         # loop through all patches and segment them
         patch_counter = 1
-        for patch_idx in patches_to_segment:
-            self.log(
-                "Detecting from patch %d / %d" % (patch_counter, len(patches_to_segment)),
-                1,
-            )
+        # the shared memory patch buffer is reused by every patch that fits in it
+        with shmem.ShmemArena() as arena:
+            for patch_idx in patches_to_segment:
+                self.log(
+                    "Detecting from patch %d / %d" % (patch_counter, len(patches_to_segment)),
+                    1,
+                )
 
-            # set up the save directory for this patch
-            patch_dir = self.make_new_dir(
-                "patch-%04d" % patch_idx, segmentation_dir_tag, add_to_dirs=False
-            )
-            stats_path = os.path.join(patch_dir, "stats.npy")
-            info_path = os.path.join(patch_dir, "info.npy")
+                # set up the save directory for this patch
+                patch_dir = self.make_new_dir(
+                    "patch-%04d" % patch_idx, segmentation_dir_tag, add_to_dirs=False
+                )
+                stats_path = os.path.join(patch_dir, "stats.npy")
+                info_path = os.path.join(patch_dir, "info.npy")
 
-            zs, ys, xs = patches[:, patch_idx]
-            vzs, vys, vxs = patches_vmap[:, patch_idx]
+                zs, ys, xs = patches[:, patch_idx]
+                vzs, vys, vxs = patches_vmap[:, patch_idx]
 
-            # prepare the movie
-            mov_patch = mov_sub[
-                ts[0] : ts[1], zs[0] : zs[1], ys[0] : ys[1], xs[0] : xs[1]
-            ]
-            if self.params["segmentation_timebin"] > 1:
+                # prepare the movie
+                if use_store_patches:
+                    mov_patch = mov_sub_store.patch(patch_idx)[ts[0] : ts[1]]
+                else:
+                    mov_patch = mov_sub[
+                        ts[0] : ts[1], zs[0] : zs[1], ys[0] : ys[1], xs[0] : xs[1]
+                    ]
+                if self.params["segmentation_timebin"] > 1:
+                    self.log(
+                        "Binning movie with a factor of %.2f"
+                        % self.params["segmentation_timebin"],
+                        2,
+                    )
+                    mov_patch = ext.binned_mean(
+                        mov_patch, self.params["segmentation_timebin"]
+                    )
                 self.log(
-                    "Binning movie with a factor of %.2f"
-                    % self.params["segmentation_timebin"],
-                    2,
+                    "Loading %.2f GB movie to memory, shape: %s "
+                    % (mov_patch.nbytes / 1024**3, str(mov_patch.shape)),
+                    3,
                 )
-                mov_patch = ext.binned_mean(
-                    mov_patch, self.params["segmentation_timebin"]
-                )
-            self.log(
-                "Loading %.2f GB movie to memory, shape: %s "
-                % (mov_patch.nbytes / 1024**3, str(mov_patch.shape)),
-                3,
-            )
-            mov_patch = mov_patch.compute()
-            mov_patch = mov_patch.astype(n.float32)
-            self.log("Loaded", 3)
-
-            # prepare the correlation map
-            vmap_patch = n.zeros_like(mov_patch[0])
-            dz = vzs[0] - zs[0]
-            dy = vys[0] - ys[0]
-            dx = vxs[0] - xs[0]
-            vmap_patch[
-                dz : dz + (vzs[1] - vzs[0]),
-                dy : dy + (vys[1] - vys[0]),
-                dx : dx + (vxs[1] - vxs[0]),
-            ] = vmap[vzs[0] : vzs[1], vys[0] : vys[1], vxs[0] : vxs[1]]
-
-            mini_info = {"vmap": vmap_patch}
-
-            stats = ext.detect_cells_mp(
-                mov_patch,
-                vmap_patch,
-                **self.params,
-                log=self.log,
-                savepath=stats_path,
-                patch_idx=patch_idx,
-                offset=(zs[0], ys[0], xs[0]),
-            )
-            n.save(info_path, mini_info)
-            patch_counter += 1
+                # memory-mapped patches are converted to the storage dtype when
+                # detect_cells_mp copies them into shared memory
+                if hasattr(mov_patch, "compute"):
+                    mov_patch = mov_patch.compute()
+                self.log("Loaded", 3)
+
+                # prepare the correlation map
+                vmap_patch = n.zeros_like(mov_patch[0])
+                dz = vzs[0] - zs[0]
+                dy = vys[0] - ys[0]
+                dx = vxs[0] - xs[0]
+                vmap_patch[
+                    dz : dz + (vzs[1] - vzs[0]),
+                    dy : dy + (vys[1] - vys[0]),
+                    dx : dx + (vxs[1] - vxs[0]),
+                ] = vmap[vzs[0] : vzs[1], vys[0] : vys[1], vxs[0] : vxs[1]]
+
+                mini_info = {"vmap": vmap_patch}
+
+                with profiling.stage(
+                    "detect_patch", frames=mov_patch.shape[0], nbytes=mov_patch.nbytes
+                ):
+                    stats = ext.detect_cells_mp(
+                        mov_patch,
+                        vmap_patch,
+                        **self.params,
+                        log=self.log,
+                        savepath=stats_path,
+                        patch_idx=patch_idx,
+                        offset=(zs[0], ys[0], xs[0]),
+                        arena=arena,
+                    )
+                n.save(info_path, mini_info)
+                patch_counter += 1
 
         # combine all segmented patches
         rois_dir_path = self.combine_patches(
@@ -1112,11 +1204,12 @@ class Job:
             self.save_file(data=data, filename=result, path=full_export_path)
             self.log("Saved %s to %s" % (result, full_export_path), 2)
 
+    @profiling.profile_job_stage("extract_and_deconvolve")
     def extract_and_deconvolve(
         self,
         patch_idx=None,
         mov=None,
-        batchsize_frames=500,
+        batchsize_frames=None,
         stats=None,
         offset=None,
         n_frames=None,
@@ -1129,6 +1222,10 @@ class Job:
         crop=True,
         mov_shape_tfirst=False,
     ):
+        if self.params.get("auto_memory_plan", False):
+            self.plan_memory()
+        if batchsize_frames is None:
+            batchsize_frames = self.params.get("extract_batchsize_frames", 500)
         self.save_params()
         if stats_dir is None and patch_idx is not None:
             stats_dir = self.get_patch_dir(patch_idx, parent_dir_name=parent_dir_name)
@@ -1159,13 +1256,15 @@ class Job:
 
         # return stats
         if mov is None:
+            # extraction reads the movie in batches, which stay in the storage dtype
+            # and are accumulated in float32 (see precision.py)
             if not mov_shape_tfirst:
                 mov = self.get_registered_movie(
-                    "registered_fused_data", "fused", edge_crop=False
+                    "registered_fused_data", "fused", edge_crop=False, astype=None
                 )
             else:
                 mov = self.get_registered_movie(
-                    "registered_fused_data", "fused", axis=0, edge_crop=False
+                    "registered_fused_data", "fused", axis=0, edge_crop=False, astype=None
                 )
         if crop and self.params["svd_crop"] is not None:
             cz, cy, cx = self.params["svd_crop"]
@@ -1220,32 +1319,47 @@ class Job:
             )
             n.save(os.path.join(save_dir, "F.npy"), F_roi)
             n.save(os.path.join(save_dir, "Fneu.npy"), F_neu)
+            del F_roi, F_neu
+            F_dir = save_dir
         else:
-            F_roi = n.load(os.path.join(stats_dir, "F.npy"))
-            F_neu = n.load(os.path.join(stats_dir, "Fneu.npy"))
+            F_dir = stats_dir
 
         self.log("Deconvolving")
-        F_sub = F_roi - F_neu * self.params.get("npil_coeff", 0.7)
-        dcnv_baseline = self.params.get("dcnv_baseline", "maximin")
-        dcnv_win_baseline = self.params.get("dcnv_win_baseline", 60)
-        dcnv_sig_baseline = self.params.get("dcnv_sig_baseline", 10)
-        dcnv_prctile_baseline = self.params.get("dcnv_prctile_baseline", 8)
-        dcnv_batchsize = self.params.get("dcnv_batchsize", 3000)
-        tau = self.params.get("tau", 1.3)
-        F_sub = dcnv.preprocess(
-            F_sub,
-            dcnv_baseline,
-            dcnv_win_baseline,
-            dcnv_sig_baseline,
-            self.params["fs"],
-            dcnv_prctile_baseline,
+        # F and Fneu are streamed from disk in chunks of dcnv_batchsize rois, and spks is
+        # written straight to disk
+        F_roi = n.load(os.path.join(F_dir, "F.npy"), mmap_mode="r")
+        F_neu = n.load(os.path.join(F_dir, "Fneu.npy"), mmap_mode="r")
+        spks = n.lib.format.open_memmap(
+            os.path.join(save_dir, "spks.npy"),
+            mode="w+",
+            dtype=n.float32,
+            shape=F_roi.shape,
         )
-        spks = dcnv.oasis(F_sub, batch_size=dcnv_batchsize, tau=tau, fs=self.params["fs"])
-
-        self.log("Saving to %s" % save_dir)
-        n.save(os.path.join(save_dir, "spks.npy"), spks)
+        with dcnv.DeconvolutionEngine(
+            F_roi.shape[1],
+            tau=self.params.get("tau", 1.3),
+            fs=self.params["fs"],
+            baseline=self.params.get("dcnv_baseline", "maximin"),
+            win_baseline=self.params.get("dcnv_win_baseline", 60),
+            sig_baseline=self.params.get("dcnv_sig_baseline", 10),
+            prctile_baseline=self.params.get("dcnv_prctile_baseline", 8),
+            n_proc=self.params.get("n_proc", 1),
+        ) as engine, profiling.stage(
+            "deconvolve", nbytes=2 * F_roi.nbytes
+        ):
+            engine.deconvolve(
+                F_roi,
+                F_neu,
+                npil_coeff=self.params.get("npil_coeff", 0.7),
+                out=spks,
+                batch_size=self.params.get("dcnv_batchsize", 3000),
+                log_cb=self.log,
+            )
+        spks.flush()
+        self.log("Saved to %s" % save_dir)
+        del spks, F_roi, F_neu
 
-        return self.get_traces(patch_dir=save_dir)
+        return self.get_traces(patch_dir=save_dir, mmap_mode="r")
 
     def get_patch_dir(self, patch_idx=0, parent_dir_name="detection"):
         if type(patch_idx) == str:
@@ -1362,13 +1476,17 @@ class Job:
         info = n.load(os.path.join(patch_dir, "info.npy"), allow_pickle=True).item()
         return stats, info
 
-    def get_traces(self, patch_idx=0, parent_dir_name="detection", patch_dir=None):
+    def get_traces(
+        self, patch_idx=0, parent_dir_name="detection", patch_dir=None, mmap_mode=None
+    ):
         if patch_dir is None:
             patch_dir = self.get_patch_dir(patch_idx, parent_dir_name=parent_dir_name)
         traces = {}
         for filename in ["F.npy", "Fneu.npy", "spks.npy"]:
             if filename in os.listdir(patch_dir):
-                traces[filename[:-4]] = n.load(os.path.join(patch_dir, filename))
+                traces[filename[:-4]] = n.load(
+                    os.path.join(patch_dir, filename), mmap_mode=mmap_mode
+                )
         return traces
 
     def get_registered_files(
@@ -1488,6 +1606,23 @@ class Job:
             fused_files = n.concatenate(fused_files, axis=1)
         return fused_files
 
+    def apply_svd_crop(self, mov, mov_shape_tfirst=False):
+        """Crop mov (nz, nt, ny, nx, or nt, nz, ny, nx if mov_shape_tfirst) to params['svd_crop']"""
+        crop = self.params.get("svd_crop", None)
+        if crop is None:
+            return mov
+        zyx = (
+            slice(crop[0][0], crop[0][1]),
+            slice(crop[1][0], crop[1][1]),
+            slice(crop[2][0], crop[2][1]),
+        )
+        if not mov_shape_tfirst:
+            mov = mov[zyx[0], :, zyx[1], zyx[2]]
+        else:
+            mov = mov[:, zyx[0], zyx[1], zyx[2]]
+        self.log("Cropped to size %s" % str(mov.shape))
+        return mov
+
     def svd_decompose_movie(
         self, svd_dir_tag, run_svd=True, end_batch=None, mov=None, mov_shape_tfirst=False
     ):
@@ -1504,23 +1639,7 @@ class Job:
                     "registered_fused_data", "fused", axis=0, edge_crop=False
                 )
             self.log("Loaded mov of size %s" % str(mov.shape))
-        if self.params.get("svd_crop", None) is not None:
-            crop = self.params["svd_crop"]
-            if not mov_shape_tfirst:
-                mov = mov[
-                    crop[0][0] : crop[0][1],
-                    :,
-                    crop[1][0] : crop[1][1],
-                    crop[2][0] : crop[2][1],
-                ]
-            else:
-                mov = mov[
-                    :,
-                    crop[0][0] : crop[0][1],
-                    crop[1][0] : crop[1][1],
-                    crop[2][0] : crop[2][1],
-                ]
-            self.log("Cropped to size %s" % str(mov.shape))
+        mov = self.apply_svd_crop(mov, mov_shape_tfirst)
         if self.params.get("svd_time_crop", None) is not None:
             svd_time_crop = self.params.get("svd_time_crop", None)
             if not mov_shape_tfirst:
@@ -1532,30 +1651,108 @@ class Job:
         if self.params.get("svd_pix_chunk") is None:
             self.params["svd_pix_chunk"] = n.product(self.params["svd_block_shape"]) // 2
         if self.params.get("svd_time_chunk") is None:
-            self.params["svd_save_time_chunk"] = 4000
+            self.params["svd_time_chunk"] = 4000
         if self.params.get("svd_save_time_chunk") is None:
-            self.params["svd_save_comp_chunk"] = 400
+            self.params["svd_save_time_chunk"] = 400
         if self.params.get("svd_save_comp_chunk") is None:
-            self.params["svd_comp_chunk"] = 100
+            self.params["svd_save_comp_chunk"] = 100
         if self.params.get("n_svd_blocks_per_batch") is None:
             self.params["n_svd_blocks_per_batch"] = 16
+
+        svd_plan = None
+        client = None
+        if self.params.get("svd_auto_plan", False):
+            svd_plan = svu.plan_svd_resources(
+                mov.shape,
+                self.params["svd_block_shape"],
+                self.params["svd_block_overlaps"],
+                self.params["n_svd_comp"],
+                flip_shape=mov_shape_tfirst,
+                mem_budget_gb=self.params.get("svd_mem_budget_gb", None),
+                log_cb=self.log,
+            )
+            self.params["svd_pix_chunk"] = svd_plan["pix_chunk"]
+            self.params["svd_time_chunk"] = svd_plan["t_chunk"]
+            self.params["n_svd_blocks_per_batch"] = svd_plan["n_svd_blocks_per_batch"]
         self.save_params(copy_dir_tag=svd_dir_tag)
+        if self.params.get("svd_method", "dask") == "streaming":
+            svd_info = svu.block_and_svd_streaming(
+                mov,
+                n_comp=self.params["n_svd_comp"],
+                block_shape=self.params["svd_block_shape"],
+                block_overlaps=self.params["svd_block_overlaps"],
+                t_batch_size=self.params.get("svd_stream_t_batch_size", 1000),
+                n_power_iter=self.params.get("svd_n_power_iter", 2),
+                n_oversample=self.params.get("svd_n_oversample", 20),
+                t_save_chunk=self.params["svd_save_time_chunk"],
+                comp_chunk=self.params["svd_save_comp_chunk"],
+                log_cb=self.log,
+                flip_shape=mov_shape_tfirst,
+                svd_dir=svd_dir,
+                run_svd=run_svd,
+                mem_budget_gb=self.params.get("svd_mem_budget_gb", None),
+            )
+            return svd_info
         # return
-        svd_info = svu.block_and_svd(
+        if svd_plan is not None and run_svd and self.params.get("svd_use_dask_cluster", False):
+            client = svu.start_svd_cluster(svd_plan, log_cb=self.log)
+        try:
+            svd_info = svu.block_and_svd(
+                mov,
+                n_comp=self.params["n_svd_comp"],
+                block_shape=self.params["svd_block_shape"],
+                block_overlaps=self.params["svd_block_overlaps"],
+                pix_chunk=self.params["svd_pix_chunk"],
+                t_chunk=self.params["svd_time_chunk"],
+                t_save_chunk=self.params["svd_save_time_chunk"],
+                comp_chunk=self.params["svd_save_comp_chunk"],
+                n_svd_blocks_per_batch=self.params["n_svd_blocks_per_batch"],
+                log_cb=self.log,
+                end_batch=end_batch,
+                flip_shape=mov_shape_tfirst,
+                svd_dir=svd_dir,
+                run_svd=run_svd,
+                svd_plan=svd_plan,
+                scheduler=None if client is not None else "threads",
+            )
+        finally:
+            if client is not None:
+                client.close()
+                client.cluster.close()
+        return svd_info
+
+    def svd_update_movie(
+        self, svd_dir_tag, files=None, mov=None, mov_shape_tfirst=False, t_batch_size=500
+    ):
+        """
+        Add newly registered frames to an existing SVD (from svd_decompose_movie) without
+        recomputing it. The new frames are appended to the end of the decomposed movie.
+
+        Args:
+            svd_dir_tag (str): dir tag of the directory containing svd_info.npy
+            files (list, optional): paths to the new registered (fused) .npy files
+            mov (ndarray or dask array, optional): the new frames, used if files is None
+            mov_shape_tfirst (bool, optional): True if the new movie is nt, nz, ny, nx
+            t_batch_size (int, optional): number of frames added to the SVD at once. Defaults to 500.
+
+        Returns:
+            dict: updated svd_info
+        """
+        svd_dir = self.dirs[svd_dir_tag]
+        if mov is None:
+            assert files is not None, "Provide either the new files or the new movie"
+            astype = None
+            if self.params.get("save_dtype", "float32") in ("float16", n.float16):
+                astype = n.float32
+            mov = utils.npy_to_dask(files, axis=0 if mov_shape_tfirst else 1, astype=astype)
+            self.log("Loaded new mov of size %s" % str(mov.shape))
+        mov = self.apply_svd_crop(mov, mov_shape_tfirst)
+        svd_info = svu.update_block_and_svd(
             mov,
-            n_comp=self.params["n_svd_comp"],
-            block_shape=self.params["svd_block_shape"],
-            block_overlaps=self.params["svd_block_overlaps"],
-            pix_chunk=self.params["svd_pix_chunk"],
-            t_chunk=self.params["svd_time_chunk"],
-            t_save_chunk=self.params["svd_save_time_chunk"],
-            comp_chunk=self.params["svd_save_comp_chunk"],
-            n_svd_blocks_per_batch=self.params["n_svd_blocks_per_batch"],
-            log_cb=self.log,
-            end_batch=end_batch,
+            svd_dir,
+            t_batch_size=t_batch_size,
             flip_shape=mov_shape_tfirst,
-            svd_dir=svd_dir,
-            run_svd=run_svd,
+            log_cb=self.log,
         )
         return svd_info
 
@@ -1575,11 +1772,13 @@ class Job:
         axis=1,
         edge_crop=False,
         edge_crop_npix=None,
+        astype="auto",
     ):
         paths = self.get_registered_files(key, filename_filter)
-        astype = None
-        if self.params.get("save_dtype", "float32") in ("float16", n.float16):
-            astype = n.float32
+        if astype == "auto":
+            astype = None
+            if self.params.get("save_dtype", "float32") in ("float16", n.float16):
+                astype = n.float32
         mov_reg = utils.npy_to_dask(paths, axis=axis, astype=astype)
         if edge_crop:
             mov_reg = self.edge_crop_movie(mov_reg, edge_crop_npix=edge_crop_npix)
@@ -1601,6 +1800,14 @@ class Job:
             if self.params["save_dtype"] == "float16":
                 astype = n.float32
 
+        if store_exists(self.dirs[key]):
+            store = MovSubStore.open(self.dirs[key])
+            self.mov_sub = darr.from_array(
+                store, chunks=(self.params["t_batch_size"],) + store.shape[1:]
+            )
+            if astype is not None:
+                self.mov_sub = self.mov_sub.astype(astype)
+            return self.mov_sub
         paths = self.get_registered_files(key, filename_filter)
         self.mov_sub = utils.npy_to_dask(paths, axis=0, astype=astype)
         return self.mov_sub
@@ -1818,54 +2025,20 @@ class Job:
         return v
 
     def get_logged_mem_usage(self):
-        mem_log_lines = []
-        with open(self.logfile, "r") as logf:
-            lines = logf.readlines()
-            for line in lines:
-                if line.find("Virtual Available") > -1:
-                    mem_log_lines.append(line)
-
-        timestamps = []
-        used_mem = []
-        used_swp = []
-        used_vrt = []
-        avail_vrt = []
-        descriptors = []
-
-        for line in mem_log_lines:
-            try:
-                tstamp = datetime.datetime.strptime(line[1:20], "%Y-%m-%d %H:%M:%S")
-                timestamps.append(tstamp)
-            except:
-                # print("Could not parse line %s" % line)
-                continue
+        """
+        Memory usage recorded by log(..., log_mem_usage=True) calls
 
-            tag = "Total Used: "
-            num_len = 7
-            num_idx = line.find(tag) + len(tag)
-            num_str = line[num_idx : num_idx + 7]
-            num_float = float(num_str)
-            used_mem.append(num_float)
-
-            descriptors.append(line[25 : num_idx - len(tag)].strip())
-
-            tag = "Swap Used: "
-            num_idx = line.find(tag) + len(tag)
-            num_str = line[num_idx : num_idx + 7]
-            num_float = float(num_str)
-            used_swp.append(num_float)
-
-            tag = "Virtual Used: "
-            num_idx = line.find(tag) + len(tag)
-            num_str = line[num_idx : num_idx + 7]
-            num_float = float(num_str)
-            used_vrt.append(num_float)
-
-            tag = "Virtual Available: "
-            num_idx = line.find(tag) + len(tag)
-            num_str = line[num_idx : num_idx + 7]
-            num_float = float(num_str)
-            avail_vrt.append(num_float)
+        Returns:
+            tuple: timestamps, used_mem, used_swp, used_vrt, avail_vrt (in GB) and descriptors
+        """
+        events = [e for e in self.load_log_events() if "total_used" in e.get("mem", {})]
+        gb = 1024**3
+        timestamps = [datetime.datetime.fromtimestamp(e["time"]) for e in events]
+        used_mem = [e["mem"]["total_used"] / gb for e in events]
+        used_swp = [e["mem"]["swap_used"] / gb for e in events]
+        used_vrt = [e["mem"]["vm_used"] / gb for e in events]
+        avail_vrt = [e["mem"]["vm_available"] / gb for e in events]
+        descriptors = [e["message"].strip() for e in events]
 
         return timestamps, used_mem, used_swp, used_vrt, avail_vrt, descriptors
 
@@ -1909,7 +2082,7 @@ class Job:
     # TODO add a non-rigid = False so can load rigid-only data
     def load_registration_results(self, offset_dir="registered_fused_data", n_files=None):
         offset_files = self.get_registered_files(offset_dir, "offsets")
-        metric_Files = self.get_registered_files(offset_dir, "reg_metrics")
+        metric_Files = self.get_registered_files(offset_dir, "reg_metrics_")
         n_offset_files = len(offset_files)
         summary = self.load_summary()
         nyb, nxb = summary["reference_params"]["block_size"]
@@ -1938,12 +2111,82 @@ class Job:
             # nonrigid_xs.append(offset['xmaxs_nr'].reshape(-1,nz, nyb, nxb))
             # nonrigid_ys.append(offset['ymaxs_nr'].reshape(-1,nz, nyb, nxb))
         results["metrics"] = all_metrics
+        metrics_path = os.path.join(self.dirs[offset_dir], "reg_metrics.npy")
+        if os.path.exists(metrics_path):
+            results["metrics"] = n.load(metrics_path, allow_pickle=True).item()
         return results
 
     def get_plane_shifts(self):
         summary = self.load_summary()
         return summary["plane_shifts"]
 
+    def plan_memory(self, mem_budget_gb=None, apply=True):
+        """
+        Choose batch sizes (tif_batch_size, split_tif_size, t_batch_size, mproc_batchsize,
+        patch_size_xy and extract_batchsize_frames) so each step fits in a RAM budget, see
+        memory_plan.plan_memory. Needs the results of the init pass.
+
+        The values the user asked for are kept in params['memory_plan']['requested'] and
+        every plan starts from them, so a plan made while little RAM was free does not
+        shrink the later ones. The planned values are used by this Job, but params.npy keeps
+        the requested ones (see save_params). A value changed by hand since the last plan
+        becomes the new requested value.
+
+        Args:
+            mem_budget_gb (float, optional): RAM to use. Defaults to params['mem_budget_gb'],
+                                             or 80% of the available RAM if that is None.
+            apply (bool, optional): update job.params with the plan. Defaults to True.
+
+        Returns:
+            dict: the plan, also saved in params['memory_plan'] if apply is True
+        """
+        if mem_budget_gb is None:
+            mem_budget_gb = self.params.get("mem_budget_gb", None)
+        previous = self.params.get("memory_plan") or {}
+        requested = dict(previous.get("requested", {}))
+        for key in memory_plan.PLANNED_PARAMS:
+            if key in self.params and (
+                key not in requested or self.params[key] != previous["params"].get(key)
+            ):
+                requested[key] = self.params[key]
+        summary = self.load_summary()
+        raw_vol_shape = summary["raw_img"].shape
+        nz, ny, nx = raw_vol_shape
+        # the registered volume is fused and padded as in register_gpu.fuse_and_pad
+        n_stitches = len(summary["new_xs"]) - 1
+        vol_shape = (
+            nz,
+            ny + int(n.sum(summary["ypad"])),
+            nx + int(n.sum(summary["xpad"])) - n_stitches * summary["fuse_shift"],
+        )
+        n_ch_tif = self.params.get("n_ch_tif", 30)
+        num_colors = self.params.get("num_colors", 1) if not self.params["lbm"] else 1
+        tif_infos = [memory_plan.get_tif_info(tif, n_ch_tif) for tif in self.tifs]
+        nt_total = sum(info[0] for info in tif_infos) // num_colors
+        nt_tif = max(info[0] for info in tif_infos) // num_colors
+        tif_info = (nt_tif,) + tif_infos[0][1:]
+        n_rois = 0
+        stats_path = os.path.join(self.dirs.get("rois", ""), "stats.npy")
+        if os.path.exists(stats_path):
+            n_rois = len(n.load(stats_path, allow_pickle=True))
+
+        plan = memory_plan.plan_memory(
+            {**self.params, **requested},
+            vol_shape,
+            raw_vol_shape,
+            tif_info,
+            nt_total,
+            n_rois=n_rois,
+            mem_budget_gb=mem_budget_gb,
+            log_cb=self.log,
+        )
+        plan["requested"] = requested
+        if apply:
+            self.params.update(plan["params"])
+            self.params["memory_plan"] = plan
+            self.save_params()
+        return plan
+
 
     def get_cwd(self):
         print(os.getcwd())
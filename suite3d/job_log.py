@@ -0,0 +1,310 @@
+import os
+import json
+import time
+import datetime
+import threading
+import atexit
+import weakref
+
+try:
+    import psutil
+except ImportError:
+    psutil = None
+
+try:
+    import cupy as cp
+except ImportError:
+    cp = None
+
+# Structured job log. Every call to Job.log is one event, a dict written as a line of
+# log.jsonl in the job directory. The human-readable log.txt is rendered from the same
+# events, and memory plots read the numbers back from log.jsonl instead of parsing text.
+# Both files are kept open and written through a buffer. Events of level 0 and 1 and
+# memory events are flushed immediately, the rest every flush_every events or by a
+# background thread after flush_interval seconds, and everything when the process exits.
+# Buffers are flushed before a fork, so child processes don't write the parent's events.
+
+EVENTS_FILE = "log.jsonl"
+TEXT_FILE = "log.txt"
+GB = 1024**3
+
+
+def memory_snapshot(gpu=True):
+    """
+    Current memory usage of the machine and of this process, in bytes
+
+    Args:
+        gpu (bool, optional): include the cupy memory pool if cupy is installed. Defaults to True.
+
+    Returns:
+        dict: rss, vm_available, vm_used, swap_used, total_used and optionally gpu_used, gpu_total
+    """
+    mem = {}
+    if psutil is not None:
+        vm = psutil.virtual_memory()
+        sm = psutil.swap_memory()
+        mem["rss"] = psutil.Process().memory_info().rss
+        mem["vm_available"] = vm.available
+        mem["vm_used"] = vm.total - vm.available
+        mem["swap_used"] = sm.used
+        mem["total_used"] = sm.used + mem["vm_used"]
+    if gpu and cp is not None:
+        try:
+            pool = cp.get_default_memory_pool()
+            mem["gpu_used"] = pool.used_bytes()
+            mem["gpu_total"] = pool.total_bytes()
+        except Exception:
+            pass
+    return mem
+
+
+class PeakMemorySampler:
+    """
+    Samples the RSS of this process and its children in a background thread and keeps
+    the peak. Used as a context manager around a stage. Records nothing without psutil.
+    """
+
+    def __init__(self, interval=0.05):
+        self.interval = interval
+        self.peak = 0
+        self.start_rss = 0
+        self.running = False
+        self.thread = None
+
+    def rss(self):
+        proc = psutil.Process()
+        rss = proc.memory_info().rss
+        for child in proc.children(recursive=True):
+            try:
+                rss += child.memory_info().rss
+            except psutil.Error:
+                pass
+        return rss
+
+    def sample(self):
+        while self.running:
+            self.peak = max(self.peak, self.rss())
+            time.sleep(self.interval)
+
+    def __enter__(self):
+        if psutil is not None:
+            self.start_rss = self.rss()
+            self.peak = self.start_rss
+            self.running = True
+            self.thread = threading.Thread(target=self.sample, daemon=True)
+            self.thread.start()
+        return self
+
+    def __exit__(self, *exc):
+        if self.thread is not None:
+            self.running = False
+            self.thread.join()
+            self.peak = max(self.peak, self.rss())
+        return False
+
+
+def format_memory(mem):
+    """Text summary of a memory_snapshot, in the format used by log.txt"""
+    if "total_used" not in mem:
+        return "Memory usage unavailable (no psutil)"
+    string = (
+        "Total Used: %07.3f GB, Virtual Available: %07.3f GB, Virtual Used: %07.3f GB, Swap Used: %07.3f GB"
+        % (
+            mem["total_used"] / GB,
+            mem["vm_available"] / GB,
+            mem["vm_used"] / GB,
+            mem["swap_used"] / GB,
+        )
+    )
+    if "gpu_used" in mem:
+        string += ", GPU Used: %07.3f GB" % (mem["gpu_used"] / GB)
+    return string
+
+
+def format_event(event):
+    """Render an event as a line of log.txt"""
+    datetime_string = datetime.datetime.fromtimestamp(event["time"]).strftime(
+        "%Y-%m-%d %H:%M:%S"
+    )
+    level = event.get("level", 1)
+    string = event.get("message", "")
+    if "mem" in event:
+        string = "{:<20}".format(string) + format_memory(event["mem"])
+    return "\n[%s][%02d] " % (datetime_string, level) + "   " * level + string
+
+
+def read_events(job_dir, kind=None):
+    """
+    Load the events of a job's log.jsonl
+
+    Args:
+        job_dir (str): job directory
+        kind (str, optional): only return events of this kind ('log', 'timer', 'profile'). Defaults to None.
+
+    Returns:
+        list: event dicts, in the order they were logged
+    """
+    path = os.path.join(job_dir, EVENTS_FILE)
+    events = []
+    if not os.path.exists(path):
+        return events
+    with open(path, "r") as f:
+        for line in f:
+            line = line.strip()
+            if not line:
+                continue
+            try:
+                event = json.loads(line)
+            except ValueError:
+                # the last line may be incomplete if the process was killed
+                continue
+            if kind is None or event.get("kind") == kind:
+                events.append(event)
+    return events
+
+
+# open loggers, held weakly so a logger is closed (and flushed) when its job is deleted
+_loggers = weakref.WeakSet()
+_flusher = None
+_flusher_lock = threading.Lock()
+FLUSH_TICK = 0.25
+
+
+def _flush_loop():
+    while True:
+        time.sleep(FLUSH_TICK)
+        for logger in list(_loggers):
+            if (
+                logger.n_buffered > 0
+                and time.time() - logger.last_flush > logger.flush_interval
+            ):
+                logger.flush()
+
+
+def _start_flusher():
+    global _flusher
+    with _flusher_lock:
+        if _flusher is None:
+            _flusher = threading.Thread(target=_flush_loop, daemon=True)
+            _flusher.start()
+
+
+def flush_all():
+    for logger in list(_loggers):
+        logger.flush()
+
+
+def close_all():
+    for logger in list(_loggers):
+        logger.close()
+
+
+def _after_fork_in_child():
+    # the flush thread and any held locks don't survive the fork
+    global _flusher, _flusher_lock
+    _flusher = None
+    _flusher_lock = threading.Lock()
+    for logger in list(_loggers):
+        logger.lock = threading.Lock()
+
+
+atexit.register(close_all)
+if hasattr(os, "register_at_fork"):
+    os.register_at_fork(before=flush_all, after_in_child=_after_fork_in_child)
+
+
+class JobLogger:
+    """
+    Buffered writer of log.jsonl and log.txt for a job directory. Safe to call from
+    several threads.
+
+    Args:
+        job_dir (str): job directory
+        flush_every (int, optional): flush after this many buffered events. Defaults to 100.
+        flush_interval (float, optional): longest time (s) an event stays buffered. Defaults to 2.
+        flush_level (int, optional): events at this level or below, and events with memory
+            usage, are flushed immediately. Defaults to 1.
+    """
+
+    def __init__(self, job_dir, flush_every=100, flush_interval=2.0, flush_level=1):
+        self.job_dir = job_dir
+        self.flush_every = flush_every
+        self.flush_interval = flush_interval
+        self.flush_level = flush_level
+        self.lock = threading.Lock()
+        self.events_file = None
+        self.text_file = None
+        self.n_buffered = 0
+        self.last_flush = time.time()
+
+    @property
+    def text_path(self):
+        return os.path.join(self.job_dir, TEXT_FILE)
+
+    @property
+    def events_path(self):
+        return os.path.join(self.job_dir, EVENTS_FILE)
+
+    def open(self):
+        if self.events_file is None:
+            self.events_file = open(self.events_path, "a", buffering=1024**2)
+            self.text_file = open(self.text_path, "a", buffering=1024**2)
+            _loggers.add(self)
+            _start_flusher()
+
+    def write(self, event):
+        """Buffer an event (a json-serialisable dict with at least 'time')"""
+        line = json.dumps(event)
+        text = format_event(event)
+        with self.lock:
+            self.open()
+            self.events_file.write(line + "\n")
+            self.text_file.write(text)
+            self.n_buffered += 1
+            if (
+                self.n_buffered >= self.flush_every
+                or event.get("level", 1) <= self.flush_level
+                or "mem" in event
+            ):
+                self._flush()
+
+    def _flush(self):
+        if self.events_file is not None:
+            self.events_file.flush()
+            self.text_file.flush()
+        self.n_buffered = 0
+        self.last_flush = time.time()
+
+    def flush(self):
+        with self.lock:
+            self._flush()
+
+    def close(self):
+        with self.lock:
+            if self.events_file is not None:
+                self._flush()
+                self.events_file.close()
+                self.text_file.close()
+                self.events_file = None
+                self.text_file = None
+        _loggers.discard(self)
+
+    def __del__(self):
+        try:
+            self.close()
+        except Exception:
+            pass
+
+    def __getstate__(self):
+        # open files and locks can't be pickled, they are reopened on the next write
+        self.flush()
+        state = self.__dict__.copy()
+        state["lock"] = None
+        state["events_file"] = None
+        state["text_file"] = None
+        return state
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        self.lock = threading.Lock()
+        self.n_buffered = 0
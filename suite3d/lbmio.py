@@ -3,6 +3,7 @@ import os
 from multiprocessing import shared_memory, Pool
 import numpy as n
 import time
+import contextlib
 
 # from skimage import io as skio
 from scipy import signal
@@ -13,6 +14,7 @@ import psutil
 import tracemalloc
 from .utils import default_log
 from .developer import deprecated_inputs
+from . import shmem as shm
 
 
 lbm_plane_to_ch = (
@@ -125,22 +127,25 @@ def load_and_stitch_tifs(
 
     mov_list = []
 
-    for tif_path in paths:
-        if verbose:
-            log_cb("Loading %s" % tif_path, 2)
-        im, px, py = load_and_stitch_full_tif_mp(
-            tif_path,
-            channels=channels,
-            verbose=False,
-            filt=filt,
-            n_ch=n_ch,
-            n_proc=n_proc,
-            debug=debug,
-            use_roi_idxs=use_roi_idxs,
-            fix_fastZ=fix_fastZ,
-            **mp_args
-        )
-        mov_list.append(im)
+    # the shared memory segments are reused by every tif of the same size
+    with shm.ShmemArena() as arena:
+        for tif_path in paths:
+            if verbose:
+                log_cb("Loading %s" % tif_path, 2)
+            im, px, py = load_and_stitch_full_tif_mp(
+                tif_path,
+                channels=channels,
+                verbose=False,
+                filt=filt,
+                n_ch=n_ch,
+                n_proc=n_proc,
+                debug=debug,
+                use_roi_idxs=use_roi_idxs,
+                fix_fastZ=fix_fastZ,
+                arena=arena,
+                **mp_args
+            )
+            mov_list.append(im)
     if concat:
         mov = n.concatenate(mov_list, axis=1)
         size = mov.nbytes / (1024 * 1024 * 1024)
@@ -168,6 +173,7 @@ def load_and_stitch_full_tif_mp(
     get_roi_start_pix=False,
     use_roi_idxs=None,
     fix_fastZ=False,
+    arena=None,
 ):
     tic = time.time()
     # TODO imread from tifffile has an overhead of ~20-30 seconds before it actually reads the file?
@@ -183,94 +189,91 @@ def load_and_stitch_full_tif_mp(
         print(tiffile.shape)
     rois = get_meso_rois(path, fix_fastZ=fix_fastZ)
     # print("XXXXXX %.2f" % (tiffile.nbytes / 1024**3))
-    sh_mem = shared_memory.SharedMemory(create=True, size=tiffile.nbytes)
-    sh_tif = n.ndarray(tiffile.shape, dtype=tiffile.dtype, buffer=sh_mem.buf)
-    sh_tif[:] = tiffile[:]
-    if debug:
-        print("4, %.4f" % (time.time() - tic))
-    sh_mem_name = sh_mem.name
-    sh_mem_params = (sh_tif.shape, sh_tif.dtype)
-
-    n_t, n_ch_tif, __, __ = sh_tif.shape
-    n_ch = len(channels)
-
-    # split and stitch two frames to figure out the output size
-    ims_sample = split_rois_from_tif(tiffile[:2], rois, ch_id=0)
-    if debug:
-        print("5, %.4f" % (time.time() - tic))
-    # sample_out = stitch_rois(ims_sample, rois, return_coords=False,mean_img=False)
-    if get_roi_start_pix:
-        return stitch_rois_fast(
-            ims_sample,
-            rois,
-            mean_img=False,
-            get_roi_start_pix=True,
-            use_roi_idxs=use_roi_idxs,
-        )
-    sample_out, px, py = stitch_rois_fast(
-        ims_sample, rois, mean_img=False, use_roi_idxs=use_roi_idxs
-    )
-    if debug:
-        print("6, %.4f" % (time.time() - tic))
-    __, n_y, n_x = sample_out.shape
-    del tiffile
-
-    shape_out = (n_ch, n_t, n_y, n_x)
-    size_out = (n_t * n_ch * n_y * n_x) * sh_tif[0, 0, 0, 0].nbytes
-    sh_mem_out = shared_memory.SharedMemory(create=True, size=size_out)
-    sh_out = n.ndarray(shape_out, dtype=sh_tif.dtype, buffer=sh_mem_out.buf)
-    sh_out_name = sh_mem_out.name
-    sh_out_params = (sh_out.shape, sh_out.dtype)
-    # print(sh_out_params)
-    if debug:
-        print("7, %.4f" % (time.time() - tic))
-
-    if translations is None:
-        translations = n.zeros((n_ch, 2))
+    # the arena unlinks both segments if loading or stitching fails. A caller loading
+    # many tifs passes its own arena, so the segments are reused by the next tif
+    owns_arena = arena is None
+    with shm.ShmemArena() if owns_arena else contextlib.nullcontext(arena) as arena:
+        sh_tif_shmem_params, sh_tif = arena.from_arr("tif", tiffile)
+        if debug:
+            print("4, %.4f" % (time.time() - tic))
+        sh_mem_name = sh_tif_shmem_params["name"]
+        sh_mem_params = (sh_tif.shape, sh_tif.dtype)
 
-    prep_tic = time.time()
-    if verbose:
-        print("    Loaded file into shared memory in %.2f sec" % (prep_tic - tic))
+        n_t, n_ch_tif, __, __ = sh_tif.shape
+        n_ch = len(channels)
 
-    p = Pool(processes=n_proc)
-    output = p.starmap(
-        load_and_stitch_full_tif_worker,
-        [
-            (
-                idx,
-                ch_id,
+        # split and stitch two frames to figure out the output size
+        ims_sample = split_rois_from_tif(tiffile[:2], rois, ch_id=0)
+        if debug:
+            print("5, %.4f" % (time.time() - tic))
+        # sample_out = stitch_rois(ims_sample, rois, return_coords=False,mean_img=False)
+        if get_roi_start_pix:
+            return stitch_rois_fast(
+                ims_sample,
                 rois,
-                sh_mem_name,
-                sh_mem_params,
-                sh_out_name,
-                sh_out_params,
-                translations[idx],
-                filt,
-                use_roi_idxs,
+                mean_img=False,
+                get_roi_start_pix=True,
+                use_roi_idxs=use_roi_idxs,
             )
-            for idx, ch_id in enumerate(channels)
-        ],
-    )
-    proc_tic = time.time()
-    if verbose:
-        print("    Workers completed in %.2f sec" % (proc_tic - prep_tic))
+        sample_out, px, py = stitch_rois_fast(
+            ims_sample, rois, mean_img=False, use_roi_idxs=use_roi_idxs
+        )
+        if debug:
+            print("6, %.4f" % (time.time() - tic))
+        __, n_y, n_x = sample_out.shape
+        del tiffile
+
+        shape_out = (n_ch, n_t, n_y, n_x)
+        sh_out_shmem_params, sh_out = arena.get("out", shape_out, sh_tif.dtype)
+        sh_out_name = sh_out_shmem_params["name"]
+        sh_out_params = (sh_out.shape, sh_out.dtype)
+        # print(sh_out_params)
+        if debug:
+            print("7, %.4f" % (time.time() - tic))
 
-    if debug:
-        print("8, %.4f" % (time.time() - tic))
+        if translations is None:
+            translations = n.zeros((n_ch, 2))
 
-    # print(output)
-    if verbose:
-        print("    Total time: %.2f sec" % (time.time() - tic))
-    sh_mem.close()
-    sh_mem.unlink()
-    p.close()
-    p.terminate()
+        prep_tic = time.time()
+        if verbose:
+            print("    Loaded file into shared memory in %.2f sec" % (prep_tic - tic))
+
+        with Pool(processes=n_proc) as p:
+            output = p.starmap(
+                load_and_stitch_full_tif_worker,
+                [
+                    (
+                        idx,
+                        ch_id,
+                        rois,
+                        sh_mem_name,
+                        sh_mem_params,
+                        sh_out_name,
+                        sh_out_params,
+                        translations[idx],
+                        filt,
+                        use_roi_idxs,
+                    )
+                    for idx, ch_id in enumerate(channels)
+                ],
+            )
+        proc_tic = time.time()
+        if verbose:
+            print("    Workers completed in %.2f sec" % (proc_tic - prep_tic))
 
-    im_full = n.zeros(sh_out.shape, sh_out.dtype)
-    im_full[:] = sh_out[:]
-    sh_mem_out.close()
-    sh_mem_out.unlink()
+        if debug:
+            print("8, %.4f" % (time.time() - tic))
 
+        # print(output)
+        if verbose:
+            print("    Total time: %.2f sec" % (time.time() - tic))
+
+        # a caller's arena keeps the raw tif segment for the next tif, otherwise it is
+        # freed before the output is copied out
+        if owns_arena:
+            arena.release("tif")
+        im_full = n.zeros(sh_out.shape, sh_out.dtype)
+        im_full[:] = sh_out[:]
     return im_full, px, py
 
 
@@ -0,0 +1,317 @@
+import os
+import numpy as n
+import tifffile
+
+from .utils import default_log
+from .precision import COMPUTE_DTYPE, storage_dtype
+
+try:
+    import psutil
+except ImportError:
+    psutil = None
+
+# Memory budget planner. Each *_bytes function is the memory model of one stage: the
+# number of bytes it holds at its peak for a given batch size, counting the copies the
+# code makes. plan_memory picks, for every batch size param, the largest value up to the
+# requested one whose predicted peak fits in the budget, and returns the params to update
+# together with the predicted peak of each Job step. Job.plan_memory applies the plan to
+# job.params, and profiling.profile_job_stage logs the predicted and observed peaks.
+
+GB = 1024**3
+
+# params chosen by plan_memory
+PLANNED_PARAMS = [
+    "tif_batch_size",
+    "t_batch_size",
+    "mproc_batchsize",
+    "split_tif_size",
+    "patch_size_xy",
+    "extract_batchsize_frames",
+]
+
+
+def stitch_bytes(nt_tif, n_ch_tif, tif_yx, n_planes, out_yx, itemsize=2):
+    """
+    Peak of lbmio.load_and_stitch_full_tif_mp for one tif. The tif loading loop passes
+    one shared memory arena to every tif, so the raw and stitched segments of the
+    previous tif are still alive (to be reused) while the next tif is read, and the raw
+    segment is alive while the output is copied out of shared memory. At most three of
+    the four copies are alive at once.
+
+    Args:
+        nt_tif (int): volumes in the tif
+        n_ch_tif (int): planes recorded in the tif
+        tif_yx (tuple): y, x size of a tif page
+        n_planes (int): planes that are loaded
+        out_yx (tuple): y, x size of a stitched plane
+        itemsize (int, optional): bytes per pixel of the tif. Defaults to 2.
+
+    Returns:
+        int: bytes
+    """
+    raw = nt_tif * n_ch_tif * tif_yx[0] * tif_yx[1] * itemsize
+    out = nt_tif * n_planes * out_yx[0] * out_yx[1] * itemsize
+    return int(raw + out + max(raw, out))
+
+
+def registration_bytes(tif_batch_size, nt_tif, vol_shape, stitch_peak, n_reg_workers=1, nonrigid=False, itemsize=2):
+    """
+    Peak of a registration batch (iter_step.register_dataset_s2p). The loaded tifs are
+    held as a list and concatenated, the next batch is loaded by the IO thread at the
+    same time, and the batch is fused and padded and then copied to shared memory.
+    Each plane-registration worker holds a float32 and a complex64 copy of its plane,
+    and nonrigid registration adds the shifted copy and the shift maps.
+
+    Args:
+        tif_batch_size (int): tifs per batch
+        nt_tif (int): volumes per tif
+        vol_shape (tuple): nz, ny, nx of the registered (fused and padded) volume
+        stitch_peak (int): bytes from stitch_bytes, 0 for non-LBM data
+        n_reg_workers (int, optional): plane-registration workers. Defaults to 1.
+        nonrigid (bool, optional): Defaults to False.
+        itemsize (int, optional): bytes per pixel of the loaded movie. Defaults to 2.
+
+    Returns:
+        int: bytes
+    """
+    nz, ny, nx = vol_shape
+    nt = tif_batch_size * nt_tif
+    batch = nt * nz * ny * nx * itemsize
+    # loaded list + concatenated + next batch + padded + shared memory
+    loaded = 5 * batch
+    plane = nt * ny * nx * (4 + 8 + (12 + 4 if nonrigid else 0))
+    workers = min(n_reg_workers, nz) * plane
+    return int(loaded + workers + stitch_peak)
+
+
+def corrmap_bytes(t_batch_size, vol_shape, minibatch_size=25, detection_timebin=1):
+    """
+    Peak of a correlation map batch (corrmap.calculate_corrmap). The batch is loaded and
+    converted to float32, filter_and_reduce_movie subtracts the neuropil from it in place
+    to make mov_sub, and the separable filters work on a few minibatches of frames at a
+    time. The accumulators (mean, max, sdmov, vmap) are 4 volumes.
+
+    Args:
+        t_batch_size (int): frames per batch
+        vol_shape (tuple): nz, ny, nx
+        minibatch_size (int, optional): frames per filter minibatch. Defaults to 25.
+        detection_timebin (int, optional): frames binned together. Defaults to 1.
+
+    Returns:
+        int: bytes
+    """
+    nz, ny, nx = vol_shape
+    vol = nz * ny * nx * COMPUTE_DTYPE.itemsize
+    nt = t_batch_size // max(1, detection_timebin)
+    # the unbinned dask batch is materialised once when timebinning
+    binned_input = t_batch_size * vol if detection_timebin > 1 else 0
+    filt_buffers = 3 * minibatch_size * vol
+    return int(nt * vol + binned_input + filt_buffers + 4 * vol)
+
+
+def detection_bytes(nt, nz, patch_yx, save_dtype="float16", load_dtype=None):
+    """
+    Peak of segmenting one patch (Job.segment_rois and extension.detect_cells_mp). The
+    patch is loaded, then detect_cells_mp copies it to shared memory in the storage dtype
+    for the workers. The patch norms and vmap are single volumes.
+
+    Args:
+        nt (int): frames of mov_sub (after the detection timebin)
+        nz (int): planes
+        patch_yx (tuple): y, x size of a patch, including overlaps
+        save_dtype (str, optional): params['save_dtype']. Defaults to 'float16'.
+        load_dtype (dtype, optional): dtype of the loaded patch. Defaults to the storage dtype.
+
+    Returns:
+        int: bytes
+    """
+    stor = storage_dtype(save_dtype)
+    load_dtype = stor if load_dtype is None else n.dtype(load_dtype)
+    pix = nz * patch_yx[0] * patch_yx[1]
+    return int(nt * pix * (stor.itemsize + load_dtype.itemsize) + 2 * pix * 4)
+
+
+def extraction_bytes(batchsize_frames, vol_shape, nt, n_rois, save_dtype="float16"):
+    """
+    Peak of extraction (extension.extract_activity). A batch is read from the registered
+    files and swapped to nz, nt, ny, nx, and F and Fneu are float32 (n_rois, nt) arrays.
+
+    Args:
+        batchsize_frames (int): frames per batch
+        vol_shape (tuple): nz, ny, nx
+        nt (int): frames in the movie
+        n_rois (int): number of ROIs
+        save_dtype (str, optional): params['save_dtype']. Defaults to 'float16'.
+
+    Returns:
+        int: bytes
+    """
+    nz, ny, nx = vol_shape
+    batch = batchsize_frames * nz * ny * nx * storage_dtype(save_dtype).itemsize
+    traces = 2 * n_rois * nt * COMPUTE_DTYPE.itemsize
+    return int(2 * batch + traces)
+
+
+def largest_fitting(bytes_fn, max_value, budget, min_value=1, step=1):
+    """
+    Largest value in [min_value, max_value], a multiple of step, with bytes_fn(value) <=
+    budget. Returns min_value if nothing fits. bytes_fn must increase with value.
+    """
+    max_value = max(min_value, (max_value // step) * step)
+    if bytes_fn(max_value) <= budget:
+        return max_value
+    lo, hi = 0, (max_value - min_value) // step
+    while lo < hi:
+        mid = (lo + hi + 1) // 2
+        if bytes_fn(min_value + mid * step) <= budget:
+            lo = mid
+        else:
+            hi = mid - 1
+    return min_value + lo * step
+
+
+def get_tif_info(tif_path, n_ch_tif):
+    """
+    Size of the pages and number of volumes of a tif, estimated from the file size
+    without reading it
+
+    Returns:
+        tuple: nt (volumes), (page y, page x), itemsize
+    """
+    with tifffile.TiffFile(tif_path) as tf:
+        page = tf.pages[0]
+        page_yx = page.shape[-2:]
+        itemsize = n.dtype(page.dtype).itemsize
+    page_bytes = page_yx[0] * page_yx[1] * itemsize
+    nt = int(os.path.getsize(tif_path) // (page_bytes * n_ch_tif))
+    return nt, page_yx, itemsize
+
+
+def plan_memory(
+    params,
+    vol_shape,
+    raw_vol_shape,
+    tif_info,
+    nt_total,
+    n_rois=0,
+    mem_budget_gb=None,
+    log_cb=default_log,
+):
+    """
+    Choose tif_batch_size, split_tif_size, t_batch_size, mproc_batchsize, patch_size_xy
+    and extract_batchsize_frames so the predicted peak of each step fits in the budget.
+    Each value is capped at its value in params, so the plan only ever lowers them. Pass
+    the values the user asked for, not a previous plan (see Job.plan_memory).
+
+    Args:
+        params (dict): job params
+        vol_shape (tuple): nz, ny, nx of the registered volume
+        raw_vol_shape (tuple): nz, ny, nx of the stitched volume before fusing and padding
+        tif_info (tuple): output of get_tif_info for a typical tif
+        nt_total (int): number of volumes in the recording
+        n_rois (int, optional): number of ROIs, for extraction. Defaults to 0.
+        mem_budget_gb (float, optional): RAM to use. Defaults to 80% of currently available RAM.
+
+    Returns:
+        dict: plan with 'params' (values to update), 'predicted_gb' (peak of each Job step),
+              'mem_budget_gb' and the shapes it was derived from
+    """
+    if mem_budget_gb is None:
+        if psutil is not None:
+            mem_budget_gb = 0.8 * psutil.virtual_memory().available / GB
+        else:
+            mem_budget_gb = n.inf
+    budget = mem_budget_gb * GB
+    nz, ny, nx = vol_shape
+    nt_tif, tif_yx, tif_itemsize = tif_info
+    save_dtype = params.get("save_dtype", "float32")
+
+    stitch_peak = 0
+    if params.get("lbm", False):
+        stitch_peak = stitch_bytes(
+            nt_tif, params.get("n_ch_tif", 30), tif_yx, nz, raw_vol_shape[1:], tif_itemsize
+        )
+    n_reg_workers = params.get("n_proc_reg", 1) if not params.get("3d_reg", False) else 1
+    nonrigid = params.get("nonrigid", False)
+
+    def reg_fn(k):
+        return registration_bytes(
+            k, nt_tif, vol_shape, stitch_peak, n_reg_workers, nonrigid, tif_itemsize
+        )
+
+    tif_batch_size = largest_fitting(reg_fn, params.get("tif_batch_size", 1), budget)
+
+    timebin = params.get("detection_timebin") or 1
+    temporal_hpf = int(params.get("temporal_hpf", 1))
+    n_proc_corr = max(1, params.get("n_proc_corr", 1))
+
+    def corr_fn(t):
+        minibatch = max(20, int(n.ceil(t / n_proc_corr)))
+        return corrmap_bytes(t, vol_shape, minibatch, timebin)
+
+    # t_batch_size should stay a multiple of temporal_hpf
+    t_batch_size = largest_fitting(
+        corr_fn,
+        min(params.get("t_batch_size", 800), max(nt_total, temporal_hpf)),
+        budget,
+        min_value=temporal_hpf,
+        step=temporal_hpf,
+    )
+    mproc_batchsize = max(1, min(params.get("mproc_batchsize", 25), t_batch_size // n_proc_corr))
+    split_tif_size = params.get("split_tif_size") or t_batch_size
+    split_tif_size = min(split_tif_size, t_batch_size)
+
+    nt_det = nt_total // timebin // max(1, params.get("segmentation_timebin", 1))
+    overlap = params.get("patch_overlap_xy", (0, 0))
+    patch_max = params.get("patch_size_xy", (150, 150))
+
+    def det_fn(p):
+        return detection_bytes(nt_det, nz, (min(p, ny), min(p, nx)), save_dtype)
+
+    patch_xy = largest_fitting(
+        det_fn, max(patch_max), budget, min_value=2 * max(overlap) + 1
+    )
+    patch_size_xy = (min(patch_xy, patch_max[0]), min(patch_xy, patch_max[1]))
+
+    def ext_fn(b):
+        return extraction_bytes(b, vol_shape, nt_total, n_rois, save_dtype)
+
+    extract_batchsize = largest_fitting(
+        ext_fn, min(params.get("extract_batchsize_frames", 500), nt_total), budget
+    )
+
+    predicted = {
+        "register": reg_fn(tif_batch_size) / GB,
+        "calculate_corr_map": corr_fn(t_batch_size) / GB,
+        "segment_rois": det_fn(max(patch_size_xy)) / GB,
+        "extract_and_deconvolve": ext_fn(extract_batchsize) / GB,
+    }
+    plan = {
+        "params": {
+            "tif_batch_size": tif_batch_size,
+            "t_batch_size": t_batch_size,
+            "mproc_batchsize": mproc_batchsize,
+            "split_tif_size": split_tif_size,
+            "patch_size_xy": patch_size_xy,
+            "extract_batchsize_frames": extract_batchsize,
+        },
+        "predicted_gb": predicted,
+        "mem_budget_gb": mem_budget_gb,
+        "vol_shape": tuple(vol_shape),
+        "nt_total": nt_total,
+        "n_rois": n_rois,
+    }
+    log_cb(
+        "Memory plan for a %.2f GB budget: %s"
+        % (mem_budget_gb, ", ".join("%s=%s" % kv for kv in plan["params"].items())),
+        1,
+    )
+    for step, gb in predicted.items():
+        log_cb("Predicted peak of %s: %.2f GB" % (step, gb), 2)
+        if gb > mem_budget_gb:
+            log_cb(
+                "WARNING: %s needs %.2f GB even at the smallest batch size, more than the %.2f GB budget"
+                % (step, gb, mem_budget_gb),
+                0,
+            )
+    return plan
@@ -0,0 +1,164 @@
+import os
+import numpy as n
+
+from . import svd_utils as svu
+
+# The neuropil-subtracted movie (mov_sub) is written by the correlation map step and
+# read back patch by patch by segmentation. The store keeps one memory-mapped .npy file
+# per segmentation patch (nt, nz, patch_y, patch_x), so corrmap can write each batch
+# straight into the files and segmentation can map a patch without reading, converting
+# or reformatting the rest of the movie.
+
+STORE_INFO_FILE = "mov_sub_store.npy"
+
+
+def store_exists(store_dir):
+    return store_dir is not None and os.path.exists(os.path.join(store_dir, STORE_INFO_FILE))
+
+
+class MovSubStore:
+    """
+    Patch-major, memory-mapped store of the neuropil-subtracted movie. Create it with
+    MovSubStore.create before the correlation map and open it with MovSubStore.open.
+
+    Args:
+        store_dir (str): directory containing the store
+        info (dict): contents of mov_sub_store.npy
+        mode (str, optional): memmap mode of the patch files. Defaults to 'r'.
+    """
+
+    def __init__(self, store_dir, info, mode="r"):
+        self.store_dir = store_dir
+        self.info = info
+        self.shape = tuple(info["shape"])
+        self.dtype = n.dtype(info["dtype"])
+        self.ndim = 4
+        self.patches = info["patches"]
+        self.patches_nonoverlap = info["patches_nonoverlap"]
+        self.patch_size_xy = tuple(info["patch_size_xy"])
+        self.patch_overlap_xy = tuple(info["patch_overlap_xy"])
+        self.mode = mode
+        self._mmaps = {}
+
+    @classmethod
+    def create(cls, store_dir, shape, patch_size_xy, patch_overlap_xy, dtype=n.float32):
+        """
+        Create an empty store for a movie of shape (nt, nz, ny, nx), split into the same
+        patches as Job.segment_rois
+        """
+        nt, nz, ny, nx = shape
+        patch_shape = (nz,) + tuple(patch_size_xy)
+        overlaps = (0,) + tuple(patch_overlap_xy)
+        patches, grid_shape = svu.make_blocks((nz, ny, nx), patch_shape, overlaps)
+        patches_nonoverlap, __ = svu.make_blocks(
+            (nz, ny, nx), patch_shape, overlaps, nonoverlapping_mask=True
+        )
+        # patches larger than the volume are cropped to it
+        for i, size in enumerate((nz, ny, nx)):
+            patches[i] = n.clip(patches[i], 0, size)
+            patches_nonoverlap[i] = n.clip(patches_nonoverlap[i], 0, size)
+        info = {
+            "shape": tuple(int(s) for s in shape),
+            "dtype": n.dtype(dtype).str,
+            "patches": patches,
+            "patches_nonoverlap": patches_nonoverlap,
+            "grid_shape": grid_shape,
+            "patch_size_xy": tuple(patch_size_xy),
+            "patch_overlap_xy": tuple(patch_overlap_xy),
+        }
+        os.makedirs(store_dir, exist_ok=True)
+        store = cls(store_dir, info, mode="r+")
+        for patch_idx in range(store.n_patches):
+            (z0, z1), (y0, y1), (x0, x1) = patches[:, patch_idx]
+            n.lib.format.open_memmap(
+                store.patch_path(patch_idx),
+                mode="w+",
+                dtype=dtype,
+                shape=(nt, z1 - z0, y1 - y0, x1 - x0),
+            )
+        # the info file is written last, so a store that exists is complete
+        n.save(os.path.join(store_dir, STORE_INFO_FILE), info)
+        return store
+
+    @classmethod
+    def open(cls, store_dir, mode="r"):
+        info = n.load(os.path.join(store_dir, STORE_INFO_FILE), allow_pickle=True).item()
+        return cls(store_dir, info, mode=mode)
+
+    @property
+    def n_patches(self):
+        return self.patches.shape[1]
+
+    def patch_path(self, patch_idx):
+        return os.path.join(self.store_dir, "mov_sub_patch-%04d.npy" % patch_idx)
+
+    def matches(self, patch_size_xy, patch_overlap_xy):
+        """True if the store is split into the patches that segmentation will use"""
+        return self.patch_size_xy == tuple(patch_size_xy) and self.patch_overlap_xy == tuple(
+            patch_overlap_xy
+        )
+
+    def patch(self, patch_idx):
+        """Memory-mapped (nt, nz, patch_y, patch_x) movie of a patch, no data is read"""
+        if patch_idx not in self._mmaps:
+            self._mmaps[patch_idx] = n.load(self.patch_path(patch_idx), mmap_mode=self.mode)
+        return self._mmaps[patch_idx]
+
+    def write(self, t0, mov_sub):
+        """
+        Write the frames mov_sub (nt_batch, nz, ny, nx) of the full volume, starting at
+        frame t0, into every patch
+        """
+        t1 = t0 + mov_sub.shape[0]
+        for patch_idx in range(self.n_patches):
+            (z0, z1), (y0, y1), (x0, x1) = self.patches[:, patch_idx]
+            self.patch(patch_idx)[t0:t1] = mov_sub[:, z0:z1, y0:y1, x0:x1]
+
+    def flush(self):
+        for mmap in self._mmaps.values():
+            mmap.flush()
+
+    def __getitem__(self, key):
+        """
+        Read any region of the full movie, each voxel is taken from the patch it is
+        closest to the centre of. Supports integers and slices with positive steps
+        """
+        if not isinstance(key, tuple):
+            key = (key,)
+        key = key + (slice(None),) * (4 - len(key))
+        ranges = []
+        squeeze = []
+        for axis, k in enumerate(key):
+            if isinstance(k, slice):
+                ranges.append(k.indices(self.shape[axis]))
+            else:
+                k = int(k) % self.shape[axis]
+                ranges.append((k, k + 1, 1))
+                squeeze.append(axis)
+        if any(r[2] < 1 for r in ranges):
+            raise NotImplementedError("Negative steps are not supported")
+        t_sl = slice(*ranges[0])
+        # read the bounding box of the spatial selection and apply the steps after
+        lo = [r[0] for r in ranges[1:]]
+        hi = [max(r[0], r[1]) for r in ranges[1:]]
+        out = n.zeros(
+            (len(range(*ranges[0])),) + tuple(h - l for l, h in zip(lo, hi)), dtype=self.dtype
+        )
+        for patch_idx in range(self.n_patches):
+            own = self.patches_nonoverlap[:, patch_idx]
+            full = self.patches[:, patch_idx]
+            src = []
+            dst = []
+            for axis in range(3):
+                a0 = max(own[axis][0], lo[axis])
+                a1 = min(own[axis][1], hi[axis])
+                if a1 <= a0:
+                    break
+                src.append(slice(a0 - full[axis][0], a1 - full[axis][0]))
+                dst.append(slice(a0 - lo[axis], a1 - lo[axis]))
+            else:
+                out[(slice(None),) + tuple(dst)] = self.patch(patch_idx)[(t_sl,) + tuple(src)]
+        out = out[(slice(None),) + tuple(slice(None, None, r[2]) for r in ranges[1:])]
+        if squeeze:
+            out = out.reshape([s for i, s in enumerate(out.shape) if i not in squeeze])
+        return out
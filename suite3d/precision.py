@@ -0,0 +1,50 @@
+import numpy as n
+
+# Precision policy for the correlation map, detection and extraction steps.
+# Large movie buffers (saved movies, the mov_sub store, the shared-memory patch used by
+# detect_cells_mp and extraction batches) are kept in the storage dtype, which follows
+# params['save_dtype']. Everything computed from them is accumulated in COMPUTE_DTYPE.
+# float64 is only used locally inside kernels that need it, never for full-size arrays.
+
+COMPUTE_DTYPE = n.dtype(n.float32)
+
+
+def storage_dtype(save_dtype="float32"):
+    """
+    dtype of large movie buffers for a value of params['save_dtype']
+
+    Args:
+        save_dtype (str or dtype, optional): 'float16' or 'float32'. Defaults to 'float32'.
+
+    Returns:
+        dtype
+    """
+    if save_dtype in ("float16", n.float16):
+        return n.dtype(n.float16)
+    return COMPUTE_DTYPE
+
+
+def to_compute(arr):
+    """arr in COMPUTE_DTYPE, without a copy if it already is"""
+    return arr.astype(COMPUTE_DTYPE, copy=False)
+
+
+def sum_squares(mov, axis=0, batch_size=100):
+    """
+    Sum of squares along the first axis, accumulated in COMPUTE_DTYPE a few frames at a
+    time, so float16 movies neither overflow nor get upcast in full
+
+    Args:
+        mov (ndarray): nt, ... movie
+        axis (int, optional): only 0 is supported. Defaults to 0.
+        batch_size (int, optional): frames converted at once. Defaults to 100.
+
+    Returns:
+        ndarray: mov.shape[1:] in COMPUTE_DTYPE
+    """
+    assert axis == 0
+    out = n.zeros(mov.shape[1:], dtype=COMPUTE_DTYPE)
+    for i in range(0, mov.shape[0], batch_size):
+        batch = to_compute(mov[i : i + batch_size])
+        out += (batch * batch).sum(axis=0)
+    return out
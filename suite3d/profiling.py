@@ -0,0 +1,222 @@
+import os
+import time
+import cProfile
+import functools
+import threading
+from contextlib import contextmanager, nullcontext
+
+from .job_log import PeakMemorySampler
+
+# Stage profiling. Pipeline code marks its stages with profiling.stage(name) (a context
+# manager) or @profiling.profiled(name) (a decorator). Each completed stage adds its
+# wall time, process CPU time, and the frames and bytes it processed to the global
+# PROFILER. Job.tic / Job.toc timers are recorded as stages too. The Job methods
+# decorated with profile_job_stage reset the profiler when they start and log a
+# per-stage report (with frames/s and GB/s) when they finish. If params['cprofile'] is
+# True they also run under cProfile and dump a .prof file to job_dir/profiles, which can
+# be read with pstats, snakeviz, or converted for flame graph viewers. They also sample
+# the peak memory of the call and log it next to the peak predicted by job.plan_memory.
+
+GB = 1024**3
+
+
+class StageRecord:
+    """Frames and bytes processed by one run of a stage, filled in by the stage's code"""
+
+    def __init__(self, frames=0, nbytes=0):
+        self.frames = frames
+        self.nbytes = nbytes
+
+    def count(self, frames=0, nbytes=0):
+        self.frames += frames
+        self.nbytes += nbytes
+
+
+class StageProfiler:
+    """
+    Aggregates the calls, wall time, CPU time, frames and bytes of named stages.
+    Safe to use from several threads.
+    """
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.stats = {}
+        self.depth = 0
+
+    def reset(self):
+        with self.lock:
+            self.stats = {}
+
+    def add(self, name, wall, cpu, frames=0, nbytes=0):
+        with self.lock:
+            st = self.stats.setdefault(
+                name, {"calls": 0, "wall": 0.0, "cpu": 0.0, "frames": 0, "nbytes": 0}
+            )
+            st["calls"] += 1
+            st["wall"] += wall
+            st["cpu"] += cpu
+            st["frames"] += int(frames)
+            st["nbytes"] += int(nbytes)
+
+    @contextmanager
+    def stage(self, name, frames=0, nbytes=0):
+        """
+        Time the enclosed block as stage name. The yielded StageRecord can be used to
+        count the frames and bytes processed inside the block.
+        """
+        rec = StageRecord(frames, nbytes)
+        wall0 = time.perf_counter()
+        cpu0 = time.process_time()
+        try:
+            yield rec
+        finally:
+            self.add(
+                name,
+                time.perf_counter() - wall0,
+                time.process_time() - cpu0,
+                rec.frames,
+                rec.nbytes,
+            )
+
+    def table(self):
+        """
+        Returns:
+            dict: per stage, calls, wall (s), cpu (s), frames, nbytes, fps and gbps
+        """
+        with self.lock:
+            table = {name: dict(st) for name, st in self.stats.items()}
+        for st in table.values():
+            wall = max(st["wall"], 1e-9)
+            st["fps"] = st["frames"] / wall if st["frames"] else None
+            st["gbps"] = st["nbytes"] / GB / wall if st["nbytes"] else None
+        return table
+
+    def report(self):
+        """Lines of text summarising each stage, slowest first"""
+        table = self.table()
+        lines = [
+            "%-28s %6s %10s %10s %10s %8s"
+            % ("Stage", "Calls", "Wall (s)", "CPU (s)", "Frames/s", "GB/s")
+        ]
+        for name, st in sorted(table.items(), key=lambda x: -x[1]["wall"]):
+            lines.append(
+                "%-28s %6d %10.2f %10.2f %10s %8s"
+                % (
+                    name[:28],
+                    st["calls"],
+                    st["wall"],
+                    st["cpu"],
+                    "%.1f" % st["fps"] if st["fps"] is not None else "-",
+                    "%.3f" % st["gbps"] if st["gbps"] is not None else "-",
+                )
+            )
+        return lines
+
+
+PROFILER = StageProfiler()
+
+
+def stage(name, frames=0, nbytes=0):
+    """PROFILER.stage, see StageProfiler.stage"""
+    return PROFILER.stage(name, frames=frames, nbytes=nbytes)
+
+
+def profiled(name=None, frames_axis=None):
+    """
+    Decorator recording each call of a function as a stage
+
+    Args:
+        name (str, optional): stage name. Defaults to the function name.
+        frames_axis (int, optional): if the function returns an array, count its size along
+                                     this axis as frames, and its nbytes as bytes. Defaults to None.
+    """
+
+    def decorator(func):
+        stage_name = name or func.__name__
+
+        @functools.wraps(func)
+        def wrapper(*args, **kwargs):
+            with PROFILER.stage(stage_name) as rec:
+                out = func(*args, **kwargs)
+                if frames_axis is not None and hasattr(out, "shape"):
+                    rec.count(frames=out.shape[frames_axis], nbytes=out.nbytes)
+            return out
+
+        return wrapper
+
+    return decorator
+
+
+def log_peak_memory(job, name, mem):
+    """Log the memory used by a Job step, and the peak predicted by job.plan_memory if there is one"""
+    if mem.thread is None:
+        return
+    used_gb = (mem.peak - mem.start_rss) / GB
+    string = "Peak memory of %s: %.2f GB above the %.2f GB at the start" % (
+        name,
+        used_gb,
+        mem.start_rss / GB,
+    )
+    plan = job.params.get("memory_plan") or {}
+    predicted_gb = plan.get("predicted_gb", {}).get(name)
+    if predicted_gb is not None:
+        string += ", predicted %.2f GB" % predicted_gb
+    job.log(string, 1, stage=name, kind="profile", log_mem_usage=True)
+
+
+def profile_job_stage(name):
+    """
+    Decorator for the main Job methods: profiles the whole call as stage name, and at
+    the end of the outermost profiled call logs the per-stage report. Runs the call
+    under cProfile if job.params['cprofile'] is True.
+    """
+
+    def decorator(method):
+        @functools.wraps(method)
+        def wrapper(self, *args, **kwargs):
+            outermost = PROFILER.depth == 0
+            if outermost:
+                PROFILER.reset()
+            PROFILER.depth += 1
+            prof = None
+            if outermost and self.params.get("cprofile", False):
+                prof = cProfile.Profile()
+                prof.enable()
+            mem = PeakMemorySampler() if outermost else nullcontext()
+            try:
+                with mem, PROFILER.stage(name):
+                    return method(self, *args, **kwargs)
+            finally:
+                PROFILER.depth -= 1
+                if outermost:
+                    log_peak_memory(self, name, mem)
+                if prof is not None:
+                    prof.disable()
+                    prof_dir = os.path.join(self.job_dir, "profiles")
+                    os.makedirs(prof_dir, exist_ok=True)
+                    prof_path = os.path.join(prof_dir, "%s.prof" % name)
+                    prof.dump_stats(prof_path)
+                    self.log("Saved cProfile stats to %s" % prof_path, 1)
+                if outermost:
+                    self.log("Profile of %s:" % name, 1)
+                    table = PROFILER.table()
+                    lines = PROFILER.report()
+                    self.log(lines[0], 2)
+                    # one 'profile' event per stage so the numbers can be read back
+                    # from log.jsonl with job.load_log_events(kind='profile')
+                    for stage_name, line in zip(
+                        sorted(table, key=lambda x: -table[x]["wall"]), lines[1:]
+                    ):
+                        st = table[stage_name]
+                        self.log(
+                            line,
+                            2,
+                            stage=stage_name,
+                            duration=st["wall"],
+                            nbytes=st["nbytes"] or None,
+                            kind="profile",
+                        )
+
+        return wrapper
+
+    return decorator
@@ -1,4 +1,5 @@
 import numpy as n
+from numba import njit, prange
 
 
 def volume_quality(volume, pct_high = 99.99, pct_low = 25.0):
@@ -47,9 +48,8 @@ def shot_noise_pct(fs, frate_hz):
 
 def choose_top_pix(vol, pct = 98):
     nz, ny, nx = vol.shape
-    pcts = n.array([n.percentile(vol[i].flatten(), pct)  for i in range(nz)])
-    n_top_pix = int((100-pct) * ny * nx / 100 - 2)
-    top_pix = n.array([vol[i] >= pcts[i] for i in range(nz)])
+    pcts = n.percentile(vol.reshape(nz, -1), pct, axis=1)
+    top_pix = vol >= pcts[:, None, None]
     return top_pix
 
 def compute_metrics_for_movie(mov, frate_hz, top_pix=None):
@@ -71,5 +71,240 @@ def compute_metrics_for_movie(mov, frate_hz, top_pix=None):
 
     return vol, metrics
 
-    
-    
+
+@njit(nogil=True, cache=True)
+def p2_push(q, pos, desired, dn, count, x):
+    '''
+    add the observation x to one P^2 quantile estimator (Jain & Chlamtac, 1985),
+    the state arrays q, pos, desired are the 5 marker heights and (desired) positions
+    '''
+    if count < 5:
+        # the first 5 observations are kept sorted in q
+        i = count
+        while i > 0 and q[i - 1] > x:
+            q[i] = q[i - 1]
+            i -= 1
+        q[i] = x
+        return count + 1
+    if x < q[0]:
+        q[0] = x
+        k = 0
+    elif x >= q[4]:
+        q[4] = x
+        k = 3
+    else:
+        k = 0
+        while x >= q[k + 1]:
+            k += 1
+    for i in range(k + 1, 5):
+        pos[i] += 1
+    for i in range(5):
+        desired[i] += dn[i]
+    for i in range(1, 4):
+        d = desired[i] - pos[i]
+        if (d >= 1 and pos[i + 1] - pos[i] > 1) or (d <= -1 and pos[i - 1] - pos[i] < -1):
+            s = 1.0 if d > 0 else -1.0
+            # parabolic prediction of the new marker height, linear if it breaks the ordering
+            qp = q[i] + s / (pos[i + 1] - pos[i - 1]) * (
+                (pos[i] - pos[i - 1] + s) * (q[i + 1] - q[i]) / (pos[i + 1] - pos[i])
+                + (pos[i + 1] - pos[i] - s) * (q[i] - q[i - 1]) / (pos[i] - pos[i - 1])
+            )
+            if not (q[i - 1] < qp < q[i + 1]):
+                j = i + int(s)
+                qp = q[i] + s * (q[j] - q[i]) / (pos[j] - pos[i])
+            q[i] = qp
+            pos[i] += s
+    return count + 1
+
+
+class P2Quantile:
+    '''
+    Streaming estimate of a quantile for many independent streams with constant memory,
+    using the P^2 algorithm. Exact for streams with 5 or fewer observations.
+
+    Args:
+        n_streams (int): number of independent streams (e.g. planes)
+        p (float, optional): quantile to estimate. Defaults to 0.5 (median).
+    '''
+
+    def __init__(self, n_streams, p=0.5):
+        self.p = p
+        self.q = n.zeros((n_streams, 5))
+        self.pos = n.tile(n.arange(1, 6, dtype=n.float64), (n_streams, 1))
+        self.desired = n.tile(
+            n.array([1, 1 + 2 * p, 1 + 4 * p, 3 + 2 * p, 5], dtype=n.float64), (n_streams, 1)
+        )
+        self.dn = n.array([0, p / 2, p, (1 + p) / 2, 1], dtype=n.float64)
+        self.count = n.zeros(n_streams, dtype=n.int64)
+
+    def estimate(self):
+        '''
+        current estimate for each stream, nan for empty streams
+        '''
+        est = self.q[:, 2].copy()
+        for i in n.where(self.count < 5)[0]:
+            c = self.count[i]
+            est[i] = n.quantile(self.q[i, :c], self.p) if c > 0 else n.nan
+        return est
+
+
+@njit(parallel=True, nogil=True, cache=True)
+def sum_frames_and_pixels(mov):
+    '''
+    single pass over a nz, nt, ny, nx movie returning the sum over time of each voxel
+    and the mean of each plane in each frame
+    '''
+    nz, nt, ny, nx = mov.shape
+    vol_sum = n.zeros((nz, ny, nx))
+    frame_means = n.zeros((nz, nt))
+    for z in prange(nz):
+        for t in range(nt):
+            frame_sum = 0.0
+            for y in range(ny):
+                for x in range(nx):
+                    v = mov[z, t, y, x]
+                    vol_sum[z, y, x] += v
+                    frame_sum += v
+            frame_means[z, t] = frame_sum / (ny * nx)
+    return vol_sum, frame_means
+
+
+@njit(parallel=True, nogil=True, cache=True)
+def push_shot_noise(
+    mov, top_ys, top_xs, frate_hz, split_state, run_state, dn, counts, pix_state, pix_counts
+):
+    '''
+    computes the samples of shot_noise_pct (|change in dF/F| between consecutive frames, per
+    frame rate) for the top pixels of each plane and adds them to the split and run P^2
+    estimators of the plane, and to the split estimator of each pixel, without making any
+    (npix, nt) copies
+    '''
+    nz, nt = mov.shape[:2]
+    npix = top_ys.shape[1]
+    for z in prange(nz):
+        means = n.zeros(npix)
+        for t in range(nt):
+            for p in range(npix):
+                means[p] += mov[z, t, top_ys[z, p], top_xs[z, p]]
+        means /= nt
+        for t in range(nt - 2):
+            for p in range(npix):
+                f0 = mov[z, t, top_ys[z, p], top_xs[z, p]]
+                f1 = mov[z, t + 1, top_ys[z, p], top_xs[z, p]]
+                f2 = mov[z, t + 2, top_ys[z, p], top_xs[z, p]]
+                val = abs(f2 - 2.0 * f1 + f0) / means[p] / frate_hz
+                if not n.isfinite(val):
+                    continue
+                counts[0, z] = p2_push(
+                    split_state[0, z], split_state[1, z], split_state[2, z], dn, counts[0, z], val
+                )
+                counts[1, z] = p2_push(
+                    run_state[0, z], run_state[1, z], run_state[2, z], dn, counts[1, z], val
+                )
+                pix_counts[z, p] = p2_push(
+                    pix_state[0, z, p], pix_state[1, z, p], pix_state[2, z, p], dn,
+                    pix_counts[z, p], val,
+                )
+
+
+class RegistrationMetrics:
+    '''
+    Streaming accumulator for the registration quality metrics. Each registered split is
+    read once, updating per-split rows (volume_quality of the split mean image, the median
+    shot noise of each top pixel as in compute_metrics_for_movie, and the median over all
+    top pixels of the plane) and run-wide per-plane aggregates: the running mean and
+    (Welford) variance of the plane brightness over frames, and a P^2 estimate of the median
+    shot noise. The medians are P^2 estimates, not the exact nanmedian.
+
+    Args:
+        top_pix (ndarray): nz, ny, nx - boolean mask of the pixels to compute noise on,
+            see choose_top_pix
+        frate_hz (float): frame rate
+    '''
+
+    def __init__(self, top_pix, frate_hz):
+        self.nz = top_pix.shape[0]
+        self.frate_hz = frate_hz
+        # same pixels as compute_metrics_for_movie, the first npix of each plane
+        npix = int(top_pix.sum(axis=(1, 2)).min())
+        top = [n.nonzero(top_pix[z]) for z in range(self.nz)]
+        self.top_ys = n.array([ys[:npix] for ys, __ in top], dtype=n.int64).reshape(self.nz, npix)
+        self.top_xs = n.array([xs[:npix] for __, xs in top], dtype=n.int64).reshape(self.nz, npix)
+
+        self.n_frames = 0
+        self.plane_mean = n.zeros(self.nz)
+        self.plane_m2 = n.zeros(self.nz)
+        self.run_noise = P2Quantile(self.nz)
+        self.rows = []
+
+    def add_split(self, mov):
+        '''
+        update the metrics with a registered split of the movie
+
+        Args:
+            mov (ndarray): nz, nt, ny, nx - registered movie
+
+        Returns:
+            vol: nz, ny, nx - mean image of the split
+        '''
+        nt = mov.shape[1]
+        vol_sum, frame_means = sum_frames_and_pixels(mov)
+        vol = (vol_sum / nt).astype(n.float32)
+
+        # merge the frame brightness of this split into the running mean and M2 (Chan et al.)
+        split_mean = frame_means.mean(axis=1)
+        split_m2 = ((frame_means - split_mean[:, None]) ** 2).sum(axis=1)
+        n_total = self.n_frames + nt
+        delta = split_mean - self.plane_mean
+        self.plane_mean += delta * nt / n_total
+        self.plane_m2 += split_m2 + delta**2 * self.n_frames * nt / n_total
+        self.n_frames = n_total
+
+        split_noise = P2Quantile(self.nz)
+        npix = self.top_ys.shape[1]
+        pix_noise = P2Quantile(self.nz * npix)
+        pix_state = n.stack([pix_noise.q, pix_noise.pos, pix_noise.desired]).reshape(
+            3, self.nz, npix, 5
+        )
+        pix_counts = pix_noise.count.reshape(self.nz, npix)
+        split_state = n.stack([split_noise.q, split_noise.pos, split_noise.desired])
+        run_state = n.stack([self.run_noise.q, self.run_noise.pos, self.run_noise.desired])
+        counts = n.stack([split_noise.count, self.run_noise.count])
+        push_shot_noise(
+            mov, self.top_ys, self.top_xs, float(self.frate_hz),
+            split_state, run_state, split_noise.dn, counts, pix_state, pix_counts,
+        )
+        pix_noise.q, pix_noise.pos, pix_noise.desired = pix_state.reshape(3, -1, 5)
+        pix_noise.count = pix_counts.reshape(-1)
+        split_noise.q, split_noise.pos, split_noise.desired = split_state
+        split_noise.count = counts[0]
+        self.run_noise.q, self.run_noise.pos, self.run_noise.desired = run_state
+        self.run_noise.count = counts[1]
+
+        row = volume_quality(vol)
+        # noise_levels is the per-pixel key written by compute_metrics_for_movie
+        row['noise_levels'] = pix_noise.estimate().reshape(self.nz, npix)
+        row['noise_level'] = split_noise.estimate()
+        row['n_frames'] = nt
+        self.rows.append(row)
+        return vol
+
+    def table(self):
+        '''
+        Returns:
+            metrics: dictionary of per-split arrays (n_splits, nz) with the keys of
+            volume_quality and noise_level, noise_levels (n_splits, nz, npix), and
+            per-plane run aggregates (nz,)
+        '''
+        metrics = {}
+        if len(self.rows) > 0:
+            for key in self.rows[0].keys():
+                metrics[key] = n.array([row[key] for row in self.rows])
+        metrics['run_n_frames'] = self.n_frames
+        metrics['run_plane_mean'] = self.plane_mean.copy()
+        metrics['run_plane_std'] = n.sqrt(self.plane_m2 / max(self.n_frames - 1, 1))
+        metrics['run_noise_level'] = self.run_noise.estimate()
+        return metrics
+
+    def save(self, path):
+        n.save(path, self.table())
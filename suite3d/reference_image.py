@@ -3,14 +3,11 @@
 import numpy as np
 
 n = np
-import cupy as cp
 import os
 import time
+from concurrent.futures import ThreadPoolExecutor
 import mkl_fft
-import cupy as cp
-import cupyx.scipy.fft as cufft
 import scipy.fft
-import cupyx.scipy.ndimage as cuimage
 from numba import vectorize, complex64
 from numpy import fft
 
@@ -18,6 +15,7 @@ from numpy import fft
 from . import register_gpu as reg
 from . import reg_3d as reg_3d  # new 3d registration functions
 from .utils import default_log
+from .backend import cp
 
 # Function which runs createion of reference image+ masks
 
@@ -95,6 +93,8 @@ def compute_reference_and_masks(
             rmaxs=rmaxs,
             max_reg_xy=max_reg_xy,
             sigma=sigma,
+            conv_tol=reference_params.get("conv_tol", 1e-3),
+            log_cb=log_cb,
         )
 
     if reference_params.get("plane_to_plane_alignment", True):
@@ -198,7 +198,7 @@ def get_phasecorr_and_masks(ref_image, reference_params):
     smooth_sigma = reference_params["smooth_sigma"]
 
     mult_mask_rigid, add_mask_rigid = compute_masks3D(ref_image.squeeze(), sigma)
-    refs_fft_rigid = np.zeros_like(ref_image, dtype=complex)
+    refs_fft_rigid = np.zeros_like(ref_image, dtype=np.complex64)
     for z in range(nz):
         refs_fft_rigid[z] = phasecorr_ref(
             ref_image[z, :, :].squeeze(), smooth_sigma=smooth_sigma
@@ -214,11 +214,14 @@ def get_phasecorr_and_masks(ref_image, reference_params):
     reference_params["yblock"] = yblock
 
     mult_mask_NR = np.zeros(
-        (nblocks[0] * nblocks[1], nz, 1, block_size[0], block_size[1])
+        (nblocks[0] * nblocks[1], nz, 1, block_size[0], block_size[1]), dtype=np.float32
+    )
+    add_mask_NR = np.zeros(
+        (nblocks[0] * nblocks[1], nz, 1, block_size[0], block_size[1]), dtype=np.float32
     )
-    add_mask_NR = np.zeros((nblocks[0] * nblocks[1], nz, 1, block_size[0], block_size[1]))
     refs_fft_NR = np.zeros(
-        (nblocks[0] * nblocks[1], nz, 1, block_size[0], block_size[1]), dtype=complex
+        (nblocks[0] * nblocks[1], nz, 1, block_size[0], block_size[1]),
+        dtype=np.complex64,
     )
     for z in range(nz):
         mult_mask_NR[:, z, :, :], add_mask_NR[:, z, :, :], refs_fft_NR[:, z, :, :] = (
@@ -480,8 +483,9 @@ def compute_masks3D(refImg, sigma):
     """
     sig, sigz = sigma
     nz, ny, nx = refImg.shape
-    mask_mul = spatial_taper3D(sig, sigz, nz, ny, nx)
-    mask_offset = refImg.mean() * (1.0 - mask_mul)
+    # float32, like the frames they are applied to (s2p_registration.addmultiply)
+    mask_mul = spatial_taper3D(sig, sigz, nz, ny, nx).astype(np.float32)
+    mask_offset = (refImg.mean() * (1.0 - mask_mul)).astype(np.float32)
     return mask_mul, mask_offset
 
 
@@ -542,59 +546,35 @@ def align_planes(mov3D, reference_params):
     smooth_sigma = reference_params["smooth_sigma"]
     max_reg_xy = reference_params["max_reg_xy_reference"]
 
-    mov3D = n.asarray(mov3D, dtype=n.complex64)
-    mov3D = np.expand_dims(
-        mov3D, axis=1
-    )  # make it (nz, 1, ny, nx) so it is in for used by other registration function
+    mov3D = n.asarray(mov3D, dtype=n.float32)
+    nz, ny, nx = mov3D.shape
+    ymaxs = n.zeros(nz, dtype=n.int16)
+    xmaxs = n.zeros(nz, dtype=n.int16)
 
-    # set up params
-    ncc = max_reg_xy * 2 + 1
-    nz, nt, ny, nx = mov3D.shape
-    # print("GOT SHAPE")
-    ymaxs = n.zeros((nz, nt), dtype=n.int16)
-    xmaxs = n.zeros((nz, nt), dtype=n.int16)
-    cmaxs = n.zeros((nz, nt), dtype=n.float32)
-    ncc = max_reg_xy * 2 + 1
-    phase_corr = n.zeros((nt, ncc, ncc))
+    mult_mask, add_mask = compute_masks3D(mov3D, sigma)
 
-    # print("COMPUTING MASKS")
-    mult_mask, add_mask = compute_masks3D(mov3D.squeeze(), sigma)
-    # print("DONE")
+    if nz < 2:
+        return np.zeros((nz, 2), dtype=int)
 
-    # turn the input mov into a reference image for registration
-    refs_f = np.zeros_like(mov3D)
-    # print("LOOP1")
-    for z in range(nz):
-        # print(z)
-        refs_f[z] = phasecorr_ref(mov3D[z, :, :].squeeze(), smooth_sigma=smooth_sigma)
-    # return None
-
-    # find the shifts between two z planes
-    for zidx in range(1, nz):
-        # print(z)
-        mov3D[zidx] = reg.clip_and_mask_mov(
-            mov3D[zidx],
-            None,
-            None,  # can speed thisup with numba/parallelisation?
-            mult_mask[zidx],
-            add_mask[zidx],
-            cp=n,
-        )
-        mov3D[zidx] = reg.convolve_2d_cpu(
-            mov3D[zidx], refs_f[zidx - 1]
-        )  # here is zidx and zidx - 1
-        reg.unwrap_fft_2d(mov3D[zidx].real, max_reg_xy, out=phase_corr, cp=n)
-        ymaxs[zidx], xmaxs[zidx], cmaxs[zidx] = reg.get_max_cc_coord(
-            phase_corr, max_reg_xy, cp=n
-        )
+    # each plane is the reference for the next plane
+    refs_f = n.stack(
+        [
+            reg.rfft_ref(phasecorr_ref(mov3D[z], smooth_sigma=smooth_sigma))
+            for z in range(nz - 1)
+        ]
+    )
+
+    # find the shifts between two z planes, all planes in one batch
+    phase_corr = reg.phasecorr_rfft_cpu(
+        mov3D[1:], refs_f, max_reg_xy, mult_mask[1:], add_mask[1:]
+    )
+    ymaxs[1:], xmaxs[1:], __ = reg.get_max_cc_coord(phase_corr, max_reg_xy, cp=n)
 
     tvecY = -np.cumsum(ymaxs)
     tvecX = -np.cumsum(xmaxs)
     return np.stack((tvecY, tvecX), axis=1)
 
 
-# TODO for these function apply_plane_shiftsXD, this can take a bit of time ~30-60s for a full 4D movie
-# There should be a faster way, numba doesnt allow 2D shifts, joblib was not faster over time for 4D array
 def apply_plane_shifts3D(mov, tvecs):
     """
     Applies planeshifts over the Z axis to allign a padded movie
@@ -611,15 +591,7 @@ def apply_plane_shifts3D(mov, tvecs):
     shifted_mov : ndarray
         Shifted version on the input movie
     """
-    nz = mov.shape[0]
-
-    shifted_mov = np.zeros_like(mov)
-    for i in range(nz):
-        shifted_mov[i] = reg.shift_frame(
-            mov[i], -tvecs[i, 0].astype(int), -tvecs[i, 1].astype(int), cp=np
-        )
-
-    return shifted_mov
+    return apply_plane_shiftd4D(mov[:, np.newaxis], tvecs)[:, 0]
 
 
 def apply_plane_shiftd4D(mov, tvecs):
@@ -638,21 +610,11 @@ def apply_plane_shiftd4D(mov, tvecs):
     shifted_mov : ndarray
         Shifted version on the input movie
     """
-    nt = mov.shape[1]
-
-    ShiftedMov = np.zeros_like(mov)
-    for i in range(nt):
-        ShiftedMov[:, i, :, :] = apply_plane_shifts3D(
-            mov[
-                :,
-                i,
-                :,
-                :,
-            ],
-            tvecs,
-        )
-
-    return np.asarray(ShiftedMov)
+    nz, __, ny, nx = mov.shape
+    plan = reg_3d.build_gather_plan(
+        nz, ny, nx, plane_shifts=np.asarray(tvecs).astype(int)
+    )
+    return reg_3d.execute_gather_plan(np.asarray(mov), plan, ny, nx)
 
 
 ##########################################
@@ -683,7 +645,8 @@ def get_reference_img_gpu(
     rmaxs : ndarray, optional
         The maximum values of each plane, by default None
     batch_size : int, optional
-        The amount of frames sent to the GPU in one batch, by default 20
+        The amount of frames sent to the GPU in one batch, by default 20.
+        None picks the largest batch that fits in the free GPU memory
     max_reg_xy : int, optional
         The maximum allowed x/y shift, by default 50
     sigma : list, optional
@@ -729,8 +692,12 @@ def get_reference_img_gpu(
 
     # GPU only, used to calculate batches for the gpu
     nt = frames.shape[1]
-    batch_size = 20  # number of time steps sent to the gpu at once #param?
-    nBatches = np.ceil(nt / batch_size).astype(int)
+    if batch_size is None:
+        batch_size = reg.auto_gpu_batch_size(
+            reg.estimate_rigid_2d_frame_bytes(nz, ny, nx, max_reg_xy),
+            fixed_bytes=3 * mult_mask.nbytes,
+            max_batch_size=nt,
+        )
 
     for iter in range(niter):
         iter_frames = []
@@ -747,12 +714,12 @@ def get_reference_img_gpu(
 
         # mask is applied in rigid_2d_reg_gpu
         # need to send to gpu a few ~ 20 frames at a a time. gpu Ram
-        for i in range(nBatches):
+        def reg_batch(batch_size):
             idx1 = min(
-                frames.shape[1], (i + 1) * batch_size
+                frames.shape[1], idx0 + batch_size
             )  # catch the case when the final idx would be larger than the array
             tmp_frames, tmp_ymax, tmp_xmax, tmp_cmax = reg.rigid_2d_reg_gpu(
-                frames[:, i * batch_size : idx1, :, :],
+                frames[:, idx0:idx1, :, :],
                 mult_mask,
                 add_mask,
                 refs_f,
@@ -765,14 +732,16 @@ def get_reference_img_gpu(
 
             # moving data from gpu to cpu
             tmp_frames = tmp_frames.swapaxes(0, 1)
-            frames[:, i * batch_size : idx1, :, :] = cp.asnumpy(tmp_frames)
-            ymax[iter, :, i * batch_size : idx1] = cp.asnumpy(tmp_ymax)
-            xmax[iter, :, i * batch_size : idx1] = cp.asnumpy(tmp_xmax)
-            cmax[iter, :, i * batch_size : idx1] = cp.asnumpy(tmp_cmax)
-            del tmp_frames
-            del tmp_ymax
-            del tmp_xmax
-            del tmp_cmax
+            frames[:, idx0:idx1, :, :] = cp.asnumpy(tmp_frames)
+            ymax[iter, :, idx0:idx1] = cp.asnumpy(tmp_ymax)
+            xmax[iter, :, idx0:idx1] = cp.asnumpy(tmp_xmax)
+            cmax[iter, :, idx0:idx1] = cp.asnumpy(tmp_cmax)
+            return idx1
+
+        # batches shrink if the GPU runs out of memory
+        idx0 = 0
+        while idx0 < nt:
+            idx0, batch_size = reg.run_with_oom_backoff(reg_batch, batch_size)
 
         # nmax = max(2, int(frames.shape[1] * (1 + iter) / (2*niter) )) #original suite 2p
         nmax = nframes[iter]  # change so it uses more frames
@@ -803,9 +772,14 @@ def get_reference_img_cpu(
     rmaxs=None,
     max_reg_xy=30,
     sigma=[1.45, 0],
+    conv_tol=1e-3,
+    n_threads=None,
+    log_cb=default_log,
 ):
     """
-    This function creates a reference image using the GPU for a speed up
+    This function creates a reference image on the cpu. Planes are built in parallel threads,
+    the fft of each plane's frames is computed once and reused in every iteration, and a plane
+    stops iterating once its shifts and reference image have converged.
 
     Parameters
     ----------
@@ -814,7 +788,7 @@ def get_reference_img_cpu(
     percent_contribute : float
         The percentage of input frames which contributed to the final reference image
     niter : int
-        The number of interation used to create the reference image
+        The maximum number of interation used to create the reference image
     rmins : ndarray, optional
         The minimum values of each plane, by default None
     rmaxs : ndarray, optional
@@ -823,6 +797,11 @@ def get_reference_img_cpu(
         The maximum allowed x/y shift, by default 30
     sigma : list, optional
         The smoothing values in x/y and z, by default [1.45, 0]
+    conv_tol : float, optional
+        A plane has converged when the frames contributing to the reference didn't move and
+        1 - corr(new reference, old reference) < conv_tol, by default 1e-3. 0 runs all iterations
+    n_threads : int, optional
+        Number of planes built at once, by default one per cpu core
 
     Returns
     -------
@@ -838,13 +817,9 @@ def get_reference_img_cpu(
         The first dimension is iteration number, the second is plane number. The value is the frames
         used for the reference iamge in that iteration and plane.
     """
-    ncc = max_reg_xy * 2 + 1 # unused?
-
-    refImg = init_ref_3d(frames)
-    nz, ny, nx = refImg.shape
-
     refImg = init_ref_3d(frames)
     nz, ny, nx = refImg.shape
+    nt = frames.shape[1]
 
     # Allows rmins/rmaxs to be None, need as list of None
     if rmins is None and rmaxs is None:
@@ -852,64 +827,197 @@ def get_reference_img_cpu(
         rmaxs = [None for i in range(nz)]
 
     # Get the computed masks, once.. as its the same for thesame shape of array.. save time...
-    # mask_offset need toupdate to refimg, so cal seeratley
-    mult_mask, add_mask = compute_masks3D(refImg, sigma)
+    # the offset mask is mean * (1 - mult_mask), the first iteration uses the mean of the
+    # initial reference and the following ones the mean of the frames
+    mult_mask, __ = compute_masks3D(refImg, sigma)
+    offsets = (refImg.mean(), frames.mean())
 
     # create empty array for values to keep
-    cmax = np.zeros((niter, frames.shape[0], frames.shape[1]))
-    ymax = np.zeros((niter, frames.shape[0], frames.shape[1]))
-    xmax = np.zeros((niter, frames.shape[0], frames.shape[1]))
-    used_frames = []
+    cmax = np.zeros((niter, nz, nt))
+    ymax = np.zeros((niter, nz, nt))
+    xmax = np.zeros((niter, nz, nt))
+    used_frames = [[None] * nz for i in range(niter)]
+    iter_times = np.full((niter, nz), np.nan)
+
+    nframes = np.linspace(20, percent_contribute * nt, niter, dtype=np.int16)
+    if n_threads is None:
+        n_threads = os.cpu_count()
+    n_threads = max(1, min(n_threads, nz))
+
+    def build_plane(z):
+        return get_reference_plane_cpu(
+            frames[z],
+            refImg[z],
+            mult_mask[z],
+            offsets,
+            nframes,
+            rmins[z],
+            rmaxs[z],
+            max_reg_xy=max_reg_xy,
+            conv_tol=conv_tol,
+        )
+
+    tic = time.time()
+    with ThreadPoolExecutor(n_threads) as pool:
+        results = list(pool.map(build_plane, range(nz)))
+    for z, (ref_z, ymax_z, xmax_z, cmax_z, used_z, times_z) in enumerate(results):
+        refImg[z] = ref_z
+        ymax[:, z], xmax[:, z], cmax[:, z] = ymax_z, xmax_z, cmax_z
+        iter_times[: len(times_z), z] = times_z
+        for iter in range(niter):
+            used_frames[iter][z] = used_z[iter]
 
-    nframes = np.linspace(20, percent_contribute * frames.shape[1], niter, dtype=np.int16)
     for iter in range(niter):
-        iter_frames = []
-        # only get offset mask if needed
-        if iter != 0:
-            add_mask = compute_mask_offset(frames, mult_mask)
+        n_planes = np.sum(~np.isnan(iter_times[iter]))
+        if n_planes == 0:
+            break
+        log_cb(
+            "Reference iteration %d: %d planes, %.2fs per plane"
+            % (iter, n_planes, np.nanmean(iter_times[iter])),
+            3,
+        )
+    n_iters = np.sum(~np.isnan(iter_times), axis=0)
+    log_cb(
+        "Built reference in %.2fs, planes ran %d-%d of %d iterations"
+        % (time.time() - tic, n_iters.min(), n_iters.max(), niter),
+        2,
+    )
+    return refImg, ymax, xmax, cmax, used_frames
 
-        # temporary
-        refs_f = n.zeros((nz, ny, nx))
 
-        for z in range(
-            nz
-        ):  # need to go iver each frame for the reference.. do sigz = 0 as well for this..
-            refs_f[z] = phasecorr_ref(refImg[z, :, :].squeeze(), smooth_sigma=1.15)
+def mean_shifted_frames(frames, idxs, shift_y, shift_x):
+    """
+    Mean of frames[idxs] after shifting each by (shift_y, shift_x), as reg.shift_frame.
+    Frames with the same shift are summed before shifting, so only one shift is done per
+    distinct shift
 
-        # mask is applied in rigid_2d_reg_cpu
-        # this will only return mov_shifted, ymaxs, xmaxs
-        # tmp, ymax[iter], xmax[iter], cmax[iter] = reg.rigid_2d_reg_cpu(
-        tmp, ymax[iter], xmax[iter] = reg.rigid_2d_reg_cpu(
-            frames,
-            mult_mask,
-            add_mask,
-            refs_f,
-            max_reg_xy,
-            rmins,
-            rmaxs,
-            crosstalk_coeff=None,
-            shift=True,
-        )  # check max_reg_xy
-        frames = tmp.swapaxes(
-            0, 1
-        )  # need to swap axes as by default reigid_2d_reg_cpu return nt,nz not nz,nt
-        del tmp
+    Parameters
+    ----------
+    frames : ndarray (nt, ny, nx)
+    idxs : ndarray
+        the frames to average
+    shift_y, shift_x : ndarray (nt,)
+        integer shift of every frame
 
-        nmax = nframes[iter]  # pick amount of frames which contribute
-        for z in range(nz):
-            isort = n.argsort(-cmax[iter, z, :])[1:nmax]
+    Returns
+    -------
+    ndarray (ny, nx), float32
+    """
+    __, ny, nx = frames.shape
+    mean_img = np.zeros((ny, nx), dtype=np.float32)
+    if len(idxs) == 0:
+        return mean_img
+    shifts = np.stack((shift_y[idxs], shift_x[idxs]), axis=1)
+    unique_shifts, group = np.unique(shifts, axis=0, return_inverse=True)
+    group = group.ravel()
+    for i, (dy, dx) in enumerate(unique_shifts):
+        summed = frames[idxs[group == i]].sum(axis=0, dtype=np.float32)
+        mean_img += reg.shift_frame(summed, int(dy), int(dx), cp=np)
+    return mean_img / len(idxs)
+
+
+def get_reference_plane_cpu(
+    frames,
+    ref_img,
+    mult_mask,
+    offsets,
+    nframes,
+    rmin=None,
+    rmax=None,
+    max_reg_xy=30,
+    conv_tol=1e-3,
+    n_workers=1,
+):
+    """
+    Iteratively builds the reference image of one plane, see get_reference_img_cpu.
+    Frames are registered from their original position in every iteration, so the fft
+    of the masked frames is only computed once.
 
-            refImg[z] = (
-                frames[z, isort.squeeze(), :, :].mean(axis=0).squeeze()
-            )  # refImg is mean of the most correlated frames
-            refImg[z, :, :] = reg.shift_frame(
-                refImg[z, :, :],
-                int(n.round(+ymax[iter, z, isort].mean())),
-                int(n.round(-xmax[iter, z, isort].mean())),
-                cp=n,
-            )  # ~recenter refImg
-        used_frames.append(iter_frames)
-    return refImg, ymax, xmax, cmax, used_frames
+    Parameters
+    ----------
+    frames : ndarray (nt, ny, nx)
+        The frames of this plane
+    ref_img : ndarray (ny, nx)
+        The initial reference image
+    mult_mask : ndarray (ny, nx)
+        The multiplication mask
+    offsets : tuple
+        mean value used for the offset mask in the first and following iterations
+    nframes : ndarray (niter,)
+        Number of frames contributing to the reference at each iteration
+
+    Returns
+    -------
+    ref_img : ndarray (ny, nx)
+    ymax, xmax : ndarray (niter, nt)
+        The shift added in each iteration, 0 once converged
+    cmax : ndarray (niter, nt)
+    used_frames : list (niter)
+    iter_times : list
+        seconds taken by each iteration that ran
+    """
+    niter = len(nframes)
+    nt, ny, nx = frames.shape
+    ymax = np.zeros((niter, nt))
+    xmax = np.zeros((niter, nt))
+    cmax = np.zeros((niter, nt))
+    used_frames = []
+    iter_times = []
+
+    # the masked frames and offset mask are fft'd once, the offset is scaled per iteration
+    mov = np.array(frames, dtype=np.float32)
+    if rmin is not None and rmax is not None:
+        np.clip(mov, rmin, rmax, out=mov)
+    mov *= mult_mask.astype(np.float32)
+    mov_f = scipy.fft.rfft2(mov, workers=n_workers)
+    del mov
+    offset_f = scipy.fft.rfft2((1.0 - mult_mask).astype(np.float32), workers=n_workers)
+
+    ref_img = ref_img.astype(np.float32)
+    shift_y = np.zeros(nt, dtype=np.int32)
+    shift_x = np.zeros(nt, dtype=np.int32)
+    for iter in range(niter):
+        tic = time.time()
+        offset = offsets[0] if iter == 0 else offsets[1]
+        ref_f = reg.rfft_ref(phasecorr_ref(ref_img, smooth_sigma=1.15))
+        phase_corr = reg.phasecorr_rfft_spectrum(
+            mov_f + np.complex64(offset) * offset_f, ref_f, max_reg_xy, nx, n_workers
+        )
+        new_y, new_x, cmax[iter] = reg.get_max_cc_coord(phase_corr, max_reg_xy, cp=n)
+        ymax[iter] = new_y - shift_y
+        xmax[iter] = new_x - shift_x
+        shift_y = new_y.astype(np.int32)
+        shift_x = new_x.astype(np.int32)
+
+        nmax = nframes[iter]  # pick amount of frames which contribute
+        isort = n.argsort(-cmax[iter])[1:nmax]
+        prev_ref = ref_img
+        # refImg is mean of the most correlated frames
+        ref_img = mean_shifted_frames(frames, isort, shift_y, shift_x)
+        # ~recenter refImg on the mean raw position of the frames used, so that the
+        # shifts settle instead of drifting by the rounded mean shift every iteration
+        ref_img = reg.shift_frame(
+            ref_img,
+            -int(n.round(shift_y[isort].mean())),
+            -int(n.round(shift_x[isort].mean())),
+            cp=n,
+        )
+        used_frames.append(isort)
+        iter_times.append(time.time() - tic)
+
+        if iter == niter - 1 or iter == 0 or conv_tol <= 0:
+            continue
+        moved = np.any(ymax[iter, isort] != 0) or np.any(xmax[iter, isort] != 0)
+        ref_change = 1 - np.corrcoef(ref_img.ravel(), prev_ref.ravel())[0, 1]
+        if not moved and ref_change < conv_tol:
+            # shifts have settled, the remaining iterations only add frames
+            isort = n.argsort(-cmax[iter])[1 : nframes[-1]]
+            ref_img = mean_shifted_frames(frames, isort, shift_y, shift_x)
+            for i in range(iter + 1, niter):
+                cmax[i] = cmax[iter]
+                used_frames.append(isort[: max(nframes[i] - 1, 0)])
+            break
+    return ref_img, ymax, xmax, cmax, used_frames, iter_times
 
 
 ############################################################
@@ -3,17 +3,169 @@ import os
 import numpy as n
 
 np = n
-import cupy as cp
-from cupyx.scipy import fft as cufft
 import scipy
-from numba import njit
+from numba import njit, prange
 
 from . import reference_image as ref
 from . import register_gpu as reg
 from . import utils
+from .utils import default_log
+from .backend import cp, get_backend
+
+
+# Gather plans: plane shifts, strip fusing and padding are all rectangular copies
+# from the source movie into a zero-filled output, so they are described once as a
+# table of blocks and executed in a single parallel pass over the movie.
+# Each block is (z, dst_y0, src_y0, len_y, dst_x0, src_x0, len_x).
+
+
+def fuse_pieces(fuse_shift, new_xs, old_xs, nx_out, x_offset=0):
+    """
+    The (dst_x0, src_x0, length) strips copied by register_gpu.fuse_and_pad
+    """
+    pieces = []
+    for (nx0, nx1), (ox0, __) in zip(new_xs, old_xs):
+        dst = range(*slice(x_offset + nx0, x_offset + nx1).indices(nx_out))
+        if len(dst) > 0:
+            pieces.append((dst.start, int(ox0), len(dst)))
+    return pieces
+
+
+def fuse_movie_pieces(n_skip, centers, shift_x, nx, nx_out):
+    """
+    The (dst_x0, src_x0, length) strips copied by iter_step.fuse_movie for one plane
+    """
+    n_skip_l = n_skip // 2
+    centers = list(centers) + [nx]
+    pieces = []
+    curr_x = 0
+    curr_x_new = 0
+    for center in centers:
+        wid = int(center + shift_x) - curr_x
+        dst = range(*slice(curr_x_new, curr_x_new + wid - n_skip).indices(nx_out))
+        src_x0 = slice(curr_x + n_skip_l, None).indices(nx)[0]
+        if len(dst) > 0:
+            pieces.append((dst.start, src_x0, len(dst)))
+        curr_x_new += wid - n_skip
+        curr_x += wid
+    return pieces
+
+
+def _shift_pieces(pieces, shift, n_out):
+    # move (dst0, src0, length) pieces by shift and clip them to [0, n_out)
+    shifted = []
+    for dst0, src0, length in pieces:
+        lo = max(dst0 + shift, 0)
+        hi = min(dst0 + shift + length, n_out)
+        if hi > lo:
+            shifted.append((lo, src0 + lo - (dst0 + shift), hi - lo))
+    return shifted
+
+
+def build_gather_plan(
+    nz, src_ny, src_nx, out_ny=None, out_nx=None, x_pieces=None, plane_shifts=None
+):
+    """
+    Builds the block table copying a (nz, nt, src_ny, src_nx) movie into a
+    (nz, nt, out_ny, out_nx) output, optionally fusing strips along x and then
+    shifting each plane so that out[z, :, y, x] = fused[z, :, y - dy, x - dx].
+
+    Parameters
+    ----------
+    nz, src_ny, src_nx : int
+        Shape of the source planes
+    out_ny, out_nx : int, optional
+        Shape of the output planes, by default the source shape
+    x_pieces : list, optional
+        (dst_x0, src_x0, length) strips, either one list for all planes or one list per plane,
+        by default the full width (see fuse_pieces and fuse_movie_pieces)
+    plane_shifts : ndarray (nz, 2), optional
+        The integer (y, x) shift of each plane, by default no shift
+
+    Returns
+    -------
+    ndarray (n_blocks, 7)
+        The gather plan for execute_gather_plan
+    """
+    if out_ny is None:
+        out_ny = src_ny
+    if out_nx is None:
+        out_nx = src_nx
+    if x_pieces is None:
+        x_pieces = [(0, 0, min(src_nx, out_nx))]
+    per_plane = len(x_pieces) > 0 and isinstance(x_pieces[0], list)
+    y_pieces = [(0, 0, min(src_ny, out_ny))]
+
+    blocks = []
+    for z in range(nz):
+        xs = x_pieces[z] if per_plane else x_pieces
+        ys = y_pieces
+        if plane_shifts is not None:
+            ys = _shift_pieces(ys, int(plane_shifts[z][0]), out_ny)
+            xs = _shift_pieces(xs, int(plane_shifts[z][1]), out_nx)
+        for dy0, sy0, ly in ys:
+            for dx0, sx0, lx in xs:
+                # never read outside of the source planes
+                ly = min(ly, src_ny - sy0)
+                lx = min(lx, src_nx - sx0)
+                if ly > 0 and lx > 0 and sy0 >= 0 and sx0 >= 0:
+                    blocks.append((z, dy0, sy0, ly, dx0, sx0, lx))
+    return np.array(blocks, dtype=np.int64).reshape(-1, 7)
+
+
+@njit(parallel=True, nogil=True, cache=True)
+def gather_copy(src, out, plan, crosstalk_coeff=0.0, cavity_size=0):
+    """
+    Copies the blocks of a gather plan from src to out, in parallel over planes and frames.
+    If crosstalk_coeff is non-zero, crosstalk is subtracted from the source planes on the fly,
+    giving the same result as utils.crosstalk_subtract before the copy
+    """
+    nz, nt = out.shape[0], out.shape[1]
+    n_blocks = plan.shape[0]
+    for i in prange(nz * nt):
+        z = i // nt
+        t = i % nt
+        # crosstalk_subtract cascades: out[z] = src[z] - c * out[z - cavity], i.e. a sum
+        # over src[z - j * cavity] with weights (-c)^j
+        n_terms = 1
+        if crosstalk_coeff != 0 and cavity_size > 0:
+            n_terms = z // cavity_size + 1
+        for b in range(n_blocks):
+            if plan[b, 0] != z:
+                continue
+            dy0, sy0, ly = plan[b, 1], plan[b, 2], plan[b, 3]
+            dx0, sx0, lx = plan[b, 4], plan[b, 5], plan[b, 6]
+            for y in range(ly):
+                for x in range(lx):
+                    val = np.float64(src[z, t, sy0 + y, sx0 + x])
+                    weight = 1.0
+                    for j in range(1, n_terms):
+                        weight *= -crosstalk_coeff
+                        val += weight * src[z - j * cavity_size, t, sy0 + y, sx0 + x]
+                    out[z, t, dy0 + y, dx0 + x] = val
+    return out
+
+
+def execute_gather_plan(
+    src, plan, out_ny, out_nx, fill_value=0, dtype=None, crosstalk_coeff=None, cavity_size=15
+):
+    """
+    Runs a plan from build_gather_plan on a (nz, nt, ny, nx) movie, returning a new
+    (nz, nt, out_ny, out_nx) movie filled with fill_value outside the copied blocks.
+    Crosstalk is subtracted during the copy if crosstalk_coeff is given
+    """
+    nz, nt = src.shape[:2]
+    if dtype is None:
+        dtype = src.dtype
+    if fill_value == 0:
+        out = np.zeros((nz, nt, out_ny, out_nx), dtype=dtype)
+    else:
+        out = np.full((nz, nt, out_ny, out_nx), fill_value, dtype=dtype)
+    if crosstalk_coeff is None or src.shape[0] <= cavity_size:
+        crosstalk_coeff = 0.0
+    return gather_copy(src, out, plan, float(crosstalk_coeff), int(cavity_size))
 
 
-@njit(nogil=True, cache=True)
 def shift_mov_lbm_fast(mov, plane_shifts, fill_value=0):
     """
     Apply LBM shifts over a 4D movie, these shifts are same for all time and have different x/y shifts per z-plane
@@ -32,66 +184,9 @@ def shift_mov_lbm_fast(mov, plane_shifts, fill_value=0):
     ndarray (nz, nt, ny, nx)
         The shifted array
     """
-
-    shifted_mov = np.zeros_like(mov)
-    nz, __, __, __ = mov.shape
-
-    for z in range(nz):
-        shift = plane_shifts[z, :]
-        # print(z, shift)
-        if (shift[0] == 0) & (shift[1] == 0):
-            # print(1)
-            shifted_mov[z, :, :, :] = mov[z, :, :, :]
-        elif (shift[0] >= 0) & (shift[1] >= 0):
-            # print(2)
-            if shift[1] > 0:
-                # print('a')
-                shifted_mov[z, :, :, : shift[1]] = fill_value
-            if shift[0] > 0:
-                # print('b')
-                shifted_mov[z, :, : shift[0], :] = fill_value
-
-            if shift[0] == 0:
-                # print('c')
-                shifted_mov[z, :, :, shift[1] :] = mov[z, :, :, : -shift[1]]
-            elif shift[1] == 0:
-                shifted_mov[z, :, shift[0] :, :] = mov[z, :, : -shift[0], :]
-            else:
-                # print('e')
-                shifted_mov[z, :, shift[0] :, shift[1] :] = mov[
-                    z, :, : -shift[0], : -shift[1]
-                ]
-        elif (shift[0] >= 0) & (shift[1] < 0):
-            # print(3)
-            shifted_mov[z, :, :, shift[1] :] = fill_value
-            if shift[0] > 0:
-                shifted_mov[z, :, : shift[0], :] = fill_value
-                shifted_mov[z, :, shift[0] :, : shift[1]] = mov[
-                    z, :, : -shift[0], -shift[1] :
-                ]
-            else:
-                shifted_mov[z, :, shift[0] :, : shift[1]] = mov[z, :, :, -shift[1] :]
-
-        elif (shift[0] < 0) & (shift[1] >= 0):
-            # print(4)
-            shifted_mov[z, :, shift[0] :, :] = fill_value
-            if shift[1] > 0:
-                shifted_mov[z, :, :, : shift[1]] = fill_value
-                shifted_mov[z, :, : shift[0], shift[1] :] = mov[
-                    z, :, -shift[0] :, : -shift[1]
-                ]
-            else:
-                shifted_mov[z, :, : shift[0], shift[1] :] = mov[z, :, -shift[0] :, :]
-
-        else:
-            # print(5)
-            shifted_mov[z, :, :, shift[1] :] = fill_value
-            shifted_mov[z, :, shift[0] :, :] = fill_value
-            shifted_mov[z, :, : shift[0], : shift[1]] = mov[
-                z, :, -shift[0] :, -shift[1] :
-            ]
-
-    return shifted_mov
+    nz, __, ny, nx = mov.shape
+    plan = build_gather_plan(nz, ny, nx, plane_shifts=plane_shifts)
+    return execute_gather_plan(mov, plan, ny, nx, fill_value)
 
 
 @njit(parallel=True)
@@ -390,9 +485,10 @@ def mask_filter_fft_ref(ref_img, mult_mask, add_mask, smooth=0.5):
     return fft_3d_ref_conj
 
 
-def clip_mov_cpu(mov, rmin, rmax):
+def clip_mov(mov, rmin, rmax, xp=np):
     """
-    Clip the movie per plane between rmin and rmax, numba seems to be slower
+    Clip the movie per plane between rmin and rmax, in place. Works on numpy
+    or cupy arrays (xp), for complex movies only the real part is clipped
 
     Parameters
     ----------
@@ -402,15 +498,42 @@ def clip_mov_cpu(mov, rmin, rmax):
         The minimum allowed value for each plane
     rmax : ndarray (nz,)
         The maximum allowed value for each plane
+    xp : module, optional
+        The array module of mov, by default numpy
 
     Returns
     -------
     ndarray (nz, nt, ny, nx)
         The clipped movie
     """
-    nz, __, __, __ = mov.shape
-    for z in range(nz):
-        mov[z, :, :, :].clip(rmin[z], rmax[z], out=mov[z, :, :, :])
+    if rmin is None and rmax is None:
+        return mov
+    real = mov.real
+    bounds = []
+    for r in (rmin, rmax):
+        if r is None or np.any(np.asarray(r) == None):
+            bounds.append(None)
+        else:
+            r = np.asarray(r, dtype=real.dtype).reshape(-1, 1, 1, 1)
+            bounds.append(xp.asarray(r))
+    if xp.iscomplexobj(mov):
+        mov.real = xp.clip(real, bounds[0], bounds[1])
+    else:
+        xp.clip(mov, bounds[0], bounds[1], out=mov)
+    return mov
+
+
+def clip_mov_cpu(mov, rmin, rmax):
+    return clip_mov(mov, rmin, rmax, xp=np)
+
+
+def apply_mask4D_batch(mov, mask_mul, mask_offset):
+    """
+    Apply the multiplication and addition masks to a (nz, nt, ny, nx) batch
+    in place, broadcasting over time. Works on numpy or cupy arrays
+    """
+    mov *= mask_mul[:, None]
+    mov += mask_offset[:, None]
     return mov
 
 
@@ -456,26 +579,12 @@ def rigid_3d_ref_cpu(
     rmaxs=None,
     crosstalk_coeff=None,
     cavity_size=15,
+    batch_size=None,
+    log_cb=default_log,
 ):
     """
-    Runs the 3d rigid registration for a 4D movie
-
-    Parameters
-    ----------
-    mov_cpu : ndarray (nz, nt, ny, nx)
-        The un-registered movie
-    mult_mask : ndarray ( nz, ny, nx)
-        The pre-calculated multiplcation mask
-    add_mask : ndarray (nz, ny, nx)
-        The pre-calcualted addition mask
-    refs_f : nd array (nz, ny, nx)
-        The filtered fourier transformed reference image
-    pc_size : nd array (2*nz_pc + 1, 2*ny_pc + 1, 2*nx_pc + 1)
-        The nQ_pc is the maximum shift allowed for the Q'th axis
-    rmins : ndarray (nz), optional
-        The minimum allowed value for each plane, by default None
-    rmaxs : ndarray (nz), optional
-        The maximum allowed value for each plane, by default None
+    Runs the 3d rigid registration for a 4D movie on the cpu, using the same
+    batched code as the gpu (see rigid_3d_ref)
 
     Returns
     -------
@@ -488,29 +597,20 @@ def rigid_3d_ref_cpu(
     sub_pixel_shifts : ndarray (nt, 3)
         The sub pixel shift estiamted from the phase correlation
     """
-
-    nz, nt, ny, nx = mov_cpu.shape
-    max_pc_size = pc_size * 2 + 1
-    phase_corr_shifted = np.zeros((nt, max_pc_size[0], max_pc_size[1], max_pc_size[2]))
-    int_shift = np.zeros((nt, 3))
-    pc_peak_loc = np.zeros((nt, 3))
-    sub_pixel_shifts = np.zeros((nt, 3))
-
-    if crosstalk_coeff is not None:
-        mov_cpu = utils.crosstalk_subtract(mov_cpu, crosstalk_coeff, cavity_size)
-    if np.logical_or(np.all(rmins != None), np.all(rmaxs != None)):
-        mov_cpu = clip_mov_cpu(mov_cpu, rmins, rmaxs)
-
-    masked_mov = np.zeros_like(mov_cpu)
-    masked_mov = apply_mask4D(mov_cpu, mult_mask, add_mask, masked_mov)
-
-    for t in range(nt):
-        phase_corr_tmp = reg_3d_cpu(masked_mov[:, t, :, :], refs_f, workers=-1)
-        phase_corr_shifted[t], int_shift[t], pc_peak_loc[t], sub_pixel_shifts[t] = (
-            process_phase_corr_per_frame(phase_corr_tmp, pc_size)
-        )
-
-    return phase_corr_shifted, int_shift, pc_peak_loc, sub_pixel_shifts
+    return rigid_3d_ref(
+        mov_cpu,
+        mult_mask,
+        add_mask,
+        refs_f,
+        pc_size,
+        batch_size=batch_size,
+        rmins=rmins,
+        rmaxs=rmaxs,
+        crosstalk_coeff=crosstalk_coeff,
+        cavity_size=cavity_size,
+        log_cb=log_cb,
+        backend=get_backend(False),
+    )[:4]
 
 
 ## GPU registration function
@@ -533,9 +633,59 @@ def rigid_3d_ref_gpu(
     plane_shifts=None,
     process_mov=False,
     cavity_size=15,
+    log_cb=default_log,
 ):
     """
-    Runs rigid registration on the gpu.
+    Runs rigid registration on the gpu, see rigid_3d_ref
+    """
+    return rigid_3d_ref(
+        mov_cpu,
+        mult_mask,
+        add_mask,
+        refs_f,
+        pc_size,
+        batch_size=batch_size,
+        rmins=rmins,
+        rmaxs=rmaxs,
+        crosstalk_coeff=crosstalk_coeff,
+        shift_reg=shift_reg,
+        xpad=xpad,
+        ypad=ypad,
+        fuse_shift=fuse_shift,
+        new_xs=new_xs,
+        old_xs=old_xs,
+        plane_shifts=plane_shifts,
+        process_mov=process_mov,
+        cavity_size=cavity_size,
+        log_cb=log_cb,
+        backend=get_backend(True),
+    )
+
+
+def rigid_3d_ref(
+    mov_cpu,
+    mult_mask,
+    add_mask,
+    refs_f,
+    pc_size,
+    batch_size=20,
+    rmins=None,
+    rmaxs=None,
+    crosstalk_coeff=None,
+    shift_reg=False,
+    xpad=None,
+    ypad=None,
+    fuse_shift=None,
+    new_xs=None,
+    old_xs=None,
+    plane_shifts=None,
+    process_mov=False,
+    cavity_size=15,
+    log_cb=default_log,
+    backend=None,
+):
+    """
+    Runs rigid registration in batches of frames, on the gpu or the cpu depending on the backend.
 
     Parameters
     ----------
@@ -555,6 +705,11 @@ def rigid_3d_ref_gpu(
         The maximum allowed value for each plane, by default None
     crosstalk_coeff : float, optional
         The value of crosstalk across LBM cavities, by default None
+    batch_size : int, optional
+        Frames sent to the device at once, None picks the largest batch that fits
+        in the free memory. Halved and retried if the device runs out of memory.
+    backend : backend.ArrayBackend, optional
+        numpy or cupy backend, normally get_backend(params['gpu_reg']), by default the gpu
 
     Returns
     -------
@@ -567,7 +722,9 @@ def rigid_3d_ref_gpu(
     sub_pixel_shifts : ndarray (nt, 3)
         The sub pixel shift estiamted from the phase correlation
     """
-    mempool = cp.get_default_memory_pool()
+    if backend is None:
+        backend = get_backend(True)
+    xp = backend.xp
     __, nt, __, __ = mov_cpu.shape
     max_pc_size = pc_size * 2 + 1
 
@@ -579,15 +736,30 @@ def rigid_3d_ref_gpu(
 
     if shift_reg == True:
         mov_shifted = np.zeros_like(mov_cpu)
-    total_batches = int(np.ceil(nt / batch_size))
-    for b in range(total_batches):
-        mempool.free_all_blocks()
-        t1 = b * batch_size  # starting time point of batch
-        t2 = int(np.min((nt, (b + 1) * batch_size)))  # end time point of batch
+    if batch_size is None:
+        nz, __, ny, nx = mov_cpu.shape
+        ny_pad = ny + (int(ypad) if process_mov else 0)
+        nx_pad = nx + (int(xpad) if process_mov else 0)
+        batch_size = reg.auto_gpu_batch_size(
+            reg.estimate_rigid_3d_frame_bytes(nz, ny_pad, nx_pad, ny, nx),
+            fixed_bytes=mult_mask.nbytes + add_mask.nbytes + refs_f.nbytes,
+            free_bytes=backend.free_bytes(),
+            max_batch_size=nt,
+            xp=xp,
+            log_cb=log_cb,
+        )
+    mult_mask = backend.asarray(mult_mask, dtype=np.float32)
+    add_mask = backend.asarray(add_mask, dtype=np.float32)
+    refs_f = backend.asarray(refs_f, dtype=np.complex64)
+    processed = [mov_cpu_processed]
+
+    def reg_batch(batch_size):
+        backend.free_memory()
+        t2 = int(np.min((nt, t1 + batch_size)))  # end time point of batch
 
         if process_mov:
-            mov_gpu = cp.asarray(mov_cpu[:, t1:t2, :, :])
-            mov_gpu, mov_cpu_processed_tmp = process_mov_gpu(
+            mov_gpu = backend.to_device(mov_cpu[:, t1:t2, :, :])
+            mov_gpu, mov_cpu_processed_tmp = process_mov_batch(
                 mov_gpu,
                 plane_shifts,
                 xpad,
@@ -597,11 +769,12 @@ def rigid_3d_ref_gpu(
                 old_xs,
                 crosstalk_coeff=crosstalk_coeff,
                 cavity_size=cavity_size,
+                backend=backend,
             )
             # ov_cpu_processed needs to be fused & padded but NOT spatially subseted!
-            if mov_cpu_processed is None:
+            if processed[0] is None:
                 # allocate CPU array for fused & padded movie ("processed")
-                mov_cpu_processed = n.zeros(
+                processed[0] = n.zeros(
                     (
                         mov_cpu_processed_tmp.shape[0],
                         nt,
@@ -610,36 +783,43 @@ def rigid_3d_ref_gpu(
                     ),
                     n.float32,
                 )
-            mov_cpu_processed[:, t1:t2] = mov_cpu_processed_tmp
+            processed[0][:, t1:t2] = mov_cpu_processed_tmp
         else:
-            mov_gpu = cp.asarray(mov_cpu[:, t1:t2, :, :])
+            mov_gpu = backend.to_device(mov_cpu[:, t1:t2, :, :], dtype=np.float32)
             if crosstalk_coeff is not None:
                 mov_gpu = utils.crosstalk_subtract(mov_gpu, crosstalk_coeff, cavity_size)
-        mult_mask = cp.asarray(mult_mask)
-        add_mask = cp.asarray(add_mask)
 
         if np.logical_or(np.all(rmins != None), np.all(rmaxs != None)):
-            mov_gpu = clip_mov_gpu(mov_gpu, rmins, rmaxs)
+            mov_gpu = clip_mov(mov_gpu, rmins, rmaxs, xp=xp)
 
-        mov_gpu = apply_mask4D_gpu(mov_gpu, mult_mask, add_mask)
+        mov_gpu = apply_mask4D_batch(mov_gpu, mult_mask, add_mask)
 
-        phase_corr_tmp = reg_3d_gpu(mov_gpu[:, :, :, :], refs_f)
+        phase_corr_tmp = reg_3d_batch(mov_gpu, refs_f, backend)
         (
             phase_corr_shifted[t1:t2],
             int_shift[t1:t2],
             pc_peak_loc[t1:t2],
             sub_pixel_shifts[t1:t2],
-        ) = process_phase_corr_gpu(phase_corr_tmp, cp.asarray(pc_size))
+        ) = process_phase_corr_batch(phase_corr_tmp, pc_size, backend)
 
         if shift_reg == True:
-            mov_gpu = shift_gpu(mov_gpu, int_shift[t1:t2])
-            mov_shifted[:, t1:t2, :, :] = mov_gpu.get()
+            mov_gpu = shift_gpu(mov_gpu, int_shift[t1:t2], xp=xp)
+            mov_shifted[:, t1:t2, :, :] = backend.asnumpy(mov_gpu)
 
         del mov_gpu
         del phase_corr_tmp
-        mempool.free_all_blocks()
+        backend.free_memory()
+        return t2
+
+    # batches shrink if the device runs out of memory
+    t1 = 0  # starting time point of batch
+    while t1 < nt:
+        t1, batch_size = reg.run_with_oom_backoff(
+            reg_batch, batch_size, xp=xp, log_cb=log_cb
+        )
+    mov_cpu_processed = processed[0]
 
-    mempool.free_all_blocks()
+    backend.free_memory()
     if shift_reg == True:
         return phase_corr_shifted, int_shift, pc_peak_loc, sub_pixel_shifts, mov_shifted
     else:
@@ -753,12 +933,12 @@ def rigid_3d_ref_gpu_dev(
         return phase_corr_shifted, int_shift, pc_peak_loc, sub_pixel_shifts
 
 
-def shift_gpu(mov_gpu, shift_batch):
+def shift_gpu(mov_gpu, shift_batch, xp=cp):
     # for a batch
 
     __, ntb, __, __ = mov_gpu.shape
     for t in range(ntb):
-        mov_gpu[:, t, :, :] = cp.roll(
+        mov_gpu[:, t, :, :] = xp.roll(
             mov_gpu[:, t, :, :], (shift_batch[t, 1], shift_batch[t, 2]), axis=(1, 2)
         )
         if shift_batch[t, 2] > 0:
@@ -774,16 +954,11 @@ def shift_gpu(mov_gpu, shift_batch):
 
 
 def clip_mov_gpu(mov, rmin, rmax):
-    nz, __, __, __ = mov.shape
-    for z in range(nz):
-        mov[z, :, :, :].real = cp.clip(mov[z, :, :, :].real, rmin[z], rmax[z])
-    return mov
+    return clip_mov(mov, rmin, rmax, xp=cp)
 
 
 def apply_mask4D_gpu(data, mask_mul, mask_offset):
-    for t in range(data.shape[1]):
-        data[:, t, :, :] = data[:, t, :, :] * mask_mul + mask_offset
-    return data
+    return apply_mask4D_batch(data, mask_mul, mask_offset)
 
 
 def process_mov_gpu(
@@ -797,43 +972,92 @@ def process_mov_gpu(
     crosstalk_coeff=None,
     cavity_size=15,
 ):
-    # fuse and pad the movie
-    # TODO solve the xpad ypad integer vs array conflict
-    mov_gpu = fuse_and_pad_gpu(
-        mov_gpu, fuse_shift, np.array(ypad), np.array(xpad), new_xs, old_xs
+    return process_mov_batch(
+        mov_gpu,
+        plane_shifts,
+        xpad,
+        ypad,
+        fuse_shift,
+        new_xs,
+        old_xs,
+        crosstalk_coeff=crosstalk_coeff,
+        cavity_size=cavity_size,
+        backend=get_backend(True),
     )
-    mov_gpu = mov_gpu.real
-    # subtract crosstalk between cavities if given, BEFORE plane shifts
-    if crosstalk_coeff is not None:
-        mov_gpu = utils.crosstalk_subtract(mov_gpu, crosstalk_coeff, cavity_size)
-    # apply the lbm shifts
-    mov_gpu = shift_mov_lbm_gpu(mov_gpu, plane_shifts)
+
+
+def process_mov_batch(
+    mov,
+    plane_shifts,
+    xpad,
+    ypad,
+    fuse_shift,
+    new_xs,
+    old_xs,
+    crosstalk_coeff=None,
+    cavity_size=15,
+    backend=None,
+):
+    """
+    Fuse, pad, crosstalk subtract and plane shift a batch already on the backend.
+    Returns the batch cropped to full z-planes and a copy of the uncropped batch on the cpu
+    """
+    if backend is None:
+        backend = get_backend(True)
+    if backend.is_gpu:
+        # fuse and pad the movie
+        # TODO solve the xpad ypad integer vs array conflict
+        mov = fuse_and_pad_batch(
+            mov, fuse_shift, int(ypad), int(xpad), new_xs, old_xs, xp=backend.xp
+        )
+        # subtract crosstalk between cavities if given, BEFORE plane shifts
+        if crosstalk_coeff is not None:
+            mov = utils.crosstalk_subtract(mov, crosstalk_coeff, cavity_size)
+        # apply the lbm shifts
+        mov = shift_mov_lbm_gpu(mov, plane_shifts)
+    else:
+        # fusing moves every plane the same way, so the crosstalk subtraction, fuse,
+        # pad and lbm shifts are all done in one pass
+        nz, __, ny, nx = mov.shape
+        ny_out = ny + int(ypad)
+        nx_out = nx + int(xpad) - (len(new_xs) - 1) * fuse_shift
+        x_pieces = fuse_pieces(fuse_shift, new_xs, old_xs, nx_out, x_offset=int(xpad))
+        plan = build_gather_plan(
+            nz, ny, nx, ny_out, nx_out, x_pieces=x_pieces, plane_shifts=plane_shifts
+        )
+        mov = execute_gather_plan(
+            mov,
+            plan,
+            ny_out,
+            nx_out,
+            dtype=np.float32,
+            crosstalk_coeff=crosstalk_coeff,
+            cavity_size=cavity_size,
+        )
     # get the processed movie on the cpu
-    mov_cpu_processed_tmp = mov_gpu.get()
+    mov_cpu_processed_tmp = backend.to_host(mov)
     # crop the movie so only full z-planes count
     if xpad > 0:
-        mov_gpu = mov_gpu[:, :, :, xpad:-xpad]
+        mov = mov[:, :, :, xpad:-xpad]
     if ypad > 0:
-        mov_gpu = mov_gpu[:, :, ypad:-ypad, :]
-    return mov_gpu, mov_cpu_processed_tmp
+        mov = mov[:, :, ypad:-ypad, :]
+    return mov, mov_cpu_processed_tmp
 
 
 # TODO changed from register_gpu, 1. pads became int
 # 2 added the shift to x-axis so the blanck space is on the left side
 def fuse_and_pad_gpu(mov_gpu, fuse_shift, ypad, xpad, new_xs, old_xs):
-    nz, nt, ny, nx = mov_gpu.shape
-    n_stitches = len(new_xs) - 1
-    n_xpix_lost_fusing = n_stitches * fuse_shift
-    nyn = ny + ypad
-    nxn = nx + xpad - n_xpix_lost_fusing
+    return fuse_and_pad_batch(
+        mov_gpu, fuse_shift, ypad, xpad, new_xs, old_xs, xp=cp, dtype=cp.complex64
+    )
 
-    mov_pad = cp.zeros((nz, nt, nyn, nxn), dtype=cp.complex64)
-    for strip_idx in range(len(new_xs)):
-        nx0, nx1 = new_xs[strip_idx]
-        ox0, ox1 = old_xs[strip_idx]
-        mov_pad[:, :, :ny, xpad + nx0 : xpad + nx1] = mov_gpu[:, :, :, ox0:ox1]
 
-    return mov_pad
+def fuse_and_pad_batch(
+    mov, fuse_shift, ypad, xpad, new_xs, old_xs, xp=np, dtype=np.float32
+):
+    return reg.fuse_and_pad(
+        mov, fuse_shift, ypad, xpad, new_xs, old_xs, xp=xp, dtype=dtype, x_offset=xpad
+    )
 
 
 def shift_mov_lbm_gpu(mov_gpu, plane_shifts, fill_value=0):
@@ -906,35 +1130,35 @@ def shift_mov_lbm_gpu(mov_gpu, plane_shifts, fill_value=0):
 
 # decide when/where to calc/get masks + fft'd filterd ref img
 def reg_3d_gpu(mov_batch_gpu, fft_3d_ref_conj):
+    return reg_3d_batch(mov_batch_gpu, fft_3d_ref_conj, get_backend(True))
+
+
+def reg_3d_batch(mov_batch, fft_3d_ref_conj, backend):
     """
-    fourier transform and multiply a 3D movie batch and the reference, ran on the GPU
+    fourier transform and multiply a 3D movie batch and the reference, on the backend's device
 
     Parameters
     ----------
-    mov_batch_gpu : ndarray (nz, nt_batch, ny, nx)
-        A batch of the movie which needs to be registered, on the gpu
+    mov_batch : ndarray (nz, nt_batch, ny, nx)
+        A batch of the movie which needs to be registered, on the backend
     fft_3d_ref_conj : ndarray (nz, ny, nx)
         The filterd fourrier transformed refference image
+    backend : backend.ArrayBackend
+        numpy or cupy backend
 
     Returns
     -------
-    ndarray (nz,nt_batch, ny, nx)
-        The full phase_correlation for this frame
+    ndarray (nt_batch, nz, ny, nx)
+        The full phase_correlation for this batch
     """
-    nz, nt, ny, nx = mov_batch_gpu.shape
+    xp = backend.xp
+    fft_3d_ref_conj = backend.asarray(fft_3d_ref_conj)
 
-    fft_3d_ref_conj_gpu = cp.asarray(fft_3d_ref_conj)
-    phase_corr_batch = cp.zeros((nt, nz, ny, nx), dtype=cp.float64)
-    # Using  cpy fftn
-    fft_3d_mov = cufft.fftn(mov_batch_gpu[:, :, :, :], axes=(0, 2, 3))
+    fft_3d_mov = backend.fftn(mov_batch, axes=(0, 2, 3))
+    fft_3d_mov /= 1e-5 + xp.abs(fft_3d_mov)
+    fft_3d_mov *= fft_3d_ref_conj[:, None]
 
-    for t in range(nt):
-        fft_3d_mov[:, t, :, :] = fft_3d_mov[:, t, :, :] / (
-            1e-5 + cp.abs(fft_3d_mov[:, t, :, :])
-        )
-        fft_3d_mov[:, t, :, :] = fft_3d_mov[:, t, :, :] * fft_3d_ref_conj_gpu
-
-    phase_corr_batch = cp.abs(cufft.ifftn(fft_3d_mov, axes=(0, 2, 3))).swapaxes(0, 1)
+    phase_corr_batch = xp.abs(backend.ifftn(fft_3d_mov, axes=(0, 2, 3))).swapaxes(0, 1)
 
     del fft_3d_mov
 
@@ -942,35 +1166,69 @@ def reg_3d_gpu(mov_batch_gpu, fft_3d_ref_conj):
 
 
 def process_phase_corr_gpu(phase_corr, pc_size):
+    return process_phase_corr_batch(phase_corr, pc_size, get_backend(True))
+
+
+def est_sub_pixel_shift_batch(r):
+    """
+    Vectorised est_sub_pixel_shift for a batch of lines through the peak
+
+    Parameters
+    ----------
+    r : ndarray (nt, nS)
+        a 1D line of the phase correlation through the peak for each frame
+
+    Returns
+    -------
+    ndarray (nt,)
+        The estimated sub pixel shift per frame
+    """
+    nt, length = r.shape
+    center = np.argmax(r, axis=1)
+    shift = center - np.floor(length / 2)
+
+    ts = np.arange(nt)
+    r_c = r[ts, center]
+    r_m = r[ts, (center - 1) % length]
+    r_p = r[ts, (center + 1) % length]
+    with np.errstate(divide="ignore", invalid="ignore"):
+        sub_pixel = (r_p - r_m) / (2 * r_c - r_m - r_p)
+    return shift + sub_pixel * 0.5
+
+
+def process_phase_corr_batch(phase_corr, pc_size, backend):
     """
     Analysise the phase correlation to return useful information, a re-aranged phase_corr, peak location and
     integer + sub pixel shifts.
-    This function is used for the gpu where registration is done in batches.
+    This function is used where registration is done in batches, on either backend.
 
     Parameters
     ----------
-    phase_corr : ndarray (nz, ny, nx)
-        The full phase correlation for a frame
+    phase_corr : ndarray (nt, nz, ny, nx)
+        The full phase correlation for a batch, on the backend
     pc_size : ndarray (nz_pc, ny_pc, nx_pc)
         This determines the size of the re-aranged phase correlation array and the maximum size of shifts allowed
+    backend : backend.ArrayBackend
+        numpy or cupy backend
 
     Returns
     -------
-    phase_corr_shifted : ndarray (2*nz_pc +1, 2*ny_pc + 1, 2*nx_pc + 1)
+    phase_corr_shifted : ndarray (nt, 2*nz_pc +1, 2*ny_pc + 1, 2*nx_pc + 1)
         The phase correlation cropped and shifted so the peak is central
-    shift : ndarray (3,)
+    shift : ndarray (nt, 3)
         The integer shift to maximise phase correlation
-    pc_peak_lock : ndarray (3,)
+    pc_peak_lock : ndarray (nt, 3)
         The index of the maximum value of the shift phase correlation array
-    sub_pixel_shifts : ndarray (3,)
+    sub_pixel_shifts : ndarray (nt, 3)
         The sub pixel shift estiamted from the phase correlation
 
     """
+    pc_size = np.asarray(backend.asnumpy(pc_size)).astype(int)
     max_pc_size = pc_size * 2 + 1
     nt, nz, ny, nx = phase_corr.shape
-    phase_corr_shifted = cp.zeros(
+    phase_corr_shifted = backend.xp.zeros(
         (nt, int(max_pc_size[0]), int(max_pc_size[1]), int(max_pc_size[2])),
-        dtype=cp.float64,
+        dtype=np.float64,
     )
 
     # want z planes 0,1,2 to go to 2,3,4
@@ -1015,35 +1273,19 @@ def process_phase_corr_gpu(phase_corr, pc_size):
     ]
 
     # SWITCHING back to cpu here
-    phase_corr_shifted = cp.asnumpy(phase_corr_shifted)
-    pc_size = cp.asnumpy(pc_size)
+    phase_corr_shifted = backend.asnumpy(phase_corr_shifted)
 
-    shift = np.zeros((nt, 3))
-    pc_peak_loc = np.zeros((nt, 3), dtype=np.int16)
-    shape = phase_corr_shifted[0].shape
-    for t in range(nt):
-        mx = np.argmax(phase_corr_shifted[t])
-        pc_peak_loc[t, :] = np.unravel_index(
-            mx, shape
-        )  # cp.asarray(cp.unravel_index(mx, shape))
-        shift[t, :] = pc_peak_loc[t, :] - pc_size
-
-    z_sub_pixel = cp.zeros(nt)
-    y_sub_pixel = cp.zeros(nt)
-    x_sub_pixel = cp.zeros(nt)
-    for t in range(nt):
-        z_sub_pixel[t] = est_sub_pixel_shift(
-            phase_corr_shifted[t, :, pc_peak_loc[t, 1], pc_peak_loc[t, 2]]
-        )
-        y_sub_pixel[t] = est_sub_pixel_shift(
-            phase_corr_shifted[t, pc_peak_loc[t, 0], :, pc_peak_loc[t, 2]]
-        )
-        x_sub_pixel[t] = est_sub_pixel_shift(
-            phase_corr_shifted[t, pc_peak_loc[t, 0], pc_peak_loc[t, 1], :]
-        )
+    shape = phase_corr_shifted.shape[1:]
+    mx = np.argmax(phase_corr_shifted.reshape(nt, -1), axis=1)
+    pc_peak_loc = np.stack(np.unravel_index(mx, shape), axis=1).astype(np.int16)
+    shift = (pc_peak_loc - pc_size).astype(np.float64)
 
-    # Somehow the result of np.vstack is a cp.ndarray so need to do cp.asnumpy, this is true try tofind out why?
-    sub_pixel_shifts = cp.asnumpy(np.vstack([z_sub_pixel, y_sub_pixel, x_sub_pixel]).T)
+    ts = np.arange(nt)
+    pz, py, px = pc_peak_loc[:, 0], pc_peak_loc[:, 1], pc_peak_loc[:, 2]
+    z_sub_pixel = est_sub_pixel_shift_batch(phase_corr_shifted[ts, :, py, px])
+    y_sub_pixel = est_sub_pixel_shift_batch(phase_corr_shifted[ts, pz, :, px])
+    x_sub_pixel = est_sub_pixel_shift_batch(phase_corr_shifted[ts, pz, py, :])
+    sub_pixel_shifts = np.stack([z_sub_pixel, y_sub_pixel, x_sub_pixel], axis=1)
 
     return phase_corr_shifted, shift, pc_peak_loc, sub_pixel_shifts
 
@@ -1140,6 +1382,8 @@ def shift_mov_z(mov, shifts, fill_value=0):
     for t in range(nt):
         shift = shifts[t, :]
 
+        if shift[0] == 0:  # 0
+            shifted_mov[:, t, :, :] = mov[:, t, :, :]
         if shift[0] > 0:  # +
             shifted_mov[:shift[0], t, :, :] = fill_value
             shifted_mov[shift[0]:, t, :, :] = mov[:-shift[0], t, :, :]
@@ -1149,6 +1393,158 @@ def shift_mov_z(mov, shifts, fill_value=0):
 
     return shifted_mov
 
+@njit(parallel=True, nogil=True, cache=True)
+def shift_mov_linear(mov, shifts, fill_value=0):
+    """
+    Applies sub-pixel (z, y, x) shifts to a movie in place, with linear interpolation.
+    Frames are shifted in parallel, each thread works on a copy of one volume
+
+    Parameters
+    ----------
+    mov : ndarray (nz, nt, ny, nx)
+        Movie to be shifted, overwritten with the shifted movie
+    shifts : ndarray (nt, 3)
+        The (z, y, x) offsets to sample from: out[z, t, y, x] = mov[z + dz, t, y + dy, x + dx].
+        For integer offsets this matches shift_mov_fast(mov, -shifts)
+    fill_value : float, optional
+        the value to fill the voxels sampled from outside the movie, by default 0
+
+    Returns
+    -------
+    ndarray (nz, nt, ny, nx)
+        The shifted movie (same array as mov)
+    """
+    nz, nt, ny, nx = mov.shape
+    for t in prange(nt):
+        vol = mov[:, t].copy()
+        z0 = int(np.floor(shifts[t, 0]))
+        y0 = int(np.floor(shifts[t, 1]))
+        x0 = int(np.floor(shifts[t, 2]))
+        wz = shifts[t, 0] - z0
+        wy = shifts[t, 1] - y0
+        wx = shifts[t, 2] - x0
+        # only read the next voxel along an axis if it has a weight
+        z1 = 1 if wz > 0 else 0
+        y1 = 1 if wy > 0 else 0
+        x1 = 1 if wx > 0 else 0
+        for z in range(nz):
+            zs = z + z0
+            z_ok = zs >= 0 and zs + z1 <= nz - 1
+            for y in range(ny):
+                ys = y + y0
+                y_ok = ys >= 0 and ys + y1 <= ny - 1
+                for x in range(nx):
+                    xs = x + x0
+                    if not (z_ok and y_ok and xs >= 0 and xs + x1 <= nx - 1):
+                        mov[z, t, y, x] = fill_value
+                        continue
+                    v0 = (1 - wy) * ((1 - wx) * vol[zs, ys, xs] + wx * vol[zs, ys, xs + x1]) + wy * (
+                        (1 - wx) * vol[zs, ys + y1, xs] + wx * vol[zs, ys + y1, xs + x1]
+                    )
+                    if z1:
+                        zn = zs + z1
+                        v1 = (1 - wy) * ((1 - wx) * vol[zn, ys, xs] + wx * vol[zn, ys, xs + x1]) + wy * (
+                            (1 - wx) * vol[zn, ys + y1, xs] + wx * vol[zn, ys + y1, xs + x1]
+                        )
+                        v0 = (1 - wz) * v0 + wz * v1
+                    mov[z, t, y, x] = v0
+    return mov
+
+
+def shift_mov_fourier(mov, shifts, fill_value=0, n_workers=-1):
+    """
+    Applies sub-pixel (y, x) shifts to a movie in place with a fourier phase ramp,
+    one z-plane at a time. Voxels which wrapped around are set to fill_value
+
+    Parameters
+    ----------
+    mov : ndarray (nz, nt, ny, nx)
+        Movie to be shifted, overwritten with the shifted movie
+    shifts : ndarray (nt, 2)
+        The (y, x) offsets to sample from, as in shift_mov_linear
+    fill_value : float, optional
+        the value to fill the voxels sampled from outside the movie, by default 0
+    n_workers : int, optional
+        threads used by scipy.fft, by default -1 (all)
+
+    Returns
+    -------
+    ndarray (nz, nt, ny, nx)
+        The shifted movie (same array as mov)
+    """
+    nz, nt, ny, nx = mov.shape
+    dy = np.asarray(shifts[:, 0], dtype=np.float64)
+    dx = np.asarray(shifts[:, 1], dtype=np.float64)
+    ky = np.fft.fftfreq(ny)
+    kx = np.fft.rfftfreq(nx)
+    ramp = np.exp(
+        2j * np.pi * (dy[:, None, None] * ky[None, :, None] + dx[:, None, None] * kx[None, None, :])
+    ).astype(np.complex64)
+    for z in range(nz):
+        plane_f = scipy.fft.rfft2(mov[z], workers=n_workers)
+        plane_f *= ramp
+        mov[z] = scipy.fft.irfft2(plane_f, s=(ny, nx), workers=n_workers)
+
+    # blank the edges that were wrapped around
+    for t in range(nt):
+        ny_edge = int(np.ceil(abs(dy[t])))
+        nx_edge = int(np.ceil(abs(dx[t])))
+        if dy[t] > 0:
+            mov[:, t, ny - ny_edge :] = fill_value
+        elif dy[t] < 0:
+            mov[:, t, :ny_edge] = fill_value
+        if dx[t] > 0:
+            mov[:, t, :, nx - nx_edge :] = fill_value
+        elif dx[t] < 0:
+            mov[:, t, :, :nx_edge] = fill_value
+    return mov
+
+
+def shift_mov_subpixel(
+    mov, int_shift, sub_pixel_shifts, method="linear", apply_z_shift=False, fill_value=0
+):
+    """
+    Registers a movie in place with the sub-pixel shifts from rigid_3d_ref, the
+    sub-pixel counterpart of shift_mov_fast(mov, -int_shift) (+ shift_mov_z)
+
+    Parameters
+    ----------
+    mov : ndarray (nz, nt, ny, nx)
+        Movie to be shifted, overwritten with the shifted movie
+    int_shift : ndarray (nt, 3)
+        The integer (z, y, x) shifts
+    sub_pixel_shifts : ndarray (nt, 3)
+        The sub-pixel (z, y, x) shifts, frames with no valid sub-pixel estimate use int_shift
+    method : str, optional
+        'linear' (numba, parallel over frames) or 'fourier' (y/x only), by default 'linear'
+    apply_z_shift : bool, optional
+        Also shift along z, by default False
+
+    Returns
+    -------
+    ndarray (nz, nt, ny, nx)
+        The shifted movie
+    """
+    int_shift = np.asarray(int_shift, dtype=np.float64)
+    # keep the estimate next to the integer peak, nan if the peak was flat
+    frac = np.asarray(sub_pixel_shifts, dtype=np.float64) - int_shift
+    frac[~np.isfinite(frac)] = 0
+    shifts = int_shift + np.clip(frac, -1, 1)
+    # shift_mov_z shifts z the opposite way to y/x
+    shifts[:, 0] *= -1
+    if not apply_z_shift:
+        shifts[:, 0] = 0
+
+    if method == "linear":
+        return shift_mov_linear(mov, shifts, fill_value)
+    elif method == "fourier":
+        mov = shift_mov_fourier(mov, shifts[:, 1:], fill_value)
+        if apply_z_shift:
+            mov = shift_mov_z(mov, -np.round(shifts).astype(np.int64), fill_value)
+        return mov
+    raise ValueError("Unknown sub-pixel shift method %s" % method)
+
+
 # dev function for finding translation between two 3d images
 def register_2_images(img1, img2, pc_size):
     """
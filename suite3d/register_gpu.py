@@ -1,10 +1,9 @@
-import cupy as cp
 import numpy as n
-from cupyx.scipy import fft as cufft
-from cupyx.scipy import ndimage as cuimage
 from functools import lru_cache
 from scipy import ndimage
+import scipy.fft
 from . import utils
+from .s2p_registration import rigid_shift_frames
 import time
 try:
     import mkl_fft
@@ -12,6 +11,7 @@ except:
     print("No MKL fft ")
 
 from .utils import default_log
+from .backend import cp, cufft
 
 def log_gpu_memory(mempool=None):
     if mempool is None:
@@ -24,6 +24,142 @@ def log_gpu_memory(mempool=None):
              % (n_blocks, used_pool_gb, total_pool_gb)
     return string
 
+def gpu_oom_errors(xp=cp):
+    """
+    Exceptions raised when the array backend runs out of memory
+    """
+    errors = [MemoryError]
+    cuda = getattr(xp, 'cuda', None)
+    if cuda is not None:
+        for mod, name in ((getattr(cuda, 'memory', None), 'OutOfMemoryError'),
+                          (getattr(cuda, 'cufft', None), 'CuFFTError')):
+            err = getattr(mod, name, None)
+            if isinstance(err, type) and issubclass(err, BaseException):
+                errors.append(err)
+    return tuple(errors)
+
+def get_free_gpu_memory(xp=cp):
+    """
+    Free memory on the current device in bytes, including blocks cached
+    by the memory pool. Returns None if it can't be queried.
+    """
+    try:
+        free_bytes, __ = xp.cuda.Device().mem_info
+        mempool = xp.get_default_memory_pool()
+        return free_bytes + mempool.total_bytes() - mempool.used_bytes()
+    except Exception:
+        return None
+
+def estimate_rigid_2d_frame_bytes(nz, ny, nx, max_reg_xy, ny_raw=None, nx_raw=None):
+    """
+    Device memory used per frame by rigid_2d_reg_gpu, for a fused and padded
+    frame of size (nz, ny, nx) loaded from a raw frame of size (nz, ny_raw, nx_raw)
+    """
+    if ny_raw is None: ny_raw = ny
+    if nx_raw is None: nx_raw = nx
+    ncc = int(max_reg_xy) * 2 + 1
+    raw = nz * ny_raw * nx_raw * 4
+    # fused complex64 movie and float32 shifted copy
+    mov = nz * ny * nx * (8 + 4)
+    # fft output and |fft| temporaries for one plane
+    fft_work = ny * nx * 8 * 2
+    phase_corr = ncc * ncc * 8
+    return raw + mov + fft_work + phase_corr
+
+def estimate_nonrigid_2d_frame_bytes(nz, n_blocks, block_shape, max_shift=3, npad=3):
+    """
+    Device memory used per frame by nonrigid_2d_reg_gpu: the complex64
+    blocked movie (nt, nz, nb, nby, nbx), its fft, and the phase correlation
+    buffers (unwrapped, smoothed and snr copies)
+    """
+    nby, nbx = block_shape
+    ncc = (max_shift + npad) * 2 + 1
+    mov_blocks = nz * n_blocks * nby * nbx * 8
+    phase_corr = nz * n_blocks * ncc * ncc * 4
+    return mov_blocks * 2 + phase_corr * 4
+
+def estimate_rigid_3d_frame_bytes(nz, ny, nx, ny_raw=None, nx_raw=None):
+    """
+    Device memory used per frame by rigid_3d_ref_gpu: raw frame, fused
+    complex64 frame, its 3D fft and the real phase correlation
+    """
+    if ny_raw is None: ny_raw = ny
+    if nx_raw is None: nx_raw = nx
+    raw = nz * ny_raw * nx_raw * 4
+    return raw + nz * ny * nx * (8 + 8 * 2 + 4)
+
+def choose_gpu_batch_size(frame_bytes, free_bytes, fixed_bytes=0, mem_fraction=0.8,
+                          max_batch_size=None, min_batch_size=1):
+    """
+    Largest number of frames per batch that fits in mem_fraction of the free
+    memory, after the fixed allocations (masks, references)
+
+    Parameters
+    ----------
+    frame_bytes : int
+        device memory needed per frame
+    free_bytes : int
+        free device memory
+    fixed_bytes : int, optional
+        memory needed independently of the batch size, by default 0
+    mem_fraction : float, optional
+        fraction of the free memory that can be used, by default 0.8
+    max_batch_size : int, optional
+        upper limit, e.g. the number of frames, by default None
+
+    Returns
+    -------
+    int
+        batch size
+    """
+    usable = free_bytes * mem_fraction - fixed_bytes
+    batch_size = max(min_batch_size, int(usable // max(frame_bytes, 1)))
+    if max_batch_size is not None:
+        batch_size = min(batch_size, max_batch_size)
+    return int(batch_size)
+
+def auto_gpu_batch_size(frame_bytes, fixed_bytes=0, free_bytes=None, mem_fraction=0.8,
+                        max_batch_size=None, default_batch_size=10, xp=cp, log_cb=default_log):
+    """
+    Pick the GPU batch size from the free device memory. free_bytes can be
+    given to use a fixed memory budget instead of querying the device.
+    """
+    if free_bytes is None:
+        free_bytes = get_free_gpu_memory(xp)
+    if free_bytes is None:
+        log_cb("Could not query free GPU memory, using batch size %d" % default_batch_size, 2)
+        return default_batch_size
+    batch_size = choose_gpu_batch_size(frame_bytes, free_bytes, fixed_bytes, mem_fraction,
+                                       max_batch_size)
+    log_cb("Auto GPU batch size: %d frames (%.3f GB/frame, %.2f GB free)" %
+           (batch_size, frame_bytes / 1024**3, free_bytes / 1024**3), 2)
+    return batch_size
+
+def run_with_oom_backoff(reg_batch, batch_size, min_batch_size=1, xp=cp, log_cb=default_log):
+    """
+    Call reg_batch(batch_size), halving the batch size and retrying if the
+    device runs out of memory
+
+    Returns
+    -------
+    result : output of reg_batch
+    batch_size : int
+        the batch size that succeeded, to be used for the following batches
+    """
+    oom_errors = gpu_oom_errors(xp)
+    while True:
+        try:
+            return reg_batch(batch_size), batch_size
+        except oom_errors:
+            if batch_size <= min_batch_size:
+                raise
+            try:
+                xp.get_default_memory_pool().free_all_blocks()
+            except AttributeError:
+                pass
+            batch_size = max(min_batch_size, batch_size // 2)
+            log_cb("Out of GPU memory, retrying with batch size %d" % batch_size, 1)
+
 def nonrigid_2d_reg_gpu(mov_gpu, mult_mask, add_mask, refs_nr_f, yblocks, xblocks, snr_thresh, smooth_mat, 
                         rmins=None, rmaxs=None,
                         max_shift=10, npad=3, n_smooth_iters=2, subpixel=5,
@@ -199,35 +335,123 @@ def rigid_2d_reg_gpu(mov_cpu, mult_mask, add_mask, refs_f, max_reg_xy,
     return ymaxs, xmaxs, cmaxs
 
 def rigid_2d_reg_cpu(mov_cpu, mult_mask, add_mask, refs_f, max_reg_xy,
-                    rmins, rmaxs, crosstalk_coeff = None, shift=True, cavity_size = 15):
+                    rmins, rmaxs, crosstalk_coeff = None, shift=True, cavity_size = 15,
+                    t_batch_size=None, n_workers=-1):
+    """
+    Rigid registration of each plane of a movie on the CPU, with batched
+    real-FFT phase correlation
+
+    Parameters
+    ----------
+    mov_cpu : ndarray (nz, nt, ny, nx)
+    mult_mask, add_mask : ndarray (nz, ny, nx)
+    refs_f : ndarray (nz, ny, nx)
+        fft'd references from phasecorr_ref
+    max_reg_xy : int
+    rmins, rmaxs : list
+        clipping values for each plane, can contain None
+    shift : bool, optional
+        return the shifted movie, by default True
+    t_batch_size : int, optional
+        number of frames transformed at once, by default None (all frames)
+    n_workers : int, optional
+        number of scipy.fft workers, by default -1 (all cores)
+
+    Returns
+    -------
+    mov_shifted : ndarray (nt, nz, ny, nx), only if shift
+    ymaxs, xmaxs, cmaxs : ndarray (nz, nt)
+    """
     nz, nt, ny, nx = mov_cpu.shape
-    mov = n.asarray(mov_cpu, dtype=n.complex64)
     ymaxs = n.zeros((nz, nt), dtype=n.int16)
     xmaxs = n.zeros((nz, nt), dtype=n.int16)
     cmaxs = n.zeros((nz, nt), dtype=n.float32) 
-    ncc = max_reg_xy * 2 + 1
-    phase_corr = n.zeros((nt, ncc, ncc))
+    if t_batch_size is None:
+        t_batch_size = nt
 
+    mov = mov_cpu
+    if crosstalk_coeff is not None: 
+        mov = utils.crosstalk_subtract(n.array(mov_cpu, dtype=n.float32), crosstalk_coeff, cavity_size)
     if shift:
         mov_shifted = n.zeros((nt,nz,ny,nx), dtype=n.float32)
-        mov_shifted[:] = mov.real.swapaxes(0,1)
-    if crosstalk_coeff is not None: 
-        mov = utils.crosstalk_subtract(mov, crosstalk_coeff, cavity_size)
+
     for zidx in range(nz):
-        mov[zidx] = clip_and_mask_mov(mov[zidx], rmins[zidx], rmaxs[zidx],
-                          mult_mask[zidx], add_mask[zidx], cp=n)
-        mov[zidx] = convolve_2d_cpu(mov[zidx], refs_f[zidx])
-        unwrap_fft_2d(mov[zidx].real, max_reg_xy, out=phase_corr, cp=n)
-        ymaxs[zidx], xmaxs[zidx], cmaxs[zidx] = get_max_cc_coord(phase_corr, max_reg_xy, cp=n)
+        ref_f = rfft_ref(refs_f[zidx])
+        for t0 in range(0, nt, t_batch_size):
+            t1 = min(nt, t0 + t_batch_size)
+            phase_corr = phasecorr_rfft_cpu(mov[zidx, t0:t1], ref_f, max_reg_xy,
+                                            mult_mask[zidx], add_mask[zidx],
+                                            rmins[zidx], rmaxs[zidx], n_workers=n_workers)
+            ymaxs[zidx, t0:t1], xmaxs[zidx, t0:t1], cmaxs[zidx, t0:t1] = \
+                get_max_cc_coord(phase_corr, max_reg_xy, cp=n)
         if shift:
-            for frame_idx in range(nt):
-                mov_shifted[frame_idx, zidx] = shift_frame(mov_shifted[frame_idx, zidx],
-                                dy=ymaxs[zidx, frame_idx], dx=xmaxs[zidx, frame_idx], cp=n)
-                
+            # the un-subtracted movie is shifted straight into the output
+            rigid_shift_frames(mov_cpu[zidx], ymaxs[zidx].astype(n.int32),
+                               xmaxs[zidx].astype(n.int32), mov_shifted[:, zidx])
     
     if shift:
-        return mov_shifted, ymaxs, xmaxs
-    return ymaxs, xmaxs
+        return mov_shifted, ymaxs, xmaxs, cmaxs
+    return ymaxs, xmaxs, cmaxs
+
+def rfft_ref(ref_f):
+    """
+    Keep the half of an fft'd reference (..., ny, nx) used by a real FFT. The
+    complex path keeps the real part of the correlation, which only depends on
+    the Hermitian part of ref_f, so that is the part kept. For references from
+    phasecorr_ref, which are Hermitian already, it is ref_f itself.
+    """
+    nx = ref_f.shape[-1]
+    # ref_f at -k, for each frequency k
+    ref_f_neg = n.roll(n.flip(ref_f, axis=(-2, -1)), 1, axis=(-2, -1))
+    ref_f_herm = (ref_f[..., :nx // 2 + 1] + n.conj(ref_f_neg[..., :nx // 2 + 1])) / 2
+    return n.ascontiguousarray(ref_f_herm, dtype=n.complex64)
+
+def phasecorr_rfft_cpu(frames, ref_f, max_reg_xy, mult_mask=None, add_mask=None,
+                       rmin=None, rmax=None, n_workers=-1):
+    """
+    Phase correlation of a batch of real frames with a reference, using real
+    FFTs. Only the rows and columns within max_reg_xy of zero shift are
+    inverse-transformed, so the output is already unwrapped.
+
+    Parameters
+    ----------
+    frames : ndarray (nt, ny, nx)
+    ref_f : ndarray (ny, nx//2+1) or (nt, ny, nx//2+1)
+        half-spectrum reference from rfft_ref
+    max_reg_xy : int
+    mult_mask, add_mask : ndarray (ny, nx), optional
+    rmin, rmax : float, optional
+        clipping values
+    n_workers : int, optional
+        number of scipy.fft workers, by default -1 (all cores)
+
+    Returns
+    -------
+    phase_corr : ndarray (nt, ncc, ncc), float32
+    """
+    nt, ny, nx = frames.shape
+    mov = n.array(frames, dtype=n.float32)
+    if rmin is not None and rmax is not None: n.clip(mov, rmin, rmax, out=mov)
+    if mult_mask is not None: mov *= mult_mask.astype(n.float32)
+    if add_mask is not None:  mov += add_mask.astype(n.float32)
+
+    mov_f = scipy.fft.rfft2(mov, axes=(1,2), workers=n_workers, overwrite_x=True)
+    del mov
+    return phasecorr_rfft_spectrum(mov_f, ref_f, max_reg_xy, nx, n_workers)
+
+def phasecorr_rfft_spectrum(mov_f, ref_f, max_reg_xy, nx, n_workers=-1):
+    """
+    The second half of phasecorr_rfft_cpu, for frames that are already
+    rfft'd (nt, ny, nx//2+1). mov_f is overwritten.
+    """
+    ny = mov_f.shape[1]
+    idxs = n.arange(-max_reg_xy, max_reg_xy + 1)
+    mov_f /= n.abs(mov_f) + n.complex64(1e-5)
+    mov_f *= ref_f
+    mov_f = scipy.fft.ifft(mov_f, axis=1, workers=n_workers, overwrite_x=True)
+    mov_f = mov_f[:, idxs % ny]
+    phase_corr = scipy.fft.irfft(mov_f, n=nx, axis=2, workers=n_workers, overwrite_x=True)
+    return phase_corr[:, :, idxs % nx].astype(n.float32)
 
 def get_max_cc_coord_old(phase_corr, max_reg_xy, cp=cp):
     nt, ncc, __ = phase_corr.shape
@@ -339,32 +563,28 @@ def convolve_2d_cpu(mov, ref_f):
 
 #TODO xpad/ypad should be integer ?
 def fuse_and_pad_gpu(mov_gpu, fuse_shift, ypad, xpad, new_xs, old_xs):
-    nz, nt, ny, nx = mov_gpu.shape
-    n_stitches = len(new_xs) - 1
-    n_xpix_lost_fusing = n_stitches * fuse_shift
-    nyn = ny + ypad.sum()
-    nxn = nx + xpad.sum() - n_xpix_lost_fusing
-
-    mov_pad = cp.zeros((nz, nt, nyn, nxn), dtype=cp.complex64)
-    for strip_idx in range(len(new_xs)):
-        nx0,nx1 = new_xs[strip_idx]
-        ox0,ox1 = old_xs[strip_idx]
-        mov_pad[:,:,:ny, nx0:nx1] = mov_gpu[:,:,:,ox0:ox1]
+    return fuse_and_pad(mov_gpu, fuse_shift, ypad, xpad, new_xs, old_xs,
+                        xp=cp, dtype=cp.complex64)
 
-    return mov_pad
-
-def fuse_and_pad(mov, fuse_shift, ypad, xpad, new_xs, old_xs):
+def fuse_and_pad(mov, fuse_shift, ypad, xpad, new_xs, old_xs, xp=n, dtype=None, x_offset=0):
+    """
+    Stitch the strips of a (nz, nt, ny, nx) movie together and pad it, on
+    either backend. ypad and xpad may be ints or per-plane arrays, the padded
+    size uses their sum. x_offset moves the strips right so the blank space
+    is on the left.
+    """
     nz, nt, ny, nx = mov.shape
     n_stitches = len(new_xs) - 1
     n_xpix_lost_fusing = n_stitches * fuse_shift
-    nyn = ny + ypad.sum()
-    nxn = nx + xpad.sum() - n_xpix_lost_fusing
+    nyn = ny + int(n.sum(ypad))
+    nxn = nx + int(n.sum(xpad)) - n_xpix_lost_fusing
+    if dtype is None: dtype = mov.dtype
 
-    mov_pad = n.zeros((nz, nt, nyn, nxn), dtype=mov.dtype)
+    mov_pad = xp.zeros((nz, nt, nyn, nxn), dtype=dtype)
     for strip_idx in range(len(new_xs)):
         nx0,nx1 = new_xs[strip_idx]
         ox0,ox1 = old_xs[strip_idx]
-        mov_pad[:,:,:ny, nx0:nx1] = mov[:,:,:,ox0:ox1]
+        mov_pad[:,:,:ny, x_offset + nx0:x_offset + nx1] = mov[:,:,:,ox0:ox1]
 
     return mov_pad
 
@@ -73,7 +73,7 @@ def register_frames(refAndMasks, frames, ops=None, base_shift=None,  do_rigid=Tr
 
     fsmooth = frames.copy().astype(np.float32)
     if ops['smooth_sigma_time'] > 0:
-        fsmooth = gaussian_filter1d(data=fsmooth, sigma=ops['smooth_sigma_time'], axis=0)
+        fsmooth = gaussian_filter1d(fsmooth, sigma=ops['smooth_sigma_time'], axis=0)
 
     # rigid registration
     if ops.get('norm_frames', False):
@@ -90,26 +90,20 @@ def register_frames(refAndMasks, frames, ops=None, base_shift=None,  do_rigid=Tr
             if ops['nonrigid']: print("base_shift with nonrigid on is broken!")
             ymax += base_shift[0]
             xmax += base_shift[1]
-
-        for frame, dy, dx in zip(frames, ymax, xmax):
-            frame[:] = shift_frame(frame=frame, dy=dy, dx=dx)
     else:
         ymax = None; xmax = None; cmax = None;
 
     # non-rigid registration
     if ops['nonrigid']:
-        # need to also shift smoothed data (if smoothing used)
-        if ops['smooth_sigma_time']:
-            for fsm, dy, dx in zip(fsmooth, ymax, xmax):
-                fsm[:] = shift_frame(frame=fsm, dy=dy, dx=dx)
-        else:
-            fsmooth = frames.copy()
-
+        # the rigidly shifted (smoothed) data is only needed for the nonrigid phase correlation
+        fshift = shift_frames(
+            fsmooth if ops['smooth_sigma_time'] else frames, ymax, xmax,
+        )
         if ops.get('norm_frames', False):
-            fsmooth = np.clip(fsmooth, ops['rmin'], ops['rmax'])
-            
+            fshift = np.clip(fshift, ops['rmin'], ops['rmax'], out=fshift)
+
         ymax1, xmax1, cmax1 =nr_phasecorr(
-            data=fsmooth,
+            data=fshift,
             maskMul=maskMulNR.squeeze(),
             maskOffset=maskOffsetNR.squeeze(),
             cfRefImg=cfRefImgNR.squeeze(),
@@ -119,17 +113,21 @@ def register_frames(refAndMasks, frames, ops=None, base_shift=None,  do_rigid=Tr
             yblock=ops['yblock'],
             maxregshiftNR=ops['maxregshiftNR'],
         )
-
-        frames = nonrigid_transform_data(
-            data=frames,
-            nblocks=ops['nblocks'],
-            xblock=ops['xblock'],
-            yblock=ops['yblock'],
-            ymax1=ymax1,
-            xmax1=xmax1,
+        del fshift
+
+        # rigid and nonrigid shifts are applied to the raw frames in one pass,
+        # reusing the smoothed buffer as the output
+        frames = shift_frames(
+            frames, ymax, xmax,
+            ymax1=ymax1, xmax1=xmax1,
+            nblocks=ops['nblocks'], xblock=ops['xblock'], yblock=ops['yblock'],
+            out=fsmooth,
         )
     else:
         ymax1, xmax1, cmax1 = None, None, None 
+        if do_rigid:
+            # integer shifts, so the frames keep their dtype as with shift_frame
+            frames = shift_frames(frames, ymax, xmax, out=fsmooth).astype(frames.dtype, copy=False)
     
     return frames, ymax, xmax, cmax, ymax1, xmax1, cmax1
 
@@ -359,6 +357,159 @@ def nonrigid_transform_data(data, nblocks, xblock, yblock, ymax1, xmax1, bilinea
     return Y
 
 
+def block_shift_coords(Lx, Ly, nblocks, xblock, yblock):
+    """
+    Fractional block coordinates of every row and column, used to interpolate
+    block shifts to pixel shifts (see upsample_block_shifts)
+
+    Returns
+    -------
+    iy : float32, Ly
+    ix : float32, Lx
+    """
+    yb = np.array(yblock[::nblocks[1]]).mean(axis=1)
+    xb = np.array(xblock[:nblocks[1]]).mean(axis=1)
+    iy = np.interp(np.arange(Ly), yb, np.arange(yb.size)).astype(np.float32)
+    ix = np.interp(np.arange(Lx), xb, np.arange(xb.size)).astype(np.float32)
+    return iy, ix
+
+
+@njit(cache=True)
+def interp_block_shift(shifts, yc, xc):
+    """
+    bilinear interpolation of a grid of block shifts at (yc, xc), same as map_coordinates
+    """
+    nby, nbx = shifts.shape
+    yc_floor = np.int32(yc)
+    xc_floor = np.int32(xc)
+    y = yc - np.float32(yc_floor)
+    x = xc - np.float32(xc_floor)
+    yf = min(nby - 1, max(0, yc_floor))
+    xf = min(nbx - 1, max(0, xc_floor))
+    yf1 = min(nby - 1, yf + 1)
+    xf1 = min(nbx - 1, xf + 1)
+    return (shifts[yf, xf] * (1 - y) * (1 - x) + shifts[yf, xf1] * (1 - y) * x +
+            shifts[yf1, xf] * y * (1 - x) + shifts[yf1, xf1] * y * x)
+
+
+@njit(cache=True)
+def rigid_sample(frame, yy, xx, dy, dx):
+    """
+    value of the frame shifted by (dy, dx) at integer (yy, xx), zero outside the frame (same as shift_frame)
+    """
+    Ly, Lx = frame.shape
+    ys = yy + dy
+    xs = xx + dx
+    if ys < 0 or ys >= Ly or xs < 0 or xs >= Lx:
+        return np.float32(0)
+    return np.float32(frame[ys, xs])
+
+
+@njit(parallel=True, cache=True)
+def rigid_shift_frames(data, ymax, xmax, out):
+    """
+    Apply integer rigid shifts to a batch of frames in a single pass
+
+    Parameters
+    ----------
+    data : nimg x Ly x Lx
+    ymax, xmax : int, nimg
+        rigid shifts of each frame
+    out : float32, nimg x Ly x Lx
+        shifted data, must not share memory with data
+    """
+    nimg, Ly, Lx = data.shape
+    for t in prange(nimg):
+        dy = ymax[t]
+        dx = xmax[t]
+        for i in range(Ly):
+            for j in range(Lx):
+                out[t, i, j] = rigid_sample(data[t], i, j, dy, dx)
+
+
+@njit(parallel=True, cache=True)
+def rigid_nonrigid_shift_frames(data, ymax, xmax, ymax1, xmax1, iy, ix, out):
+    """
+    Apply integer rigid shifts followed by the piecewise affine nonrigid
+    transform to a batch of frames in a single pass. Equivalent to shift_frame
+    followed by nonrigid_transform_data, without the per-pixel shift maps.
+
+    Parameters
+    ----------
+    data : nimg x Ly x Lx
+    ymax, xmax : int, nimg
+        rigid shifts of each frame
+    ymax1, xmax1 : float32, nimg x nblocks[0] x nblocks[1]
+        nonrigid shifts of each block
+    iy, ix : float32, Ly and Lx
+        block coordinates of each row and column, from block_shift_coords
+    out : float32, nimg x Ly x Lx
+        shifted data, must not share memory with data
+    """
+    nimg, Ly, Lx = data.shape
+    for t in prange(nimg):
+        dy = ymax[t]
+        dx = xmax[t]
+        for i in range(Ly):
+            for j in range(Lx):
+                yc = np.float32(i) + interp_block_shift(ymax1[t], iy[i], ix[j])
+                xc = np.float32(j) + interp_block_shift(xmax1[t], iy[i], ix[j])
+                yc_floor = np.int32(yc)
+                xc_floor = np.int32(xc)
+                y = yc - np.float32(yc_floor)
+                x = xc - np.float32(xc_floor)
+                yf = min(Ly - 1, max(0, yc_floor))
+                xf = min(Lx - 1, max(0, xc_floor))
+                yf1 = min(Ly - 1, yf + 1)
+                xf1 = min(Lx - 1, xf + 1)
+                out[t, i, j] = (rigid_sample(data[t], yf, xf, dy, dx) * (1 - y) * (1 - x) +
+                                rigid_sample(data[t], yf, xf1, dy, dx) * (1 - y) * x +
+                                rigid_sample(data[t], yf1, xf, dy, dx) * y * (1 - x) +
+                                rigid_sample(data[t], yf1, xf1, dy, dx) * y * x)
+
+
+def shift_frames(data, ymax=None, xmax=None, ymax1=None, xmax1=None, nblocks=None,
+                 xblock=None, yblock=None, out=None):
+    """
+    Apply rigid and (optionally) nonrigid shifts to a batch of frames with a
+    fused parallel kernel, writing into a preallocated output
+
+    Parameters
+    ----------
+    data : nimg x Ly x Lx
+    ymax, xmax : int, nimg (optional)
+        rigid shifts, no rigid shift if None
+    ymax1, xmax1 : nimg x nblocks (optional)
+        nonrigid block shifts, no nonrigid shift if None
+    nblocks: (int, int)
+    xblock: float array
+    yblock: float array
+    out : float32, nimg x Ly x Lx (optional)
+        output array, must not share memory with data. Allocated if None
+
+    Returns
+    -------
+    out : float32, nimg x Ly x Lx
+        shifted data
+    """
+    nimg, Ly, Lx = data.shape
+    if out is None:
+        out = np.empty((nimg, Ly, Lx), np.float32)
+    if ymax is None:
+        ymax = np.zeros(nimg, np.int32)
+        xmax = np.zeros(nimg, np.int32)
+    ymax = np.asarray(ymax, np.int32)
+    xmax = np.asarray(xmax, np.int32)
+    if ymax1 is None:
+        rigid_shift_frames(data, ymax, xmax, out)
+    else:
+        iy, ix = block_shift_coords(Lx, Ly, nblocks, xblock, yblock)
+        ymax1 = np.asarray(ymax1, np.float32).reshape(nimg, nblocks[0], nblocks[1])
+        xmax1 = np.asarray(xmax1, np.float32).reshape(nimg, nblocks[0], nblocks[1])
+        rigid_nonrigid_shift_frames(data, ymax, xmax, ymax1, xmax1, iy, ix, out)
+    return out
+
+
 def shift_frame(frame: np.ndarray, dy: int, dx: int) -> np.ndarray:
     """
     Returns frame, shifted by dy and dx
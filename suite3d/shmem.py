@@ -0,0 +1,212 @@
+import os
+import uuid
+import atexit
+import threading
+import numpy as n
+from multiprocessing import shared_memory
+
+# Shared memory lifecycle. Every segment suite3d creates is named s3d_<pid>_<id> and
+# tracked until it is unlinked, and all tracked segments are unlinked when the process
+# exits. ShmemArena hands out named buffers that are reused across batches when the new
+# array fits in the old segment, and unlinks all of them when it is closed, so using it
+# as a context manager (or closing it in a finally block) frees its segments even if an
+# exception is raised. sweep_stale_segments removes segments left in /dev/shm by
+# processes that crashed or were killed, and runs once when the first Job is created.
+
+PREFIX = "s3d"
+SHM_DIR = "/dev/shm"
+
+_segments = {}
+_lock = threading.Lock()
+
+
+def create_segment(nbytes):
+    """
+    Create a tracked shared memory segment
+
+    Args:
+        nbytes (int): size in bytes
+
+    Returns:
+        SharedMemory
+    """
+    name = "%s_%d_%s" % (PREFIX, os.getpid(), uuid.uuid4().hex[:12])
+    shmem = shared_memory.SharedMemory(name=name, create=True, size=max(int(nbytes), 1))
+    with _lock:
+        _segments[shmem.name] = shmem
+    return shmem
+
+
+def free_segment(shmem):
+    """
+    Unlink a segment if this process created it, and close it. If arrays still point
+    into the segment it can't be closed yet, but once unlinked its memory is released
+    when the last of them is deleted.
+    """
+    with _lock:
+        owned = _segments.pop(shmem.name, None) is not None
+    if owned:
+        try:
+            shmem.unlink()
+        except FileNotFoundError:
+            pass
+    try:
+        shmem.close()
+    except BufferError:
+        pass
+
+
+def free_segment_by_name(name):
+    """free_segment for a segment known only by name, e.g. from shmem params"""
+    with _lock:
+        shmem = _segments.get(name)
+    if shmem is None:
+        try:
+            shmem = shared_memory.SharedMemory(name=name, create=False)
+        except FileNotFoundError:
+            return
+        shmem.unlink()
+    free_segment(shmem)
+
+
+def free_all_segments():
+    """Unlink every segment created by this process that is still alive"""
+    with _lock:
+        segments = list(_segments.values())
+    for shmem in segments:
+        free_segment(shmem)
+
+
+atexit.register(free_all_segments)
+
+
+def live_segments():
+    """Names and sizes (bytes) of the tracked segments of this process"""
+    with _lock:
+        return {name: shmem.size for name, shmem in _segments.items()}
+
+
+def pid_alive(pid):
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return False
+    except PermissionError:
+        return True
+    return True
+
+
+def stale_segments(shm_dir=SHM_DIR):
+    """
+    Names of suite3d segments in shm_dir whose creating process is no longer running.
+    Returns an empty list where shared memory is not backed by a directory (e.g. macOS).
+    """
+    if not os.path.isdir(shm_dir):
+        return []
+    stale = []
+    for name in os.listdir(shm_dir):
+        parts = name.split("_")
+        if len(parts) != 3 or parts[0] != PREFIX or not parts[1].isdigit():
+            continue
+        if not pid_alive(int(parts[1])):
+            stale.append(name)
+    return stale
+
+
+def sweep_stale_segments(shm_dir=SHM_DIR, log_cb=None):
+    """
+    Unlink the segments left behind by suite3d processes that crashed
+
+    Returns:
+        int: number of bytes freed
+    """
+    n_bytes = 0
+    names = stale_segments(shm_dir)
+    for name in names:
+        path = os.path.join(shm_dir, name)
+        try:
+            n_bytes += os.path.getsize(path)
+            os.unlink(path)
+        except OSError:
+            continue
+    if names and log_cb is not None:
+        log_cb(
+            "Removed %d stale shared memory segments (%.2f GB)"
+            % (len(names), n_bytes / 1024**3),
+            1,
+        )
+    return n_bytes
+
+
+_swept = False
+
+
+def sweep_once(log_cb=None):
+    """sweep_stale_segments, the first time it is called in this process"""
+    global _swept
+    if not _swept:
+        _swept = True
+        sweep_stale_segments(log_cb=log_cb)
+
+
+class ShmemArena:
+    """
+    Named shared memory buffers that are reused across batches. get() returns the
+    buffer for a key, reusing its segment if the requested array fits and replacing it
+    otherwise. close() unlinks every segment of the arena.
+
+    The params returned with each array are the same as utils.create_shmem_from_arr's,
+    so workers attach to them with utils.load_shmem.
+    """
+
+    def __init__(self):
+        self.buffers = {}
+
+    def get(self, key, shape, dtype, zero=False):
+        """
+        Args:
+            key (str): name of the buffer
+            shape (tuple): shape of the array
+            dtype (dtype): dtype of the array
+            zero (bool, optional): set the array to 0. Defaults to False.
+
+        Returns:
+            tuple: shmem params (dict), array backed by the segment
+        """
+        dtype = n.dtype(dtype)
+        nbytes = int(n.prod(shape)) * dtype.itemsize
+        shmem = self.buffers.get(key)
+        if shmem is not None and shmem.size < nbytes:
+            self.release(key)
+            shmem = None
+        if shmem is None:
+            shmem = create_segment(nbytes)
+            self.buffers[key] = shmem
+        params = {"dtype": dtype, "shape": tuple(shape), "nbytes": nbytes, "name": shmem.name}
+        arr = n.ndarray(params["shape"], dtype, buffer=shmem.buf)
+        if zero:
+            arr[:] = 0
+        return params, arr
+
+    def from_arr(self, key, arr, dtype=None):
+        """Copy arr into the buffer for key, converting it to dtype if given"""
+        params, sh_arr = self.get(key, arr.shape, arr.dtype if dtype is None else dtype)
+        sh_arr[:] = arr[:]
+        return params, sh_arr
+
+    def release(self, key):
+        """Unlink the segment of key. Arrays returned for it must not be used afterwards"""
+        shmem = self.buffers.pop(key, None)
+        if shmem is not None:
+            free_segment(shmem)
+
+    def close(self):
+        for key in list(self.buffers):
+            self.release(key)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+        return False
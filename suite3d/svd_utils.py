@@ -5,15 +5,114 @@ from dask_image.ndfilters import uniform_filter as dask_uniform_filter
 import numpy as n
 import zarr
 import time
-from scipy import ndimage
+from concurrent.futures import ThreadPoolExecutor
+from scipy import ndimage, special
 
 from .utils import default_log
+from . import detection3d as dtu
+from . import profiling
+
+try:
+    import psutil
+except:
+    print("No psutil")
+
+
+def plan_svd_resources(mov_shape, block_shape, block_overlaps, n_comp, flip_shape=False,
+                       mem_budget_gb=None, n_cores=None, target_chunk_mb=256, itemsize=4,
+                       log_cb=default_log):
+    """
+    Choose the dask chunking, number of blocks per batch and cluster layout for block_and_svd
+    from the available RAM, cores and the block shape.
+
+    Memory model for one block in svd_compressed: the (nt, npix) block is materialized about
+    twice (the loaded chunks and the compressed product during the power iterations),
+    plus the (nt, n_comp) and (npix, n_comp) sketches.
+
+    Args:
+        mov_shape (tuple): nz, nt, ny, nx (or nt, nz, ny, nx if flip_shape)
+        block_shape (tuple): svd block shape in z,y,x
+        block_overlaps (tuple): svd block overlaps in z,y,x
+        n_comp (int): number of svd components
+        flip_shape (bool, optional): True if mov_shape is nt, nz, ny, nx
+        mem_budget_gb (float, optional): RAM to use. Defaults to 80% of currently available RAM.
+        n_cores (int, optional): Defaults to os.cpu_count()
+        target_chunk_mb (int, optional): target size of a dask chunk
+        itemsize (int, optional): bytes per element during the computation
+
+    Returns:
+        dict: plan with n_svd_blocks_per_batch, t_chunk, pix_chunk, n_workers,
+              threads_per_worker, worker_memory_gb and the inputs it was derived from
+    """
+    if not flip_shape:
+        nz, nt, ny, nx = mov_shape
+    else:
+        nt, nz, ny, nx = mov_shape
+    if mem_budget_gb is None:
+        mem_budget_gb = 0.8 * psutil.virtual_memory().available / 1024**3
+    if n_cores is None:
+        n_cores = os.cpu_count()
+    blocks, __ = make_blocks((nz, ny, nx), block_shape, block_overlaps)
+    n_blocks = blocks.shape[1]
+    n_pix = int(n.prod(block_shape))
+
+    block_gb = nt * n_pix * itemsize / 1024**3
+    sketch_gb = (nt + n_pix) * n_comp * itemsize / 1024**3
+    per_block_gb = 2 * block_gb + sketch_gb
+
+    n_blocks_per_batch = int(max(1, min(n_blocks, n_cores, mem_budget_gb // per_block_gb)))
+    # one worker per block in the batch, sharing the cores
+    n_workers = n_blocks_per_batch
+    threads_per_worker = max(1, n_cores // n_workers)
+    worker_memory_gb = mem_budget_gb / n_workers
+
+    pix_chunk = n_pix
+    t_chunk = int(max(n_comp, min(nt, target_chunk_mb * 1024**2 // (pix_chunk * itemsize))))
+
+    plan = {
+        'n_svd_blocks_per_batch': n_blocks_per_batch,
+        't_chunk': t_chunk,
+        'pix_chunk': pix_chunk,
+        'n_workers': n_workers,
+        'threads_per_worker': threads_per_worker,
+        'worker_memory_gb': worker_memory_gb,
+        'mem_budget_gb': mem_budget_gb,
+        'n_cores': n_cores,
+        'est_block_gb': per_block_gb,
+    }
+    log_cb("SVD plan: %d blocks per batch (%.2f GB each, %.2f GB budget), chunks (%d, %d), %d workers x %d threads"
+           % (n_blocks_per_batch, per_block_gb, mem_budget_gb, t_chunk, pix_chunk, n_workers,
+              threads_per_worker), 1)
+    if per_block_gb > mem_budget_gb:
+        log_cb("WARNING: a single block needs %.2f GB, more than the %.2f GB budget. Reduce svd_block_shape"
+               % (per_block_gb, mem_budget_gb), 0)
+    return plan
+
+
+def start_svd_cluster(plan, log_cb=default_log):
+    """
+    Start a local dask.distributed cluster with the worker layout and memory limits of an
+    SVD plan. The returned client becomes the default scheduler for dask computations.
+    Returns None if dask.distributed is not installed.
+    """
+    try:
+        from dask.distributed import Client, LocalCluster
+    except ImportError:
+        log_cb("dask.distributed is not installed, using the threaded scheduler", 1)
+        return None
+    cluster = LocalCluster(n_workers=plan['n_workers'], threads_per_worker=plan['threads_per_worker'],
+                           memory_limit='%dMiB' % int(plan['worker_memory_gb'] * 1024),
+                           processes=True)
+    client = Client(cluster)
+    log_cb("Started dask cluster with %d workers, dashboard at %s" %
+           (plan['n_workers'], client.dashboard_link), 1)
+    return client
 
 
 def block_and_svd(mov_reg, n_comp, block_shape= (1, 128, 128), block_overlaps=(0, 18, 18),
                   t_chunk=4000, pix_chunk= None,t_save_chunk=100, comp_chunk=100, n_svd_blocks_per_batch = 4, svd_dir=None,
                   block_validity=None, log_cb=default_log, flip_shape=False, end_batch=None,
-                  start_batch = 0, run_svd=True, other_info = {}):
+                  start_batch = 0, run_svd=True, other_info = {}, svd_plan=None, scheduler=None):
     
     if mov_reg.shape[0] > 30:
         log_cb("Not possible to have more than 30 planes -> inferring that shape must be flipped")
@@ -48,7 +147,9 @@ def block_and_svd(mov_reg, n_comp, block_shape= (1, 128, 128), block_overlaps=(0
             'grid_shape': grid_shape,
             'mov_shape': mov_reg.shape,
             'n_comps': n_comp,
-            'svd_dirs': []
+            'svd_dirs': [],
+            'svd_plan': svd_plan,
+            'batch_throughput_gbps': [],
         }
         svd_info.update(other_info)
     else:
@@ -63,6 +164,7 @@ def block_and_svd(mov_reg, n_comp, block_shape= (1, 128, 128), block_overlaps=(0
         log_cb("Starting batch %d / %d, blocks %d - %d" %
                (batch_idx, n_batches, batch_start, batch_end), 2)
         to_compute = []
+        batch_nbytes = 0
         for block_idx in range(batch_start, batch_end):
             if block_validity is not None:
                 if not block_validity[block_idx]:
@@ -82,11 +184,15 @@ def block_and_svd(mov_reg, n_comp, block_shape= (1, 128, 128), block_overlaps=(0
                                     timechunk=t_save_chunk, compchunk=comp_chunk)
             svd_info['svd_dirs'].append(zarr_dir)
             to_compute.append(temp)
+            batch_nbytes += block.nbytes
         log_cb("Sending batch %d to dask" % batch_idx, 2)
         dask_tic = time.time()
-        xx = darr.compute(to_compute)
+        xx = darr.compute(to_compute, scheduler=scheduler)
         dask_toc = time.time() - dask_tic
-        log_cb("Dask completed in %.3f sec" % dask_toc, 2)
+        throughput = batch_nbytes / 1024**3 / dask_toc
+        svd_info.setdefault('batch_throughput_gbps', []).append(throughput)
+        log_cb("Dask completed in %.3f sec, %.2f GB at %.3f GB/s" %
+               (dask_toc, batch_nbytes / 1024**3, throughput), 2)
 
         log_cb("Saving svd_info to %s" % svd_info_path, 2)
         n.save(svd_info_path, svd_info)
@@ -112,6 +218,319 @@ def block_and_svd(mov_reg, n_comp, block_shape= (1, 128, 128), block_overlaps=(0
         batch_idx += 1
     return svd_info
 
+def block_and_svd_streaming(mov_reg, n_comp, block_shape=(1, 128, 128), block_overlaps=(0, 18, 18),
+                            t_batch_size=1000, n_power_iter=2, n_oversample=20, t_save_chunk=100,
+                            comp_chunk=100, svd_dir=None, block_validity=None, log_cb=default_log,
+                            flip_shape=False, run_svd=True, seed=0, other_info={}, mem_budget_gb=None):
+    """
+    Out-of-core randomized SVD of every block of the movie, computed with a fixed number
+    of passes over the movie in time order. Each pass loads one time batch of the full volume
+    and feeds it to the sketches of all blocks, so every byte of the movie is read
+    2 * n_power_iter + 2 times in total, regardless of the number of blocks.
+
+    For each block A (nt, npix), the sketch follows the randomized range finder:
+        Y = A P,  P = orth(A^T orth(Y)),  repeated n_power_iter times
+        B^T = A^T orth(Y),  svd(B) -> U = orth(Y) @ Ub, S, V
+    The time-side (nt, l) factors of each block are kept in memory-mapped .npy files in the
+    block directory, and are read and written once per pass. Every time batch updates the
+    whole pixel-side (npix, l) factor of every block, so these are kept in RAM for as many
+    blocks as fit in mem_budget_gb, and only the rest fall back to memory-mapped files
+    (which are then read and written once per time batch). The files are removed when the
+    block is saved.
+    Results are saved in the same u.zarr/s.zarr/v.zarr layout as block_and_svd.
+
+    Args:
+        mov_reg (ndarray or dask array): nz, nt, ny, nx (or nt, nz, ny, nx if flip_shape)
+        n_comp (int): number of components to save per block
+        block_shape (tuple, optional): size of a block in z,y,x
+        block_overlaps (tuple, optional): overlap between blocks in z,y,x
+        t_batch_size (int, optional): number of frames loaded per step of each pass
+        n_power_iter (int, optional): number of power iterations (q)
+        n_oversample (int, optional): extra sketch columns, l = n_comp + n_oversample
+        t_save_chunk (int, optional): time chunksize of the saved u.zarr
+        comp_chunk (int, optional): component chunksize of the saved zarrs
+        svd_dir (str, optional): directory to save svd_info.npy and blocks/
+        block_validity (ndarray, optional): boolean per block, False blocks are skipped
+        log_cb (func, optional): Defaults to default_log.
+        flip_shape (bool, optional): True if the movie is nt, nz, ny, nx
+        run_svd (bool, optional): If False, only return svd_info
+        seed (int, optional): seed for the random test matrices
+        other_info (dict, optional): extra entries for svd_info
+        mem_budget_gb (float, optional): RAM to use. Defaults to 80% of currently available RAM.
+
+    Returns:
+        dict: svd_info
+    """
+    if mov_reg.shape[0] > 30:
+        log_cb("Not possible to have more than 30 planes -> inferring that shape must be flipped")
+        flip_shape = True
+    if not flip_shape:
+        nz, nt, ny, nx = mov_reg.shape
+    else:
+        nt, nz, ny, nx = mov_reg.shape
+    blocks, grid_shape = make_blocks((nz, ny, nx), block_shape, block_overlaps)
+    n_blocks = blocks.shape[1]
+    n_sketch = min(n_comp + n_oversample, nt, int(n.prod(block_shape)))
+    n_batches = int(n.ceil(nt / t_batch_size))
+    n_passes = 2 * n_power_iter + 2
+
+    log_cb("Will compute streaming SVD in %d blocks in a grid shaped %s" %
+           (n_blocks, str(grid_shape)), 1)
+    log_cb("Sketch size %d, %d power iterations, %d passes of %d time batches" %
+           (n_sketch, n_power_iter, n_passes, n_batches))
+
+    svd_block_dir = os.path.join(svd_dir, 'blocks')
+    os.makedirs(svd_block_dir, exist_ok=True)
+    svd_info_path = os.path.join(svd_dir, 'svd_info.npy')
+    svd_info = {
+        'n_blocks': n_blocks,
+        'block_shape': block_shape,
+        'block_overlaps': block_overlaps,
+        'blocks': blocks,
+        'grid_shape': grid_shape,
+        'mov_shape': mov_reg.shape,
+        'n_comps': n_comp,
+        'svd_dirs': []
+    }
+    svd_info.update(other_info)
+    if not run_svd: return svd_info
+
+    if mem_budget_gb is None:
+        mem_budget_gb = 0.8 * psutil.virtual_memory().available / 1024**3
+    # the loaded batch and the block extracted from it
+    batch_bytes = 2 * min(t_batch_size, nt) * nz * ny * nx * 4
+    p_budget = mem_budget_gb * 1024**3 - batch_bytes
+
+    block_idxs = [i for i in range(n_blocks) if block_validity is None or block_validity[i]]
+    rng = n.random.default_rng(seed)
+    sketches = {}
+    p_bytes = 0
+    for block_idx in block_idxs:
+        zarr_dir = os.path.join(svd_block_dir, '%04d' % block_idx)
+        os.makedirs(zarr_dir, exist_ok=True)
+        n_pix = int(n.prod(n.diff(blocks[:, block_idx], axis=1)))
+        ys = n.lib.format.open_memmap(os.path.join(zarr_dir, 'sketch_y.npy'), mode='w+',
+                                      dtype=n.float32, shape=(nt, n_sketch))
+        p0 = rng.standard_normal((n_pix, n_sketch), dtype=n.float32)
+        if p_bytes + p0.nbytes <= p_budget:
+            ps = p0
+            p_bytes += p0.nbytes
+        else:
+            ps = n.lib.format.open_memmap(os.path.join(zarr_dir, 'sketch_p.npy'), mode='w+',
+                                          dtype=n.float32, shape=(n_pix, n_sketch))
+            ps[:] = p0
+        del p0
+        sketches[block_idx] = {'dir': zarr_dir, 'y': ys, 'p': ps}
+        svd_info['svd_dirs'].append(zarr_dir)
+    n_p_ram = sum(not isinstance(sk['p'], n.memmap) for sk in sketches.values())
+    log_cb("Pixel-side sketches of %d / %d blocks in RAM (%.2f GB)" %
+           (n_p_ram, len(sketches), p_bytes / 1024**3), 2)
+
+    def stream_pass(pass_idx, range_pass):
+        # range_pass: Y = A @ P, otherwise P = A^T @ Y
+        tic = time.time()
+        if not range_pass:
+            for sk in sketches.values():
+                sk['p'][:] = 0
+        for batch_idx in range(n_batches):
+            t0 = batch_idx * t_batch_size
+            t1 = min(nt, t0 + t_batch_size)
+            with profiling.stage('svd_batch', frames=t1 - t0) as rec:
+                mov_batch = load_time_batch(mov_reg, t0, t1, flip_shape)
+                rec.count(nbytes=mov_batch.nbytes)
+                for block_idx, sk in sketches.items():
+                    a = extract_block_from_batch(mov_batch, blocks[:, block_idx], flip_shape)
+                    if range_pass:
+                        sk['y'][t0:t1] = a @ sk['p']
+                    else:
+                        sk['p'] += a.T @ sk['y'][t0:t1]
+        log_cb("Pass %d / %d completed in %.2f sec" % (pass_idx + 1, n_passes, time.time() - tic), 2)
+
+    def orthonormalize(key):
+        # one block at a time, so only a single (nt, l) or (npix, l) factor is in memory
+        for sk in sketches.values():
+            sk[key][:] = n.linalg.qr(n.asarray(sk[key]))[0]
+
+    pass_idx = 0
+    stream_pass(pass_idx, range_pass=True)
+    for iter_idx in range(n_power_iter + 1):
+        orthonormalize('y')
+        pass_idx += 1
+        stream_pass(pass_idx, range_pass=False)
+        if iter_idx == n_power_iter:
+            break
+        orthonormalize('p')
+        pass_idx += 1
+        stream_pass(pass_idx, range_pass=True)
+
+    log_cb("Saving %d blocks to %s" % (len(sketches), svd_block_dir), 1)
+    for block_idx, sk in sketches.items():
+        # the pixel-side store now holds B^T = A^T Q, and Q is in the time-side store
+        w, s, xt = n.linalg.svd(n.asarray(sk['p']), full_matrices=False)
+        save_usv_to_zarr(sk['y'], xt.T[:, :n_comp].astype(n.float32), s[:n_comp].astype(n.float32),
+                         w.T[:n_comp].astype(n.float32), sk['dir'],
+                         timechunk=t_save_chunk, compchunk=comp_chunk)
+        on_disk = isinstance(sk['p'], n.memmap)
+        del sk['y'], sk['p']
+        os.remove(os.path.join(sk['dir'], 'sketch_y.npy'))
+        if on_disk:
+            os.remove(os.path.join(sk['dir'], 'sketch_p.npy'))
+    log_cb("Saving svd_info to %s" % svd_info_path, 2)
+    n.save(svd_info_path, svd_info)
+    return svd_info
+
+
+def update_block_and_svd(mov_new, svd_dir, t_batch_size=500, flip_shape=False, log_cb=default_log):
+    """
+    Update an existing block SVD with frames appended to the end of the movie, without
+    recomputing it. The new movie is read once, in time batches, and each batch updates
+    every block with update_usv (Brand's incremental SVD, truncated to the existing number
+    of components). New rows of U are appended to the u.zarr stores, s.zarr and v.zarr are
+    overwritten, and the existing rows of U are rotated once at the end of the update.
+    svd_info['mov_shape'] is extended by the number of new frames.
+
+    Args:
+        mov_new (ndarray or dask array): new frames, nz, nt_new, ny, nx (or nt_new, nz, ny, nx
+                                         if flip_shape), with the same crop as the original SVD
+        svd_dir (str): directory containing svd_info.npy
+        t_batch_size (int, optional): number of frames added to the SVD at once. Defaults to 500.
+        flip_shape (bool, optional): True if mov_new is nt, nz, ny, nx
+        log_cb (func, optional): Defaults to default_log.
+
+    Returns:
+        dict: updated svd_info
+    """
+    svd_info_path = os.path.join(svd_dir, 'svd_info.npy')
+    svd_info = n.load(svd_info_path, allow_pickle=True).item()
+    mov_shape = list(svd_info['mov_shape'])
+    t_axis = 0 if mov_shape[0] > 30 else 1
+    nt_old = mov_shape[t_axis]
+    nt_new = mov_new.shape[0] if flip_shape else mov_new.shape[1]
+    spatial_old = [x for i, x in enumerate(mov_shape) if i != t_axis]
+    spatial_new = [x for i, x in enumerate(mov_new.shape) if i != (0 if flip_shape else 1)]
+    assert spatial_old == spatial_new, "New movie volume %s does not match the SVD volume %s" % \
+        (str(spatial_new), str(spatial_old))
+
+    blocks = svd_info['blocks']
+    block_dirs = svd_info['svd_dirs']
+    block_idxs = [int(os.path.basename(os.path.normpath(d))) for d in block_dirs]
+    log_cb("Updating SVD of %d blocks with %d new frames (%d existing)" %
+           (len(block_dirs), nt_new, nt_old), 1)
+
+    states = []
+    for block_dir in block_dirs:
+        s = n.asarray(zarr.open(os.path.join(block_dir, 's.zarr'), mode='r')[:], dtype=n.float32)
+        v = n.asarray(zarr.open(os.path.join(block_dir, 'v.zarr'), mode='r')[:], dtype=n.float32)
+        n_comp = s.shape[0]
+        states.append({'s': s, 'v': v, 'rot': n.eye(n_comp, dtype=n.float32),
+                       'u_new': n.zeros((0, n_comp), dtype=n.float32)})
+
+    tic = time.time()
+    for t0 in range(0, nt_new, t_batch_size):
+        t1 = min(nt_new, t0 + t_batch_size)
+        with profiling.stage('svd_batch', frames=t1 - t0) as rec:
+            mov_batch = load_time_batch(mov_new, t0, t1, flip_shape)
+            rec.count(nbytes=mov_batch.nbytes)
+            for i, st in enumerate(states):
+                c = extract_block_from_batch(mov_batch, blocks[:, block_idxs[i]], flip_shape)
+                mix, u_c, st['s'], st['v'] = update_usv(st['s'], st['v'], c)
+                # rows of U from before this batch are rotated by the top-left block of the mix
+                st['rot'] = st['rot'] @ mix
+                st['u_new'] = n.concatenate([st['u_new'] @ mix, u_c])
+        log_cb("Added frames %d - %d in %.2f sec" % (t0, t1, time.time() - tic), 2)
+
+    log_cb("Saving updated blocks", 2)
+    for block_dir, st in zip(block_dirs, states):
+        u_zarr = zarr.open(os.path.join(block_dir, 'u.zarr'), mode='r+')
+        t_chunk = u_zarr.chunks[0]
+        for t0 in range(0, nt_old, t_chunk * 10):
+            t1 = min(nt_old, t0 + t_chunk * 10)
+            u_zarr[t0:t1] = n.asarray(u_zarr[t0:t1], dtype=n.float32) @ st['rot']
+        u_zarr.append(st['u_new'].astype(u_zarr.dtype), axis=0)
+        zarr.open(os.path.join(block_dir, 's.zarr'), mode='r+')[:] = st['s']
+        zarr.open(os.path.join(block_dir, 'v.zarr'), mode='r+')[:] = st['v']
+
+    mov_shape[t_axis] = nt_old + nt_new
+    svd_info['mov_shape'] = tuple(mov_shape)
+    svd_info.setdefault('svd_updates', []).append(nt_new)
+    log_cb("Saving svd_info to %s, new movie shape %s" % (svd_info_path, str(svd_info['mov_shape'])), 2)
+    n.save(svd_info_path, svd_info)
+    return svd_info
+
+
+def update_usv(s, v, c):
+    """
+    Brand's incremental SVD for appending rows c (m, npix) to A = U diag(s) v,
+    truncated to the current number of components k:
+        [A; c] = blockdiag(U, I) @ M @ [v; J^T],   M = [[diag(s), 0], [c v^T, K^T]]
+    where J K is the QR of the part of c^T orthogonal to the rows of v.
+
+    Returns:
+        mix (k, k): new U for the existing rows is U @ mix
+        u_c (m, k): rows of the new U for c
+        s_new (k,), v_new (k, npix)
+    """
+    k = s.shape[0]
+    m = c.shape[0]
+    l = c @ v.T
+    h = c - l @ v
+    j, kr = n.linalg.qr(h.T)
+    mid = n.zeros((k + m, k + j.shape[1]), dtype=n.float32)
+    mid[:k, :k] = n.diag(s)
+    mid[k:, :k] = l
+    mid[k:, k:] = kr.T
+    um, sm, vmt = n.linalg.svd(mid, full_matrices=False)
+    v_new = vmt[:k, :k] @ v + vmt[:k, k:] @ j.T
+    return um[:k, :k], um[k:, :k], sm[:k], v_new
+
+
+def load_time_batch(mov_reg, t0, t1, flip_shape=False):
+    """
+    Load frames t0:t1 of a movie into memory as a float32 numpy array, in the movie's own
+    axis order (nz, nt, ny, nx) or (nt, nz, ny, nx) if flip_shape
+    """
+    if not flip_shape:
+        batch = mov_reg[:, t0:t1]
+    else:
+        batch = mov_reg[t0:t1]
+    if isinstance(batch, darr.Array):
+        batch = batch.compute()
+    return n.asarray(batch, dtype=n.float32)
+
+
+def extract_block_from_batch(mov_batch, block_limits, flip_shape=False):
+    """
+    Return a block of a time batch reshaped to (nt, npix), with the same pixel ordering
+    that block_and_svd uses
+    """
+    zz, yy, xx = block_limits
+    if not flip_shape:
+        block = mov_batch[zz[0]:zz[1], :, yy[0]:yy[1], xx[0]:xx[1]].swapaxes(0, 1)
+    else:
+        block = mov_batch[:, zz[0]:zz[1], yy[0]:yy[1], xx[0]:xx[1]]
+    return n.ascontiguousarray(block).reshape(block.shape[0], -1)
+
+
+def save_usv_to_zarr(ys, u_transform, s, v, svd_dir, timechunk=200, compchunk=100, t_batch_size=4000):
+    """
+    Save u = ys @ u_transform, s and v to u.zarr, s.zarr, v.zarr in svd_dir with the same
+    chunking as run_svd_on_block. u is written in time batches so ys can be memory-mapped
+    """
+    nt = ys.shape[0]
+    n_comp, n_pix = v.shape
+    u_zarr = zarr.open(os.path.join(svd_dir, 'u.zarr'), compressor=None, mode='w',
+                       shape=(nt, n_comp), chunks=(min(timechunk, nt), min(compchunk, n_comp)),
+                       dtype=n.float32)
+    for t0 in range(0, nt, t_batch_size):
+        t1 = min(nt, t0 + t_batch_size)
+        u_zarr[t0:t1] = n.asarray(ys[t0:t1]) @ u_transform
+    s_zarr = zarr.open(os.path.join(svd_dir, 's.zarr'), compressor=None, mode='w',
+                       shape=(n_comp,), chunks=(min(compchunk, n_comp),), dtype=n.float32)
+    s_zarr[:] = s
+    v_zarr = zarr.open(os.path.join(svd_dir, 'v.zarr'), compressor=None, mode='w',
+                       shape=(n_comp, n_pix), chunks=(min(compchunk, n_comp), n_pix), dtype=n.float32)
+    v_zarr[:] = v
+
 import time
 
 def reconstruct(svd_info, t_indices):
@@ -125,61 +544,157 @@ def get_overlap_mask(block_shape, overlaps, bsize=3, fsize=1.4):
     mask = ndimage.uniform_filter(mask, (noz//fsize, noy//fsize, nox//fsize))
     return mask
 
-def reconstruct_overlapping_movie(svd_info, t_indices, filt_size = None, block_chunks=1, normalize=True, n_comps = None, crop_z = None, log_cb=default_log):
-    
-    # print("RECONSTRUCT START")
-    tic = time.time()
-    ntx = t_indices[1] - t_indices[0]
-    t_batch_size = ntx
-    all_blocks = reconstruct_movie(svd_info, t_batch_size = t_batch_size, return_blocks=True, block_chunks=block_chunks, n_comps = n_comps, t_indices=t_indices)
-    
-    nz, nt, ny, nx = svd_info['mov_shape']
-    block_limits = svd_info['blocks']
-    nbz, nby, nbx = svd_info['block_shape']
-    n_blocks = svd_info['n_blocks']
-    
-    if crop_z is not None:
-        nz = crop_z[1] - crop_z[0]
-        valid_blocks = []
-        for i in range(n_blocks):
-            if block_limits[0,i,0] in range(*crop_z):
-                valid_blocks.append(i)
-        valid_blocks = n.array(valid_blocks)
-        all_blocks = all_blocks[valid_blocks]
-        n_blocks = all_blocks.shape[0]
-
-    mov3d = n.zeros((ntx, nz, ny, nx), dtype=n.float32)
-    norm3d = n.zeros((nz,ny,nx))
-    noz, noy, nox = svd_info['block_overlaps']
-    mask = n.zeros((nbz, nby, nbx)) 
-    bsize = 3
-    mask[(noz//bsize):(nbz-noz//bsize),(noy//bsize) : (nby-noy//bsize),(nox//bsize) : (nbx-nox//bsize)] = 1
-    fsize = 1.4
-    mask = ndimage.uniform_filter(mask, (noz//fsize, noy//fsize, nox//fsize))
-    # print(all_blocks.shape)
-    # all_blocks_batch = all_blocks[:, t_indices[0]:t_indices[1]]
-    # print(all_blocks.shape)
-    # return
-    log_cb("Sending all blocks to dask to compute",3, log_mem_usage=True)
-    all_blocks_batch = all_blocks.compute()
-    log_cb("Dask reconstruction complete", 3, log_mem_usage=True)
-    # print("RECONSTRUCT - DASK COMPLETE at t %.2f" % (time.time()-tic))
-    # TODO this is slow! 
-    for i in range(n_blocks):
-        zz,yy,xx = block_limits[:,i]
-        block = all_blocks_batch[i].reshape(
-            t_batch_size, nbz, nby, nbx) * mask[n.newaxis]
-        mov3d[:,zz[0]:zz[1], yy[0]:yy[1], xx[0]:xx[1]] += block
-        norm3d[zz[0]:zz[1], yy[0]:yy[1], xx[0]:xx[1]] += mask
+class OverlapReconstructor:
+    """
+    Reconstruct the denoised movie from block SVDs, blending the overlapping blocks.
+
+    The blending mask, the normalisation volume and the spatial components S*V of every
+    block (premultiplied by the mask) are computed once at construction. Each call then
+    only loads U for the requested frames, and a thread pool computes U @ (S V mask) for
+    every block and adds it into the output, with each thread owning a range of frames
+    so no two threads write to the same voxels. Everything is float32.
+    """
+
+    def __init__(self, svd_info, n_comps=None, crop_z=None, n_threads=8, log_cb=default_log):
+        if type(svd_info) == str:
+            svd_info = n.load(os.path.join(svd_info, 'svd_info.npy'), allow_pickle=True).item()
+        self.svd_info = svd_info
+        self.n_comps = svd_info['n_comps'] if n_comps is None else n_comps
+        self.n_threads = n_threads
+        self.log_cb = log_cb
+
+        nz, nt, ny, nx = svd_info['mov_shape']
+        self.nt = nt
+        self.block_shape = tuple(svd_info['block_shape'])
+        block_limits = svd_info['blocks']
+        block_idxs = n.arange(svd_info['n_blocks'])
+        z_offset = 0
+        if crop_z is not None:
+            block_idxs = n.array([i for i in block_idxs if block_limits[0, i, 0] in range(*crop_z)])
+            nz = crop_z[1] - crop_z[0]
+            z_offset = crop_z[0]
+        self.vol_shape = (nz, ny, nx)
+        self.block_idxs = block_idxs
+        self.block_dirs = [svd_info['svd_dirs'][i] for i in block_idxs]
+        self.block_slices = []
+        for i in block_idxs:
+            zz, yy, xx = block_limits[:, i]
+            self.block_slices.append((slice(zz[0] - z_offset, zz[1] - z_offset),
+                                      slice(yy[0], yy[1]), slice(xx[0], xx[1])))
 
-        
+        tic = time.time()
+        self.mask = get_overlap_mask(self.block_shape, svd_info['block_overlaps']).astype(n.float32)
+        norm = n.zeros(self.vol_shape, dtype=n.float32)
+        for sl in self.block_slices:
+            norm[sl] += self.mask
+        self.norm = norm
+        self.inv_norm = n.zeros_like(norm)
+        valid = norm >= 1e-5
+        self.inv_norm[valid] = 1 / norm[valid]
+        self.svs = load_and_multiply_stack_svs(self.block_dirs, self.n_comps, compute=True)
+        self.svs *= self.mask.reshape(1, 1, -1)
+        log_cb("Prepared reconstruction weights for %d blocks in %.2f sec, %.2f GB" %
+               (len(self.block_dirs), time.time() - tic, self.svs.nbytes / 1024**3), 3)
+
+    def load_us(self, t_indices):
+        return load_stack_us(self.block_dirs, self.n_comps, t_indices=t_indices, compute=True)
+
+    def reconstruct(self, t_indices, out=None, normalize=True, us=None):
+        """
+        Reconstruct frames t_indices[0]:t_indices[1].
+
+        Args:
+            t_indices (tuple): start and end frame
+            out (ndarray, optional): float32 (nt_batch, nz, ny, nx) buffer to write into.
+                                     Allocated if None. Overwritten, not accumulated into.
+            normalize (bool, optional): divide by the summed blending weights. Defaults to True.
+            us (ndarray, optional): (n_blocks, nt_batch, n_comp) temporal components, loaded if None
+
+        Returns:
+            ndarray: out
+        """
+        nt_batch = t_indices[1] - t_indices[0]
+        if us is None:
+            us = self.load_us(t_indices)
+        if out is None:
+            out = n.empty((nt_batch,) + self.vol_shape, dtype=n.float32)
+        assert out.shape == (nt_batch,) + self.vol_shape
+
+        t_splits = n.linspace(0, nt_batch, min(self.n_threads, nt_batch) + 1).astype(int)
+
+        def worker(t0, t1):
+            out_t = out[t0:t1]
+            out_t[:] = 0
+            for i, sl in enumerate(self.block_slices):
+                block = (us[i, t0:t1].astype(n.float32, copy=False) @ self.svs[i])
+                out_t[(slice(None),) + sl] += block.reshape((t1 - t0,) + self.block_shape)
+            if normalize:
+                out_t *= self.inv_norm
+
+        with ThreadPoolExecutor(len(t_splits) - 1) as pool:
+            futures = [pool.submit(worker, t0, t1) for t0, t1 in zip(t_splits[:-1], t_splits[1:])]
+            for future in futures:
+                future.result()
+        return out
+
+    def reconstruct_into(self, out, t_batch_size=400, t_indices=None, normalize=True):
+        """
+        Stream the reconstruction in time batches into a caller-provided buffer
+        (e.g. a memory-mapped .npy) of shape (nt, nz, ny, nx).
+        """
+        if t_indices is None:
+            t_indices = (0, self.nt)
+        for t0 in range(t_indices[0], t_indices[1], t_batch_size):
+            t1 = min(t_indices[1], t0 + t_batch_size)
+            self.log_cb("Reconstructing frames %d - %d" % (t0, t1), 3)
+            self.reconstruct((t0, t1), out=out[t0 - t_indices[0]:t1 - t_indices[0]],
+                             normalize=normalize)
+        return out
+
+
+reconstructor_cache = {}
+
+
+def svd_dirs_mtime(svd_dirs):
+    """Latest modification time (ns) of the files in the block directories"""
+    mtime = 0
+    for svd_dir in svd_dirs:
+        with os.scandir(svd_dir) as entries:
+            for entry in entries:
+                mtime = max(mtime, entry.stat().st_mtime_ns)
+    return mtime
+
+
+def clear_reconstructor_cache():
+    """Drop the cached OverlapReconstructor and the spatial components it holds"""
+    reconstructor_cache.clear()
+
+
+def get_overlap_reconstructor(svd_info, n_comps=None, crop_z=None, log_cb=default_log):
+    """
+    Return the OverlapReconstructor for svd_info, re-using the previous one if it was built
+    for the same blocks and parameters and the block files have not been rewritten since.
+    Only the most recent one is kept, but it holds the masked S*V of every block (as large
+    as V), so call clear_reconstructor_cache once the reconstruction is done.
+    """
+    key = (tuple(svd_info['svd_dirs']), tuple(svd_info['mov_shape']), n_comps,
+           None if crop_z is None else tuple(crop_z), svd_dirs_mtime(svd_info['svd_dirs']))
+    if key not in reconstructor_cache:
+        reconstructor_cache.clear()
+        reconstructor_cache[key] = OverlapReconstructor(svd_info, n_comps=n_comps, crop_z=crop_z,
+                                                        log_cb=log_cb)
+    return reconstructor_cache[key]
+
+
+def reconstruct_overlapping_movie(svd_info, t_indices, filt_size = None, block_chunks=1, normalize=True, n_comps = None, crop_z = None, log_cb=default_log, out=None):
+    recon = get_overlap_reconstructor(svd_info, n_comps=n_comps, crop_z=crop_z, log_cb=log_cb)
+    log_cb("Reconstructing frames %d - %d" % tuple(t_indices), 3, log_mem_usage=True)
+    mov3d = recon.reconstruct(t_indices, out=out, normalize=normalize)
+    log_cb("Reconstruction complete", 3, log_mem_usage=True)
     if normalize:
-        norm3d[norm3d < 1e-5] = n.inf
-        # print("RECONSTRUCT - ALL COMPLETE at t %.2f" % (time.time()-tic))
-        return mov3d / norm3d
-    else: 
-        # print("RECONSTRUCT - ALL COMPLETE at t %.2f" % (time.time()-tic))
-        return mov3d, norm3d
+        return mov3d
+    else:
+        return mov3d, recon.norm.copy()
 
 def reconstruct_movie(svd_info, t_batch_size=None, return_blocks=False, block_chunks=1, n_comps=None, old_func=False, t_indices=None):
     if type(svd_info) == str:
@@ -454,6 +969,159 @@ def rechunk_usv_comps(u, s, v, comp_chunksize=16, z_chunksize=None, t_chunksize=
         v = v.rechunk(tuple(cs))
     return u, s, v
 
+def filter_v_block(v, block_shape, filt_type, filt_size, mode='mirror'):
+    """
+    Apply a 3D spatial filter to every spatial component of a block.
+
+    Args:
+        v (ndarray): (n_comp, n_pix) spatial components of a block
+        block_shape (tuple): bz, by, bx with bz*by*bx = n_pix
+        filt_type (str): 'unif' or 'gaussian'
+        filt_size (tuple): size (unif) or sigma (gaussian) in z,y,x
+        mode (str, optional): boundary mode of the filter. Defaults to 'mirror'.
+
+    Returns:
+        ndarray: filtered v, same shape
+    """
+    n_comp = v.shape[0]
+    v = v.reshape((n_comp,) + tuple(block_shape))
+    if filt_type == 'unif':
+        v_filt = ndimage.uniform_filter(v, (1,) + tuple(filt_size), mode=mode)
+    elif filt_type == 'gaussian':
+        v_filt = ndimage.gaussian_filter(v, (0,) + tuple(filt_size), mode=mode)
+    else:
+        assert False, "Unknown filter type %s" % filt_type
+    return v_filt.reshape(n_comp, -1)
+
+
+def corrmap_filter_reach(npil_filt_type, npil_filt_pix, cell_filt_type, cell_filt_pix):
+    """
+    Number of voxels along z, y, x that the neuropil subtraction followed by the cell
+    filter reads on each side of an output voxel.
+    """
+    reach = n.zeros(3, dtype=int)
+    for filt_type, filt_pix in ((npil_filt_type, npil_filt_pix), (cell_filt_type, cell_filt_pix)):
+        if filt_type is None or filt_type == 'none':
+            continue
+        for ax in range(3):
+            filt = dtu.filter_weights(filt_type, filt_pix[ax])
+            if filt is not None:
+                weights, left, __ = filt
+                reach[ax] += max(left, weights.shape[0] - 1 - left)
+    return reach
+
+
+def corrmap_preprocess_u(u, temporal_hpf_width, detection_timebin=1):
+    """
+    Time-bin u and apply the rolling-mean high-pass filter, as compute_corr_map_batch does
+    to the movie when the whole movie is one batch.
+
+    Returns:
+        u_binned (nt_binned, n_comp), u_hpf (nt_binned, n_comp)
+    """
+    u = n.asarray(u, dtype=n.float32)
+    if detection_timebin is not None and detection_timebin > 1:
+        nt_bin = u.shape[0] // detection_timebin
+        u = u[:nt_bin * detection_timebin].reshape(nt_bin, detection_timebin, -1).mean(axis=1)
+    nt = u.shape[0]
+    # same adjustment as compute_corr_map_batch, so the windows tile the movie
+    temporal_hpf_width = min(nt, int(temporal_hpf_width))
+    if nt % temporal_hpf_width != 0:
+        temporal_hpf_width = int(nt / (n.floor(nt / temporal_hpf_width)))
+    return u, dtu.hp_rolling_mean_filter(u, temporal_hpf_width, copy=True)
+
+
+def _quad_form(cov, x, y=None):
+    # diag(x^T cov y), one value per pixel
+    return n.einsum('kp,kp->p', cov.astype(n.float32) @ x, x if y is None else y)
+
+
+def sdmov_from_usv(u_hpf, w):
+    """
+    sdmov (see dtu.accumulate_sdmov) of the movie u_hpf @ w, from its factors: the mean
+    squared temporal difference of each pixel is diag(W^T (dU^T dU) W) / nt.
+
+    Args:
+        u_hpf (ndarray): (nt, n_comp) output of corrmap_preprocess_u
+        w (ndarray): (n_comp, n_pix)
+
+    Returns:
+        ndarray: (n_pix,)
+    """
+    ud = n.diff(u_hpf, axis=0).astype(n.float64)
+    return n.sqrt(n.maximum(1e-10, _quad_form(ud.T @ ud, w) / u_hpf.shape[0]))
+
+
+def corrmap_block_from_usv(u_hpf, w, region_shape, block_sl, npil_filt_type, npil_filt_pix,
+                           cell_filt_type, cell_filt_pix, intensity_thresh=None, standard_vmap=True):
+    """
+    Compute the correlation map reduction of one block from the factors u_hpf @ w of the
+    normalized movie around it, without forming the filtered movie. w covers the block
+    padded by the reach of the spatial filters (see corrmap_filter_reach), so the filters
+    see the neighbouring data rather than a mirrored block edge, and the result on the
+    block is exact for the movie u_hpf @ w. The neuropil subtraction and cell filter act
+    on the n_comp images of w, and the sums over time are quadratic forms in the
+    n_comp x n_comp covariance of u_hpf, so the cost is O(n_comp**2) per voxel of the
+    padded block instead of O(nt).
+
+    Without intensity_thresh the sum of squares is exact. With a threshold, the sums over
+    the frames above it are estimated by treating each voxel's filtered trace x as
+    Gaussian with the mean and variance given by the factors, using the truncated moment
+    E[x**2; x > th] (or E[x*y; x > th] for the neuropil subtracted trace y, if
+    standard_vmap is False).
+
+    Args:
+        u_hpf (ndarray): (nt, n_comp) output of corrmap_preprocess_u
+        w (ndarray): (n_comp, n_pix) spatial components over the padded block, after the
+            edge crop and sdmov normalization. Filtered in place if it is float32
+        region_shape (tuple): shape of the padded block, with prod(region_shape) = n_pix
+        block_sl (tuple): slices of the block inside the padded block
+        npil_filt_type, npil_filt_pix, cell_filt_type, cell_filt_pix: see compute_corr_map_batch
+        intensity_thresh (float, optional): threshold before taking the sum of squares
+        standard_vmap (bool, optional): see dtu.filter_and_reduce_movie
+
+    Returns:
+        ndarray: vmap_2 (n_block_pix,)
+    """
+    w = n.asarray(w, dtype=n.float32)
+    n_comp = w.shape[0]
+    region_shape = tuple(region_shape)
+    block_idx = (slice(None),) + tuple(block_sl)
+
+    def crop_block(x):
+        return x.reshape((n_comp,) + region_shape)[block_idx].reshape(n_comp, -1)
+
+    if npil_filt_type is not None and npil_filt_type != 'none':
+        w -= filter_v_block(w, region_shape, npil_filt_type, npil_filt_pix)
+    f = cell_filt_pix[-1] * crop_block(filter_v_block(w, region_shape, cell_filt_type, cell_filt_pix))
+    w = crop_block(w)
+
+    nt = u_hpf.shape[0]
+    u = u_hpf.astype(n.float64)
+    u_mean = u.mean(axis=0)
+    u_sq = u.T @ u / nt
+    if standard_vmap and intensity_thresh is None:
+        return nt * _quad_form(u_sq, f)
+
+    thresh = 0.0 if intensity_thresh is None else float(intensity_thresh)
+    u_cov = u_sq - n.outer(u_mean, u_mean)
+    f_mean = u_mean @ f
+    f_var = n.maximum(_quad_form(u_cov, f), 1e-20).astype(n.float64)
+    f_sd = n.sqrt(f_var)
+    a = (thresh - f_mean) / f_sd
+    tail = special.ndtr(-a)
+    dens = n.exp(-0.5 * a ** 2) / n.sqrt(2 * n.pi)
+    # E[x**2; x > th] for x ~ N(f_mean, f_var)
+    vmap_2 = (f_mean ** 2 + f_var) * tail + f_sd * dens * (f_mean + thresh)
+    if not standard_vmap:
+        # E[x*y; x > th], with y = w_mean + beta * (x - f_mean) + noise independent of x
+        w_mean = u_mean @ w
+        beta = _quad_form(u_cov, f, w) / f_var
+        x_tail = f_mean * tail + f_sd * dens
+        vmap_2 = w_mean * x_tail + beta * (vmap_2 - f_mean * x_tail)
+    return (nt * vmap_2).astype(n.float32)
+
+
 def reconstruct_movie_batch(stack_block_dirs, svs, t_indices, vol_shape, block_limits, us=None, log_cb=default_log):
     block_shape = tuple(n.diff(block_limits[:,0])[:,0])
     block_overlaps = tuple([int(n.median(block_shape[i] - n.diff(n.unique(block_limits[i,:,0]))))\
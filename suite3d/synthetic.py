@@ -0,0 +1,345 @@
+import os
+import json
+import uuid
+import numpy as n
+import tifffile
+from scipy import ndimage
+
+# Synthetic recordings for benchmarking and testing. make_synthetic_recording draws a
+# volume of sparse 3D cells on a textured background, moves it with a known rigid
+# (y, x) shift per volume, optionally adds LBM crosstalk between planes a cavity apart,
+# and writes it as ScanImage-style tifs (interleaved planes, or LBM strips with mROI
+# metadata) that the normal s3dio loaders can read. The ground truth (shifts, cell
+# centers, footprints and activity) is saved next to the tifs in ground_truth.npy.
+
+GROUND_TRUTH_FILE = "ground_truth.npy"
+
+# preset recording sizes, see make_synthetic_recording for the meaning of each key
+SIZES = {
+    "tiny": dict(nz=4, ny=96, nx=96, nt_per_file=60, n_files=3, n_cells=20),
+    "small": dict(nz=8, ny=192, nx=192, nt_per_file=100, n_files=4, n_cells=80),
+    "medium": dict(nz=16, ny=384, nx=384, nt_per_file=200, n_files=6, n_cells=400),
+}
+
+
+def make_footprint(sigma_zyx, radius_zyx):
+    """
+    Gaussian footprint of a cell, normalised to a peak of 1
+
+    Returns:
+        ndarray: footprint of shape 2 * radius_zyx + 1
+    """
+    grids = n.meshgrid(
+        *[n.arange(-r, r + 1, dtype=n.float32) for r in radius_zyx], indexing="ij"
+    )
+    dist2 = sum((g / max(s, 1e-3)) ** 2 for g, s in zip(grids, sigma_zyx))
+    return n.exp(-0.5 * dist2).astype(n.float32)
+
+
+def simulate_activity(n_cells, nt, fs, tau, rate_hz=0.5, amp=(1.0, 3.0), rng=None):
+    """
+    Spike trains convolved with an exponential calcium kernel
+
+    Args:
+        n_cells (int): number of cells
+        nt (int): number of volumes
+        fs (float): volume rate
+        tau (float): decay time of the indicator in seconds
+        rate_hz (float, optional): mean firing rate. Defaults to 0.5.
+        amp (tuple, optional): range of the per-cell dF/F of one spike. Defaults to (1.0, 3.0).
+        rng (Generator, optional): random generator. Defaults to None.
+
+    Returns:
+        tuple: spikes (n_cells, nt), calcium (n_cells, nt)
+    """
+    if rng is None:
+        rng = n.random.default_rng()
+    spikes = rng.poisson(rate_hz / fs, size=(n_cells, nt)).astype(n.float32)
+    spikes *= rng.uniform(*amp, size=(n_cells, 1)).astype(n.float32)
+    decay = n.exp(-1.0 / (tau * fs))
+    calcium = n.zeros_like(spikes)
+    for t in range(nt):
+        calcium[:, t] = spikes[:, t] + (decay * calcium[:, t - 1] if t > 0 else 0)
+    return spikes, calcium
+
+
+def simulate_motion(nt, max_shift, smooth=5, rng=None):
+    """
+    Smooth random (y, x) integer shifts per volume, bounded by max_shift
+
+    Returns:
+        ndarray: shifts of shape (nt, 2)
+    """
+    if rng is None:
+        rng = n.random.default_rng()
+    if max_shift == 0:
+        return n.zeros((nt, 2), dtype=int)
+    walk = rng.standard_normal((nt, 2))
+    walk = ndimage.gaussian_filter1d(walk, smooth, axis=0)
+    walk /= max(n.abs(walk).max(), 1e-6)
+    return n.round(walk * max_shift).astype(int)
+
+
+def apply_crosstalk(vol, coeff, cavity_size):
+    """
+    Add coeff times plane z - cavity_size to plane z, in place. vol is (nz, ...)
+    """
+    for z in range(vol.shape[0] - 1, cavity_size - 1, -1):
+        vol[z] += coeff * vol[z - cavity_size]
+    return vol
+
+
+def lbm_roi_metadata(n_strips, strip_nx, ny):
+    """
+    ScanImage mROI metadata (the json in the Artist tag) for strips that tile the x axis
+
+    Returns:
+        str: json string
+    """
+    rois = []
+    for i in range(n_strips):
+        rois.append(
+            {
+                "zs": 0,
+                "scanfields": {
+                    "roiUuid": uuid.UUID(int=i + 1).hex,
+                    "centerXY": [i * strip_nx + strip_nx / 2, ny / 2],
+                    "sizeXY": [strip_nx, ny],
+                    "pixelResolutionXY": [strip_nx, ny],
+                },
+            }
+        )
+    return json.dumps({"RoiGroups": {"imagingRoiGroup": {"rois": rois}}})
+
+
+def si_software_tag(fs, n_ch):
+    """Minimal ScanImage header (the Software tag) read by io.get_vol_rate and io.get_si_params"""
+    return "\n".join(
+        [
+            "SI.hRoiManager.scanFrameRate = %.4f" % fs,
+            "SI.hScan2D.scannerFrequency = 7910.0000",
+            "SI.hFastZ.position = 0",
+            "SI.hChannels.channelSave = %s" % list(range(1, n_ch + 1)),
+        ]
+    )
+
+
+def volumes_to_tif_frames(vols, lbm=False, n_strips=1, n_buff=0):
+    """
+    Arrange volumes (nt, nz, ny, nx) as the pages of a ScanImage tif: planes of each
+    volume are interleaved, and for LBM the strips of each plane are stacked along y
+    with n_buff empty lines between them.
+
+    Returns:
+        ndarray: (nt * nz, ny_tif, nx_tif)
+    """
+    nt, nz, ny, nx = vols.shape
+    if not lbm:
+        return vols.reshape(nt * nz, ny, nx)
+    strip_nx = nx // n_strips
+    ny_tif = n_strips * ny + (n_strips - 1) * n_buff
+    frames = n.zeros((nt, nz, ny_tif, strip_nx), dtype=vols.dtype)
+    for i in range(n_strips):
+        y0 = i * (ny + n_buff)
+        frames[:, :, y0 : y0 + ny] = vols[..., i * strip_nx : (i + 1) * strip_nx]
+    return frames.reshape(nt * nz, ny_tif, strip_nx)
+
+
+def make_synthetic_recording(
+    out_dir,
+    nz=8,
+    ny=192,
+    nx=192,
+    nt_per_file=100,
+    n_files=4,
+    n_cells=80,
+    fs=4.0,
+    tau=1.3,
+    max_shift=4,
+    lbm=False,
+    n_strips=2,
+    n_buff=8,
+    crosstalk_coeff=0.0,
+    cavity_size=None,
+    cell_sigma_zyx=(0.7, 2.0, 2.0),
+    baseline=200.0,
+    cell_brightness=300.0,
+    noise_std=20.0,
+    seed=0,
+):
+    """
+    Write a synthetic recording with known motion, crosstalk and cells as tifs
+
+    Args:
+        out_dir (str): directory for the tifs and ground truth
+        nz, ny, nx (int, optional): size of the volume (after stitching the strips for LBM)
+        nt_per_file (int, optional): volumes per tif. Defaults to 100.
+        n_files (int, optional): number of tifs. Defaults to 4.
+        n_cells (int, optional): number of cells. Defaults to 80.
+        fs (float, optional): volume rate. Defaults to 4.0.
+        tau (float, optional): indicator decay time in seconds. Defaults to 1.3.
+        max_shift (int, optional): max rigid y/x motion in pixels. Defaults to 4.
+        lbm (bool, optional): write LBM strips with mROI metadata instead of standard
+                              multiplane tifs. Defaults to False.
+        n_strips (int, optional): number of LBM strips, must divide nx. Defaults to 2.
+        n_buff (int, optional): lines between LBM strips in the tif. Defaults to 8.
+        crosstalk_coeff (float, optional): fraction of plane z - cavity_size added to plane z. Defaults to 0.
+        cavity_size (int, optional): planes between crosstalk pairs. Defaults to nz // 2.
+        cell_sigma_zyx (tuple, optional): gaussian width of cells in voxels. Defaults to (0.7, 2.0, 2.0).
+        baseline (float, optional): mean background brightness. Defaults to 200.
+        cell_brightness (float, optional): brightness of a cell at rest. Defaults to 300.
+        noise_std (float, optional): std of the additive noise. Defaults to 20.
+        seed (int, optional): random seed, the same seed writes identical files. Defaults to 0.
+
+    Returns:
+        tuple: tif paths (list), ground truth (dict)
+    """
+    rng = n.random.default_rng(seed)
+    os.makedirs(out_dir, exist_ok=True)
+    if cavity_size is None:
+        cavity_size = max(1, nz // 2)
+    if lbm:
+        assert nx % n_strips == 0, "nx must be a multiple of n_strips"
+        assert nx // n_strips <= 145, "ScanImage strips are at most 145 pixels wide"
+    nt = nt_per_file * n_files
+    pad = max_shift
+
+    # static background with some texture for registration to lock on to
+    canvas_shape = (nz, ny + 2 * pad, nx + 2 * pad)
+    texture = ndimage.gaussian_filter(
+        rng.standard_normal(canvas_shape).astype(n.float32), (0.5, 6, 6)
+    )
+    texture /= texture.std()
+    background = (baseline * (1 + 0.3 * texture)).clip(0.2 * baseline)
+
+    # cells away from the edges of the field of view
+    radius = tuple(int(n.ceil(3 * s)) for s in cell_sigma_zyx)
+    footprint = make_footprint(cell_sigma_zyx, radius)
+    margin = [radius[0], pad + radius[1] + 4, pad + radius[2] + 4]
+    centers = n.stack(
+        [
+            rng.integers(0, nz, n_cells),
+            rng.integers(margin[1], canvas_shape[1] - margin[1], n_cells),
+            rng.integers(margin[2], canvas_shape[2] - margin[2], n_cells),
+        ],
+        axis=1,
+    )
+    spikes, calcium = simulate_activity(n_cells, nt, fs, tau, rng=rng)
+    shifts = simulate_motion(nt, max_shift, rng=rng)
+
+    # slices of the canvas and of the footprint covered by each cell
+    cell_slices = []
+    for cz, cy, cx in centers:
+        canvas_sl, fp_sl = [], []
+        for c, r, size in zip((cz, cy, cx), radius, canvas_shape):
+            lo, hi = c - r, c + r + 1
+            canvas_sl.append(slice(max(lo, 0), min(hi, size)))
+            fp_sl.append(slice(max(lo, 0) - lo, 2 * r + 1 - (hi - min(hi, size))))
+        cell_slices.append((tuple(canvas_sl), tuple(fp_sl)))
+
+    n_ch = nz
+    software = si_software_tag(fs, n_ch)
+    extratags = []
+    if lbm:
+        artist = lbm_roi_metadata(n_strips, nx // n_strips, ny)
+        extratags = [(315, "s", 0, artist, True)]
+
+    tifs = []
+    for file_idx in range(n_files):
+        t0 = file_idx * nt_per_file
+        vols = n.empty((nt_per_file, nz, ny, nx), dtype=n.float32)
+        for i in range(nt_per_file):
+            t = t0 + i
+            vol = background.copy()
+            for cell_idx, (canvas_sl, fp_sl) in enumerate(cell_slices):
+                vol[canvas_sl] += (
+                    cell_brightness * (1 + calcium[cell_idx, t]) * footprint[fp_sl]
+                )
+            dy, dx = shifts[t]
+            vols[i] = vol[:, pad + dy : pad + dy + ny, pad + dx : pad + dx + nx]
+        if crosstalk_coeff > 0:
+            for i in range(nt_per_file):
+                apply_crosstalk(vols[i], crosstalk_coeff, cavity_size)
+        vols += rng.normal(0, noise_std, size=vols.shape).astype(n.float32)
+        frames = volumes_to_tif_frames(
+            vols.clip(-32768, 32767).astype(n.int16), lbm, n_strips, n_buff
+        )
+        tif_path = os.path.join(out_dir, "synthetic_%05d.tif" % file_idx)
+        tifffile.imwrite(
+            tif_path, frames, software=software, metadata=None, extratags=extratags
+        )
+        tifs.append(tif_path)
+
+    # cell centers in the coordinates of the (unmoved) field of view
+    ground_truth = {
+        "shifts": shifts,
+        "centers": centers - n.array([0, pad, pad]),
+        "spikes": spikes,
+        "calcium": calcium,
+        "footprint": footprint,
+        "crosstalk_coeff": crosstalk_coeff,
+        "cavity_size": cavity_size,
+        "shape": (nz, nt, ny, nx),
+        "fs": fs,
+        "tau": tau,
+        "lbm": lbm,
+        "n_strips": n_strips if lbm else 1,
+        "seed": seed,
+        "tifs": tifs,
+    }
+    n.save(os.path.join(out_dir, GROUND_TRUTH_FILE), ground_truth)
+    return tifs, ground_truth
+
+
+def load_ground_truth(out_dir):
+    """Load the ground truth saved by make_synthetic_recording"""
+    return n.load(os.path.join(out_dir, GROUND_TRUTH_FILE), allow_pickle=True).item()
+
+
+def job_params_for_recording(ground_truth, **overrides):
+    """
+    Job params that match a synthetic recording, on CPU only
+
+    Args:
+        ground_truth (dict): from make_synthetic_recording
+        overrides: any other job params
+
+    Returns:
+        dict: params for Job
+    """
+    nz, nt, ny, nx = ground_truth["shape"]
+    lbm = ground_truth["lbm"]
+    crosstalk = ground_truth["crosstalk_coeff"] > 0
+    params = {
+        "fs": ground_truth["fs"],
+        "tau": ground_truth["tau"],
+        "planes": n.arange(nz),
+        "n_ch_tif": nz,
+        "lbm": lbm,
+        "convert_plane_ids_to_channel_ids": False,
+        "3d_reg": False,
+        "gpu_reg": False,
+        "subtract_crosstalk": lbm and crosstalk,
+        "cavity_size": ground_truth["cavity_size"],
+        "fuse_strips": lbm,
+        # the synthetic strips tile the image exactly, nothing to cut when fusing
+        "fuse_shift_override": 0 if lbm else None,
+        "n_init_files": 1,
+        "init_n_frames": None,
+        "block_size": (64, 64),
+        "max_rigid_shift_pix": 20,
+        "voxel_size_um": (15, 2.5, 2.5),
+        "svd_block_shape": (min(4, nz), 64, 64),
+        "svd_block_overlaps": (min(1, nz - 1), 16, 16),
+        "n_svd_comp": 20,
+        "svd_method": "streaming",
+        "t_batch_size": 100,
+        "temporal_hpf": 50,
+        "mproc_batchsize": 10,
+        "edge_crop_npix": 4,
+        "patch_size_xy": (ny, nx),
+        "patch_overlap_xy": (0, 0),
+        "split_tif_size": 100,
+    }
+    params.update(overrides)
+    return params
@@ -29,10 +29,12 @@ except:
 from datetime import datetime
 import pickle
 from multiprocessing import cpu_count
+from multiprocessing.pool import ThreadPool
 import time
 
 # from . import tiff_utils as tfu
 from .developer import deprecated
+from . import shmem as shm
 
 try:
     from git import Repo
@@ -202,6 +204,27 @@ def sum_log_lik_one_line(m, x, y, b=0, sigma_0=10, c=1e-10, m_penalty=0):
     return -log_lik
 
 
+def sum_log_lik_lines(ms, x, y, b=0, sigma_0=10, c=1e-10, m_penalty=0, n_proc=1,
+                      max_elements=2**24):
+    """
+    sum_log_lik_one_line for every slope in ms, evaluated as (slopes x pixels) blocks
+    of at most max_elements, split over n_proc threads
+    """
+    ms = n.asarray(ms, dtype=n.float64)
+    block = max(1, max_elements // max(1, x.size))
+
+    def block_liks(m0):
+        m = ms[m0 : m0 + block, None]
+        lik = gaussian(y[None], m * x[None] + b, sigma_0)
+        return -n.log(lik + c - m * m_penalty).sum(axis=1)
+
+    starts = range(0, len(ms), block)
+    if n_proc == 1:
+        return n.concatenate([block_liks(m0) for m0 in starts])
+    with ThreadPool(n_proc) as pool:
+        return n.concatenate(pool.map(block_liks, starts))
+
+
 def calculate_crosstalk_coeff(
     im3d,
     exclude_below=1,
@@ -262,22 +285,9 @@ def calculate_crosstalk_coeff(
         idxs = X > n.percentile(X, fit_above_percentile)
         # print(len(idxs), X.shape)
 
-        if n_proc == 1:
-            liks = n.array(
-                [
-                    sum_log_lik_one_line(
-                        m, X[idxs], Y[idxs], sigma_0=sigma, m_penalty=m_penalty
-                    )
-                    for m in ms
-                ]
-            )
-        else:
-            p = Pool(n_proc)
-            liks = p.starmap(
-                sum_log_lik_one_line,
-                [(m, X[idxs], Y[idxs], 0, sigma, 1e-10, m_penalty) for m in ms],
-            )
-            liks = n.array(liks)
+        liks = sum_log_lik_lines(
+            ms, X[idxs], Y[idxs], sigma_0=sigma, m_penalty=m_penalty, n_proc=n_proc
+        )
 
         m_opt = ms[n.argmin(liks)]
         pks = find_peaks(-liks, width=peak_width)[0]
@@ -385,42 +395,41 @@ def register_movie(mov3d, tvecs=None, save_path=None, n_shift_proc=10):
 
     n_planes = mov3d.shape[0]
     shape_mem = mov3d.shape
-    size_mem = mov3d.nbytes
-
-    sh_mem = shared_memory.SharedMemory(create=True, size=size_mem)
-
-    mov_reg = n.ndarray(shape_mem, dtype=mov3d.dtype, buffer=sh_mem.buf)
-    mov_reg[:] = mov3d[:]
 
-    sh_mem_name = sh_mem.name
-    p = Pool(n_shift_proc)
-
-    p.starmap(
-        shift_movie_plane,
-        [
-            (idx, sh_mem_name, tvecs[idx], shape_mem, mov_reg.dtype)
-            for idx in n.arange(1, n_planes)
-        ],
-    )
+    # the arena unlinks the segment and the pool is terminated even if a worker fails
+    with shm.ShmemArena() as arena, Pool(n_shift_proc) as p:
+        sh_mem_params, mov_reg = arena.from_arr("mov", mov3d)
+        sh_mem_name = sh_mem_params["name"]
+
+        p.starmap(
+            shift_movie_plane,
+            [
+                (idx, sh_mem_name, tvecs[idx], shape_mem, mov_reg.dtype)
+                for idx in n.arange(1, n_planes)
+            ],
+        )
 
-    im3d = mov_reg.mean(axis=1)
-    mov_reg_ret = mov_reg.copy()
-    sh_mem.close()
-    sh_mem.unlink()
+        im3d = mov_reg.mean(axis=1)
+        mov_reg_ret = mov_reg.copy()
+        del mov_reg
 
     return mov_reg_ret
 
 def create_shmem(shmem_params):
-    shmem = shared_memory.SharedMemory(create=True, size=shmem_params["nbytes"])
+    # segments are tracked and unlinked at exit if they are not freed, see shmem.py
+    shmem = shm.create_segment(shmem_params["nbytes"])
     shmem_params["name"] = shmem.name
     return shmem, shmem_params
 
 
-def create_shmem_from_arr(sample_arr, copy=False):
+def create_shmem_from_arr(sample_arr, copy=False, dtype=None):
+    # with a dtype, the array is converted while it is copied into shared memory
+    if dtype is None:
+        dtype = sample_arr.dtype
     shmem_params = {
-        "dtype": sample_arr.dtype,
+        "dtype": n.dtype(dtype),
         "shape": sample_arr.shape,
-        "nbytes": sample_arr.nbytes,
+        "nbytes": int(n.prod(sample_arr.shape)) * n.dtype(dtype).itemsize,
     }
     shmem, shmem_params = create_shmem(shmem_params)
     sh_arr = n.ndarray(shmem_params["shape"], shmem_params["dtype"], buffer=shmem.buf)
@@ -444,11 +453,8 @@ def close_shmem(shmem_params):
 
 
 def close_and_unlink_shmem(shmem_params):
-    print("Don't use me. I cause memory leaks :(")
     if "name" in shmem_params.keys():
-        shmem = shared_memory.SharedMemory(name=shmem_params["name"], create=False)
-        shmem.close()
-        shmem.unlink()
+        shm.free_segment_by_name(shmem_params["name"])
 
 
 def get_centroid(ref_img_3d):
@@ -818,7 +824,7 @@ def make_batch_paths(parent_dir, n_batches=1, prefix="batch", suffix="", dirs=Tr
 # TODO try numba to speed it up? (will have to do seperate cpu/gpu)
 def crosstalk_subtract(mov, crosstalk_coeff, cavity_size):
     """
-    Subtracts the crosstalk from cavity A in cavity B planes
+    Subtracts the crosstalk from cavity A in cavity B planes, in place. Works on numpy and cupy arrays
 
     Parameters
     ----------
@@ -834,16 +840,49 @@ def crosstalk_subtract(mov, crosstalk_coeff, cavity_size):
     ndarray
         The crosstalk subtracted movie
     """
-    nz, __, __, __ = mov.shape
+    nz = mov.shape[0]
     if nz <= cavity_size:
         return mov
-    for i in range(nz - cavity_size):
-        mov[i + cavity_size] = mov[i + cavity_size] - crosstalk_coeff * mov[i]
+    # one broadcast subtraction per cavity_size planes, usually a single one. If there are more
+    # than 2 * cavity_size planes the later blocks use the already subtracted planes, as before
+    for z0 in range(0, nz - cavity_size, cavity_size):
+        z1 = min(z0 + cavity_size, nz - cavity_size)
+        target = mov[z0 + cavity_size : z1 + cavity_size]
+        target -= (crosstalk_coeff * mov[z0:z1]).astype(target.dtype, copy=False)
     return mov
 
 
+def crosstalk_corr_curves(im3d, cavity_size, steps):
+    """
+    corrcoef(plane z, plane z + cavity_size - step * plane z) for every cavity A / B plane
+    pair and every step, from the per-pair variances and covariance
+
+    Returns
+    -------
+    ndarray (nz - cavity_size, n_steps)
+    """
+    nz = im3d.shape[0]
+    base = im3d[: nz - cavity_size].reshape(nz - cavity_size, -1).astype(n.float64)
+    test = im3d[cavity_size:].reshape(nz - cavity_size, -1).astype(n.float64)
+    base = base - base.mean(axis=1, keepdims=True)
+    test = test - test.mean(axis=1, keepdims=True)
+    var_b = n.einsum("ij,ij->i", base, base)[:, None]
+    var_t = n.einsum("ij,ij->i", test, test)[:, None]
+    cov_bt = n.einsum("ij,ij->i", base, test)[:, None]
+    steps = n.asarray(steps)[None, :]
+    # cov(b, t - s b) / (std(b) std(t - s b))
+    return (cov_bt - steps * var_b) / n.sqrt(
+        var_b * (var_t - 2 * steps * cov_bt + steps**2 * var_b)
+    )
+
+
 def estimate_crosstalk(
-    im3d, cavity_size, step_dist=0.005, max_test_ct=0.5, use_mutual_information=False
+    im3d,
+    cavity_size,
+    step_dist=0.005,
+    max_test_ct=0.5,
+    use_mutual_information=False,
+    n_proc=1,
 ):
     """
     This function estimates the crosstalk between two cavities by iterativley testing different
@@ -864,6 +903,8 @@ def estimate_crosstalk(
         The maximum test corsstalk coefficent value, by default 0.5
     use_mutual_information : bool, optional
         If True will use the mutual information method (not reccomended), by default False
+    n_proc : int, optional
+        Number of threads computing the mutual information of plane pairs, by default 1
 
     Returns
     -------
@@ -887,42 +928,40 @@ def estimate_crosstalk(
     d2y = n.zeros((n_second_cavity_planes, steps.shape[0] - 2))
     ct = n.zeros(n_second_cavity_planes)
 
-    for z in range(n_second_cavity_planes):
-        for i, step in enumerate(steps):
+    if use_mutual_information:
+        print("Using mutual information, not recommended")
+
+        def mi_curve(z):
             base_plane = im3d[z]
             test_plane = im3d[z + cavity_size]
-
-            test_plane_ct_sub = test_plane - step * base_plane
-
-            if use_mutual_information:
-                if z == 0 and i == 0:
-                    print("Using mutual information, not recommended")
-                ct_metric[z, i] = normalized_mutual_information(
-                    base_plane, test_plane_ct_sub, bins=100
+            return [
+                normalized_mutual_information(
+                    base_plane, test_plane - step * base_plane, bins=100
                 )
-            else:
-                ct_metric[z, i] = n.corrcoef(
-                    base_plane.flatten(), test_plane_ct_sub.flatten()
-                )[0, 1]
-
-        if use_mutual_information:
-            ct_info = {"ct_metric": ct_metric, "steps": steps}
-            ct[z] = steps[n.argmin(ct_metric[z, :])]
-        else:
-            # The point of inflection of the gradient, is seemingly a good estiamte for the crosstalk
-            ct_metric_grad[z, :] = ct_metric[z, 1:] - ct_metric[z, :-1]
-            d2y[z, :] = ct_metric[z, :-2] - 2 * ct_metric[z, 1:-1] + ct_metric[z, 2:]
-            min_idx = n.argmin(d2y[z, :])
-
-            ct_info = {
-                "ct_metric": ct_metric,
-                "ct_metric_gradient": ct_metric_grad,
-                "ct_metric_d2": d2y,
-                "steps": steps,
-            }
-            ct[z] = steps[
-                min_idx + 2
-            ]  # + 2 is to account for the change in shape doing second derivative
+                for step in steps
+            ]
+
+        with ThreadPool(min(n_proc, n_second_cavity_planes)) as pool:
+            ct_metric[:] = pool.map(mi_curve, range(n_second_cavity_planes))
+        ct_info = {"ct_metric": ct_metric, "steps": steps}
+        ct[:] = steps[n.argmin(ct_metric, axis=1)]
+    else:
+        # all plane pairs and steps at once
+        ct_metric[:] = crosstalk_corr_curves(im3d, cavity_size, steps)
+        # The point of inflection of the gradient, is seemingly a good estiamte for the crosstalk
+        ct_metric_grad[:] = ct_metric[:, 1:] - ct_metric[:, :-1]
+        d2y[:] = ct_metric[:, :-2] - 2 * ct_metric[:, 1:-1] + ct_metric[:, 2:]
+        min_idx = n.argmin(d2y, axis=1)
+
+        ct_info = {
+            "ct_metric": ct_metric,
+            "ct_metric_gradient": ct_metric_grad,
+            "ct_metric_d2": d2y,
+            "steps": steps,
+        }
+        ct[:] = steps[
+            min_idx + 2
+        ]  # + 2 is to account for the change in shape doing second derivative
 
     ct_estimate = n.median(ct)
     print(f"Estiamted crosstalk in {time.time() - time_init}s")
@@ -0,0 +1,22 @@
+import json
+import os
+
+from suite3d import benchmark
+
+
+def test_tiny_benchmark_runs_end_to_end(tmp_path):
+    out_dir = str(tmp_path)
+    results = benchmark.run_benchmark(out_dir, size="tiny", verbosity=0)
+
+    assert list(results["stages"]) == list(benchmark.STAGES)
+    for stage in results["stages"].values():
+        assert stage["wall"] > 0
+    accuracy = results["accuracy"]
+    assert accuracy["shift_error_px"] < benchmark.DEFAULT_THRESHOLDS["shift_error_px"]
+    assert accuracy["n_rois"] > 0
+    assert "trace_corr" in accuracy
+
+    with open(os.path.join(out_dir, "results.json")) as f:
+        assert json.load(f)["config"]["size"] == "tiny"
+    # a run compares cleanly against itself
+    assert benchmark.compare_to_baseline(results, results, print_output=False) == []
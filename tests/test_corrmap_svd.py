@@ -0,0 +1,142 @@
+import os
+
+import numpy as n
+import pytest
+from scipy import ndimage
+
+from suite3d import corrmap
+from suite3d import svd_utils as svu
+
+NT = 120  # one batch, and below accumulate_sdmov's 500 frame minibatches
+
+
+def quiet_log(*args, **kwargs):
+    pass
+
+
+def make_movie(vol_shape, n_cells=12, noise=0.3, gaussian=False, seed=0):
+    # nz, nt, ny, nx movie of blurred point sources on a shared neuropil trace
+    nz, ny, nx = vol_shape
+    rng = n.random.default_rng(seed)
+    mov = noise * rng.normal(size=(NT, nz, ny, nx))
+    for __ in range(n_cells):
+        img = n.zeros(vol_shape)
+        img[rng.integers(nz), rng.integers(ny), rng.integers(nx)] = 1
+        img = ndimage.gaussian_filter(img, (0.7, 1.5, 1.5))
+        trace = rng.normal(size=NT) if gaussian else n.maximum(0, rng.normal(size=NT)) ** 3
+        mov += trace[:, n.newaxis, n.newaxis, n.newaxis] * img / img.max()
+    mov += ndimage.gaussian_filter1d(rng.normal(size=NT), 3)[:, n.newaxis, n.newaxis, n.newaxis]
+    return n.swapaxes(mov, 0, 1).astype(n.float32)
+
+
+def make_svd(mov, svd_dir, block_shape, overlaps, n_comp):
+    nz, nt, ny, nx = mov.shape
+    blocks, grid_shape = svu.make_blocks((nz, ny, nx), block_shape, overlaps)
+    svd_dirs = []
+    for block_idx in range(blocks.shape[1]):
+        zz, yy, xx = blocks[:, block_idx]
+        block = mov[zz[0] : zz[1], :, yy[0] : yy[1], xx[0] : xx[1]]
+        u, s, vt = n.linalg.svd(n.swapaxes(block, 0, 1).reshape(nt, -1), full_matrices=False)
+        k = min(n_comp, s.size)
+        block_dir = os.path.join(str(svd_dir), "%04d" % block_idx)
+        os.makedirs(block_dir)
+        svu.save_usv_to_zarr(u[:, :k], n.eye(k, dtype=n.float32), s[:k], vt[:k], block_dir)
+        svd_dirs.append(block_dir)
+    return {
+        "n_blocks": blocks.shape[1],
+        "block_shape": block_shape,
+        "block_overlaps": overlaps,
+        "blocks": blocks,
+        "grid_shape": grid_shape,
+        "mov_shape": mov.shape,
+        "n_comps": n_comp,
+        "svd_dirs": svd_dirs,
+    }
+
+
+def make_params(**kwargs):
+    params = {
+        "voxel_size_um": (1, 1, 1),
+        "temporal_hpf": 50,
+        "edge_crop_npix": 0,
+        "npil_filt_type": "unif",
+        "npil_filt_z_um": 3,
+        "npil_filt_xy_um": 11,
+        "cell_filt_type": "gaussian",
+        "cell_filt_z_um": 0.7,
+        "cell_filt_xy_um": 1.5,
+        "fix_vmap_edge_planes": False,
+        "detection_timebin": 1,
+        "sdnorm_exp": 0.9,
+        "intensity_thresh": None,
+        "standard_vmap": True,
+        "n_proc": 2,
+        "dtype": n.float32,
+        "t_batch_size": NT,
+    }
+    params.update(kwargs)
+    return params
+
+
+def run_both(tmp_path, mov, block_shape, overlaps, n_comp, **kwargs):
+    svd_info = make_svd(mov, tmp_path / "svd", block_shape, overlaps, n_comp)
+    params = make_params(**kwargs)
+    # the movie-space reference runs on the movie the SVD describes
+    rec = svu.OverlapReconstructor(svd_info, log_cb=quiet_log).reconstruct((0, NT))
+    for name in ("corrmap_mov", "corrmap_svd"):
+        os.makedirs(tmp_path / name)
+    corrmap.calculate_corrmap(
+        n.swapaxes(rec, 0, 1), params, batch_dir=str(tmp_path / "corrmap_mov"),
+        save_mov_sub=False, log=quiet_log,
+    )
+    corrmap.calculate_corrmap_from_svd(
+        svd_info, params, batch_dir=str(tmp_path / "corrmap_svd"), n_comps=n_comp, log=quiet_log
+    )
+    return [
+        {key: n.load(tmp_path / name / (key + ".npy")) for key in ("vmap", "mean_img")}
+        for name in ("corrmap_mov", "corrmap_svd")
+    ]
+
+
+def rel_err(vmap, ref):
+    return n.abs(vmap - ref) / n.median(ref)
+
+
+@pytest.mark.parametrize("timebin", [1, 3])
+def test_single_block_full_rank_is_exact(tmp_path, timebin):
+    mov = make_movie((3, 20, 20))
+    ref, svd = run_both(tmp_path, mov, (3, 20, 20), (0, 0, 0), NT, detection_timebin=timebin)
+    assert rel_err(svd["vmap"], ref["vmap"]).max() < 1e-4
+    n.testing.assert_allclose(svd["mean_img"], ref["mean_img"], atol=1e-5)
+
+
+def test_full_rank_blocks_are_exact(tmp_path):
+    # the neuropil filter (11 px) is wider than the overlap (6 px), so this needs the padding
+    mov = make_movie((4, 40, 40))
+    ref, svd = run_both(tmp_path, mov, (4, 16, 16), (0, 6, 6), NT)
+    assert rel_err(svd["vmap"], ref["vmap"]).max() < 1e-4
+    n.testing.assert_allclose(svd["mean_img"], ref["mean_img"], atol=1e-5)
+
+
+def test_truncated_blocks_within_tolerance(tmp_path):
+    # the padding is projected onto each block's 30 components, which loses the part of the
+    # neighbours' signal (mostly their noise) outside them: stated tolerance is a median
+    # error of 20% of the median vmap and a correlation of 0.98 with the movie-space map
+    mov = make_movie((4, 40, 40))
+    ref, svd = run_both(tmp_path, mov, (4, 16, 16), (0, 6, 6), 30)
+    assert n.median(rel_err(svd["vmap"], ref["vmap"])) < 0.2
+    assert n.corrcoef(svd["vmap"].ravel(), ref["vmap"].ravel())[0, 1] > 0.98
+    n.testing.assert_allclose(svd["mean_img"], ref["mean_img"], atol=1e-5)
+
+
+@pytest.mark.parametrize("standard_vmap", [True, False])
+def test_threshold_estimate_on_gaussian_movie(tmp_path, standard_vmap):
+    # the thresholded sums are estimated from Gaussian truncated moments, so on a movie
+    # with Gaussian activity the stated tolerance is a median error of 10% of the median
+    mov = make_movie((3, 20, 20), gaussian=True)
+    ref, svd = run_both(
+        tmp_path, mov, (3, 20, 20), (0, 0, 0), NT, intensity_thresh=0.1,
+        standard_vmap=standard_vmap,
+    )
+    assert n.median(rel_err(svd["vmap"], ref["vmap"])) < 0.1
+    assert n.corrcoef(svd["vmap"].ravel(), ref["vmap"].ravel())[0, 1] > 0.95
@@ -0,0 +1,152 @@
+import numpy as n
+import pytest
+from scipy import ndimage
+from scipy.signal import find_peaks
+from skimage.metrics import normalized_mutual_information
+
+from suite3d import utils
+
+
+def make_im3d(nz=8, cavity_size=4, coeff=0.15, ny=40, nx=50, seed=0):
+    # smooth planes where cavity B picks up coeff times the cavity A plane
+    rng = n.random.default_rng(seed)
+    im3d = ndimage.gaussian_filter(rng.normal(size=(nz, ny, nx)), (0, 2, 2)) * 100 + 200
+    im3d[cavity_size:] += coeff * im3d[: nz - cavity_size]
+    return im3d.astype(n.float32)
+
+
+def make_sparse_im3d(nz=6, cavity_size=3, coeff=0.2, ny=40, nx=50, n_cells=60, seed=0):
+    # blurred point sources on a near-zero background, so the planted crosstalk is a line
+    # through the origin in the cavity A vs B pixel scatter
+    rng = n.random.default_rng(seed)
+    im3d = n.zeros((nz, ny, nx))
+    im3d[rng.integers(nz, size=n_cells), rng.integers(ny, size=n_cells),
+         rng.integers(nx, size=n_cells)] = 1
+    im3d = ndimage.gaussian_filter(im3d, (0, 1.5, 1.5)) * 1000 + rng.uniform(0, 2, im3d.shape)
+    im3d[cavity_size:] += coeff * im3d[: nz - cavity_size]
+    return im3d.astype(n.float32)
+
+
+def estimate_crosstalk_loop(im3d, cavity_size, step_dist=0.005, max_test_ct=0.5, use_mi=False):
+    # the original per-plane, per-step estimate_crosstalk
+    n_second_cavity_planes = im3d.shape[0] - cavity_size
+    steps = n.arange(0, max_test_ct, step_dist)
+    ct_metric = n.zeros((n_second_cavity_planes, steps.shape[0]))
+    d2y = n.zeros((n_second_cavity_planes, steps.shape[0] - 2))
+    ct = n.zeros(n_second_cavity_planes)
+    for z in range(n_second_cavity_planes):
+        for i, step in enumerate(steps):
+            base_plane = im3d[z]
+            test_plane_ct_sub = im3d[z + cavity_size] - step * base_plane
+            if use_mi:
+                ct_metric[z, i] = normalized_mutual_information(
+                    base_plane, test_plane_ct_sub, bins=100
+                )
+            else:
+                ct_metric[z, i] = n.corrcoef(
+                    base_plane.flatten(), test_plane_ct_sub.flatten()
+                )[0, 1]
+        if use_mi:
+            ct[z] = steps[n.argmin(ct_metric[z, :])]
+        else:
+            d2y[z, :] = ct_metric[z, :-2] - 2 * ct_metric[z, 1:-1] + ct_metric[z, 2:]
+            ct[z] = steps[n.argmin(d2y[z, :]) + 2]
+    return ct, ct_metric, d2y
+
+
+# the loop subtracts the crosstalk in float32 before corrcoef, the closed form is all float64
+CORR_ATOL = 1e-6
+
+
+def test_corr_curves_match_corrcoef():
+    im3d = make_im3d()
+    steps = n.arange(0, 0.5, 0.005)
+    __, ref_metric, __ = estimate_crosstalk_loop(im3d, 4)
+    curves = utils.crosstalk_corr_curves(im3d, 4, steps)
+    assert curves.shape == (4, steps.size)
+    n.testing.assert_allclose(curves, ref_metric, atol=CORR_ATOL)
+
+
+@pytest.mark.parametrize("nz, cavity_size", [(8, 4), (5, 3)])
+def test_estimate_crosstalk_matches_loop(nz, cavity_size):
+    im3d = make_im3d(nz=nz, cavity_size=cavity_size)
+    ref_ct, ref_metric, ref_d2y = estimate_crosstalk_loop(im3d, cavity_size)
+    ct, ct_estimate, ct_info = utils.estimate_crosstalk(im3d, cavity_size)
+    n.testing.assert_array_equal(ct, ref_ct)
+    assert ct_estimate == n.median(ref_ct)
+    n.testing.assert_allclose(ct_info["ct_metric"], ref_metric, atol=CORR_ATOL)
+    n.testing.assert_allclose(ct_info["ct_metric_d2"], ref_d2y, atol=CORR_ATOL)
+    n.testing.assert_allclose(
+        ct_info["ct_metric_gradient"], n.diff(ref_metric, axis=1), atol=CORR_ATOL
+    )
+
+
+@pytest.mark.parametrize("n_proc", [1, 2])
+def test_estimate_crosstalk_mutual_information_matches_loop(n_proc):
+    im3d = make_im3d(nz=6, cavity_size=3, ny=20, nx=20)
+    ref_ct, ref_metric, __ = estimate_crosstalk_loop(
+        im3d, 3, step_dist=0.05, use_mi=True
+    )
+    ct, __, ct_info = utils.estimate_crosstalk(
+        im3d, 3, step_dist=0.05, use_mutual_information=True, n_proc=n_proc
+    )
+    n.testing.assert_array_equal(ct_info["ct_metric"], ref_metric)
+    n.testing.assert_array_equal(ct, ref_ct)
+
+
+def test_estimate_crosstalk_needs_two_cavities():
+    with pytest.raises(ValueError):
+        utils.estimate_crosstalk(make_im3d(nz=4, cavity_size=4), 4)
+
+
+@pytest.mark.parametrize("n_proc", [1, 3])
+@pytest.mark.parametrize("max_elements", [2**24, 1000])
+def test_sum_log_lik_lines_matches_per_slope_loop(n_proc, max_elements):
+    rng = n.random.default_rng(0)
+    x = rng.uniform(0, 50, size=700)
+    y = 0.2 * x + rng.normal(size=x.size)
+    ms = n.linspace(0, 1, 101)
+    for m_penalty in (0, 1e-3):
+        ref = n.array(
+            [
+                utils.sum_log_lik_one_line(m, x, y, sigma_0=2, m_penalty=m_penalty)
+                for m in ms
+            ]
+        )
+        liks = utils.sum_log_lik_lines(
+            ms, x, y, sigma_0=2, m_penalty=m_penalty, n_proc=n_proc,
+            max_elements=max_elements,
+        )
+        assert liks.shape == ms.shape
+        n.testing.assert_allclose(liks, ref, rtol=1e-12)
+
+
+def calculate_crosstalk_coeff_loop(im3d, sigma, n_per_cavity):
+    # the original per-slope likelihood scan of calculate_crosstalk_coeff
+    im3d = im3d - im3d.min(axis=(1, 2), keepdims=True)
+    ms = n.linspace(0, 1, 101)
+    nz = im3d.shape[0]
+    m_opts, m_firsts = [], []
+    for i in range(n_per_cavity):
+        Y = im3d[nz - i - 1].flatten()
+        X = im3d[nz - i - 1 - n_per_cavity].flatten()
+        liks = n.array([utils.sum_log_lik_one_line(m, X, Y, sigma_0=sigma) for m in ms])
+        m_opts.append(ms[n.argmin(liks)])
+        m_firsts.append(ms[find_peaks(-liks, width=1)[0][0]])
+    return n.array(m_opts), n.array(m_firsts)
+
+
+@pytest.mark.parametrize("n_proc", [1, 2])
+def test_calculate_crosstalk_coeff_matches_loop(monkeypatch, n_proc):
+    # the "seaborn" style was renamed in newer matplotlib, and only sets the plot look
+    monkeypatch.setattr(utils.plt.style, "use", lambda style: None)
+    im3d = make_sparse_im3d()
+    ref_opts, ref_firsts = calculate_crosstalk_coeff_loop(im3d, 2, 3)
+    m_opts, m_firsts, __ = utils.calculate_crosstalk_coeff(
+        im3d, sigma=2, verbose=False, estimate_gamma=False, n_proc=n_proc,
+        show_plots=False,
+    )
+    n.testing.assert_array_equal(m_opts, ref_opts)
+    n.testing.assert_array_equal(m_firsts, ref_firsts)
+    # the planted coefficient is found
+    assert n.abs(m_opts - 0.2).max() <= 0.1
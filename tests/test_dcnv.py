@@ -0,0 +1,58 @@
+import numpy as n
+import pytest
+
+from suite3d import dcnv
+
+
+def make_traces(n_roi=23, nt=600, fs=4.0, tau=1.5, seed=0):
+    rng = n.random.default_rng(seed)
+    spikes = rng.poisson(0.05, size=(n_roi, nt)).astype(n.float32)
+    kernel = n.exp(-n.arange(50) / (tau * fs))
+    calcium = n.stack([n.convolve(s, kernel)[:nt] for s in spikes])
+    drift = n.linspace(0, 2, nt)[n.newaxis] * rng.uniform(0, 1, size=(n_roi, 1))
+    F = 100 + 10 * calcium + drift + rng.normal(0, 0.5, size=(n_roi, nt))
+    Fneu = 50 + rng.normal(0, 1, size=(n_roi, nt))
+    return F.astype(n.float32), Fneu.astype(n.float32)
+
+
+def reference(F, Fneu, npil_coeff, baseline, tau=1.5, fs=4.0):
+    Fc = F - npil_coeff * Fneu
+    Fc = dcnv.preprocess(Fc, baseline, win_baseline=60, sig_baseline=10, fs=fs)
+    return dcnv.oasis(Fc, batch_size=3000, tau=tau, fs=fs)
+
+
+@pytest.mark.parametrize("baseline", ["maximin", "constant", "constant_prctile", None])
+def test_engine_matches_preprocess_and_oasis(baseline):
+    F, Fneu = make_traces()
+    ref = reference(F, Fneu, 0.7, baseline)
+    with dcnv.DeconvolutionEngine(F.shape[1], 1.5, 4.0, baseline=baseline) as engine:
+        out = engine.deconvolve(F, Fneu, npil_coeff=0.7)
+    assert out.dtype == n.float32
+    assert n.allclose(out, ref, atol=1e-3 * n.abs(ref).max())
+
+
+def test_engine_chunks_threads_and_memmaps(tmp_path):
+    F, Fneu = make_traces()
+    n.save(tmp_path / "F.npy", F)
+    n.save(tmp_path / "Fneu.npy", Fneu)
+    F_mm = n.load(tmp_path / "F.npy", mmap_mode="r")
+    Fneu_mm = n.load(tmp_path / "Fneu.npy", mmap_mode="r")
+    out_mm = n.lib.format.open_memmap(
+        tmp_path / "spks.npy", mode="w+", dtype=n.float32, shape=F.shape
+    )
+
+    with dcnv.DeconvolutionEngine(F.shape[1], 1.5, 4.0, n_proc=3) as engine:
+        single = engine.deconvolve(F, Fneu)
+        engine.deconvolve(F_mm, Fneu_mm, out=out_mm, batch_size=7)
+    assert engine.pool is None
+    ref = reference(F, Fneu, 0.7, "maximin")
+    assert n.allclose(single, ref, atol=1e-3 * n.abs(ref).max())
+    assert n.allclose(out_mm, single, atol=1e-5)
+
+
+def test_engine_without_neuropil():
+    F, __ = make_traces()
+    ref = dcnv.oasis(dcnv.preprocess(F, "maximin", 60, 10, 4.0), 3000, 1.5, 4.0)
+    with dcnv.DeconvolutionEngine(F.shape[1], 1.5, 4.0) as engine:
+        out = engine.deconvolve(F)
+    assert n.allclose(out, ref, atol=1e-3 * n.abs(ref).max())
@@ -0,0 +1,24 @@
+import numpy as n
+
+from suite3d import extension as ext
+
+
+def bright_cell_movie(dtype):
+    # a bright 5x5 cell over a dim background, sum(lam**2) is far beyond float16's range
+    rng = n.random.default_rng(0)
+    mov = rng.uniform(0, 50, size=(20, 3, 16, 16))
+    mov[:10, 1, 6:11, 6:11] += 3000
+    return mov.astype(dtype)
+
+
+def test_iter_extend3d_float16_matches_float32():
+    active_frames = n.arange(10)
+    seed = (n.array([1]), n.array([8]), n.array([8]))
+    ref = ext.iter_extend3d(*seed, active_frames, bright_cell_movie(n.float32))
+    out = ext.iter_extend3d(*seed, active_frames, bright_cell_movie(n.float16))
+    for ref_v, out_v in zip(ref[:3], out[:3]):
+        assert n.array_equal(ref_v, out_v)
+    lam = out[3]
+    assert n.isfinite(lam).all()
+    assert n.isclose(n.sum(lam.astype(n.float64) ** 2), 1, atol=1e-3)
+    assert n.allclose(lam, ref[3], atol=1e-3)
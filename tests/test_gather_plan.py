@@ -0,0 +1,115 @@
+import numpy as n
+import pytest
+
+from suite3d import reg_3d
+from suite3d import register_gpu as reg_gpu
+from suite3d import utils
+
+
+def shift_reference(mov, plane_shifts):
+    # out[z, :, y, x] = mov[z, :, y - dy, x - dx], zero outside
+    out = n.zeros_like(mov)
+    nz, nt, ny, nx = mov.shape
+    for z in range(nz):
+        dy, dx = (int(s) for s in plane_shifts[z])
+        for y in range(ny):
+            for x in range(nx):
+                if 0 <= y - dy < ny and 0 <= x - dx < nx:
+                    out[z, :, y, x] = mov[z, :, y - dy, x - dx]
+    return out
+
+
+def random_mov(shape=(4, 3, 20, 30), seed=0):
+    return n.random.default_rng(seed).normal(size=shape).astype(n.float32)
+
+
+def test_plan_without_pieces_or_shifts_copies_the_movie():
+    mov = random_mov()
+    nz, nt, ny, nx = mov.shape
+    plan = reg_3d.build_gather_plan(nz, ny, nx)
+    assert plan.shape == (nz, 7)
+    out = reg_3d.execute_gather_plan(mov, plan, ny, nx)
+    assert n.array_equal(out, mov)
+
+
+def test_plane_shifts():
+    mov = random_mov()
+    nz, nt, ny, nx = mov.shape
+    plane_shifts = n.array([[0, 0], [3, -2], [-5, 4], [25, 0]])
+    plan = reg_3d.build_gather_plan(nz, ny, nx, plane_shifts=plane_shifts)
+    out = reg_3d.execute_gather_plan(mov, plan, ny, nx)
+    assert n.array_equal(out, shift_reference(mov, plane_shifts))
+    # the last plane is shifted out of the frame entirely
+    assert not (plan[:, 0] == 3).any()
+    assert (out[3] == 0).all()
+
+
+def test_fuse_pieces_match_fuse_and_pad():
+    mov = random_mov()
+    nz, nt, ny, nx = mov.shape
+    fuse_shift, ypad, xpad, x_offset = 2, 3, 4, 1
+    old_xs = [(0, 9), (11, 19), (21, 30)]
+    new_xs = [(0, 9), (9, 17), (17, 26)]
+    ref = reg_gpu.fuse_and_pad(mov, fuse_shift, ypad, xpad, new_xs, old_xs, x_offset=x_offset)
+    out_ny, out_nx = ref.shape[2:]
+    pieces = reg_3d.fuse_pieces(fuse_shift, new_xs, old_xs, out_nx, x_offset=x_offset)
+    plan = reg_3d.build_gather_plan(nz, ny, nx, out_ny, out_nx, x_pieces=pieces)
+    out = reg_3d.execute_gather_plan(mov, plan, out_ny, out_nx)
+    assert n.array_equal(out, ref)
+
+
+def crosstalk_subtract_loop(mov, crosstalk_coeff, cavity_size):
+    # the original plane-by-plane crosstalk_subtract
+    nz = mov.shape[0]
+    if nz <= cavity_size:
+        return mov
+    for i in range(nz - cavity_size):
+        mov[i + cavity_size] = mov[i + cavity_size] - crosstalk_coeff * mov[i]
+    return mov
+
+
+@pytest.mark.parametrize("nz, cavity_size", [(10, 3), (6, 3), (3, 3)])
+def test_crosstalk_subtract_matches_loop(nz, cavity_size):
+    mov = random_mov(shape=(nz, 3, 8, 9))
+    ref = crosstalk_subtract_loop(mov.copy(), 0.1, cavity_size)
+    out = utils.crosstalk_subtract(mov, 0.1, cavity_size)
+    # in place
+    assert out is mov
+    assert n.allclose(out, ref, atol=1e-6)
+
+
+@pytest.mark.parametrize("cavity_size", [3, 4])
+def test_gather_copy_subtracts_crosstalk(cavity_size):
+    mov = random_mov(shape=(10, 3, 8, 9))
+    nz, nt, ny, nx = mov.shape
+    coeff = 0.1
+    ref = crosstalk_subtract_loop(mov.copy(), coeff, cavity_size)
+    plan = reg_3d.build_gather_plan(nz, ny, nx)
+    out = reg_3d.execute_gather_plan(
+        mov, plan, ny, nx, crosstalk_coeff=coeff, cavity_size=cavity_size
+    )
+    assert n.allclose(out, ref, atol=1e-5)
+
+
+def test_gather_copy_subtracts_crosstalk_before_shifting():
+    # the old path subtracted crosstalk from the raw batch, cast to float32, then shifted
+    mov = (random_mov(shape=(8, 3, 20, 30)) * 1000).astype(n.int16)
+    nz, nt, ny, nx = mov.shape
+    coeff, cavity_size = 0.2, 4
+    plane_shifts = n.array([[0, 0], [3, -2], [-5, 4], [1, 1], [2, 0], [0, -3], [-1, 2], [4, 4]])
+    ref = crosstalk_subtract_loop(mov.astype(n.float32), coeff, cavity_size)
+    ref = shift_reference(ref, plane_shifts)
+    plan = reg_3d.build_gather_plan(nz, ny, nx, plane_shifts=plane_shifts)
+    out = reg_3d.execute_gather_plan(
+        mov, plan, ny, nx, dtype=n.float32, crosstalk_coeff=coeff, cavity_size=cavity_size
+    )
+    assert out.dtype == n.float32
+    n.testing.assert_allclose(out, ref, rtol=1e-6, atol=1e-3)
+
+
+def test_gather_copy_without_enough_planes_skips_crosstalk():
+    mov = random_mov(shape=(3, 3, 8, 9))
+    nz, nt, ny, nx = mov.shape
+    plan = reg_3d.build_gather_plan(nz, ny, nx)
+    out = reg_3d.execute_gather_plan(mov, plan, ny, nx, crosstalk_coeff=0.1, cavity_size=3)
+    assert n.array_equal(out, mov)
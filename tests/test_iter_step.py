@@ -0,0 +1,74 @@
+import numpy as n
+import pytest
+from scipy import ndimage
+
+from suite3d import iter_step
+from suite3d import reference_image as ref
+from suite3d import shmem as shm
+
+
+def quiet_log(*args, **kwargs):
+    pass
+
+
+def make_reg_inputs(nonrigid, nz=3, nt=8, ny=64, nx=64, seed=0):
+    # a smooth reference per plane and frames that are shifted, noisy copies of it
+    rng = n.random.default_rng(seed)
+    ref_img = ndimage.gaussian_filter(rng.normal(size=(nz, ny, nx)), (0, 2, 2)) * 100 + 500
+    mov = n.zeros((nz, nt, ny, nx), dtype=n.float32)
+    for z in range(nz):
+        for t in range(nt):
+            shift = rng.integers(-4, 5, size=2)
+            mov[z, t] = n.roll(ref_img[z], shift, axis=(0, 1)) + rng.normal(size=(ny, nx))
+    reference_params = {"sigma": (1.15, 0), "block_size": (32, 32), "smooth_sigma": 1.15}
+    refs_and_masks, reference_params = ref.get_phasecorr_and_masks(
+        ref_img.astype(n.float32), reference_params
+    )
+    all_ops = [
+        {
+            "smooth_sigma_time": 0,
+            "nonrigid": nonrigid,
+            "snr_thresh": 1.2,
+            "maxregshift": 0.15,
+            "NRsm": reference_params["NRsm"],
+            "yblock": reference_params["yblock"],
+            "xblock": reference_params["xblock"],
+            "nblocks": reference_params["nblocks"],
+            "maxregshiftNR": 3,
+        }
+        for __ in range(nz)
+    ]
+    return mov, refs_and_masks, all_ops
+
+
+@pytest.mark.parametrize("nonrigid", [False, True])
+def test_pooled_registration_matches_serial(nonrigid):
+    mov, refs_and_masks, all_ops = make_reg_inputs(nonrigid)
+
+    mov_serial = mov.copy()
+    offsets_serial = iter_step.register_mov(mov_serial, refs_and_masks, all_ops, quiet_log)
+
+    pool = iter_step.make_reg_pool(2, 1)
+    try:
+        with shm.ShmemArena() as arena:
+            shmem_params, mov_pooled = arena.from_arr("reg_batch", mov)
+            offsets_pooled = iter_step.register_mov(
+                mov_pooled,
+                refs_and_masks,
+                all_ops,
+                quiet_log,
+                pool=pool,
+                shmem_params=shmem_params,
+            )
+            mov_pooled = mov_pooled.copy()
+    finally:
+        pool.terminate()
+        pool.join()
+
+    assert offsets_pooled.keys() == offsets_serial.keys()
+    assert ("xmaxs_nr" in offsets_serial) == nonrigid
+    for key in offsets_serial:
+        n.testing.assert_array_equal(offsets_pooled[key], offsets_serial[key])
+    n.testing.assert_array_equal(mov_pooled, mov_serial)
+    # the planes were actually registered
+    assert n.abs(offsets_serial["ymaxs_rr"]).max() > 0
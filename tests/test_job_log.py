@@ -0,0 +1,114 @@
+import os
+import gc
+import sys
+import time
+import subprocess
+
+import pytest
+
+from suite3d import job_log
+from suite3d.job_log import JobLogger
+
+
+def event(level, **kwargs):
+    return dict(time=time.time(), level=level, kind="log", message="level %d" % level, **kwargs)
+
+
+def n_lines(path):
+    with open(path) as f:
+        return len(f.readlines())
+
+
+def test_important_events_are_flushed_immediately(tmp_path):
+    logger = JobLogger(str(tmp_path), flush_interval=60)
+    logger.write(event(3))
+    assert n_lines(logger.events_path) == 0
+    logger.write(event(1))
+    assert n_lines(logger.events_path) == 2
+    logger.write(event(3))
+    logger.write(event(3, mem={"rss": 1.0}))
+    assert n_lines(logger.events_path) == 4
+    logger.close()
+
+
+def test_buffered_events_are_flushed_by_the_timer(tmp_path):
+    logger = JobLogger(str(tmp_path), flush_interval=0.1)
+    logger.write(event(3))
+    assert n_lines(logger.events_path) == 0
+    deadline = time.time() + 5
+    while n_lines(logger.events_path) == 0 and time.time() < deadline:
+        time.sleep(0.05)
+    assert n_lines(logger.events_path) == 1
+    logger.close()
+
+
+def test_loggers_are_not_kept_alive(tmp_path):
+    logger = JobLogger(str(tmp_path), flush_interval=60)
+    logger.write(event(3))
+    assert logger in job_log._loggers
+    del logger
+    gc.collect()
+    assert len([l for l in job_log._loggers if l.job_dir == str(tmp_path)]) == 0
+    # closed on collection, so the buffered event was written
+    assert n_lines(os.path.join(str(tmp_path), job_log.EVENTS_FILE)) == 1
+
+
+def test_close_removes_the_logger(tmp_path):
+    logger = JobLogger(str(tmp_path), flush_interval=60)
+    logger.write(event(3))
+    logger.close()
+    assert logger not in job_log._loggers
+    assert n_lines(logger.events_path) == 1
+
+
+FORK_SCRIPT = """
+import os, sys, time
+from suite3d.job_log import JobLogger
+
+logger = JobLogger(sys.argv[1], flush_interval=60)
+logger.write(dict(time=time.time(), level=3, kind="log", message="parent"))
+pid = os.fork()
+if pid == 0:
+    logger.write(dict(time=time.time(), level=3, kind="log", message="child"))
+    logger.close()
+    os._exit(0)
+os.waitpid(pid, 0)
+logger.close()
+"""
+
+
+@pytest.mark.skipif(not hasattr(os, "fork"), reason="needs fork")
+def test_forked_child_does_not_duplicate_events(tmp_path):
+    # forked from a fresh interpreter, pytest's own threads make fork unsafe
+    subprocess.run(
+        [sys.executable, "-c", FORK_SCRIPT, str(tmp_path)], check=True, timeout=60
+    )
+    events = job_log.read_events(str(tmp_path))
+    assert sorted(e["message"] for e in events) == ["child", "parent"]
+
+
+def test_profile_events_record_stage_nbytes(tmp_path):
+    from suite3d import profiling
+
+    class FakeJob:
+        params = {}
+        job_dir = str(tmp_path)
+
+        def __init__(self):
+            self.events = []
+
+        def log(self, string, level=1, **kwargs):
+            self.events.append(kwargs)
+
+        @profiling.profile_job_stage("step")
+        def step(self):
+            with profiling.stage("inner", frames=2, nbytes=1000):
+                pass
+
+    job = FakeJob()
+    job.step()
+    profile = {e["stage"]: e for e in job.events if e.get("kind") == "profile" and "duration" in e}
+    assert profile["inner"]["nbytes"] == 1000
+    assert "bytes_read" not in profile["inner"]
+    # the step itself processes no counted bytes
+    assert profile["step"]["nbytes"] is None
@@ -0,0 +1,155 @@
+import numpy as n
+import pytest
+
+from suite3d import memory_plan as mp
+
+GB = mp.GB
+
+
+@pytest.mark.parametrize("min_value,step", [(1, 1), (5, 1), (4, 4), (50, 50)])
+def test_largest_fitting_matches_a_linear_scan(min_value, step):
+    def bytes_fn(v):
+        return 3 * v * v + 100
+
+    for max_value in [min_value, 7, 64, 999]:
+        for budget in [0, 150, 1000, 12345, 10**7]:
+            got = mp.largest_fitting(bytes_fn, max_value, budget, min_value, step)
+            fitting = [
+                v
+                for v in range(min_value, max(min_value, max_value) + 1, step)
+                if bytes_fn(v) <= budget
+            ]
+            assert got == (max(fitting) if fitting else min_value)
+
+
+def params(**kwargs):
+    p = {
+        "tif_batch_size": 8,
+        "t_batch_size": 800,
+        "temporal_hpf": 50,
+        "mproc_batchsize": 25,
+        "split_tif_size": None,
+        "patch_size_xy": (150, 150),
+        "patch_overlap_xy": (10, 10),
+        "extract_batchsize_frames": 500,
+        "save_dtype": "float16",
+        "n_proc_corr": 4,
+    }
+    p.update(kwargs)
+    return p
+
+
+def plan(mem_budget_gb, **kwargs):
+    vol_shape = (16, 512, 512)
+    tif_info = (20, (512, 512), 2)
+    return mp.plan_memory(
+        params(**kwargs), vol_shape, vol_shape, tif_info, nt_total=2000, n_rois=1000,
+        mem_budget_gb=mem_budget_gb, log_cb=lambda *a, **k: None,
+    )
+
+
+def test_large_budget_keeps_the_params():
+    p = plan(1e6)["params"]
+    assert p["tif_batch_size"] == 8
+    assert p["t_batch_size"] == 800
+    assert p["mproc_batchsize"] == 25
+    assert p["split_tif_size"] == 800
+    assert p["patch_size_xy"] == (150, 150)
+    assert p["extract_batchsize_frames"] == 500
+
+
+@pytest.mark.parametrize("mem_budget_gb", [4.0, 8.0, 16.0, 32.0])
+def test_plan_fits_the_budget_and_is_maximal(mem_budget_gb):
+    result = plan(mem_budget_gb)
+    p = result["params"]
+    for step, gb in result["predicted_gb"].items():
+        assert gb <= mem_budget_gb, step
+    assert p["t_batch_size"] % 50 == 0
+    assert p["split_tif_size"] <= p["t_batch_size"]
+    assert p["mproc_batchsize"] <= p["t_batch_size"] // 4
+
+    # one step larger would not fit, unless the value is already at its cap
+    vol_shape = (16, 512, 512)
+    budget = mem_budget_gb * GB
+    if p["tif_batch_size"] < 8:
+        assert mp.registration_bytes(p["tif_batch_size"] + 1, 20, vol_shape, 0) > budget
+    if p["t_batch_size"] < 800:
+        minibatch = max(20, int(n.ceil((p["t_batch_size"] + 50) / 4)))
+        assert mp.corrmap_bytes(p["t_batch_size"] + 50, vol_shape, minibatch) > budget
+    if p["extract_batchsize_frames"] < 500:
+        assert (
+            mp.extraction_bytes(p["extract_batchsize_frames"] + 1, vol_shape, 2000, 1000)
+            > budget
+        )
+
+
+def test_smaller_budget_never_plans_larger_batches():
+    prev = None
+    for mem_budget_gb in [64.0, 16.0, 8.0, 4.0, 2.0, 0.5]:
+        p = plan(mem_budget_gb)["params"]
+        if prev is not None:
+            for key in ["tif_batch_size", "t_batch_size", "extract_batchsize_frames"]:
+                assert p[key] <= prev[key], key
+            assert max(p["patch_size_xy"]) <= max(prev["patch_size_xy"])
+        prev = p
+
+
+def test_tiny_budget_falls_back_to_the_smallest_values():
+    result = plan(1e-6)
+    p = result["params"]
+    assert p["tif_batch_size"] == 1
+    assert p["t_batch_size"] == 50
+    assert p["extract_batchsize_frames"] == 1
+    # the smallest patch still holds its overlaps
+    assert p["patch_size_xy"] == (21, 21)
+    assert all(gb > 1e-6 for gb in result["predicted_gb"].values())
+
+
+@pytest.fixture
+def plan_job(tmp_path, monkeypatch):
+    # a Job with just what plan_memory and save_params read, instead of an init pass
+    from suite3d.job import Job
+
+    job = Job.__new__(Job)
+    job.params = params(lbm=False, n_ch_tif=16, auto_memory_plan=True)
+    job.dirs = {"job_dir": str(tmp_path), "rois": str(tmp_path / "rois")}
+    job.tifs = ["a.tif", "b.tif"]
+    job.log = lambda *args, **kwargs: None
+    summary = {
+        "raw_img": n.zeros((16, 512, 512)),
+        "new_xs": [0],
+        "ypad": [0],
+        "xpad": [0],
+        "fuse_shift": 0,
+    }
+    job.load_summary = lambda: summary
+    monkeypatch.setattr(mp, "get_tif_info", lambda tif, n_ch: (1000, (512, 512), 2))
+    return job
+
+
+def saved_params(job):
+    return n.load(job.dirs["job_dir"] + "/params.npy", allow_pickle=True).item()
+
+
+def test_job_plan_starts_from_the_requested_values(plan_job):
+    plan_job.plan_memory(mem_budget_gb=4.0)
+    assert plan_job.params["t_batch_size"] < 800
+    assert plan_job.params["memory_plan"]["requested"]["t_batch_size"] == 800
+    # params.npy keeps the requested values
+    assert saved_params(plan_job)["t_batch_size"] == 800
+    assert saved_params(plan_job)["patch_size_xy"] == (150, 150)
+
+    # a later plan with more RAM goes back up to them
+    plan_job.plan_memory(mem_budget_gb=1e6)
+    for key in mp.PLANNED_PARAMS:
+        if key != "split_tif_size":
+            assert plan_job.params[key] == params()[key], key
+
+
+def test_job_plan_picks_up_values_set_by_hand(plan_job):
+    plan_job.plan_memory(mem_budget_gb=4.0)
+    plan_job.params["t_batch_size"] = 400
+    plan_job.plan_memory(mem_budget_gb=1e6)
+    assert plan_job.params["t_batch_size"] == 400
+    assert plan_job.params["memory_plan"]["requested"]["t_batch_size"] == 400
+    assert saved_params(plan_job)["t_batch_size"] == 400
@@ -0,0 +1,47 @@
+import numpy as n
+
+from suite3d.mov_sub_store import MovSubStore, store_exists
+
+
+def make_store(tmp_path, shape=(12, 3, 50, 70), dtype=n.float32):
+    mov = n.random.default_rng(0).normal(size=shape).astype(dtype)
+    store_dir = str(tmp_path / "mov_sub")
+    assert not store_exists(store_dir)
+    store = MovSubStore.create(store_dir, shape, (32, 32), (8, 8), dtype=dtype)
+    # written in batches, as by the correlation map
+    for t0 in range(0, shape[0], 5):
+        store.write(t0, mov[t0 : t0 + 5])
+    store.flush()
+    return store, mov
+
+
+def test_patches_hold_their_region(tmp_path):
+    store, mov = make_store(tmp_path)
+    assert store.n_patches > 1
+    for patch_idx in range(store.n_patches):
+        (z0, z1), (y0, y1), (x0, x1) = store.patches[:, patch_idx]
+        assert n.array_equal(store.patch(patch_idx), mov[:, z0:z1, y0:y1, x0:x1])
+
+
+def test_reopened_store_reads_the_full_movie(tmp_path):
+    store, mov = make_store(tmp_path)
+    assert store_exists(store.store_dir)
+    store = MovSubStore.open(store.store_dir)
+    assert store.shape == mov.shape
+    assert store.dtype == mov.dtype
+    assert store.matches((32, 32), (8, 8))
+    assert not store.matches((64, 64), (8, 8))
+    assert n.array_equal(store[:], mov)
+    for key in [
+        (slice(2, 9), slice(None), slice(10, 45), slice(5, 66)),
+        (3, 1),
+        (slice(None, None, 2), slice(None), slice(0, 50, 3), slice(1, 70, 4)),
+        (-1, slice(None), 30, slice(20, 40)),
+    ]:
+        assert n.array_equal(store[key], mov[key])
+
+
+def test_float16_store(tmp_path):
+    store, mov = make_store(tmp_path, shape=(4, 2, 40, 40), dtype=n.float16)
+    assert store.patch(0).dtype == n.float16
+    assert n.array_equal(store[:], mov)
@@ -0,0 +1,123 @@
+import os
+
+import numpy as n
+import pytest
+from scipy import ndimage
+
+from suite3d import svd_utils as svu
+
+MOV_SHAPE = (4, 30, 40, 44)  # nz, nt, ny, nx
+BLOCK_SHAPE = (2, 16, 16)
+OVERLAPS = (1, 6, 6)
+N_COMP = 6
+
+
+def make_svd(svd_dir, seed=0):
+    nz, nt, ny, nx = MOV_SHAPE
+    blocks, grid_shape = svu.make_blocks((nz, ny, nx), BLOCK_SHAPE, OVERLAPS)
+    rng = n.random.default_rng(seed)
+    svd_dirs = []
+    for block_idx in range(blocks.shape[1]):
+        block_dir = os.path.join(str(svd_dir), "%04d" % block_idx)
+        os.makedirs(block_dir)
+        u = rng.normal(size=(nt, N_COMP)).astype(n.float32)
+        s = n.linspace(5, 1, N_COMP).astype(n.float32)
+        v = rng.normal(size=(N_COMP, int(n.prod(BLOCK_SHAPE)))).astype(n.float32)
+        svu.save_usv_to_zarr(u, n.eye(N_COMP, dtype=n.float32), s, v, block_dir, timechunk=8)
+        svd_dirs.append(block_dir)
+    return {
+        "n_blocks": blocks.shape[1],
+        "block_shape": BLOCK_SHAPE,
+        "block_overlaps": OVERLAPS,
+        "blocks": blocks,
+        "grid_shape": grid_shape,
+        "mov_shape": MOV_SHAPE,
+        "n_comps": N_COMP,
+        "svd_dirs": svd_dirs,
+    }
+
+
+def blend_reference(svd_info, t0, t1, n_comps=N_COMP, crop_z=None):
+    # the per-block U S V blend of the original reconstruct_overlapping_movie
+    nz, nt, ny, nx = svd_info["mov_shape"]
+    nbz, nby, nbx = svd_info["block_shape"]
+    noz, noy, nox = svd_info["block_overlaps"]
+    mask = n.zeros((nbz, nby, nbx))
+    mask[noz // 3 : nbz - noz // 3, noy // 3 : nby - noy // 3, nox // 3 : nbx - nox // 3] = 1
+    mask = ndimage.uniform_filter(mask, (noz // 1.4, noy // 1.4, nox // 1.4))
+    z0 = 0
+    if crop_z is not None:
+        nz, z0 = crop_z[1] - crop_z[0], crop_z[0]
+    mov = n.zeros((t1 - t0, nz, ny, nx))
+    norm = n.zeros((nz, ny, nx))
+    for block_idx, block_dir in enumerate(svd_info["svd_dirs"]):
+        zz, yy, xx = svd_info["blocks"][:, block_idx]
+        if crop_z is not None and zz[0] not in range(*crop_z):
+            continue
+        u, s, v = svu.load_usv(block_dir, n_comps, compute=True)
+        block = ((u[t0:t1] * s) @ v).reshape(t1 - t0, nbz, nby, nbx) * mask
+        sl = (slice(zz[0] - z0, zz[1] - z0), slice(yy[0], yy[1]), slice(xx[0], xx[1]))
+        mov[(slice(None),) + sl] += block
+        norm[sl] += mask
+    return mov, norm
+
+
+@pytest.fixture
+def svd_info(tmp_path):
+    svu.clear_reconstructor_cache()
+    yield make_svd(tmp_path)
+    svu.clear_reconstructor_cache()
+
+
+def test_reconstruct_matches_blend(svd_info):
+    recon = svu.OverlapReconstructor(svd_info, log_cb=lambda *a, **k: None)
+    mov_ref, norm_ref = blend_reference(svd_info, 5, 23)
+    out = recon.reconstruct((5, 23), normalize=False)
+    assert out.dtype == n.float32
+    n.testing.assert_allclose(out, mov_ref, rtol=1e-4, atol=1e-4)
+    n.testing.assert_allclose(recon.norm, norm_ref, rtol=1e-6)
+
+    normed = recon.reconstruct((5, 23))
+    valid = norm_ref >= 1e-5
+    n.testing.assert_allclose(normed[:, valid], (mov_ref / n.where(valid, norm_ref, 1))[:, valid],
+                              rtol=1e-4, atol=1e-4)
+    assert (normed[:, ~valid] == 0).all()
+
+
+def test_reconstruct_into_and_options(svd_info):
+    recon = svu.OverlapReconstructor(svd_info, n_comps=4, crop_z=(2, 4), n_threads=3,
+                                     log_cb=lambda *a, **k: None)
+    mov_ref, norm_ref = blend_reference(svd_info, 0, MOV_SHAPE[1], n_comps=4, crop_z=(2, 4))
+    out = n.full((MOV_SHAPE[1], 2) + MOV_SHAPE[2:], n.nan, dtype=n.float32)
+    recon.reconstruct_into(out, t_batch_size=7, normalize=False)
+    n.testing.assert_allclose(out, mov_ref, rtol=1e-4, atol=1e-4)
+
+    mov, norm = svu.reconstruct_overlapping_movie(svd_info, (3, 9), normalize=False, n_comps=4,
+                                                  crop_z=(2, 4), log_cb=lambda *a, **k: None)
+    n.testing.assert_allclose(mov, mov_ref[3:9], rtol=1e-4, atol=1e-4)
+    # the returned norm is a copy, the cached reconstructor's is unchanged
+    norm[:] = 0
+    assert svu.get_overlap_reconstructor(svd_info, n_comps=4, crop_z=(2, 4)).norm.any()
+
+
+def test_cache_is_reused_invalidated_and_cleared(svd_info):
+    quiet = lambda *a, **k: None
+    recon = svu.get_overlap_reconstructor(svd_info, log_cb=quiet)
+    assert svu.get_overlap_reconstructor(svd_info, log_cb=quiet) is recon
+    assert svu.get_overlap_reconstructor(svd_info, n_comps=3, log_cb=quiet) is not recon
+    assert len(svu.reconstructor_cache) == 1
+
+    # rewriting a block invalidates the cached S V
+    recon = svu.get_overlap_reconstructor(svd_info, log_cb=quiet)
+    block_dir = svd_info["svd_dirs"][0]
+    u, s, v = svu.load_usv(block_dir, N_COMP, compute=True)
+    svu.save_usv_to_zarr(u, n.eye(N_COMP, dtype=n.float32), 2 * s, v, block_dir, timechunk=8)
+    mtime = svu.svd_dirs_mtime(svd_info["svd_dirs"]) + 10**9
+    os.utime(os.path.join(block_dir, "s.zarr"), ns=(mtime, mtime))
+    new_recon = svu.get_overlap_reconstructor(svd_info, log_cb=quiet)
+    assert new_recon is not recon
+    n.testing.assert_allclose(new_recon.reconstruct((0, 4), normalize=False),
+                              blend_reference(svd_info, 0, 4)[0], rtol=1e-4, atol=1e-4)
+
+    svu.clear_reconstructor_cache()
+    assert len(svu.reconstructor_cache) == 0
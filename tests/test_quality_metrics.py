@@ -0,0 +1,64 @@
+import numpy as n
+
+from suite3d import quality_metrics as qm
+
+
+def push_all(est, stream, values):
+    for x in values:
+        est.count[stream] = qm.p2_push(
+            est.q[stream], est.pos[stream], est.desired[stream], est.dn, est.count[stream], x
+        )
+
+
+def test_p2_quantile_is_exact_for_short_streams():
+    rng = n.random.default_rng(0)
+    est = qm.P2Quantile(6)
+    samples = [rng.normal(size=i) for i in range(6)]
+    for i, values in enumerate(samples):
+        push_all(est, i, values)
+    estimate = est.estimate()
+    assert n.isnan(estimate[0])
+    for i in range(1, 6):
+        assert n.isclose(estimate[i], n.median(samples[i]))
+
+
+def test_p2_quantile_tracks_the_quantile_of_long_streams():
+    rng = n.random.default_rng(1)
+    for p in (0.1, 0.5, 0.9):
+        est = qm.P2Quantile(2, p=p)
+        normal = rng.normal(3, 2, size=20000)
+        skewed = rng.exponential(1, size=20000)
+        push_all(est, 0, normal)
+        push_all(est, 1, skewed)
+        estimate = est.estimate()
+        assert abs(estimate[0] - n.quantile(normal, p)) < 0.05
+        assert abs(estimate[1] - n.quantile(skewed, p)) < 0.05
+
+
+def test_registration_metrics_match_compute_metrics_for_movie():
+    rng = n.random.default_rng(2)
+    nz, ny, nx = 2, 16, 16
+    base = rng.uniform(100, 200, size=(nz, 1, ny, nx))
+    splits = [
+        (base + rng.normal(0, 5, size=(nz, nt, ny, nx))).astype(n.float32)
+        for nt in (300, 200)
+    ]
+    frate_hz = 10.0
+    top_pix = qm.choose_top_pix(base[:, 0])
+
+    metrics = qm.RegistrationMetrics(top_pix, frate_hz)
+    for mov in splits:
+        vol = metrics.add_split(mov)
+        ref_vol, ref_metrics = qm.compute_metrics_for_movie(mov, frate_hz, top_pix=top_pix)
+        assert n.allclose(vol, ref_vol, rtol=1e-5)
+    table = metrics.table()
+
+    assert table["noise_levels"].shape == (2, nz, ref_metrics["noise_levels"].shape[1])
+    assert n.allclose(table["noise_levels"][-1], ref_metrics["noise_levels"], rtol=0.1)
+    all_frames = n.concatenate(splits, axis=1)
+    frame_means = all_frames.mean(axis=(2, 3))
+    assert table["run_n_frames"] == all_frames.shape[1]
+    assert n.allclose(table["run_plane_mean"], frame_means.mean(axis=1), rtol=1e-5)
+    assert n.allclose(table["run_plane_std"], frame_means.std(axis=1, ddof=1), rtol=1e-3)
+    ref_run_noise = n.median(ref_metrics["noise_levels"], axis=1)
+    assert n.allclose(table["run_noise_level"], ref_run_noise, rtol=0.1)
@@ -0,0 +1,180 @@
+import numpy as n
+import pytest
+from scipy import ndimage
+
+from suite3d import reference_image as ref
+from suite3d import register_gpu as reg_gpu
+from suite3d import utils
+
+
+def quiet_log(*args, **kwargs):
+    pass
+
+
+def test_choose_gpu_batch_size():
+    gb = 1024**3
+    # 80% of 10 GB, minus 2 GB fixed, in 0.5 GB frames
+    assert reg_gpu.choose_gpu_batch_size(gb // 2, 10 * gb, fixed_bytes=2 * gb) == 12
+    assert reg_gpu.choose_gpu_batch_size(gb // 2, 10 * gb, max_batch_size=5) == 5
+    # never below the minimum, even if nothing fits
+    assert reg_gpu.choose_gpu_batch_size(gb, gb, fixed_bytes=2 * gb) == 1
+    assert reg_gpu.choose_gpu_batch_size(gb, gb, fixed_bytes=2 * gb, min_batch_size=3) == 3
+
+
+def test_auto_gpu_batch_size():
+    gb = 1024**3
+    assert reg_gpu.auto_gpu_batch_size(gb, free_bytes=10 * gb, log_cb=quiet_log) == 8
+    # numpy has no device to query, so the default is used
+    assert (
+        reg_gpu.auto_gpu_batch_size(gb, default_batch_size=7, xp=n, log_cb=quiet_log) == 7
+    )
+
+
+def make_fake_reg_batch(max_ok, error=MemoryError):
+    calls = []
+
+    def reg_batch(batch_size):
+        calls.append(batch_size)
+        if batch_size > max_ok:
+            raise error("out of memory")
+        return "registered %d" % batch_size
+
+    return reg_batch, calls
+
+
+def test_oom_backoff_halves_until_it_fits():
+    reg_batch, calls = make_fake_reg_batch(max_ok=10)
+    result, batch_size = reg_gpu.run_with_oom_backoff(reg_batch, 64, xp=n, log_cb=quiet_log)
+    assert calls == [64, 32, 16, 8]
+    assert batch_size == 8
+    assert result == "registered 8"
+
+
+def test_oom_backoff_no_retry_when_it_fits():
+    reg_batch, calls = make_fake_reg_batch(max_ok=100)
+    __, batch_size = reg_gpu.run_with_oom_backoff(reg_batch, 64, xp=n, log_cb=quiet_log)
+    assert calls == [64]
+    assert batch_size == 64
+
+
+def test_oom_backoff_stops_at_min_batch_size():
+    reg_batch, calls = make_fake_reg_batch(max_ok=0)
+    with pytest.raises(MemoryError):
+        reg_gpu.run_with_oom_backoff(
+            reg_batch, 20, min_batch_size=4, xp=n, log_cb=quiet_log
+        )
+    assert calls == [20, 10, 5, 4]
+
+
+def test_oom_backoff_reraises_other_errors():
+    reg_batch, calls = make_fake_reg_batch(max_ok=0, error=ValueError)
+    with pytest.raises(ValueError):
+        reg_gpu.run_with_oom_backoff(reg_batch, 16, xp=n, log_cb=quiet_log)
+    assert calls == [16]
+
+
+# the complex-FFT phase correlation that rigid_2d_reg_cpu and align_planes used before
+# the real-FFT engine, kept here as the reference implementation
+def phasecorr_complex(frames, ref_f, max_reg_xy, mult_mask=None, add_mask=None, rmin=None, rmax=None):
+    mov = n.array(frames, dtype=n.complex64)
+    mov = reg_gpu.clip_and_mask_mov(mov, rmin, rmax, mult_mask, add_mask, cp=n)
+    mov = reg_gpu.convolve_2d_cpu(mov, ref_f)
+    ncc = 2 * max_reg_xy + 1
+    phase_corr = n.zeros((mov.shape[0], ncc, ncc), dtype=n.float32)
+    return reg_gpu.unwrap_fft_2d(mov.real, max_reg_xy, out=phase_corr, cp=n)
+
+
+def rigid_2d_reg_cpu_complex(mov_cpu, mult_mask, add_mask, refs_f, max_reg_xy, rmins, rmaxs,
+                             crosstalk_coeff=None, cavity_size=15):
+    nz, nt, ny, nx = mov_cpu.shape
+    mov = n.array(mov_cpu, dtype=n.complex64)
+    mov_shifted = n.ascontiguousarray(mov.real.swapaxes(0, 1))
+    if crosstalk_coeff is not None:
+        mov = utils.crosstalk_subtract(mov, crosstalk_coeff, cavity_size)
+    ymaxs, xmaxs, cmaxs = [n.zeros((nz, nt), dtype=dt) for dt in (n.int16, n.int16, n.float32)]
+    for z in range(nz):
+        phase_corr = phasecorr_complex(
+            mov[z], refs_f[z], max_reg_xy, mult_mask[z], add_mask[z], rmins[z], rmaxs[z]
+        )
+        ymaxs[z], xmaxs[z], cmaxs[z] = reg_gpu.get_max_cc_coord(phase_corr, max_reg_xy, cp=n)
+        for t in range(nt):
+            reg_gpu.shift_frame(mov_shifted[t, z], ymaxs[z, t], xmaxs[z, t], cp=n)
+    return mov_shifted, ymaxs, xmaxs, cmaxs
+
+
+def make_rigid_inputs(nz=4, nt=6, ny=48, nx=56, seed=0):
+    rng = n.random.default_rng(seed)
+    base = ndimage.gaussian_filter(rng.normal(size=(nz, ny, nx)), (0, 2, 2)) * 50 + 100
+    mov = n.zeros((nz, nt, ny, nx), dtype=n.float32)
+    for z in range(nz):
+        for t in range(nt):
+            shift = rng.integers(-4, 5, size=2)
+            mov[z, t] = n.roll(base[z], shift, axis=(0, 1)) + rng.normal(size=(ny, nx))
+    mult_mask, add_mask = ref.compute_masks3D(base.astype(n.float32), (1.15, 0))
+    refs_f = n.stack([ref.phasecorr_ref(base[z], smooth_sigma=1.15) for z in range(nz)])
+    return rng, mov, mult_mask, add_mask, refs_f
+
+
+def test_phasecorr_refs_are_hermitian():
+    __, __, __, __, refs_f = make_rigid_inputs()
+    refs_f_neg = n.roll(n.flip(refs_f, axis=(-2, -1)), 1, axis=(-2, -1))
+    n.testing.assert_allclose(refs_f, n.conj(refs_f_neg), atol=1e-6)
+
+
+@pytest.mark.parametrize("hermitian", [True, False])
+def test_phasecorr_rfft_matches_complex_fft(hermitian):
+    rng, mov, mult_mask, add_mask, refs_f = make_rigid_inputs()
+    ref_f = refs_f[0]
+    if not hermitian:
+        # rfft_ref keeps the Hermitian part, which is all the complex path uses
+        ref_f = (ref_f * n.exp(1j * rng.uniform(0, 1, ref_f.shape))).astype(n.complex64)
+    expected = phasecorr_complex(mov[0], ref_f, 8, mult_mask[0], add_mask[0], 90, 160)
+    phase_corr = reg_gpu.phasecorr_rfft_cpu(
+        mov[0], reg_gpu.rfft_ref(ref_f), 8, mult_mask[0], add_mask[0], 90, 160
+    )
+    assert phase_corr.shape == expected.shape
+    n.testing.assert_allclose(phase_corr, expected, atol=1e-5 * n.abs(expected).max())
+
+
+@pytest.mark.parametrize("crosstalk_coeff", [None, 0.2])
+@pytest.mark.parametrize("t_batch_size", [None, 4])
+def test_rigid_2d_reg_cpu_matches_complex_fft(crosstalk_coeff, t_batch_size):
+    __, mov, mult_mask, add_mask, refs_f = make_rigid_inputs()
+    nz = mov.shape[0]
+    rmins, rmaxs = [None] * nz, [None] * nz
+    expected = rigid_2d_reg_cpu_complex(
+        mov, mult_mask, add_mask, refs_f, 8, rmins, rmaxs, crosstalk_coeff, cavity_size=2
+    )
+    out = reg_gpu.rigid_2d_reg_cpu(
+        mov, mult_mask, add_mask, refs_f, 8, rmins, rmaxs, crosstalk_coeff,
+        cavity_size=2, t_batch_size=t_batch_size,
+    )
+    mov_shifted, ymaxs, xmaxs, cmaxs = out
+    n.testing.assert_array_equal(ymaxs, expected[1])
+    n.testing.assert_array_equal(xmaxs, expected[2])
+    n.testing.assert_allclose(cmaxs, expected[3], rtol=1e-4)
+    n.testing.assert_array_equal(mov_shifted, expected[0])
+    # the input movie is not changed, with or without crosstalk subtraction
+    n.testing.assert_array_equal(mov, make_rigid_inputs()[1])
+
+
+def test_align_planes_matches_complex_fft():
+    rng = n.random.default_rng(5)
+    base = ndimage.gaussian_filter(rng.normal(size=(80, 88)), 2) * 50 + 100
+    shifts = n.array([[0, 0], [2, -3], [-1, 4], [3, 1]])
+    mov3d = n.stack([n.roll(base, s, axis=(0, 1)) + rng.normal(size=base.shape) for s in shifts])
+    params = {"sigma": (1.15, 0), "smooth_sigma": 1.15, "max_reg_xy_reference": 10}
+    tvecs = ref.align_planes(mov3d, params)
+
+    mov3d = mov3d.astype(n.float32)
+    mult_mask, add_mask = ref.compute_masks3D(mov3d, params["sigma"])
+    ymaxs, xmaxs = n.zeros(len(mov3d), dtype=int), n.zeros(len(mov3d), dtype=int)
+    for z in range(1, len(mov3d)):
+        ref_f = ref.phasecorr_ref(mov3d[z - 1], smooth_sigma=params["smooth_sigma"])
+        phase_corr = phasecorr_complex(mov3d[z : z + 1], ref_f, 10, mult_mask[z], add_mask[z])
+        ymax, xmax, __ = reg_gpu.get_max_cc_coord(phase_corr, 10, cp=n)
+        ymaxs[z], xmaxs[z] = ymax[0], xmax[0]
+    expected = n.stack((-n.cumsum(ymaxs), -n.cumsum(xmaxs)), axis=1)
+    n.testing.assert_array_equal(tvecs, expected)
+    # the planes are shifted by shifts relative to the first one
+    n.testing.assert_array_equal(tvecs, -shifts)
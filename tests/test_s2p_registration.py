@@ -0,0 +1,57 @@
+import numpy as n
+import pytest
+
+from suite3d import reference_image as ref
+from suite3d import s2p_registration as s2p
+
+
+def make_frames(nimg=6, ly=64, lx=80, seed=0):
+    rng = n.random.default_rng(seed)
+    data = rng.normal(size=(nimg, ly, lx)).astype(n.float32) * 100
+    ymax = rng.integers(-5, 6, size=nimg)
+    xmax = rng.integers(-5, 6, size=nimg)
+    return rng, data, ymax, xmax
+
+
+def shift_frames_ref(data, ymax, xmax):
+    return n.stack([s2p.shift_frame(f, dy, dx) for f, dy, dx in zip(data, ymax, xmax)])
+
+
+def test_rigid_shift_frames_matches_shift_frame():
+    __, data, ymax, xmax = make_frames()
+    out = s2p.shift_frames(data, ymax, xmax)
+    n.testing.assert_array_equal(out, shift_frames_ref(data, ymax, xmax))
+
+
+@pytest.mark.parametrize("block_size", [(32, 32), (24, 48)])
+def test_nonrigid_shift_frames_matches_shift_frame_and_transform(block_size):
+    rng, data, ymax, xmax = make_frames()
+    nimg, ly, lx = data.shape
+    yblock, xblock, nblocks, __, __ = ref.make_blocks(ly, lx, block_size=block_size)
+    n_blocks = nblocks[0] * nblocks[1]
+    ymax1 = rng.uniform(-3, 3, size=(nimg, n_blocks)).astype(n.float32)
+    xmax1 = rng.uniform(-3, 3, size=(nimg, n_blocks)).astype(n.float32)
+
+    out = s2p.shift_frames(
+        data, ymax, xmax, ymax1=ymax1, xmax1=xmax1,
+        nblocks=nblocks, xblock=xblock, yblock=yblock,
+    )
+    expected = s2p.nonrigid_transform_data(
+        shift_frames_ref(data, ymax, xmax), nblocks, xblock, yblock, ymax1, xmax1
+    )
+    # the fused kernel interpolates the block shifts per pixel instead of reading the
+    # upsampled shift maps, which differs in the last bits of float32
+    assert n.abs(out - expected).max() <= 1.2e-5 * n.abs(data).max()
+
+
+def test_rigid_register_frames_keeps_the_frame_dtype():
+    __, data, ymax, xmax = make_frames()
+    data = data.astype(n.int16)
+    # get_phasecorr_and_masks squeezes the reference, so it needs two planes
+    ref_img = n.stack([data.mean(axis=0)] * 2).astype(n.float32)
+    reference_params = {"sigma": (1.15, 0), "block_size": (32, 32), "smooth_sigma": 1.15}
+    refs_and_masks, __ = ref.get_phasecorr_and_masks(ref_img, reference_params)
+    ops = {"smooth_sigma_time": 0, "nonrigid": False, "maxregshift": 0.15}
+    frames, ym, xm, __, __, __, __ = s2p.register_frames(refs_and_masks[0], data.copy(), ops)
+    assert frames.dtype == n.int16
+    n.testing.assert_array_equal(frames, shift_frames_ref(data, ym, xm))
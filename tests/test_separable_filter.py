@@ -0,0 +1,56 @@
+import numpy as n
+import pytest
+from scipy import ndimage
+
+from suite3d import detection3d as det3d
+
+
+def random_mov(shape=(3, 5, 40, 36), seed=0):
+    return n.random.default_rng(seed).normal(size=shape).astype(n.float32)
+
+
+@pytest.mark.parametrize(
+    "filt_type, filt_size",
+    [
+        ("unif", (3, 5, 5)),
+        ("unif", (1, 4, 7)),
+        ("unif", (2.5, 25, 25)),
+        ("gaussian", (1, 1.5, 1.5)),
+        ("gaussian", (0, 3, 2)),
+        # wide enough for the FFT path
+        ("gaussian", (0.5, 8, 8)),
+    ],
+)
+def test_separable_filter_batch_matches_scipy(filt_type, filt_size):
+    mov = random_mov()
+    if filt_type == "unif":
+        ref = n.stack([ndimage.uniform_filter(f, filt_size, mode="mirror") for f in mov])
+    else:
+        ref = n.stack([ndimage.gaussian_filter(f, filt_size, mode="mirror") for f in mov])
+    out = det3d.separable_filter_batch(mov.copy(), filt_type, filt_size)
+    assert out.dtype == n.float32
+    assert n.allclose(out, ref, atol=1e-4)
+
+
+def test_separable_filter_batch_fft_and_direct_paths_agree():
+    mov = random_mov()
+    direct = det3d.separable_filter_batch(mov.copy(), "gaussian", (1, 7, 7), fft_min_taps=10**6)
+    fft = det3d.separable_filter_batch(mov.copy(), "gaussian", (1, 7, 7), fft_min_taps=1)
+    assert n.allclose(direct, fft, atol=1e-4)
+
+
+def test_filter_and_reduce_movie_copies_only_when_asked():
+    mov = random_mov()
+    args = ("unif", (1, 5, 5), "gaussian", (0.5, 1, 1), 0.1)
+    kwargs = dict(minibatch_size=2, log=lambda *a, **k: None)
+
+    mov_copy = mov.copy()
+    vmap_copy, sub_copy = det3d.filter_and_reduce_movie(mov_copy, *args, copy=True, **kwargs)
+    assert n.array_equal(mov_copy, mov)
+    assert not n.shares_memory(sub_copy, mov_copy)
+
+    mov_in_place = mov.copy()
+    vmap, sub = det3d.filter_and_reduce_movie(mov_in_place, *args, **kwargs)
+    assert sub is mov_in_place
+    assert n.array_equal(sub, sub_copy)
+    assert n.array_equal(vmap, vmap_copy)
@@ -0,0 +1,129 @@
+import os
+
+import numpy as n
+import pytest
+
+from suite3d import shmem as shm
+from suite3d import utils
+
+
+def exists(name):
+    # segments are files in /dev/shm on linux
+    return os.path.exists(os.path.join(shm.SHM_DIR, name))
+
+
+needs_shm_dir = pytest.mark.skipif(
+    not os.path.isdir(shm.SHM_DIR), reason="shared memory is not backed by a directory"
+)
+
+
+def test_arena_reuses_segments_that_fit():
+    with shm.ShmemArena() as arena:
+        params, arr = arena.get("batch", (4, 10, 20), n.float32)
+        name = params["name"]
+        assert arr.shape == (4, 10, 20) and arr.dtype == n.float32
+        assert name in shm.live_segments()
+
+        # same size, and smaller or with a smaller dtype: same segment
+        for shape, dtype in [
+            ((4, 10, 20), n.float32),
+            ((3, 10, 20), n.float32),
+            ((4, 10, 20), n.float16),
+        ]:
+            params, arr = arena.get("batch", shape, dtype)
+            assert params["name"] == name
+            assert params["shape"] == shape and arr.dtype == dtype
+
+        # larger: the old segment is replaced
+        params, arr = arena.get("batch", (5, 10, 20), n.float32)
+        assert params["name"] != name
+        assert name not in shm.live_segments()
+        assert params["name"] in shm.live_segments()
+
+        # keys have their own segments
+        other, __ = arena.get("other", (2, 2), n.float32)
+        assert other["name"] != params["name"]
+        names = [params["name"], other["name"]]
+    for name in names:
+        assert name not in shm.live_segments()
+
+
+def test_workers_see_the_arena_array():
+    mov = n.random.default_rng(0).normal(size=(3, 8, 9)).astype(n.float32)
+    with shm.ShmemArena() as arena:
+        params, sh_arr = arena.from_arr("mov", mov, dtype=n.float16)
+        assert sh_arr.dtype == n.float16
+        assert n.array_equal(sh_arr, mov.astype(n.float16))
+
+        params, sh_arr = arena.from_arr("mov", mov)
+        shmem, attached = utils.load_shmem(params)
+        attached[0, 0, 0] = 42
+        assert sh_arr[0, 0, 0] == 42
+        del attached
+        shmem.close()
+
+        params, zeros = arena.get("mov", mov.shape, mov.dtype, zero=True)
+        assert not zeros.any()
+
+
+@needs_shm_dir
+def test_release_and_close_unlink_segments():
+    arena = shm.ShmemArena()
+    a, __ = arena.get("a", (100,), n.float32)
+    b, __ = arena.get("b", (100,), n.float32)
+    assert exists(a["name"]) and exists(b["name"])
+    arena.release("a")
+    assert not exists(a["name"]) and exists(b["name"])
+    arena.release("a")
+    arena.close()
+    assert not exists(b["name"])
+    assert arena.buffers == {}
+
+
+@needs_shm_dir
+def test_context_manager_unlinks_on_error():
+    with pytest.raises(RuntimeError):
+        with shm.ShmemArena() as arena:
+            params, __ = arena.get("batch", (100,), n.float32)
+            raise RuntimeError
+    assert not exists(params["name"])
+    assert params["name"] not in shm.live_segments()
+
+
+@needs_shm_dir
+def test_free_segment_by_name():
+    shmem = shm.create_segment(64)
+    name = shmem.name
+    assert name.startswith("%s_%d_" % (shm.PREFIX, os.getpid()))
+    shm.free_segment_by_name(name)
+    assert not exists(name)
+    assert name not in shm.live_segments()
+    # freeing a segment that is already gone is a no-op
+    shm.free_segment_by_name(name)
+
+
+def test_filter_and_reduce_movie_reuses_caller_arena():
+    from suite3d import detection3d as dtu
+
+    mov = n.random.default_rng(1).normal(size=(10, 3, 16, 16)).astype(n.float32)
+    args = ("unif", (1, 5, 5), "gaussian", (0.5, 1, 1), 0.1)
+    kwargs = dict(n_proc=2, minibatch_size=5, engine="scipy", log=lambda *a, **k: None)
+    before = set(shm.live_segments())
+
+    # without an arena the function frees everything it created
+    vmap_own, sub_own = dtu.filter_and_reduce_movie(mov.copy(), *args, **kwargs)
+    assert set(shm.live_segments()) == before
+
+    # a caller's arena keeps its buffers, and the next batch reuses them
+    with shm.ShmemArena() as arena:
+        vmap_1, sub_1 = dtu.filter_and_reduce_movie(mov.copy(), *args, arena=arena, **kwargs)
+        names = {key: s.name for key, s in arena.buffers.items()}
+        assert set(names) == {"mov_sub", "mov_filt"}
+        vmap_2, sub_2 = dtu.filter_and_reduce_movie(mov.copy(), *args, arena=arena, **kwargs)
+        assert {key: s.name for key, s in arena.buffers.items()} == names
+    assert set(shm.live_segments()) == before
+
+    # the returned mov_sub is a copy, not a view of the reused segment
+    for vmap, sub in [(vmap_1, sub_1), (vmap_2, sub_2)]:
+        n.testing.assert_allclose(vmap, vmap_own, rtol=1e-6)
+        n.testing.assert_array_equal(sub, sub_own)
@@ -0,0 +1,121 @@
+import os
+
+import numpy as n
+import pytest
+
+from suite3d import svd_utils as svu
+
+BLOCK_SHAPE = (1, 16, 16)
+OVERLAPS = (0, 8, 8)
+
+
+def low_rank_movie(nz=2, nt=150, ny=24, nx=24, rank=5, seed=0):
+    rng = n.random.default_rng(seed)
+    time_factors = rng.normal(size=(nt, rank))
+    space_factors = rng.normal(size=(rank, nz * ny * nx)) * n.linspace(4, 1, rank)[:, None]
+    mov = (time_factors @ space_factors).reshape(nt, nz, ny, nx)
+    return n.ascontiguousarray(mov.swapaxes(0, 1)).astype(n.float32)
+
+
+def run_streaming(mov, svd_dir, n_comp=5, **kwargs):
+    return svu.block_and_svd_streaming(
+        mov, n_comp, BLOCK_SHAPE, OVERLAPS, t_batch_size=40, n_power_iter=2,
+        n_oversample=10, svd_dir=str(svd_dir), log_cb=lambda *a, **k: None, **kwargs
+    )
+
+
+@pytest.mark.parametrize("mem_budget_gb", [0, 1.0])
+def test_streaming_svd_matches_numpy(tmp_path, mem_budget_gb):
+    # a budget of 0 keeps every pixel-side sketch on disk, 1 GB keeps all of them in RAM
+    mov = low_rank_movie()
+    n_comp = 5
+    svd_info = run_streaming(mov, tmp_path, n_comp, mem_budget_gb=mem_budget_gb)
+    blocks = svd_info["blocks"]
+    assert svd_info["n_blocks"] == blocks.shape[1] > 1
+    assert len(svd_info["svd_dirs"]) == svd_info["n_blocks"]
+
+    for block_idx, block_dir in enumerate(svd_info["svd_dirs"]):
+        assert sorted(f for f in os.listdir(block_dir) if f.endswith(".npy")) == []
+        a = svu.extract_block_from_batch(mov, blocks[:, block_idx]).astype(n.float64)
+        s_ref = n.linalg.svd(a, compute_uv=False)[:n_comp]
+
+        u, s, v = svu.load_usv(block_dir, n_comp, compute=True)
+        assert u.shape == (mov.shape[1], n_comp)
+        assert s.shape == (n_comp,)
+        assert v.shape == (n_comp, a.shape[1])
+        assert u.dtype == s.dtype == v.dtype == n.float32
+        n.testing.assert_allclose(s, s_ref, rtol=1e-4)
+        n.testing.assert_allclose(u.T @ u, n.eye(n_comp), atol=1e-4)
+        n.testing.assert_allclose(v @ v.T, n.eye(n_comp), atol=1e-4)
+        recon = (u * s) @ v
+        assert n.abs(recon - a).max() < 1e-4 * n.abs(a).max()
+
+
+def test_sketch_placement_does_not_change_the_result(tmp_path):
+    mov = low_rank_movie(seed=1)
+    on_disk = run_streaming(mov, tmp_path / "disk", mem_budget_gb=0)
+    in_ram = run_streaming(mov, tmp_path / "ram", mem_budget_gb=1.0)
+    for dir_disk, dir_ram in zip(on_disk["svd_dirs"], in_ram["svd_dirs"]):
+        usv_disk = svu.load_usv(dir_disk, 5, compute=True)
+        usv_ram = svu.load_usv(dir_ram, 5, compute=True)
+        for a, b in zip(usv_disk, usv_ram):
+            n.testing.assert_allclose(a, b, rtol=1e-5, atol=1e-6)
+
+
+def test_flipped_movie_gives_the_same_svd(tmp_path):
+    mov = low_rank_movie(seed=2)
+    info = run_streaming(mov, tmp_path / "zt")
+    mov_tfirst = n.ascontiguousarray(mov.swapaxes(0, 1))
+    info_flipped = run_streaming(mov_tfirst, tmp_path / "tz", flip_shape=True)
+    assert info_flipped["mov_shape"] == (mov.shape[1], mov.shape[0]) + mov.shape[2:]
+    for block_dir, block_dir_flipped in zip(info["svd_dirs"], info_flipped["svd_dirs"]):
+        __, s, __ = svu.load_usv(block_dir, 5, compute=True)
+        __, s_flipped, __ = svu.load_usv(block_dir_flipped, 5, compute=True)
+        n.testing.assert_allclose(s, s_flipped, rtol=1e-4)
+
+
+def test_update_usv_matches_svd_of_appended_rows():
+    # with k equal to the number of pixels the truncation loses nothing
+    rng = n.random.default_rng(3)
+    a = rng.normal(size=(20, 8)).astype(n.float32)
+    c = rng.normal(size=(5, 8)).astype(n.float32)
+    u, s, v = n.linalg.svd(a, full_matrices=False)
+    mix, u_c, s_new, v_new = svu.update_usv(s, v, c)
+    u_new = n.concatenate([u @ mix, u_c])
+    s_ref = n.linalg.svd(n.concatenate([a, c]), compute_uv=False)
+    n.testing.assert_allclose(s_new, s_ref, rtol=1e-4)
+    n.testing.assert_allclose((u_new * s_new) @ v_new, n.concatenate([a, c]), atol=1e-4)
+    n.testing.assert_allclose(u_new.T @ u_new, n.eye(8), atol=1e-4)
+    n.testing.assert_allclose(v_new @ v_new.T, n.eye(8), atol=1e-4)
+
+
+@pytest.mark.parametrize("flip_shape", [False, True])
+def test_update_block_and_svd_matches_svd_of_concatenated_movie(tmp_path, flip_shape):
+    mov = low_rank_movie(nt=210, seed=4)
+    mov_old, mov_new = mov[:, :150], mov[:, 150:]
+    if flip_shape:
+        mov_old = n.ascontiguousarray(mov_old.swapaxes(0, 1))
+        mov_new = n.ascontiguousarray(mov_new.swapaxes(0, 1))
+    info_old = run_streaming(mov_old, tmp_path, flip_shape=flip_shape)
+    info = svu.update_block_and_svd(
+        mov_new, str(tmp_path), t_batch_size=25, flip_shape=flip_shape,
+        log_cb=lambda *a, **k: None,
+    )
+
+    t_axis = 0 if flip_shape else 1
+    expected_shape = list(info_old["mov_shape"])
+    expected_shape[t_axis] = mov.shape[1]
+    assert tuple(info["mov_shape"]) == tuple(expected_shape)
+    saved = n.load(os.path.join(str(tmp_path), "svd_info.npy"), allow_pickle=True).item()
+    assert tuple(saved["mov_shape"]) == tuple(expected_shape)
+    assert saved["svd_updates"] == [60]
+
+    for block_idx, block_dir in enumerate(info["svd_dirs"]):
+        a = svu.extract_block_from_batch(mov, info["blocks"][:, block_idx]).astype(n.float64)
+        s_ref = n.linalg.svd(a, compute_uv=False)[:5]
+        u, s, v = svu.load_usv(block_dir, 5, compute=True)
+        assert u.shape == (mov.shape[1], 5)
+        n.testing.assert_allclose(s, s_ref, rtol=1e-4)
+        n.testing.assert_allclose(u.T @ u, n.eye(5), atol=1e-4)
+        recon = (u * s) @ v
+        assert n.abs(recon - a).max() < 1e-4 * n.abs(a).max()
@@ -61,13 +61,15 @@ class RegistrationPanel(param.Parameterized):
         print("Loaded images")
 
         quality_dict = n.load(self.metric_files[0],allow_pickle=True).item()
-        for k in quality_dict.keys():
-            quality_dict[k] = quality_dict[k][n.newaxis]
-
-        for i in range(1,len(self.metric_files)):
-            new_data = n.load(self.metric_files[i],allow_pickle=True).item()
+        # newer jobs save a single metrics table for the run, with per-file rows
+        if 'run_n_frames' not in quality_dict:
             for k in quality_dict.keys():
-                quality_dict[k] = n.concatenate([quality_dict[k], new_data[k][n.newaxis]],axis=0)
+                quality_dict[k] = quality_dict[k][n.newaxis]
+
+            for i in range(1,len(self.metric_files)):
+                new_data = n.load(self.metric_files[i],allow_pickle=True).item()
+                for k in quality_dict.keys():
+                    quality_dict[k] = n.concatenate([quality_dict[k], new_data[k][n.newaxis]],axis=0)
         self.quality_dict = quality_dict
 
 